@@ -0,0 +1,83 @@
+#
+# Shared by the stand-in downloaders of bench/pipeline.py. Their behaviour is
+# configured through environment variables:
+#
+#   FAKE_DL_LATENCY      seconds each run takes, a distribution (see sample())
+#   FAKE_DL_SIZE         bytes of each chat file written, a distribution
+#   FAKE_DL_MEMBERS      share of Youtube videos that are members-only
+#   FAKE_DL_NOCHAT       share of Youtube videos without a live chat replay
+#   FAKE_DL_UNAVAILABLE  share of Youtube videos removed or private
+#   FAKE_DL_NOT_FOUND    share of Twitch VODs gone (404)
+#   FAKE_DL_SEED         the outcome of a videoId only depends on it and the seed
+#
+# Distributions are written "const:X", "uniform:A,B", "exp:MEAN" or
+# "lognormal:MU,SIGMA" (of the natural logarithm of the value).
+
+from typing import Tuple
+import hashlib
+import os
+import random
+
+DEFAULTS = {
+  "FAKE_DL_LATENCY": "lognormal:-2.3,0.5",
+  "FAKE_DL_SIZE": "lognormal:11.5,1",
+  "FAKE_DL_MEMBERS": "0.05",
+  "FAKE_DL_NOCHAT": "0.1",
+  "FAKE_DL_UNAVAILABLE": "0.02",
+  "FAKE_DL_NOT_FOUND": "0.05",
+  "FAKE_DL_SEED": "0",
+}
+
+
+def setting(name: str) -> str:
+  return os.environ.get(name) or DEFAULTS[name]
+
+
+def rng_for(video_id: str) -> random.Random:
+  """Random numbers that are the same for a videoId on every run."""
+  seed = hashlib.blake2b(
+    f"{setting('FAKE_DL_SEED')}:{video_id}".encode(), digest_size=8).digest()
+  return random.Random(int.from_bytes(seed, "big"))
+
+
+def sample(spec: str, rng: random.Random) -> float:
+  kind, _, params = spec.partition(":")
+  values = [float(v) for v in params.split(",")]
+  if kind == "const":
+    return values[0]
+  if kind == "uniform":
+    return rng.uniform(values[0], values[1])
+  if kind == "exp":
+    return rng.expovariate(1 / values[0])
+  if kind == "lognormal":
+    return rng.lognormvariate(values[0], values[1])
+  raise ValueError(f"Unknown distribution {spec}")
+
+
+def outcome(rng: random.Random, *shares: Tuple[str, str]) -> str:
+  """Pick one of the named outcomes by their share setting, "ok" otherwise."""
+  draw = rng.random()
+  for name, variable in shares:
+    share = float(setting(variable))
+    if draw < share:
+      return name
+    draw -= share
+  return "ok"
+
+
+def write_sized(path: str, head: bytes, item, separator: bytes, tail: bytes, size: int) -> int:
+  """
+  Write head, then items produced by item(i) joined with separator until size
+  bytes are reached, then tail. Return the number of items.
+  """
+  count = 0
+  written = len(head) + len(tail)
+  with open(path, "wb") as f:
+    f.write(head)
+    while written < size or count == 0:
+      chunk = (separator if count else b"") + item(count)
+      f.write(chunk)
+      written += len(chunk)
+      count += 1
+    f.write(tail)
+  return count
@@ -0,0 +1,82 @@
+#
+# Stand-in for TwitchDownloaderCLI chatdownload, as run by subs.py. It prints
+# what TwitchDownloaderCLI prints, takes as long as FAKE_DL_LATENCY says, and
+# writes a chat of FAKE_DL_SIZE bytes, or crashes like it does on a VOD that
+# is gone. See fake_common.py for the settings.
+
+import json
+import sys
+import time
+from fake_common import rng_for, sample, setting, outcome, write_sized
+
+
+def comment(i: int) -> bytes:
+  return json.dumps({
+    "_id": f"{i:08x}-0000-4000-8000-000000000000",
+    "created_at": "2022-01-21T20:00:00.123456Z",
+    "channel_id": "12345678",
+    "content_type": "video",
+    "content_id": "1271243650",
+    "content_offset_seconds": i * 0.7,
+    "commenter": {
+      "display_name": f"Viewer{i % 500}", "_id": str(10_000_000 + i % 500),
+      "name": f"viewer{i % 500}", "bio": None, "logo": "https://static-cdn.jtvnw.net/fake.png"},
+    "message": {
+      "body": f"message {i}", "bits_spent": 0,
+      "fragments": [{"text": f"message {i}", "emoticon": None}],
+      "user_badges": [{"_id": "subscriber", "version": "12"}],
+      "user_color": "#8A2BE2", "emoticons": []},
+  }).encode()
+
+
+def embedded_data() -> bytes:
+  """
+  What "-E" appends after the comments: the images the chat uses, in base64.
+  """
+  image = "iVBORw0KGgoAAAANSUhEUgAAABIAAAASCAYAAABWzo5XAAAAAElFTkSuQmCC"
+  return json.dumps({
+    "thirdParty": [
+      {"id": "5590b223b344e2c42a9e28e3", "imageScale": 2, "data": image,
+       "name": "FakeEmote", "url": "https://cdn.betterttv.net/emote/fake/2x",
+       "width": 56, "height": 56}],
+    "firstParty": [],
+    "twitchBadges": [
+      {"name": "subscriber", "versions": {"12": image}}],
+    "twitchBitCheers": [],
+  }).encode()
+
+
+def main(args) -> int:
+  video_id = args[args.index("--id") + 1]
+  name = args[args.index("-o") + 1]
+  rng = rng_for(video_id)
+  latency = sample(setting("FAKE_DL_LATENCY"), rng)
+
+  if outcome(rng, ("gone", "FAKE_DL_NOT_FOUND")) == "gone":
+    time.sleep(latency / 4)
+    print(
+      "Unhandled exception. System.Net.WebException: The remote server returned "
+      "an error: (404) Not Found.\n"
+      "   at TwitchDownloaderCore.ChatDownloader.DownloadAsync(CancellationToken)\n"
+      "   at TwitchDownloaderCLI.Modes.DownloadChat.Download(ChatDownloadArgs)",
+      file=sys.stderr)
+    return 134
+
+  size = int(sample(setting("FAKE_DL_SIZE"), rng))
+  start = time.perf_counter()
+  head = json.dumps({
+    "FileInfo": {"Version": {"Major": 1, "Minor": 2, "Patch": 2}},
+    "streamer": {"name": "fakestreamer", "id": 12345678},
+    "video": {"title": f"stream {video_id}", "id": video_id, "start": 0, "end": 3600},
+  })[:-1].encode() + b',"comments":['
+  for percent in (0, 25, 50, 75):
+    print(f"[STATUS] - Downloading {percent}%")
+    time.sleep(latency / 5)
+  write_sized(name, head, comment, b",", b'],"embeddedData":' + embedded_data() + b"}", size)
+  time.sleep(max(0.0, latency / 5 - (time.perf_counter() - start)))
+  print("[STATUS] - Downloading 100%")
+  return 0
+
+
+if __name__ == "__main__":
+  exit(main(sys.argv[1:]))
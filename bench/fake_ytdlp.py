@@ -0,0 +1,108 @@
+#
+# Stand-in for yt-dlp, as run by subs.py to download live chats
+# (--skip-download --write-subs --sub-langs live_chat). It prints what yt-dlp
+# prints, takes as long as FAKE_DL_LATENCY says, and writes a live_chat.json
+# of FAKE_DL_SIZE bytes. See fake_common.py for the settings.
+
+import json
+import sys
+import time
+from fake_common import rng_for, sample, setting, outcome, write_sized
+
+UPLOAD_DATE = "20220106"
+UPLOADER = "Fake Channel"
+
+
+def chat_line(video_id: str, i: int) -> bytes:
+  thumbnails = {"thumbnails": [
+    {"url": f"https://yt4.ggpht.com/fake{i % 97}=s{s}-c-k-c0x00ffffff-no-rj",
+     "width": s, "height": s} for s in (32, 64)]}
+  renderer = {
+    "message": {"runs": [{"text": f"message {i} for {video_id}"}]},
+    "authorName": {"simpleText": f"viewer{i % 500}"},
+    "authorPhoto": thumbnails,
+    "contextMenuEndpoint": {
+      "clickTrackingParams": "CAEQl98BIhMIqJXe6pS99QIVxB0GAB0mQw",
+      "liveChatItemContextMenuEndpoint": {"params": "Q2g0S0dnb2FDTjZyNj" * 6}},
+    "id": f"ChwKGkNKaTQ3{i:012}",
+    "timestampUsec": str(1641500000000000 + i * 700_000),
+    "authorExternalChannelId": f"UC{i % 500:022}",
+  }
+  return json.dumps({
+    "clickTrackingParams": "CAEQl98BIhMIqJXe6pS99QIVxB0GAB0mQw",
+    "replayChatItemAction": {
+      "actions": [{"addChatItemAction": {
+        "item": {"liveChatTextMessageRenderer": renderer}, "clientId": "CNjJ7"}}],
+      "videoOffsetTimeMsec": str(i * 700)
+    }
+  }).encode()
+
+
+def option(args, name: str, default=None):
+  return args[args.index(name) + 1] if name in args else default
+
+
+def main(args) -> int:
+  print(f"[debug] Command-line config: {args}", file=sys.stderr)
+  print("[debug] yt-dlp version 2023.03.04 [392389b7d] (fake)", file=sys.stderr)
+  if info_json := option(args, "--load-info-json"):
+    with open(info_json) as f:
+      video_id = json.load(f)["id"]
+  else:
+    video_id = args[-1].split("v=")[-1]
+    print(f"[youtube] Extracting URL: {args[-1]}")
+  rng = rng_for(video_id)
+  latency = sample(setting("FAKE_DL_LATENCY"), rng)
+
+  print(f"[youtube] {video_id}: Downloading webpage")
+  print(f"[youtube] {video_id}: Downloading android player API JSON")
+  sys.stdout.flush()
+  time.sleep(latency / 2)
+
+  result = outcome(
+    rng, ("unavailable", "FAKE_DL_UNAVAILABLE"), ("members", "FAKE_DL_MEMBERS"),
+    ("nochat", "FAKE_DL_NOCHAT"))
+  if result == "unavailable":
+    print(f"ERROR: [youtube] {video_id}: Video unavailable. This video has been "
+      "removed by the uploader", file=sys.stderr)
+    return 1
+  if result == "members":
+    print(f"ERROR: [youtube] {video_id}: Join this channel to get access to "
+      "members-only content like this video, and other exclusive perks.",
+      file=sys.stderr)
+    return 1
+
+  fields = {
+    "upload_date": UPLOAD_DATE, "uploader": UPLOADER, "title": f"stream {video_id}",
+    "id": video_id,
+  }
+  templates = [a for i, a in enumerate(args) if i and args[i - 1] == "-o"]
+  if "--write-info-json" in args:
+    template = [t for t in templates if t.startswith("infojson:")][0][len("infojson:"):]
+    info = dict(
+      fields, availability="public", live_status="was_live",
+      subtitles={} if result == "nochat" else {"live_chat": [{"ext": "json"}]})
+    with open(template.replace("%(id)s", video_id).replace("%(ext)s", "info.json"), "w") as f:
+      json.dump(info, f)
+  if result == "nochat":
+    print(f"[info] {video_id}: There are no subtitles for the requested languages")
+    return 0
+
+  name = [t for t in templates if not t.startswith("infojson:")][0]
+  for key, value in fields.items():
+    name = name.replace(f"%({key})s", value)
+  name = name.replace("%(ext)s", "live_chat.json")
+  print(f"[info] {video_id}: Downloading subtitles: live_chat")
+  print(f"[info] Writing video subtitles to: {name}")
+  sys.stdout.flush()
+  size = int(sample(setting("FAKE_DL_SIZE"), rng))
+  start = time.perf_counter()
+  write_sized(name, b"", lambda i: chat_line(video_id, i), b"\n", b"\n", size)
+  time.sleep(max(0.0, latency / 2 - (time.perf_counter() - start)))
+  print(f"[download] Destination: {name}")
+  print(f"[download] 100% of {size / 1024:.2f}KiB in {latency:.2f}s")
+  return 0
+
+
+if __name__ == "__main__":
+  exit(main(sys.argv[1:]))
@@ -0,0 +1,241 @@
+#!/bin/env python3
+#
+# Measure subs.py end to end, without hitting Youtube or Twitch: the
+# downloaders are replaced by bench/fake_ytdlp.py and bench/fake_tdcli.py
+# (through the YTDL and TDCLI variables), and run over a synthetic tree of
+# empty media files, once per concurrency level. For each level, report the
+# throughput, the latency of the download and compress stages, and the peak
+# memory of subs.py itself.
+#
+# Usage: python bench/pipeline.py [--dirs 20] [--videos 50] [--jobs 1,4,16]
+#          [--latency lognormal:-2.3,0.5] [--size lognormal:11.5,1] [--json OUT]
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import List, Dict, Optional, Any
+import argparse
+import json
+import os
+import random
+import resource
+import shlex
+import string
+import subprocess
+import sys
+import threading
+import time
+
+REPO = Path(__file__).absolute().parent.parent
+BENCH = Path(__file__).absolute().parent
+YT_CHARS = string.ascii_letters + string.digits + "-_"
+
+
+def build_tree(
+  root: Path, dirs: int, videos: int, twitch_ratio: float, have_subs: float,
+  seed: int = 0
+) -> int:
+  """Empty media files named as on disk, some with their subs already."""
+  rng = random.Random(seed)
+  count = 0
+  for d in range(dirs):
+    directory = root / f"channel{d:03}"
+    directory.mkdir(parents=True)
+    for _ in range(videos):
+      if rng.random() < twitch_ratio:
+        _id = str(rng.randrange(1_000_000_000, 2_000_000_000))
+        media = f"20220121 Fake Channel stream [270]_{_id}.mp4"
+        subs = f"20220121_{_id}.json.bz2"
+      else:
+        _id = "".join(rng.choice(YT_CHARS) for _ in range(11))
+        media = f"20220106 Fake Channel stream [240]_{_id}.mkv"
+        subs = f"20220106 Fake Channel stream [240]_{_id}.live_chat.json.bz2"
+      (directory / media).touch()
+      if rng.random() < have_subs:
+        (directory / subs).touch()
+      else:
+        count += 1
+  return count
+
+
+def write_wrapper(path: Path, script: Path) -> Path:
+  path.write_text(
+    f"#!/bin/sh\nexec {shlex.quote(sys.executable)} {shlex.quote(str(script))} \"$@\"\n")
+  path.chmod(0o755)
+  return path
+
+
+class PeakRSS(threading.Thread):
+  """Follow the high water mark of the resident memory of a process."""
+  def __init__(self, pid: int, interval: float = 0.05) -> None:
+    super().__init__(daemon=True)
+    self.status = Path(f"/proc/{pid}/status")
+    self.interval = interval
+    self.peak_kb: Optional[int] = None
+    self.stopped = threading.Event()
+
+  def run(self) -> None:
+    while not self.stopped.wait(self.interval):
+      try:
+        for line in self.status.read_text().splitlines():
+          if line.startswith("VmHWM:"):
+            self.peak_kb = int(line.split()[1])
+      except (OSError, ValueError):
+        return
+
+
+def quantile(values: Dict[str, Any], q: float) -> Optional[float]:
+  """Upper bound of the bucket holding quantile q of a histogram."""
+  if not values["count"]:
+    return None
+  for bound, count in values["buckets"].items():
+    if count >= q * values["count"]:
+      return float(bound)
+  return None
+
+
+def histogram(metrics: Dict, name: str) -> Dict[str, Any]:
+  """Merge the label sets of a histogram of the metrics JSON of subs.py."""
+  merged: Dict[str, Any] = {"count": 0, "sum": 0.0, "buckets": {}}
+  for values in metrics.get(f"ytdl_batch_{name}", {}).get("values", ()):
+    merged["count"] += values["count"]
+    merged["sum"] += values["sum"]
+    for bound, count in values["buckets"].items():
+      merged["buckets"][bound] = merged["buckets"].get(bound, 0) + count
+  return merged
+
+
+def run_level(tmp: Path, pargs: argparse.Namespace, jobs: int, env) -> Dict[str, Any]:
+  work = tmp / f"jobs{jobs}"
+  tree = work / "tree"
+  expected = build_tree(
+    tree, pargs.dirs, pargs.videos, pargs.twitch_ratio, pargs.have_subs, pargs.seed)
+  metrics_path = work / "metrics.json"
+  cmd = [
+    sys.executable, str(REPO / "subs.py"), "--mode", "download",
+    "--download-jobs", str(jobs), "--compression", pargs.compression,
+    "--remove-compressed", "--state-db", str(work / "state.db"),
+    "--metrics-json", str(metrics_path), *pargs.extra, str(tree)]
+
+  start = time.perf_counter()
+  with open(work / "subs.out", "w") as out:
+    proc = subprocess.Popen(cmd, cwd=work, env=env, stdout=out, stderr=subprocess.STDOUT)
+    sampler = PeakRSS(proc.pid)
+    sampler.start()
+    proc.wait()
+    sampler.stopped.set()
+    sampler.join()
+  wall = time.perf_counter() - start
+  if proc.returncode != 0:
+    raise Exception(f"subs.py exited with {proc.returncode}, see {work / 'subs.out'}")
+
+  with open(metrics_path) as f:
+    metrics = json.load(f)["metrics"]
+  results: Dict[str, int] = {}
+  for values in metrics.get("ytdl_batch_subs_downloads_total", {}).get("values", ()):
+    result = values["labels"]["result"]
+    results[result] = results.get(result, 0) + int(values["value"])
+  stages = {}
+  for stage, name in (("download", "subs_download_seconds"), ("compress", "subs_compress_seconds")):
+    h = histogram(metrics, name)
+    stages[stage] = {
+      "count": h["count"],
+      "mean": h["sum"] / h["count"] if h["count"] else None,
+      "p50": quantile(h, 0.5),
+      "p95": quantile(h, 0.95),
+    }
+  peak_kb = sampler.peak_kb
+  if peak_kb is None:
+    # No /proc: includes the downloaders run by subs.py
+    peak_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  attempts = sum(results.values())
+  return {
+    "jobs": jobs,
+    "videos": pargs.dirs * pargs.videos,
+    "expected_downloads": expected,
+    "wall_seconds": wall,
+    "results": results,
+    "downloads_per_second": attempts / wall if wall else 0.0,
+    "ok_per_second": results.get("ok", 0) / wall if wall else 0.0,
+    "stages": stages,
+    "peak_rss_mb": peak_kb / 1024,
+  }
+
+
+def _ms(value: Optional[float]) -> str:
+  return "-" if value is None else f"{value * 1000:.0f}"
+
+
+def print_header() -> None:
+  print(
+    f"{'jobs':>4} {'wall s':>7} {'dl/s':>6} {'ok/s':>6} {'ok':>5} {'failed':>6} "
+    f"{'dl mean/p95 ms':>15} {'compress mean/p95':>18} {'peak MB':>8}")
+
+
+def print_row(r: Dict[str, Any]) -> None:
+  dl, comp = r["stages"]["download"], r["stages"]["compress"]
+  print(
+    f"{r['jobs']:>4} {r['wall_seconds']:>7.1f} {r['downloads_per_second']:>6.1f} "
+    f"{r['ok_per_second']:>6.1f} {r['results'].get('ok', 0):>5} "
+    f"{r['results'].get('failed', 0):>6} "
+    f"{_ms(dl['mean']) + '/' + _ms(dl['p95']):>15} "
+    f"{_ms(comp['mean']) + '/' + _ms(comp['p95']):>18} {r['peak_rss_mb']:>8.1f}")
+
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Benchmark subs.py end to end with fake downloaders.')
+  parser.add_argument('--dirs', metavar='N', type=int, default=20)
+  parser.add_argument('--videos', metavar='N', type=int, default=50,
+    help='Videos per directory.')
+  parser.add_argument('--twitch-ratio', metavar='R', type=float, default=0.3)
+  parser.add_argument('--have-subs', metavar='R', type=float, default=0.2,
+    help='Share of the videos whose subs are already there.')
+  parser.add_argument('--jobs', metavar='N,N', type=str, default="1,4,16",
+    help='Concurrency levels (--download-jobs) to compare.')
+  parser.add_argument('--compression', metavar='ALGO', type=str, default="bz2")
+  parser.add_argument('--latency', metavar='DIST', type=str, default=None,
+    help='Latency of each download, in seconds, as in bench/fake_common.py.')
+  parser.add_argument('--size', metavar='DIST', type=str, default=None,
+    help='Size of each chat, in bytes, as in bench/fake_common.py.')
+  parser.add_argument('--seed', metavar='N', type=int, default=0)
+  parser.add_argument('--keep', metavar='DIR', type=str, default=None,
+    help='Work in DIR and leave the trees, outputs and metrics there.')
+  parser.add_argument('--json', metavar='OUT', type=str, default=None,
+    help='Also write the results to OUT.')
+  parser.add_argument('extra', metavar='ARG', nargs='*',
+    help='Extra arguments for subs.py, after --.')
+  return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+  pargs = parse_args(args)
+  env = dict(os.environ)
+  env["PYTHONPATH"] = str(REPO) + os.pathsep + env.get("PYTHONPATH", "")
+  env["FAKE_DL_SEED"] = str(pargs.seed)
+  if pargs.latency:
+    env["FAKE_DL_LATENCY"] = pargs.latency
+  if pargs.size:
+    env["FAKE_DL_SIZE"] = pargs.size
+
+  with TemporaryDirectory() as tmp:
+    work = Path(pargs.keep) if pargs.keep else Path(tmp)
+    work.mkdir(parents=True, exist_ok=True)
+    bin_dir = work / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    env["YTDL"] = str(write_wrapper(bin_dir / "yt-dlp", BENCH / "fake_ytdlp.py"))
+    env["TDCLI"] = str(write_wrapper(bin_dir / "TwitchDownloaderCLI", BENCH / "fake_tdcli.py"))
+
+    print_header()
+    levels = []
+    for jobs in (int(j) for j in pargs.jobs.split(",")):
+      levels.append(run_level(work, pargs, jobs, env))
+      print_row(levels[-1])
+
+  if pargs.json:
+    with open(pargs.json, "w") as f:
+      json.dump(levels, f, indent=1)
+  return 0
+
+
+if __name__ == "__main__":
+  exit(main())
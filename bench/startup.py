@@ -0,0 +1,93 @@
+#!/bin/env python3
+#
+# Measure how long the scripts take to start, i.e. the fixed cost paid by
+# every invocation from shell loops, for modes which do little actual work.
+#
+# Usage: python bench/startup.py [--runs 20] [--importtime]
+
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from typing import List, Tuple
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+REPO = Path(__file__).absolute().parent.parent
+
+
+def scenarios(tmp: Path) -> List[Tuple[str, List[str]]]:
+  empty = tmp / "empty"
+  empty.mkdir(exist_ok=True)
+  subs = str(REPO / "subs.py")
+  return [
+    ("python (baseline)", [sys.executable, "-c", "pass"]),
+    ("import subs", [sys.executable, "-c", "import subs"]),
+    ("subs.py --help", [sys.executable, subs, "--help"]),
+    ("subs.py compress", [sys.executable, subs, "--mode", "compress", str(empty)]),
+    ("subs.py download --dry-run", [
+      sys.executable, subs, "--mode", "download", "--dry-run",
+      "--state-db", str(tmp / "state.db"), str(empty)]),
+  ]
+
+
+def time_command(cmd: List[str], cwd: Path, env, runs: int) -> List[float]:
+  timings = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    subprocess.run(
+      cmd, cwd=cwd, env=env, check=True,
+      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    timings.append(time.perf_counter() - start)
+  return timings
+
+
+def import_times(env, top: int) -> None:
+  """Print the slowest modules imported by subs, according to -X importtime."""
+  proc = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", "import subs"],
+    cwd=REPO, env=env, capture_output=True, text=True, check=True)
+  rows = []
+  for line in proc.stderr.splitlines():
+    if not line.startswith("import time:") or "self [us]" in line:
+      continue
+    self_us, cumulative, name = line[len("import time:"):].split("|")
+    rows.append((int(cumulative), int(self_us), name.rstrip()))
+  rows.sort(reverse=True)
+  print(f"\n{'cumulative ms':>14} {'self ms':>8}  module")
+  for cumulative, self_us, name in rows[:top]:
+    print(f"{cumulative / 1000:>14.1f} {self_us / 1000:>8.1f}  {name}")
+
+
+def main(args=None) -> int:
+  parser = argparse.ArgumentParser(description='Benchmark the startup time of subs.py.')
+  parser.add_argument('--runs', metavar='N', type=int, default=20)
+  parser.add_argument(
+    '--importtime', action="store_true", default=False,
+    help='Also list the slowest imports.')
+  parser.add_argument('--top', metavar='N', type=int, default=15)
+  pargs = parser.parse_args(args)
+
+  env = dict(os.environ)
+  env["PYTHONPATH"] = str(REPO) + os.pathsep + env.get("PYTHONPATH", "")
+  # Downloaders must not be needed by these modes
+  env.pop("YTDL", None)
+  env.pop("TDCLI", None)
+
+  with TemporaryDirectory() as tmp:
+    print(f"{'scenario':<28} {'min ms':>8} {'median ms':>10} {'max ms':>8}")
+    for name, cmd in scenarios(Path(tmp)):
+      timings = time_command(cmd, Path(tmp), env, pargs.runs)
+      print(
+        f"{name:<28} {min(timings) * 1000:>8.1f} "
+        f"{median(timings) * 1000:>10.1f} {max(timings) * 1000:>8.1f}")
+
+  if pargs.importtime:
+    import_times(env, pargs.top)
+  return 0
+
+
+if __name__ == "__main__":
+  exit(main())
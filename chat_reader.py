@@ -0,0 +1,523 @@
+"""
+Read back chat files written by subs.py, plain or compressed by compress().
+
+Both yt-dlp's live_chat.json (one JSON document per line) and
+TwitchDownloaderCLI's single JSON document are supported, as well as the slim
+version of live_chat.json written by chat_slim.py. Messages are yielded
+lazily as normalized ChatMessage records, without ever loading a whole file in
+memory: decompression runs ahead on a background thread while the caller parses.
+"""
+from pathlib import Path
+from typing import Optional, Dict, Generator, Tuple, Any, NamedTuple, Union
+from datetime import datetime
+import bz2
+import gzip
+import io
+import json
+import queue
+import re
+import threading
+import logging
+from regex import yt_base_subn, twitch_sub_file_pattern
+log = logging.getLogger()
+
+CHUNK_SIZE = 64 * 1024
+# First line of the live chats slimmed by chat_slim.py, and the latest version
+# of their schema this module reads
+SLIM_SCHEMA = "ytdl_batch/slim_live_chat"
+SLIM_VERSION = 1
+READAHEAD_DEPTH = 8
+
+twitch_sub_re = re.compile(twitch_sub_file_pattern, re.IGNORECASE)
+# Leading or trailing currency symbol around a formatted amount, ie. "$5.00",
+# "CA$10.00", "¥1,000" or "1.000,00 €"
+amount_re = re.compile(r'^(?P<pre>[^\d\s]*)\s*(?P<num>[\d.,\s]+?)\s*(?P<post>[^\d\s]*)$')
+
+
+class ChatMessage(NamedTuple):
+  service: str
+  id: str
+  offset: float  # seconds since the start of the stream
+  timestamp: Optional[float]  # unix time, if known
+  author_id: str
+  author_name: str
+  text: str
+  kind: str = "text"  # text, paid, sticker or membership
+  currency: Optional[str] = None  # set for paid messages only
+  amount: float = 0.0
+  badges: Tuple[str, ...] = ()
+
+
+class ReadaheadReader(io.RawIOBase):
+  """
+  Read fd in chunks on a background thread, so that decompression (which
+  releases the GIL) overlaps with parsing in the calling thread.
+  """
+  def __init__(
+    self, fd, chunk_size: int = CHUNK_SIZE, depth: int = READAHEAD_DEPTH
+  ) -> None:
+    super().__init__()
+    self.fd = fd
+    self.chunk_size = chunk_size
+    self._queue: queue.Queue = queue.Queue(maxsize=depth)
+    self._stop = threading.Event()
+    self._pending = memoryview(b"")
+    self._eof = False
+    self._thread = threading.Thread(
+      target=self._produce, name="chat-readahead", daemon=True)
+    self._thread.start()
+
+  def _put(self, item) -> bool:
+    while not self._stop.is_set():
+      try:
+        self._queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def _produce(self) -> None:
+    try:
+      while not self._stop.is_set():
+        chunk = self.fd.read(self.chunk_size)
+        if not self._put(chunk) or not chunk:
+          return
+    except BaseException as e:
+      self._put(e)
+
+  def readable(self) -> bool:
+    return True
+
+  def readinto(self, b) -> int:
+    if not self._pending:
+      if self._eof:
+        return 0
+      item = self._queue.get()
+      if isinstance(item, BaseException):
+        self._eof = True
+        raise item
+      if not item:
+        self._eof = True
+        return 0
+      self._pending = memoryview(item)
+    n = min(len(b), len(self._pending))
+    b[:n] = self._pending[:n]
+    self._pending = self._pending[n:]
+    return n
+
+  def close(self) -> None:
+    if self.closed:
+      return
+    self._stop.set()
+    # Unblock the producer if it is waiting on a full queue
+    while True:
+      try:
+        self._queue.get_nowait()
+      except queue.Empty:
+        break
+    self._thread.join()
+    self.fd.close()
+    super().close()
+
+
+def open_archive(path: Path):
+  """
+  Open path for binary reading, transparently decompressing .bz2 and .gz files.
+  """
+  if path.suffix == ".bz2":
+    return bz2.open(path, "rb")
+  if path.suffix == ".gz":
+    return gzip.open(path, "rb")
+  return open(path, "rb")
+
+
+def open_chat(path: Path, readahead: Optional[bool] = None) -> io.BufferedReader:
+  """
+  Open a chat file for binary reading. By default, compressed files are
+  decompressed ahead on a background thread.
+  """
+  fd = open_archive(path)
+  if readahead is None:
+    readahead = path.suffix in (".bz2", ".gz")
+  if not readahead:
+    return fd
+  return io.BufferedReader(ReadaheadReader(fd), buffer_size=CHUNK_SIZE)
+
+
+def service_for(path: Path) -> str:
+  """Guess which service a chat file comes from, by looking at its name."""
+  if twitch_sub_re.match(path.name):
+    return "twitch"
+  return "youtube"
+
+
+def detect_service(fd: io.BufferedReader, path: Optional[Path] = None) -> str:
+  """
+  Guess the format of an open chat file by peeking at its first bytes, fall
+  back to its file name.
+  """
+  head = fd.peek(1024)[:1024]
+  if b'"replayChatItemAction"' in head or b'"clickTrackingParams"' in head \
+  or SLIM_SCHEMA.encode() in head:
+    return "youtube"
+  if b'"comments"' in head or b'"streamer"' in head or b'"FileInfo"' in head:
+    return "twitch"
+  return service_for(path) if path is not None else "youtube"
+
+
+def parse_amount(text: str) -> Tuple[str, float]:
+  """Split a formatted paid amount like "$5.00" into ("$", 5.0)."""
+  match = amount_re.match(text.strip())
+  if not match:
+    return text.strip(), 0.0
+  currency = match.group("pre") or match.group("post")
+  num = match.group("num").replace(" ", "")
+  # Guess which separator is the decimal one: whichever comes last, if it is
+  # followed by exactly two digits.
+  if len(num) > 3 and num[-3] in ",.":
+    num = num[:-3].replace(",", "").replace(".", "") + "." + num[-2:]
+  else:
+    num = num.replace(",", "").replace(".", "") if num.count(".") > 1 \
+      else num.replace(",", "")
+  try:
+    return currency, float(num)
+  except ValueError:
+    return currency, 0.0
+
+
+def _text(obj: Optional[Dict]) -> str:
+  if not obj:
+    return ""
+  if "simpleText" in obj:
+    return obj["simpleText"]
+  parts = []
+  for run in obj.get("runs", ()):
+    if "text" in run:
+      parts.append(run["text"])
+    elif emoji := run.get("emoji"):
+      shortcuts = emoji.get("shortcuts")
+      parts.append(shortcuts[0] if shortcuts else emoji.get("emojiId", ""))
+  return "".join(parts)
+
+
+# Live chat item renderers kept as messages, and the kind of their messages
+YT_MESSAGE_KINDS = {
+  "liveChatTextMessageRenderer": "text",
+  "liveChatPaidMessageRenderer": "paid",
+  "liveChatPaidStickerRenderer": "sticker",
+  "liveChatMembershipItemRenderer": "membership",
+}
+
+
+def youtube_message(renderer_kind: str, renderer: Dict, offset: float) \
+  -> Optional[ChatMessage]:
+  """Normalize a single live chat item renderer."""
+  kind = YT_MESSAGE_KINDS.get(renderer_kind)
+  if kind is None:
+    return None
+
+  currency, amount = None, 0.0
+  if kind == "paid" or kind == "sticker":
+    currency, amount = parse_amount(_text(renderer.get("purchaseAmountText")))
+
+  timestamp = renderer.get("timestampUsec")
+  badges = tuple(
+    b["liveChatAuthorBadgeRenderer"].get("tooltip", "")
+    for b in renderer.get("authorBadges", ())
+    if "liveChatAuthorBadgeRenderer" in b
+  )
+  text = _text(renderer.get("message")) \
+    or _text(renderer.get("headerSubtext"))
+  return ChatMessage(
+    "youtube",
+    renderer.get("id", ""),
+    offset,
+    int(timestamp) / 1_000_000 if timestamp else None,
+    renderer.get("authorExternalChannelId", ""),
+    _text(renderer.get("authorName")),
+    text,
+    kind,
+    currency,
+    amount,
+    badges
+  )
+
+
+def slim_message(doc: Dict) -> ChatMessage:
+  """Normalize a message of a slim live chat."""
+  text = "".join(
+    run if isinstance(run, str) else run.get("emoji", "")
+    for run in doc.get("runs", ()))
+  currency, amount = None, 0.0
+  if "amount" in doc:
+    currency, amount = parse_amount(doc["amount"])
+  return ChatMessage(
+    "youtube",
+    doc.get("id", ""),
+    doc.get("offset", 0) / 1000,
+    doc["ts"] / 1_000_000 if "ts" in doc else None,
+    doc.get("author_id", ""),
+    doc.get("author", ""),
+    text,
+    doc.get("kind", "text"),
+    currency,
+    amount,
+    tuple(doc.get("badges", ()))
+  )
+
+
+def iter_youtube_messages(fd) -> Generator[ChatMessage, None, None]:
+  """
+  Parse a yt-dlp live_chat.json file, which holds one JSON document per line,
+  or its slim version.
+  """
+  slim = False
+  for line in fd:
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      doc = json.loads(line)
+    except ValueError:
+      # Most likely a truncated last line from an interrupted download
+      log.warning(f"Skipping invalid live chat line: {line[:80]!r}")
+      continue
+
+    if slim:
+      yield slim_message(doc)
+      continue
+    if doc.get("schema") == SLIM_SCHEMA:
+      if doc.get("version", 0) > SLIM_VERSION:
+        raise ValueError(
+          f"Slim live chat version {doc['version']} is newer than this reader.")
+      slim = True
+      continue
+
+    replay = doc.get("replayChatItemAction", doc)
+    try:
+      offset = int(replay.get("videoOffsetTimeMsec", 0)) / 1000
+    except ValueError:
+      offset = 0.0
+
+    for action in replay.get("actions", ()):
+      item = action.get("addChatItemAction", {}).get("item", {})
+      for kind, renderer in item.items():
+        msg = youtube_message(kind, renderer, offset)
+        if msg is not None:
+          yield msg
+
+
+class JSONStream():
+  """
+  Minimal incremental reader over a text stream holding a single large JSON
+  document. Only as much of the document as needed to decode the current value
+  is kept in memory.
+  """
+  _ws = " \t\r\n"
+  _structural = re.compile(r'[\[\]{}",]')
+
+  def __init__(self, fd, chunk_size: int = CHUNK_SIZE) -> None:
+    self.fd = fd
+    self.chunk_size = chunk_size
+    self.buf = ""
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def _fill(self) -> bool:
+    if self.eof:
+      return False
+    chunk = self.fd.read(self.chunk_size)
+    if not chunk:
+      self.eof = True
+      return False
+    self.buf = self.buf[self.pos:] + chunk
+    self.pos = 0
+    return True
+
+  def peek(self) -> str:
+    """Return the next non-whitespace character without consuming it."""
+    while True:
+      while self.pos < len(self.buf) and self.buf[self.pos] in self._ws:
+        self.pos += 1
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self._fill():
+        return ""
+
+  def expect(self, char: str) -> None:
+    found = self.peek()
+    if found != char:
+      raise ValueError(f"Expected {char!r} in JSON stream, got {found!r}.")
+    self.pos += 1
+
+  def decode(self) -> Any:
+    """Decode the next complete value (an object, array or string)."""
+    self.peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+        self.pos = end
+        return value
+      except json.JSONDecodeError:
+        if not self._fill():
+          raise
+
+  def skip(self) -> None:
+    """Consume the next value without decoding it."""
+    depth = 0
+    while True:
+      if not self.peek():
+        return
+      match = self._structural.search(self.buf, self.pos)
+      if match is None:
+        self.pos = len(self.buf)
+        if not self._fill():
+          return
+        continue
+      char = match.group()
+      if char == '"':
+        self.pos = match.end()
+        self._skip_string()
+      elif char in "[{":
+        depth += 1
+        self.pos = match.end()
+      elif char in "]}":
+        if depth == 0:  # end of a scalar value inside its container
+          self.pos = match.start()
+          return
+        depth -= 1
+        self.pos = match.end()
+      else:  # comma
+        if depth == 0:
+          self.pos = match.start()
+          return
+        self.pos = match.end()
+      if depth == 0 and char in '"]}':
+        return
+
+  def _skip_string(self) -> None:
+    while True:
+      end = self.buf.find('"', self.pos)
+      if end == -1:
+        # Keep trailing backslashes, they may escape a quote in the next chunk
+        self.pos = max(self.pos, len(self.buf.rstrip("\\")))
+        if not self._fill():
+          return
+        continue
+      # Count escaping backslashes preceding the quote
+      backslashes = 0
+      while end - backslashes - 1 >= self.pos \
+      and self.buf[end - backslashes - 1] == "\\":
+        backslashes += 1
+      self.pos = end + 1
+      if backslashes % 2 == 0:
+        return
+
+  def iter_array(self, key: str) -> Generator[Any, None, None]:
+    """
+    Yield each element of the array stored under key in the top-level object.
+    """
+    self.expect("{")
+    while True:
+      char = self.peek()
+      if char == "}" or not char:
+        return
+      if char == ",":
+        self.pos += 1
+        continue
+      name = self.decode()
+      self.expect(":")
+      if name != key:
+        self.skip()
+        continue
+      self.expect("[")
+      while True:
+        char = self.peek()
+        if char == "]" or not char:
+          self.pos += 1
+          return
+        if char == ",":
+          self.pos += 1
+          continue
+        yield self.decode()
+
+
+def _iso_timestamp(value: Optional[str]) -> Optional[float]:
+  if not value:
+    return None
+  # fromisoformat() in python < 3.11 handles neither "Z" nor nanoseconds
+  value = value.replace("Z", "+00:00")
+  if "." in value:
+    head, _, tail = value.partition(".")
+    frac = re.match(r"\d*", tail).group()
+    value = head + "." + frac[:6].ljust(6, "0") + tail[len(frac):]
+  try:
+    return datetime.fromisoformat(value).timestamp()
+  except ValueError:
+    return None
+
+
+def twitch_message(comment: Dict) -> ChatMessage:
+  """Normalize a single TwitchDownloaderCLI comment."""
+  commenter = comment.get("commenter") or {}
+  message = comment.get("message") or {}
+  bits = message.get("bits_spent") or 0
+  return ChatMessage(
+    "twitch",
+    comment.get("_id", ""),
+    float(comment.get("content_offset_seconds") or 0),
+    _iso_timestamp(comment.get("created_at")),
+    str(commenter.get("_id", "")),
+    commenter.get("display_name") or commenter.get("name", ""),
+    message.get("body", ""),
+    "paid" if bits else "text",
+    "bits" if bits else None,
+    float(bits),
+    tuple(b.get("_id", "") for b in message.get("user_badges") or ())
+  )
+
+
+def iter_twitch_messages(fd) -> Generator[ChatMessage, None, None]:
+  """
+  Parse a TwitchDownloaderCLI JSON document, streaming its "comments" array.
+  """
+  stream = JSONStream(io.TextIOWrapper(fd, encoding="utf-8"))
+  for comment in stream.iter_array("comments"):
+    yield twitch_message(comment)
+
+
+def iter_messages(
+  path: Union[Path, str],
+  service: Optional[str] = None,
+  readahead: Optional[bool] = None
+) -> Generator[ChatMessage, None, None]:
+  """
+  Yield normalized messages from a chat file. The format is detected from the
+  content of the file unless service is "youtube" or "twitch".
+  """
+  path = Path(path)
+  with open_chat(path, readahead=readahead) as fd:
+    if service is None:
+      service = detect_service(fd, path)
+    if service == "twitch":
+      yield from iter_twitch_messages(fd)
+    else:
+      yield from iter_youtube_messages(fd)
+
+
+def is_chat_file(path: Path) -> bool:
+  name = path.name
+  for ext in ("", ".bz2", ".gz"):
+    if name.endswith(f".{yt_base_subn}.json{ext}"):
+      return True
+  return twitch_sub_re.match(name) is not None
+
+
+def find_chat_files(path: Path) -> Generator[Path, None, None]:
+  if path.is_file():
+    yield path
+    return
+  for f in path.rglob("*.json*"):
+    if is_chat_file(f):
+      yield f
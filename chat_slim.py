@@ -0,0 +1,176 @@
+#!/bin/env python3
+#
+# Slim down yt-dlp's live_chat.json. Each line of it wraps a few chat items in
+# renderer envelopes (replayChatItemAction, click tracking params, context
+# menu endpoints, every size of every thumbnail), which make up most of its
+# bytes. The slim file keeps, one message per line, only what chat_reader
+# uses. Its first line names the schema and its version:
+#
+#   {"schema": "ytdl_batch/slim_live_chat", "version": 1}
+#   {"id": "...", "offset": 1234, "ts": 1641500000000000, "kind": "paid",
+#    "author_id": "UC...", "author": "name", "runs": ["hi ", {"emoji": ":_x:"}],
+#    "badges": ["Member (1 year)"], "amount": "$5.00"}
+#
+# offset is in milliseconds from the start of the stream, ts in microseconds
+# since the epoch. Empty fields are left out.
+#
+#   python ./chat_slim.py < in.live_chat.json > out.live_chat.json
+
+from os import replace
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Tuple, Union, Iterable
+import bz2
+import gzip
+import json
+import sys
+from chat_reader import (
+  open_archive, YT_MESSAGE_KINDS, SLIM_SCHEMA as SCHEMA, SLIM_VERSION as VERSION
+)
+import logging
+log = logging.getLogger()
+
+HEADER = {"schema": SCHEMA, "version": VERSION}
+# Name of the original file, if kept
+ORIGINAL_SUFFIX = ".orig"
+
+
+def is_header(doc: Dict) -> bool:
+  return doc.get("schema") == SCHEMA
+
+
+def slim_runs(obj: Optional[Dict]) -> List[Union[str, Dict[str, str]]]:
+  """Text runs as strings, emojis as {"emoji": shortcut}."""
+  if not obj:
+    return []
+  if "simpleText" in obj:
+    return [obj["simpleText"]]
+  runs: List[Union[str, Dict[str, str]]] = []
+  for run in obj.get("runs", ()):
+    if "text" in run:
+      runs.append(run["text"])
+    elif emoji := run.get("emoji"):
+      shortcuts = emoji.get("shortcuts")
+      runs.append({"emoji": shortcuts[0] if shortcuts else emoji.get("emojiId", "")})
+  return runs
+
+
+def slim_renderer(kind: str, renderer: Dict, offset_ms: int) -> Optional[Dict[str, Any]]:
+  """The slim message of a chat item renderer, None if it is not a message."""
+  if (message_kind := YT_MESSAGE_KINDS.get(kind)) is None:
+    return None
+  msg: Dict[str, Any] = {"id": renderer.get("id", ""), "offset": offset_ms}
+  if timestamp := renderer.get("timestampUsec"):
+    msg["ts"] = int(timestamp)
+  msg["kind"] = message_kind
+  msg["author_id"] = renderer.get("authorExternalChannelId", "")
+  msg["author"] = _plain(slim_runs(renderer.get("authorName")))
+  if runs := slim_runs(renderer.get("message")) \
+  or slim_runs(renderer.get("headerSubtext")):
+    msg["runs"] = runs
+  if badges := [
+    b["liveChatAuthorBadgeRenderer"].get("tooltip", "")
+    for b in renderer.get("authorBadges", ())
+    if "liveChatAuthorBadgeRenderer" in b
+  ]:
+    msg["badges"] = badges
+  if amount := slim_runs(renderer.get("purchaseAmountText")):
+    msg["amount"] = _plain(amount)
+  return msg
+
+
+def _plain(runs: List[Union[str, Dict[str, str]]]) -> str:
+  return "".join(r for r in runs if isinstance(r, str))
+
+
+def slim_line(doc: Dict) -> Iterable[Dict[str, Any]]:
+  """Slim messages of a line of live_chat.json."""
+  replay = doc.get("replayChatItemAction", doc)
+  try:
+    offset_ms = int(replay.get("videoOffsetTimeMsec", 0))
+  except ValueError:
+    offset_ms = 0
+  for action in replay.get("actions", ()):
+    item = action.get("addChatItemAction", {}).get("item", {})
+    for kind, renderer in item.items():
+      if (msg := slim_renderer(kind, renderer, offset_ms)) is not None:
+        yield msg
+
+
+def slim_chat(in_fd, out_fd) -> Tuple[int, int]:
+  """
+  Write the slim version of the live_chat.json lines read from the binary
+  in_fd to the binary out_fd, line by line. Return the number of lines read
+  and messages written.
+  """
+  lines = messages = 0
+  out_fd.write(json.dumps(HEADER).encode() + b"\n")
+  for line in in_fd:
+    line = line.strip()
+    if not line:
+      continue
+    lines += 1
+    try:
+      doc = json.loads(line)
+    except ValueError:
+      log.warning(f"Skipping invalid live chat line: {line[:80]!r}")
+      continue
+    if is_header(doc):
+      raise ValueError("Live chat is already slim")
+    for msg in slim_line(doc):
+      out_fd.write(
+        json.dumps(msg, ensure_ascii=False, separators=(",", ":")).encode() + b"\n")
+      messages += 1
+  return lines, messages
+
+
+def _open_output(path: Path, compression: str):
+  if compression == ".bz2":
+    return bz2.open(path, "wb")
+  if compression == ".gz":
+    return gzip.open(path, "wb")
+  return open(path, "wb")
+
+
+def original_path(path: Path) -> Path:
+  """Where the original of path is kept: a.live_chat.json.gz -> a.live_chat.orig.json.gz"""
+  count = 2 if path.suffix in (".bz2", ".gz") else 1
+  suffixes = "".join(path.suffixes[-count:])
+  return path.with_name(path.name[:-len(suffixes)] + ORIGINAL_SUFFIX + suffixes)
+
+
+def slim_file(path: Path, keep_original: bool = False) -> Optional[Path]:
+  """
+  Replace the live chat file path, plain or compressed, by its slim version,
+  compressed the same way. Return the path of the original if it was kept.
+  """
+  tmp = path.with_name(path.name + ".slim.tmp")
+  try:
+    with open_archive(path) as in_fd, _open_output(tmp, path.suffix) as out_fd:
+      lines, messages = slim_chat(in_fd, out_fd)
+  except BaseException:
+    tmp.unlink(missing_ok=True)
+    raise
+  size, slim_size = path.stat().st_size, tmp.stat().st_size
+  log.info(
+    f"Slimmed {path.name}: {lines} lines into {messages} messages, "
+    f"{size} to {slim_size} bytes.")
+  kept = None
+  if keep_original:
+    kept = original_path(path)
+    replace(path, kept)
+  replace(tmp, path)
+  return kept
+
+
+def main() -> int:
+  try:
+    slim_chat(sys.stdin.buffer, sys.stdout.buffer)
+  except ValueError as e:
+    print(e, file=sys.stderr)
+    return 1
+  return 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  exit(main())
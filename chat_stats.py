@@ -0,0 +1,235 @@
+#!/bin/env python3
+#
+# Compute per-stream statistics (messages per minute, unique chatters, top
+# chatters, superchat totals) from the chat archives written by subs.py.
+# Archives are streamed through chat_reader, and each one is handled by a
+# separate process. Results are cached per archive, keyed on size + mtime.
+
+from os import replace, getpid
+from pathlib import Path
+from typing import Optional, List, Dict, Generator, Tuple, Any, Iterable
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import logging
+from chat_reader import ChatMessage, iter_messages, find_chat_files, service_for
+log = logging.getLogger()
+
+TOP_CHATTERS = 10
+
+
+class ChatStats():
+  """
+  Accumulate statistics incrementally, one message at a time.
+  """
+  def __init__(self) -> None:
+    self.messages = 0
+    self.per_minute: Counter = Counter()
+    self.chatters: Counter = Counter()
+    self.names: Dict[str, str] = {}
+    self.superchats: Dict[str, float] = {}
+    self.superchat_count = 0
+
+  def add(self, msg: ChatMessage) -> None:
+    self.messages += 1
+    self.per_minute[int(msg.offset // 60)] += 1
+    author = msg.author_id or msg.author_name
+    self.chatters[author] += 1
+    if author not in self.names:
+      self.names[author] = msg.author_name
+    if msg.currency is not None:
+      self.superchat_count += 1
+      self.superchats[msg.currency] = \
+        self.superchats.get(msg.currency, 0.0) + msg.amount
+
+  def to_dict(self) -> Dict[str, Any]:
+    minutes = (max(self.per_minute) + 1) if self.per_minute else 0
+    peak = self.per_minute.most_common(1)
+    return {
+      "messages": self.messages,
+      "duration_minutes": minutes,
+      "messages_per_minute": round(self.messages / minutes, 2) if minutes else 0.0,
+      "peak_minute": list(peak[0]) if peak else None,
+      "per_minute": [self.per_minute.get(m, 0) for m in range(minutes)],
+      "unique_chatters": len(self.chatters),
+      "top_chatters": [
+        [self.names.get(a, a), count]
+        for a, count in self.chatters.most_common(TOP_CHATTERS)
+      ],
+      "superchat_count": self.superchat_count,
+      "superchats": {k: round(v, 2) for k, v in self.superchats.items()},
+    }
+
+
+def compute_stats(path: Path) -> Dict[str, Any]:
+  stats = ChatStats()
+  service = service_for(path)
+  for msg in iter_messages(path):
+    service = msg.service
+    stats.add(msg)
+  result = stats.to_dict()
+  result["service"] = service
+  return result
+
+
+def _stats_worker(path: str) -> Tuple[str, Optional[Dict], Optional[str]]:
+  """Entry point in worker processes. Exceptions are returned, not raised."""
+  try:
+    return path, compute_stats(Path(path)), None
+  except Exception as e:
+    return path, None, f"{e.__class__.__name__}: {e}"
+
+
+class StatsCache():
+  """
+  Results of previous runs, stored as JSON and keyed by absolute path.
+  An entry is only valid if the size and mtime of the archive did not change.
+  """
+  def __init__(self, path: Optional[Path]) -> None:
+    self.path = path
+    self.entries: Dict[str, Dict] = {}
+    self.dirty = False
+    if path is not None and path.exists():
+      try:
+        with open(path, "r") as f:
+          self.entries = json.load(f)
+      except ValueError as e:
+        log.warning(f"Ignoring corrupted stats cache {path}: {e}")
+
+  @staticmethod
+  def _key(archive: Path) -> Tuple[str, int, int]:
+    st = archive.stat()
+    return str(archive.absolute()), st.st_size, st.st_mtime_ns
+
+  def get(self, archive: Path) -> Optional[Dict]:
+    key, size, mtime = self._key(archive)
+    entry = self.entries.get(key)
+    if entry and entry["size"] == size and entry["mtime_ns"] == mtime:
+      return entry["stats"]
+    return None
+
+  def put(self, archive: Path, stats: Dict) -> None:
+    key, size, mtime = self._key(archive)
+    self.entries[key] = {"size": size, "mtime_ns": mtime, "stats": stats}
+    self.dirty = True
+
+  def save(self) -> None:
+    if self.path is None or not self.dirty:
+      return
+    tmp = self.path.with_name(f"{self.path.name}.{getpid()}.tmp")
+    with open(tmp, "w") as f:
+      json.dump(self.entries, f)
+    replace(tmp, self.path)
+    self.dirty = False
+
+
+def collect_stats(
+  paths: Iterable[Path],
+  cache: StatsCache,
+  jobs: Optional[int] = None
+) -> Generator[Tuple[Path, Optional[Dict], Optional[str]], None, None]:
+  """
+  Yield (path, stats, error) for each archive. Cached results are yielded
+  first, the remaining archives are processed in a pool of jobs processes.
+  """
+  todo: List[str] = []
+  for p in paths:
+    cached = cache.get(p)
+    if cached is not None:
+      yield p, cached, None
+    else:
+      todo.append(str(p))
+
+  if not todo:
+    return
+
+  log.info(f"Computing chat stats for {len(todo)} archives.")
+  if jobs == 1 or len(todo) == 1:
+    results = map(_stats_worker, todo)
+    for path, stats, error in results:
+      if stats is not None:
+        cache.put(Path(path), stats)
+      yield Path(path), stats, error
+    return
+
+  with ProcessPoolExecutor(max_workers=jobs) as pool:
+    for path, stats, error in pool.map(_stats_worker, todo, chunksize=4):
+      if stats is not None:
+        cache.put(Path(path), stats)
+      yield Path(path), stats, error
+
+
+def report(
+  supplied_path: Path,
+  jobs: Optional[int] = None,
+  cache_path: Optional[Path] = Path("chat_stats_cache.json"),
+  output: Optional[Path] = None
+) -> int:
+  """
+  Print stats for every chat archive found in supplied_path. Return the number
+  of archives that could not be processed.
+  """
+  cache = StatsCache(cache_path)
+  results = {}
+  failed = 0
+  try:
+    for path, stats, error in collect_stats(
+      find_chat_files(supplied_path), cache=cache, jobs=jobs):
+      if stats is None:
+        failed += 1
+        print(f"Failed computing stats for \"{path}\": {error}")
+        continue
+      results[str(path)] = stats
+      top = ", ".join(f"{name} ({count})" for name, count in stats["top_chatters"][:3])
+      print(
+        f"{path.name}: {stats['messages']} messages, "
+        f"{stats['messages_per_minute']}/min, "
+        f"{stats['unique_chatters']} chatters"
+        + (f", superchats: {stats['superchats']}" if stats["superchats"] else "")
+        + (f", top: {top}" if top else "")
+      )
+  finally:
+    cache.save()
+
+  print(
+    f"Total: {len(results)} archives, "
+    f"{sum(s['messages'] for s in results.values())} messages.")
+
+  if output is not None:
+    with open(output, "w") as f:
+      json.dump(results, f, indent=1)
+  return failed
+
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Compute statistics from live chat archives.')
+  parser.add_argument(
+    '--jobs', metavar='N', type=int, default=None,
+    help='Number of worker processes (defaults to the number of CPUs).')
+  parser.add_argument(
+    '--stats-cache', metavar='CACHE', type=str, default="chat_stats_cache.json",
+    help='JSON file where results are cached between runs.')
+  parser.add_argument(
+    '--stats-output', metavar='OUTPUT', type=str, default=None,
+    help='Write the stats of every archive to this JSON file.')
+  parser.add_argument(
+    'path', metavar='PATH', type=str,
+    help='Chat archive, or directory to scan for chat archives.')
+  return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+  pargs = parse_args(args)
+  return 1 if report(
+    Path(pargs.path),
+    jobs=pargs.jobs,
+    cache_path=Path(pargs.stats_cache) if pargs.stats_cache else None,
+    output=Path(pargs.stats_output) if pargs.stats_output else None
+  ) else 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  exit(main())
@@ -0,0 +1,369 @@
+#!/bin/env python3
+"""
+Pack the compressed chats of a directory into a single file, chats.pack, so
+that listing, backing up or syncing the archive does not pay for one small
+file per video.
+
+A pack is append-only: members (the compressed chat files, byte for byte)
+are written one after the other, followed by a JSON index of their names,
+services, videoIds, offsets and lengths, and a fixed size footer pointing to
+that index. Each append writes its members and a new index after the last
+one, and only then a new footer, so an interrupted append leaves the previous
+index in place. Members replaced by a newer one, and the old indexes, are
+dead bytes until the pack is compacted.
+
+  python ./chatpack.py pack --remove /archive
+  python ./chatpack.py list /archive/channel
+  python ./chatpack.py extract /archive/channel zp0sfEVWH9A
+  python ./chatpack.py compact /archive
+"""
+from os import walk, fsync, replace, utime, fstat, stat
+from pathlib import Path
+from typing import (
+  Optional, List, Dict, Tuple, Iterable, NamedTuple, Union, BinaryIO
+)
+import argparse
+import fcntl
+import json
+import re
+import struct
+import shutil
+import time
+import logging
+log = logging.getLogger()
+
+PACK_NAME = "chats.pack"
+MAGIC = b"YTCHPAK1"
+# Magic, offset and length of the index
+FOOTER = struct.Struct(">8sQQ")
+VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+# Only compressed chats are packed, plain ones may still be written to
+PACKED_SUFFIXES = (".bz2", ".gz")
+
+
+class PackMember(NamedTuple):
+  # Name of the chat file, which it gets back when extracted
+  name: str
+  service: str
+  id: str
+  offset: int
+  length: int
+  mtime: float
+
+
+class ChatPack():
+  """
+  A chats.pack file. Appends and compactions take an exclusive lock on the
+  file, so that several processes may pack the same directory.
+  """
+  def __init__(self, path: Union[Path, str]) -> None:
+    self.path = Path(path)
+    self.members: Dict[str, PackMember] = {}
+    # Where the valid data ends, past the footer of the last index
+    self.end = 0
+    if self.path.exists():
+      with open(self.path, "rb") as f:
+        self._load(f)
+
+  def _load(self, f: BinaryIO) -> None:
+    self.members, self.end = read_index(f)
+
+  def __len__(self) -> int:
+    return len(self.members)
+
+  def __contains__(self, key: Tuple[str, str]) -> bool:
+    return bool(self.lookup(*key))
+
+  def lookup(self, service: str, _id: str) -> List[PackMember]:
+    """The members holding the chats of _id, a slim and a full one maybe."""
+    return [m for m in self.members.values() if m.service == service and m.id == _id]
+
+  @property
+  def live_bytes(self) -> int:
+    return sum(m.length for m in self.members.values())
+
+  def append(self, files: Iterable[Tuple[Path, str, str]]) -> List[Path]:
+    """
+    Append (path, service, videoId) chat files, replacing members of the same
+    name. The pack is synced to disk before returning the paths appended,
+    which may then be removed.
+    """
+    appended: List[Path] = []
+    self.path.touch(exist_ok=True)
+    with _open_locked(self.path, "r+b") as f:
+      # Another process may have appended since we read the index
+      self._load(f)
+      f.truncate(self.end)
+      f.seek(self.end)
+      offset = self.end
+      for path, service, _id in files:
+        st = path.stat()
+        with open(path, "rb") as src:
+          shutil.copyfileobj(src, f, CHUNK_SIZE)
+        length = f.tell() - offset
+        if length != st.st_size:
+          raise OSError(f"{path} changed while being packed")
+        self.members[path.name] = PackMember(
+          path.name, service, _id, offset, length, st.st_mtime)
+        appended.append(path)
+        offset += length
+      if not appended:
+        return appended
+      self.end = _write_index(f, self.members.values(), offset)
+      f.flush()
+      fsync(f.fileno())
+    return appended
+
+  def read(self, member: PackMember) -> bytes:
+    with open(self.path, "rb") as f:
+      f.seek(member.offset)
+      data = f.read(member.length)
+    if len(data) != member.length:
+      raise OSError(f"{self.path} is truncated in {member.name}")
+    return data
+
+  def extract(self, member: PackMember, directory: Path) -> Path:
+    """Write member back as a file in directory, with its name and mtime."""
+    out = Path(directory) / member.name
+    tmp = out.with_name(out.name + ".tmp")
+    try:
+      tmp.write_bytes(self.read(member))
+      utime(tmp, (member.mtime, member.mtime))
+      replace(tmp, out)
+    except BaseException:
+      tmp.unlink(missing_ok=True)
+      raise
+    return out
+
+  def compact(self) -> int:
+    """
+    Rewrite the pack with its live members only. Return the number of bytes
+    reclaimed.
+    """
+    tmp = self.path.with_name(self.path.name + ".tmp")
+    with _open_locked(self.path, "rb") as f:
+      self._load(f)
+      before = f.seek(0, 2)
+      members: Dict[str, PackMember] = {}
+      try:
+        with open(tmp, "wb") as out:
+          for m in sorted(self.members.values(), key=lambda m: m.offset):
+            f.seek(m.offset)
+            offset = out.tell()
+            _copy(f, out, m.length)
+            members[m.name] = m._replace(offset=offset)
+          end = _write_index(out, members.values(), out.tell())
+          out.flush()
+          fsync(out.fileno())
+        replace(tmp, self.path)
+      except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    self.members, self.end = members, end
+    return before - end
+
+
+def _open_locked(path: Path, mode: str) -> BinaryIO:
+  """
+  Open path with an exclusive lock. A compaction may replace the file while
+  we wait for the lock, in which case the new one is opened.
+  """
+  while True:
+    f = open(path, mode)
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      if fstat(f.fileno()).st_ino == stat(path).st_ino:
+        return f
+    except FileNotFoundError:
+      pass
+    f.close()
+
+
+def _copy(src: BinaryIO, dst: BinaryIO, length: int) -> None:
+  while length > 0:
+    chunk = src.read(min(CHUNK_SIZE, length))
+    if not chunk:
+      raise OSError("Pack is truncated")
+    dst.write(chunk)
+    length -= len(chunk)
+
+
+def _write_index(f: BinaryIO, members: Iterable[PackMember], offset: int) -> int:
+  """Write the index and footer at offset. Return where they end."""
+  index = json.dumps({
+    "version": VERSION,
+    "members": [list(m) for m in members],
+  }, ensure_ascii=False, separators=(",", ":")).encode()
+  f.seek(offset)
+  f.write(index)
+  f.write(FOOTER.pack(MAGIC, offset, len(index)))
+  return offset + len(index) + FOOTER.size
+
+
+def read_index(f: BinaryIO) -> Tuple[Dict[str, PackMember], int]:
+  """
+  The members of the last complete index of an open pack, and where that
+  index ends. Bytes after it are left by an interrupted append.
+  """
+  size = f.seek(0, 2)
+  end = size
+  while end >= FOOTER.size:
+    f.seek(end - FOOTER.size)
+    magic, offset, length = FOOTER.unpack(f.read(FOOTER.size))
+    if magic == MAGIC and offset + length + FOOTER.size == end:
+      f.seek(offset)
+      try:
+        index = json.loads(f.read(length))
+      except ValueError:
+        index = None
+      if index is not None:
+        if index.get("version", 0) > VERSION:
+          raise ValueError(f"Pack version {index['version']} is newer than this reader.")
+        if end != size:
+          log.warning(f"Ignoring {size - end} bytes after the last index of {f.name}.")
+        return {m[0]: PackMember(*m) for m in index["members"]}, end
+    end = _previous_footer(f, end)
+  if size:
+    log.warning(f"No index found in {f.name}.")
+  return {}, 0
+
+
+def _previous_footer(f: BinaryIO, end: int) -> int:
+  """End of the last footer candidate that ends before end, or 0."""
+  # The magic must start before limit
+  limit = end - FOOTER.size
+  while limit > 0:
+    start = max(0, limit - CHUNK_SIZE)
+    f.seek(start)
+    found = f.read(limit - start + len(MAGIC) - 1).rfind(MAGIC)
+    if found != -1:
+      return start + found + FOOTER.size
+    limit = start
+  return 0
+
+
+def pack_members(directory: Union[Path, str]) -> List[PackMember]:
+  """Members of the pack in directory, none if there is no readable pack."""
+  path = Path(directory) / PACK_NAME
+  try:
+    with open(path, "rb") as f:
+      return list(read_index(f)[0].values())
+  except (OSError, ValueError) as e:
+    log.warning(f"Cannot read {path}: {e}")
+    return []
+
+
+def pack_directories(
+  path: Path,
+  filter_re: Optional[re.Pattern] = None,
+  remove: bool = False,
+  dry_run: bool = False
+) -> Tuple[int, int]:
+  """
+  Append the compressed chat files of every directory under path to the pack
+  of their directory. Return the number of files packed and of packs written.
+  """
+  # manifest reads the packs, hence imported here
+  from manifest import scan
+  files = packs = 0
+  directory: Optional[Path] = None
+  pending: List[Tuple[Path, str, str]] = []
+
+  def flush() -> None:
+    nonlocal files, packs
+    if not pending:
+      return
+    if dry_run:
+      print(f"Would pack {len(pending)} chats into {directory / PACK_NAME}.")
+    else:
+      appended = ChatPack(directory / PACK_NAME).append(pending)
+      if remove:
+        for p in appended:
+          p.unlink()
+      files += len(appended)
+      packs += 1
+    pending.clear()
+
+  for record in scan(path, filter_re):
+    for sub in record.sub_paths:
+      sub = Path(sub)
+      if sub.parent.name == PACK_NAME or sub.suffix not in PACKED_SUFFIXES:
+        continue
+      if sub.parent != directory:
+        flush()
+        directory = sub.parent
+      pending.append((sub, record.service, record.id))
+  flush()
+  return files, packs
+
+
+def find_packs(path: Path) -> Iterable[Path]:
+  for root, _, files in walk(path):
+    if PACK_NAME in files:
+      yield Path(root) / PACK_NAME
+
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Pack the compressed chats of each directory into a single file.')
+  sub = parser.add_subparsers(dest="command", required=True)
+  pack = sub.add_parser(
+    "pack", help='Append the compressed chats found under PATH to the pack of '
+      'their directory.')
+  pack.add_argument(
+    '--remove', action="store_true", default=False,
+    help='Remove the chat files once they are safely in their pack.')
+  pack.add_argument(
+    '--exclude-regex', metavar='EXCLUDE', type=str, default=None,
+    help='Regex to filter out directories.')
+  pack.add_argument('--dry-run', action="store_true", default=False)
+  pack.add_argument('path', metavar='PATH', type=str)
+  show = sub.add_parser("list", help='List the members of the pack of a directory.')
+  show.add_argument('path', metavar='DIR', type=str)
+  extract = sub.add_parser(
+    "extract", help='Write the chats of videoIds back as files in the directory.')
+  extract.add_argument('path', metavar='DIR', type=str)
+  extract.add_argument('ids', metavar='ID', nargs='+')
+  compact = sub.add_parser(
+    "compact", help='Rewrite the packs under PATH without their dead bytes.')
+  compact.add_argument(
+    '--min-waste', metavar='RATIO', type=float, default=0.1,
+    help='Only compact packs with at least this ratio of dead bytes.')
+  compact.add_argument('path', metavar='PATH', type=str)
+  return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+  pargs = parse_args(args)
+  if pargs.command == "pack":
+    filter_re = re.compile(pargs.exclude_regex, re.IGNORECASE) \
+      if pargs.exclude_regex else None
+    start = time.perf_counter()
+    files, packs = pack_directories(
+      Path(pargs.path), filter_re, remove=pargs.remove, dry_run=pargs.dry_run)
+    print(f"Packed {files} chats into {packs} packs in {time.perf_counter() - start:.1f}s.")
+  elif pargs.command == "list":
+    pack = ChatPack(Path(pargs.path) / PACK_NAME)
+    for m in sorted(pack.members.values(), key=lambda m: m.name):
+      print(f"{m.service}\t{m.id}\t{m.length}\t{m.name}")
+  elif pargs.command == "extract":
+    pack = ChatPack(Path(pargs.path) / PACK_NAME)
+    for _id in pargs.ids:
+      members = [m for m in pack.members.values() if m.id == _id]
+      if not members:
+        print(f"{_id} is not in {pack.path}.")
+      for m in members:
+        print(f"Written {pack.extract(m, pack.path.parent)}")
+  elif pargs.command == "compact":
+    for path in find_packs(Path(pargs.path)):
+      pack = ChatPack(path)
+      size = path.stat().st_size
+      if size and (size - pack.live_bytes) / size >= pargs.min_waste:
+        print(f"Reclaimed {pack.compact()} bytes from {path}.")
+  return 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  exit(main())
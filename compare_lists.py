@@ -1,4 +1,5 @@
 from sys import argv
+from idset import IdSet
 
 # Objective: compare a given list of Youtube video Ids with another list
 # and return the differences (the missing youtube video Ids from list1 and 
@@ -21,13 +22,14 @@ def read_lines(file_path):
 
 
 def compare(list1, list2, list3=None):
-    l1_ids = {id for id in read_lines(list1)}
-    l2_ids = {id for id in read_lines(list2)}
+    # Compact sets, as these lists can hold millions of Ids
+    l1_ids = IdSet(read_lines(list1))
+    l2_ids = IdSet(read_lines(list2))
 
     print(f"{len(l1_ids)} unique Ids in {list1}")
     print(f"{len(l2_ids)} unique Ids in {list2}")
     
-    missing_from_l1 = {_id for _id in l1_ids if _id not in l2_ids}
+    missing_from_l1 = [_id for _id in l1_ids if _id not in l2_ids]
     if missing_from_l1:
         # We don't really care much about this list, but it's good to know
         # what we have caught that Playboard did not
@@ -36,15 +38,15 @@ def compare(list1, list2, list3=None):
             print(_id)
 
     # Items advertised as deleted will probably never be recovered unfortunately
-    deleted_in_pb = set()
+    deleted_in_pb = IdSet()
     if list3 is not None:
-        deleted_in_pb = {_id for _id in read_lines(list3)}
+        deleted_in_pb = IdSet(read_lines(list3))
 
-    missing_from_l2 = {
-        _id for _id in l2_ids 
+    missing_from_l2 = [
+        _id for _id in l2_ids
         if _id not in l1_ids
         and _id not in deleted_in_pb
-    }
+    ]
     if missing_from_l2:
         print(f"{len(missing_from_l2)} Ids are only in {list2}:")
         for _id in missing_from_l2:
@@ -1,10 +1,12 @@
 from os.path import expanduser
-from platform import python_version_tuple
 from pathlib import Path
+from typing import List, Iterable
+import sys
 import logging
 log = logging.getLogger(__name__)
 
-py_ver_tuple = python_version_tuple()
+# Same as platform.python_version_tuple(), without importing platform
+py_ver_tuple = tuple(str(v) for v in sys.version_info[:3])
 
 # Could also use --cookies-from-browser BROWSER[:PROFILE] with yt-dlp
 COOKIE_PATH = expanduser("~/Cookies/firefox_cookies.txt")
@@ -18,7 +20,15 @@ SFX = {
     "~/Music/sfx/256113_3263906-lq.ogg")
 }
 
-for var in (COOKIE_PATH,):
-  pvar = Path(var)
-  if not pvar.exists():
-    print(f"Error: could not find \"{var}\". Edit the variable")
+
+def missing_paths(paths: Iterable[str] = (COOKIE_PATH,)) -> List[str]:
+  """
+  Return those of paths (the configured ones by default) that do not exist.
+  Call it explicitly, importing this module must not touch the filesystem.
+  """
+  missing = []
+  for var in paths:
+    if not Path(var).expanduser().exists():
+      log.warning(f"Could not find \"{var}\".")
+      missing.append(var)
+  return missing
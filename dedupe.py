@@ -0,0 +1,370 @@
+#!/bin/env python3
+"""
+Find media files stored more than once in the archive, under any name.
+
+Only files of the same size can be identical, so most files are never read.
+Files of the same size are first compared with a hash of a few sampled
+ranges (head, tail and evenly spaced middle chunks), and only files whose
+samples collide are hashed in full. Hashing runs on a pool of threads, as
+it mostly waits on the disk or the network share.
+
+Files holding the same videoId but a different content (re-encodes, other
+resolutions) are reported separately, as they cannot be merged.
+
+  python ./dedupe.py /archive
+  python ./dedupe.py --link hardlink /archive
+"""
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from os import link, replace, stat_result
+from pathlib import Path
+from typing import (
+  Optional, List, Dict, Tuple, Iterable, Callable, NamedTuple, DefaultDict
+)
+from collections import defaultdict
+import argparse
+import errno
+import json
+import re
+import shutil
+import sys
+from manifest import scan
+from profiling import phase, Profiler
+import logging
+log = logging.getLogger()
+
+SAMPLE_SIZE = 64 * 1024
+# Chunks sampled between the head and the tail
+MIDDLE_SAMPLES = 3
+FULL_CHUNK = 4 * 1024 * 1024
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+class MediaFile(NamedTuple):
+  path: Path
+  size: int
+  # Hardlinks to the same inode are the same file
+  inode: Tuple[int, int]
+  service: str
+  id: str
+  # To tell whether the file changed since it was hashed
+  mtime_ns: int = 0
+
+
+class DuplicateSet(NamedTuple):
+  size: int
+  # Sorted, the first one is kept when linking
+  files: List[MediaFile]
+
+  @property
+  def wasted(self) -> int:
+    return self.size * (len({f.inode for f in self.files}) - 1)
+
+
+def sample_ranges(size: int, sample_size: int = SAMPLE_SIZE) -> List[Tuple[int, int]]:
+  """(offset, length) of the ranges hashed for a file of size bytes."""
+  count = MIDDLE_SAMPLES + 2
+  if size <= sample_size * count:
+    return [(0, size)]
+  step = (size - sample_size) // (count - 1)
+  return [(i * step, sample_size) for i in range(count - 1)] \
+    + [(size - sample_size, sample_size)]
+
+
+def sample_hash(path: Path, size: int, sample_size: int = SAMPLE_SIZE) -> str:
+  digest = blake2b(str(size).encode(), digest_size=20)
+  with open(path, "rb") as f:
+    for offset, length in sample_ranges(size, sample_size):
+      f.seek(offset)
+      digest.update(f.read(length))
+  return digest.hexdigest()
+
+
+def full_hash(path: Path) -> str:
+  digest = blake2b(digest_size=20)
+  with open(path, "rb") as f:
+    while chunk := f.read(FULL_CHUNK):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def collect(
+  paths: Iterable[Path], filter_re: Optional[re.Pattern] = None, min_size: int = 1
+) -> List[MediaFile]:
+  """Media files found by the scanners in paths, at least min_size bytes."""
+  files = []
+  for path in paths:
+    for record in scan(path, filter_re):
+      for media in record.media_paths:
+        try:
+          st: stat_result = Path(media).stat()
+        except OSError as e:
+          log.warning(f"Cannot stat {media}: {e}")
+          continue
+        if st.st_size >= min_size:
+          files.append(MediaFile(
+            Path(media), st.st_size, (st.st_dev, st.st_ino),
+            record.service, record.id, st.st_mtime_ns))
+  return files
+
+
+def _group(
+  files: List[MediaFile],
+  key: Callable[[MediaFile], str],
+  pool: ThreadPoolExecutor
+) -> List[List[MediaFile]]:
+  """
+  Split files into groups of equal key, computed on the pool once per inode.
+  Files that could not be read are dropped.
+  """
+  by_inode: Dict[Tuple[int, int], MediaFile] = {}
+  for f in files:
+    by_inode.setdefault(f.inode, f)
+
+  def compute(f: MediaFile) -> Optional[str]:
+    try:
+      return key(f)
+    except OSError as e:
+      log.warning(f"Cannot read {f.path}: {e}")
+      return None
+
+  keys = dict(zip(by_inode, pool.map(compute, by_inode.values())))
+  groups: DefaultDict[str, List[MediaFile]] = defaultdict(list)
+  for f in files:
+    if (k := keys[f.inode]) is not None:
+      groups[k].append(f)
+  return list(groups.values())
+
+
+def find_duplicates(
+  files: List[MediaFile],
+  jobs: int = 8,
+  sample_size: int = SAMPLE_SIZE
+) -> List[DuplicateSet]:
+  """Sets of files with the same content, largest waste first."""
+  by_size: DefaultDict[int, List[MediaFile]] = defaultdict(list)
+  for f in files:
+    by_size[f.size].append(f)
+  candidates = [group for group in by_size.values() if len(group) > 1]
+  log.info(f"{sum(len(g) for g in candidates)} of {len(files)} files share their size.")
+
+  duplicates = []
+  with ThreadPoolExecutor(jobs, thread_name_prefix="hash") as pool:
+    with phase("sample"):
+      sampled = [
+        group
+        for size_group in candidates
+        for group in _group(
+          size_group, lambda f: sample_hash(f.path, f.size, sample_size), pool)
+        if len(group) > 1
+      ]
+    with phase("hash"):
+      for group in sampled:
+        size = group[0].size
+        if len(sample_ranges(size, sample_size)) == 1:
+          # The sample covered the whole file
+          confirmed = [group]
+        else:
+          confirmed = _group(group, lambda f: full_hash(f.path), pool)
+        for same in confirmed:
+          # Hardlinks of a single file are not duplicates
+          if len({f.inode for f in same}) > 1:
+            same.sort(key=lambda f: str(f.path))
+            duplicates.append(DuplicateSet(size, same))
+  duplicates.sort(key=lambda d: (-d.wasted, str(d.files[0].path)))
+  return duplicates
+
+
+def same_id_variants(
+  files: List[MediaFile], duplicates: List[DuplicateSet]
+) -> Dict[Tuple[str, str], List[MediaFile]]:
+  """
+  Files sharing a videoId with at least one file of another content, such as
+  re-encodes. Copies of the same content count once.
+  """
+  identical = {f.inode: d.files[0].inode for d in duplicates for f in d.files}
+  by_id: DefaultDict[Tuple[str, str], Dict[Tuple[int, int], MediaFile]] = \
+    defaultdict(dict)
+  for f in sorted(files, key=lambda f: str(f.path)):
+    by_id[(f.service, f.id)].setdefault(identical.get(f.inode, f.inode), f)
+  return {
+    key: sorted(contents.values(), key=lambda f: str(f.path))
+    for key, contents in by_id.items()
+    if len(contents) > 1
+  }
+
+
+def reflink(src: Path, dst: Path) -> None:
+  """Make dst share the data blocks of src (btrfs, XFS), or raise OSError."""
+  import fcntl
+  with open(src, "rb") as fin, open(dst, "wb") as fout:
+    fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+  shutil.copystat(src, dst)
+
+
+def unchanged(f: MediaFile) -> bool:
+  """Whether f is still the file that was hashed."""
+  try:
+    st = f.path.stat()
+  except OSError:
+    return False
+  return st.st_size == f.size and st.st_mtime_ns == f.mtime_ns \
+    and (st.st_dev, st.st_ino) == f.inode
+
+
+def link_set(dup: DuplicateSet, mode: str) -> int:
+  """
+  Replace every file of dup by a hardlink or a reflink to its first file.
+  Files modified or replaced since they were hashed are left alone.
+  Return the number of files replaced.
+  """
+  keep = dup.files[0]
+  replaced = 0
+  for f in dup.files[1:]:
+    if f.inode == keep.inode:
+      continue
+    if mode == "hardlink" and f.inode[0] != keep.inode[0]:
+      log.warning(f"{f.path} is on another filesystem than {keep.path}.")
+      continue
+    tmp = f.path.with_name(f.path.name + ".dedupe.tmp")
+    try:
+      if mode == "hardlink":
+        link(keep.path, tmp)
+      else:
+        reflink(keep.path, tmp)
+      if not (unchanged(keep) and unchanged(f)):
+        tmp.unlink()
+        print(f"{f.path} or {keep.path} changed since they were hashed, skipped.")
+        continue
+      replace(tmp, f.path)
+    except OSError as e:
+      tmp.unlink(missing_ok=True)
+      if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+        print(f"Cannot {mode} {f.path} to {keep.path}: {e.strerror}")
+      else:
+        log.exception(e)
+        print(f"Failed to replace {f.path}: {e}")
+      continue
+    replaced += 1
+  return replaced
+
+
+def human(size: float) -> str:
+  for unit in ("B", "KiB", "MiB", "GiB"):
+    if size < 1024:
+      return f"{size:.1f} {unit}"
+    size /= 1024
+  return f"{size:.1f} TiB"
+
+
+def print_report(
+  duplicates: List[DuplicateSet],
+  variants: Dict[Tuple[str, str], List[MediaFile]],
+  out=sys.stdout
+) -> None:
+  for dup in duplicates:
+    print(f"{len(dup.files)} copies of {human(dup.size)}:", file=out)
+    for f in dup.files:
+      print(f"  {f.path}", file=out)
+  if variants:
+    print("Different files with the same videoId:", file=out)
+    for (service, _id), files in sorted(variants.items()):
+      print(f"{service} {_id}:", file=out)
+      for f in files:
+        print(f"  {human(f.size)}  {f.path}", file=out)
+  wasted = sum(d.wasted for d in duplicates)
+  print(
+    f"{len(duplicates)} duplicate sets, {human(wasted)} to reclaim, "
+    f"{len(variants)} videoIds with several versions.", file=out)
+
+
+def write_json(
+  duplicates: List[DuplicateSet],
+  variants: Dict[Tuple[str, str], List[MediaFile]],
+  out
+) -> None:
+  json.dump({
+    "duplicates": [
+      {"size": d.size, "wasted": d.wasted, "paths": [str(f.path) for f in d.files]}
+      for d in duplicates
+    ],
+    "same_id": [
+      {"service": service, "id": _id,
+       "files": [{"path": str(f.path), "size": f.size} for f in files]}
+      for (service, _id), files in sorted(variants.items())
+    ],
+  }, out, indent=1, ensure_ascii=False)
+  out.write("\n")
+
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Report media files stored more than once, and optionally '
+      'replace the copies by links to a single file.')
+  parser.add_argument(
+    '--jobs', metavar='N', type=int, default=8,
+    help='Number of files hashed at the same time.')
+  parser.add_argument(
+    '--exclude-regex', metavar='EXCLUDE', type=str, default=None,
+    help='Regex to filter out directories.')
+  parser.add_argument(
+    '--min-size', metavar='BYTES', type=int, default=1024 * 1024,
+    help='Ignore smaller files.')
+  parser.add_argument(
+    '--sample-size', metavar='BYTES', type=int, default=SAMPLE_SIZE,
+    help='Size of each range sampled before hashing whole files.')
+  parser.add_argument(
+    '--link', metavar='MODE', type=str, choices=["hardlink", "reflink"], default=None,
+    help='Replace the copies of each duplicate set by a hardlink, or a reflink '
+      '(copy-on-write filesystems only), to its first file.')
+  parser.add_argument(
+    '--json', metavar='FILE', type=str, default=None,
+    help='Also write the report as JSON to FILE ("-" for stdout).')
+  parser.add_argument(
+    '--profile', action="store_true", default=False,
+    help='Profile each phase of the run and write the reports in the current '
+      'directory.')
+  parser.add_argument(
+    '--profiler', metavar="PROFILER", type=str, default="auto",
+    choices=["auto", "cprofile", "sampling"],
+    help='Profiler used by --profile. "sampling" requires pyinstrument, '
+      '"auto" uses it when it is installed.')
+  parser.add_argument('paths', metavar='PATH', type=str, nargs='+')
+  return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+  pargs = parse_args(args)
+  logging.basicConfig()
+  if pargs.profile:
+    with Profiler(Path(), "dedupe", kind=pargs.profiler):
+      return run(pargs)
+  return run(pargs)
+
+
+def run(pargs: argparse.Namespace) -> int:
+  filter_re = re.compile(pargs.exclude_regex, re.IGNORECASE) \
+    if pargs.exclude_regex else None
+  with phase("scan"):
+    files = collect([Path(p) for p in pargs.paths], filter_re, pargs.min_size)
+  duplicates = find_duplicates(files, jobs=pargs.jobs, sample_size=pargs.sample_size)
+  variants = same_id_variants(files, duplicates)
+
+  report_out = sys.stderr if pargs.json == "-" else sys.stdout
+  print_report(duplicates, variants, out=report_out)
+  if pargs.json == "-":
+    write_json(duplicates, variants, sys.stdout)
+  elif pargs.json:
+    with open(pargs.json, "w", encoding="utf-8") as f:
+      write_json(duplicates, variants, f)
+
+  if pargs.link:
+    with phase("link"):
+      replaced = sum(link_set(d, pargs.link) for d in duplicates)
+    print(f"Replaced {replaced} files by {pargs.link}s.", file=report_out)
+  return 0
+
+
+if __name__ == "__main__":
+  exit(main())
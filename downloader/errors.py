@@ -0,0 +1,14 @@
+# Exceptions raised by the downloaders, whichever program or engine they use
+
+
+class AlreadyPresentError(Exception):
+  pass
+
+class NotAvailableAnymore(Exception):
+  pass
+
+class NeedCookies(Exception):
+  pass
+
+class NoSubsAvailable(Exception):
+  pass
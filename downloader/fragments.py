@@ -0,0 +1,234 @@
+"""
+Pick the number of concurrent fragments of the next video download from the
+throughput of the previous ones.
+
+The throughput of each setting is kept as a moving average per host and per
+period of the day, as the best setting at night is not the best one during
+the day, and saved between runs so that a batch starts from the setting that
+worked best at that time. The controller climbs one fragment at a time while
+throughput improves, goes back to the best known setting when it does not,
+and halves the fragments when the host throttles. Repeated throttling can
+switch to an external downloader (aria2c), if one is configured.
+"""
+from os import getenv, replace, getpid
+from os.path import expanduser
+from pathlib import Path
+from typing import Optional, Dict, NamedTuple, Callable, Set, Tuple
+import json
+import re
+import threading
+import time
+import logging
+log = logging.getLogger()
+
+# The day is split in periods of this many hours
+PERIOD_HOURS = 3
+# Weight of the latest sample in the moving averages
+ALPHA = 0.3
+# A setting this much slower than the best one is abandoned
+TOLERANCE = 0.9
+
+_units = {"": 1, "K": 1e3, "M": 1e6, "G": 1e9, "KI": 1024, "MI": 1024 ** 2, "GI": 1024 ** 3}
+speed_re = re.compile(r"(?P<value>[\d.]+)\s*(?P<unit>[KMG]?i?)B/s", re.IGNORECASE)
+# Signs of throttling in the output of yt-dlp
+throttle_re = re.compile(r"HTTP Error 429|Too Many Requests|throttl", re.IGNORECASE)
+retry_re = re.compile(r"Retrying fragment|Got error:", re.IGNORECASE)
+
+
+def parse_speed(text: Optional[str]) -> Optional[float]:
+  """Return bytes per second from a speed printed by yt-dlp ("2.30MiB/s")."""
+  if not text:
+    return None
+  match = speed_re.search(text)
+  if match is None:
+    return None
+  return float(match.group("value")) * _units[match.group("unit").upper()]
+
+
+def default_history_path() -> Path:
+  base = getenv("XDG_CACHE_HOME") or expanduser("~/.cache")
+  return Path(base) / "ytdl_batch" / "throughput.json"
+
+
+class FragmentSettings(NamedTuple):
+  fragments: int
+  # External downloader used by yt-dlp, None for its own
+  external: Optional[str] = None
+
+  @property
+  def key(self) -> str:
+    return f"{self.external or 'native'}:{self.fragments}"
+
+  @classmethod
+  def from_key(cls, key: str) -> "FragmentSettings":
+    external, fragments = key.rsplit(":", 1)
+    return cls(int(fragments), None if external == "native" else external)
+
+
+class DownloadStats():
+  """Throughput and throttling signs gathered from the output of yt-dlp."""
+  def __init__(self) -> None:
+    self.speeds = 0.0
+    self.samples = 0
+    self.retries = 0
+    self.throttled = False
+
+  def feed(self, line: str, speed: Optional[str] = None) -> None:
+    if (value := parse_speed(speed)) is not None:
+      self.speeds += value
+      self.samples += 1
+    elif throttle_re.search(line):
+      self.throttled = True
+    elif retry_re.search(line):
+      self.retries += 1
+
+  @property
+  def throughput(self) -> Optional[float]:
+    return self.speeds / self.samples if self.samples else None
+
+  def is_throttled(self, max_retries: int = 3) -> bool:
+    return self.throttled or self.retries >= max_retries
+
+
+class FragmentController():
+  """
+  Thread-safe: concurrent downloads each call settings() before starting and
+  observe() once done.
+  """
+  def __init__(
+    self,
+    history_path: Optional[Path] = None,
+    host: str = "youtube",
+    initial: int = 4,
+    min_fragments: int = 1,
+    max_fragments: int = 16,
+    external: Optional[str] = None,
+    clock: Callable[[], time.struct_time] = time.localtime
+  ) -> None:
+    self.history_path = history_path
+    self.host = host
+    self.min_fragments = min_fragments
+    self.max_fragments = max(min_fragments, max_fragments)
+    self.external = external
+    self.clock = clock
+    self._lock = threading.Lock()
+    # bucket -> setting key -> [average bytes/s, samples, throttled count]
+    self.history: Dict[str, Dict[str, list]] = self._load()
+    # Entries updated by this run, the others may come from another run
+    self._updated: Set[Tuple[str, str]] = set()
+    self._throttle_streak = 0
+
+    best = self.best()
+    self._next = best if best is not None else \
+      FragmentSettings(self._clamp(initial))
+    log.info(f"Starting downloads from {self.host} with {self._next.key}.")
+
+  def _clamp(self, fragments: int) -> int:
+    return min(self.max_fragments, max(self.min_fragments, fragments))
+
+  def _bucket(self) -> str:
+    return f"{self.host}@{self.clock().tm_hour // PERIOD_HOURS}"
+
+  def _load(self) -> Dict[str, Dict[str, list]]:
+    if self.history_path is None:
+      return {}
+    try:
+      with open(self.history_path, "r") as f:
+        return json.load(f).get("buckets", {})
+    except (OSError, ValueError, AttributeError):
+      return {}
+
+  def save(self) -> None:
+    """
+    Write the entries updated by this run over the current history file, so
+    that concurrent runs do not lose each other's entries.
+    """
+    if self.history_path is None:
+      return
+    history = self._load()
+    with self._lock:
+      for bucket, key in self._updated:
+        history.setdefault(bucket, {})[key] = self.history[bucket][key]
+      data = json.dumps({"version": 1, "buckets": history}, indent=1)
+    path = Path(self.history_path)
+    try:
+      path.parent.mkdir(parents=True, exist_ok=True)
+      tmp = path.with_name(f"{path.name}.{getpid()}.tmp")
+      tmp.write_text(data)
+      replace(tmp, path)
+    except OSError as e:
+      log.warning(f"Could not save throughput history {path}: {e}")
+
+  def _allowed(self, settings: FragmentSettings) -> bool:
+    return settings.external in (None, self.external) \
+      and self.min_fragments <= settings.fragments <= self.max_fragments
+
+  def best(self) -> Optional[FragmentSettings]:
+    """The setting with the best average throughput in the current period."""
+    stats = self.history.get(self._bucket(), {})
+    candidates = [
+      (entry[0], settings)
+      for settings, entry in (
+        (FragmentSettings.from_key(key), entry) for key, entry in stats.items())
+      if self._allowed(settings) and entry[0] > 0
+    ]
+    return max(candidates)[1] if candidates else None
+
+  def settings(self) -> FragmentSettings:
+    with self._lock:
+      return self._next
+
+  def observe(
+    self,
+    settings: FragmentSettings,
+    throughput: Optional[float],
+    throttled: bool = False
+  ) -> FragmentSettings:
+    """
+    Record the outcome of a download made with settings, and return the
+    settings of the next download.
+    """
+    with self._lock:
+      bucket = self._bucket()
+      stats = self.history.setdefault(bucket, {})
+      entry = stats.setdefault(settings.key, [0.0, 0, 0])
+      self._updated.add((bucket, settings.key))
+      if throttled:
+        entry[2] += 1
+      if throughput:
+        entry[0] = throughput if entry[1] == 0 \
+          else ALPHA * throughput + (1 - ALPHA) * entry[0]
+        entry[1] += 1
+      self._next = self._decide(settings, stats, throttled)
+      next_settings = self._next
+    if next_settings != settings:
+      log.info(
+        f"Next downloads from {self.host} use {next_settings.key} "
+        f"(was {settings.key}, {(throughput or 0) / 1e6:.2f} MB/s"
+        f"{', throttled' if throttled else ''}).")
+    return next_settings
+
+  def _decide(
+    self, settings: FragmentSettings, stats: Dict[str, list], throttled: bool
+  ) -> FragmentSettings:
+    if throttled:
+      self._throttle_streak += 1
+      if self._throttle_streak >= 2 and self.external \
+      and settings.external is None:
+        self._throttle_streak = 0
+        return FragmentSettings(settings.fragments, self.external)
+      return settings._replace(fragments=self._clamp(settings.fragments // 2))
+    self._throttle_streak = 0
+
+    def speed(candidate: FragmentSettings) -> float:
+      entry = stats.get(candidate.key)
+      return entry[0] if entry else 0.0
+
+    best = self.best() or settings
+    if speed(settings) < speed(best) * TOLERANCE:
+      return best
+    # As good as the best: see whether one more fragment does better
+    up = settings._replace(fragments=self._clamp(settings.fragments + 1))
+    if up != settings and (up.key not in stats or speed(up) >= speed(settings)):
+      return up
+    return settings
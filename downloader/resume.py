@@ -0,0 +1,181 @@
+"""
+Detect chat files left incomplete by an interrupted download, and find where
+to resume them.
+
+A Youtube live_chat.json holds one JSON document per line: it is incomplete
+when its last line is truncated, or when it still has its .part suffix.
+A Twitch chat is a single JSON document: it is incomplete when its comments
+array is not closed. Either way, the data is kept up to the last complete
+message, and the download resumes from the offset of that message.
+"""
+from pathlib import Path
+from typing import Optional, NamedTuple, FrozenSet, List, Dict, Tuple
+import json
+import re
+import logging
+log = logging.getLogger()
+
+# Bytes read from the end of a Youtube chat, doubled until enough lines are found
+TAIL_SIZE = 256 * 1024
+
+_decoder = json.JSONDecoder()
+_comments_re = re.compile(r'"comments"\s*:\s*\[')
+
+
+class ResumePoint(NamedTuple):
+  # Bytes of the file to keep, up to the end of the last complete message
+  size: int
+  # Offset of the last complete message in the video, in seconds
+  offset: float
+  # Ids of the messages already written at that offset
+  seen: FrozenSet[str]
+  # Number of messages kept, 0 if only the Twitch header was written
+  count: int
+
+
+def youtube_action_ids(action: Dict) -> List[str]:
+  """Ids of the chat items held by a line of live_chat.json."""
+  replay = action.get("replayChatItemAction", action)
+  ids = []
+  for sub_action in replay.get("actions") or ():
+    for value in sub_action.values():
+      item = value.get("item") if isinstance(value, dict) else None
+      for renderer in (item or {}).values():
+        if isinstance(renderer, dict) and "id" in renderer:
+          ids.append(renderer["id"])
+  return ids
+
+
+def youtube_action_offset(action: Dict) -> Optional[float]:
+  msec = action.get("replayChatItemAction", {}).get("videoOffsetTimeMsec")
+  try:
+    return int(msec) / 1000 if msec is not None else None
+  except ValueError:
+    return None
+
+
+def _complete_lines(tail: bytes) -> Tuple[List[Tuple[int, Dict]], int]:
+  """
+  Decode the complete lines of tail. Return them with their end position in
+  tail, and the position where the valid data ends.
+  """
+  lines = []
+  end = 0
+  pos = 0
+  while (newline := tail.find(b"\n", pos)) != -1:
+    line = tail[pos:newline].strip()
+    if line:
+      try:
+        lines.append((newline + 1, json.loads(line)))
+      except ValueError:
+        # Only the first line of the tail may be cut, anything else is corrupt
+        if lines:
+          break
+        pos = newline + 1
+        continue
+    end = newline + 1
+    pos = newline + 1
+  return lines, end
+
+
+def youtube_resume_point(path: Path) -> Optional[ResumePoint]:
+  """
+  Return where to resume the Youtube chat at path, or None if its last line
+  is complete. Only the end of the file is read.
+  """
+  size = path.stat().st_size
+  if size == 0:
+    return ResumePoint(0, 0.0, frozenset(), 0)
+  tail_size = TAIL_SIZE
+  with open(path, "rb") as f:
+    while True:
+      start = max(0, size - tail_size)
+      f.seek(start)
+      tail = f.read()
+      if start == 0:
+        tail = b"\n" + tail
+        start = -1
+      lines, end = _complete_lines(tail)
+      if start <= 0:
+        break
+      # Go back until a line before the offset of the last one is found
+      offsets = {youtube_action_offset(action) for _, action in lines}
+      if len(offsets) > 1:
+        break
+      tail_size *= 2
+
+  if not lines:
+    return ResumePoint(0, 0.0, frozenset(), 0)
+  if end == len(tail) and path.suffix != ".part":
+    return None
+
+  # Keep whole lines only, and remember what was already written at the
+  # offset of the last one, as the resumed download starts at that offset
+  offset = None
+  seen: List[str] = []
+  for _, action in reversed(lines):
+    action_offset = youtube_action_offset(action)
+    if offset is None:
+      offset = action_offset
+    elif action_offset is not None and action_offset != offset:
+      break
+    seen.extend(youtube_action_ids(action))
+  keep = start + lines[-1][0]
+  return ResumePoint(keep, offset or 0.0, frozenset(seen), _count_lines(path, keep))
+
+
+def _count_lines(path: Path, size: int) -> int:
+  count = 0
+  with open(path, "rb") as f:
+    while size > 0 and (chunk := f.read(min(size, 1024 * 1024))):
+      count += chunk.count(b"\n")
+      size -= len(chunk)
+  return count
+
+
+def twitch_resume_point(path: Path) -> Optional[ResumePoint]:
+  """
+  Return where to resume the Twitch chat at path, or None if its comments
+  array is closed. The whole file is decoded, which only happens once per
+  interrupted download.
+  """
+  text = path.read_text(encoding="utf-8", errors="replace")
+  match = _comments_re.search(text)
+  if match is None:
+    # Not even the header, start over
+    return ResumePoint(0, 0.0, frozenset(), 0)
+
+  pos = last_end = match.end()
+  count = 0
+  offset = 0.0
+  seen: List[str] = []
+  while True:
+    while pos < len(text) and text[pos] in " \t\r\n,":
+      pos += 1
+    if pos < len(text) and text[pos] == "]":
+      return None
+    try:
+      comment, pos = _decoder.raw_decode(text, pos)
+    except ValueError:
+      break
+    last_end = pos
+    count += 1
+    comment_offset = float(comment.get("content_offset_seconds") or 0)
+    if comment_offset != offset:
+      offset = comment_offset
+      seen = []
+    seen.append(comment.get("_id"))
+
+  return ResumePoint(
+    len(text[:last_end].encode("utf-8")), offset, frozenset(seen), count)
+
+
+def resume_point(path: Path, service: str) -> Optional[ResumePoint]:
+  """Return where to resume the chat at path, or None if it is complete."""
+  if service == "twitch":
+    return twitch_resume_point(path)
+  return youtube_resume_point(path)
+
+
+def is_complete(path: Path, service: str) -> bool:
+  return resume_point(path, service) is None
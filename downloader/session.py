@@ -0,0 +1,296 @@
+"""
+HTTP session with persistent keep-alive connections, shared across threads.
+
+Only the standard library is required. Responses are decoded incrementally
+(gzip, deflate, and br if the brotli module is installed), and failed requests
+are retried with exponential backoff.
+"""
+from http.client import (
+  HTTPConnection, HTTPSConnection, HTTPResponse, HTTPException
+)
+from http.cookiejar import CookieJar
+from typing import Optional, Dict, Generator, Tuple, List, Any, Union
+from urllib.parse import urlsplit, urlencode
+from urllib.request import Request
+import json
+import random
+import socket
+import ssl
+import threading
+import time
+import zlib
+import logging
+log = logging.getLogger()
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+ACCEPT_ENCODING = "gzip, deflate" + (", br" if brotli is not None else "")
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CHUNK_SIZE = 64 * 1024
+# Longest Retry-After honoured, unless the backoff itself is longer
+MAX_RETRY_AFTER = 60.0
+
+
+class HTTPError(Exception):
+  def __init__(self, status: int, reason: str, url: str, body: bytes = b"") -> None:
+    super().__init__(f"HTTP {status} {reason} for {url}")
+    self.status = status
+    self.reason = reason
+    self.url = url
+    self.body = body
+
+
+class _Decoder():
+  """Incremental decoder for a Content-Encoding."""
+  def __init__(self, encoding: Optional[str]) -> None:
+    encoding = (encoding or "identity").lower()
+    self._obj: Any = None
+    self._deflate = False
+    if encoding == "gzip":
+      self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+      self._deflate = True
+      self._obj = zlib.decompressobj()
+    elif encoding == "br":
+      if brotli is None:
+        raise Exception("Received a brotli encoded response, but brotli is not installed.")
+      self._obj = brotli.Decompressor()
+    elif encoding != "identity":
+      raise Exception(f"Unsupported content encoding: {encoding}")
+
+  def decompress(self, data: bytes) -> bytes:
+    if self._obj is None:
+      return data
+    if self._deflate:
+      try:
+        return self._obj.decompress(data)
+      except zlib.error:
+        # Some servers send raw deflate streams without zlib header
+        self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._deflate = False
+        return self._obj.decompress(data)
+    if brotli is not None and isinstance(self._obj, brotli.Decompressor):
+      return self._obj.process(data)
+    return self._obj.decompress(data)
+
+  def flush(self) -> bytes:
+    if self._obj is not None and hasattr(self._obj, "flush"):
+      return self._obj.flush()
+    return b""
+
+
+class Response():
+  """
+  Response whose body is decoded on the fly. The underlying connection goes
+  back to the pool once the body has been fully read.
+  """
+  def __init__(
+    self, session: "HTTPSession", key: Tuple, conn: HTTPConnection,
+    raw: HTTPResponse, url: str
+  ) -> None:
+    self._session = session
+    self._key = key
+    self._conn: Optional[HTTPConnection] = conn
+    self.raw = raw
+    self.url = url
+    self.status = raw.status
+    self.reason = raw.reason
+    self.headers = raw.headers
+    self._decoder = _Decoder(raw.getheader("content-encoding"))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.close()
+
+  def iter_content(self, chunk_size: int = CHUNK_SIZE) -> Generator[bytes, None, None]:
+    try:
+      while True:
+        chunk = self.raw.read(chunk_size)
+        if not chunk:
+          break
+        data = self._decoder.decompress(chunk)
+        if data:
+          yield data
+      data = self._decoder.flush()
+      if data:
+        yield data
+    finally:
+      self.close()
+
+  def read(self) -> bytes:
+    return b"".join(self.iter_content())
+
+  def json(self) -> Any:
+    return json.loads(self.read())
+
+  def close(self) -> None:
+    if self._conn is None:
+      return
+    reusable = self.raw.isclosed() and not self.raw.will_close
+    if not self.raw.isclosed():
+      self.raw.close()
+    self._session._release(self._key, self._conn, reusable=reusable)
+    self._conn = None
+
+
+class HTTPSession():
+  """
+  Keep up to max_per_host idle connections per host, so that consecutive
+  requests skip the TCP and TLS handshakes. Safe to share between threads: each
+  request takes a connection out of the pool and gives it back when done.
+  """
+  def __init__(
+    self,
+    headers: Optional[Dict[str, str]] = None,
+    max_per_host: int = 8,
+    timeout: float = 30.0,
+    retries: int = 3,
+    backoff: float = 1.0,
+    cookies: Optional[CookieJar] = None,
+    ssl_context: Optional[ssl.SSLContext] = None
+  ) -> None:
+    self.headers = {"accept-encoding": ACCEPT_ENCODING}
+    self.headers.update({k.lower(): v for k, v in (headers or {}).items()})
+    self.max_per_host = max_per_host
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.cookies = cookies
+    self.ssl_context = ssl_context or ssl.create_default_context()
+    self._idle: Dict[Tuple, List[HTTPConnection]] = {}
+    self._lock = threading.Lock()
+    # Number of connections created, mostly useful to check reuse
+    self.connections_opened = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.close()
+
+  def _acquire(self, key: Tuple) -> Tuple[HTTPConnection, bool]:
+    with self._lock:
+      idle = self._idle.get(key)
+      if idle:
+        return idle.pop(), True
+      self.connections_opened += 1
+    scheme, host, port = key
+    if scheme == "https":
+      conn = HTTPSConnection(
+        host, port, timeout=self.timeout, context=self.ssl_context)
+    else:
+      conn = HTTPConnection(host, port, timeout=self.timeout)
+    return conn, False
+
+  def _release(self, key: Tuple, conn: HTTPConnection, reusable: bool) -> None:
+    if not reusable:
+      conn.close()
+      return
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self.max_per_host:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def _delay(self, attempt: int, response: Optional[Response] = None) -> float:
+    backoff = self.backoff * (2 ** attempt)
+    if response is not None:
+      retry_after = response.headers.get("retry-after")
+      if retry_after and retry_after.isdigit():
+        # A server asking for hours would stall the worker thread
+        return min(float(retry_after), max(backoff, MAX_RETRY_AFTER))
+    return backoff * (0.5 + random.random() / 2)
+
+  def request(
+    self,
+    method: str,
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    data: Union[bytes, str, None] = None,
+    json_data: Any = None,
+    headers: Optional[Dict[str, str]] = None,
+    raise_for_status: bool = True
+  ) -> Response:
+    """
+    Send a request and return its Response once the headers are received.
+    Connection errors, 429 and 5xx responses are retried.
+    """
+    if params:
+      url += ("&" if "?" in url else "?") + urlencode(params)
+    if json_data is not None:
+      data = json.dumps(json_data)
+    if isinstance(data, str):
+      data = data.encode()
+
+    parts = urlsplit(url)
+    scheme = parts.scheme or "http"
+    port = parts.port or (443 if scheme == "https" else 80)
+    key = (scheme, parts.hostname, port)
+    path = parts.path or "/"
+    if parts.query:
+      path += "?" + parts.query
+
+    _headers = dict(self.headers)
+    _headers.update({k.lower(): v for k, v in (headers or {}).items()})
+    if json_data is not None:
+      _headers.setdefault("content-type", "application/json")
+    if self.cookies is not None:
+      req = Request(url, headers=_headers, method=method)
+      self.cookies.add_cookie_header(req)
+      _headers = {k.lower(): v for k, v in req.header_items()}
+
+    attempt = 0
+    while True:
+      conn, reused = self._acquire(key)
+      try:
+        conn.request(method, path, body=data, headers=_headers)
+        raw = conn.getresponse()
+      except (HTTPException, ConnectionError, socket.timeout, OSError) as e:
+        conn.close()
+        # A kept-alive connection may have been closed by the server meanwhile
+        if reused:
+          log.debug(f"Stale connection to {key[1]}, reconnecting: {e!r}")
+          continue
+        if attempt >= self.retries:
+          raise
+        delay = self._delay(attempt)
+        log.info(f"{method} {url} failed ({e!r}), retrying in {delay:.1f}s.")
+        time.sleep(delay)
+        attempt += 1
+        continue
+
+      response = Response(self, key, conn, raw, url)
+      if self.cookies is not None:
+        self.cookies.extract_cookies(raw, Request(url, method=method))
+
+      if response.status in RETRY_STATUSES and attempt < self.retries:
+        delay = self._delay(attempt, response)
+        response.read()
+        log.info(f"{method} {url} returned {response.status}, retrying in {delay:.1f}s.")
+        time.sleep(delay)
+        attempt += 1
+        continue
+
+      if raise_for_status and response.status >= 400:
+        body = response.read()
+        raise HTTPError(response.status, response.reason, url, body)
+      return response
+
+  def get(self, url: str, **kwargs) -> Response:
+    return self.request("GET", url, **kwargs)
+
+  def post(self, url: str, **kwargs) -> Response:
+    return self.request("POST", url, **kwargs)
+
+  def close(self) -> None:
+    with self._lock:
+      for idle in self._idle.values():
+        for conn in idle:
+          conn.close()
+      self._idle.clear()
@@ -0,0 +1,210 @@
+"""
+Download into a local scratch directory, and move the finished files to
+their final directory on the archive volume in batches.
+
+Partial files, temporary files and the write, compress, delete cycle of each
+chat stay on the local disk. Each final directory gets its own scratch
+directory, named after a hash of its path, holding a .target file with that
+path. Files still in scratch when a run stops are moved by the next one,
+while partial downloads stay there to be resumed.
+"""
+from errno import EXDEV
+from hashlib import sha1
+from os import rename, replace, fsync, open as os_open, close, O_RDONLY
+from pathlib import Path
+from typing import Optional, List, Tuple, Callable, Dict, Union
+import shutil
+import threading
+import time
+from .resume import is_complete
+import logging
+log = logging.getLogger()
+
+TARGET_FILE = ".target"
+# Suffixes of files still being written
+PARTIAL_SUFFIXES = (".part", ".tmp", ".ytdl")
+COMPRESSED_SUFFIXES = (".bz2", ".gz")
+
+
+def fsync_dir(path: Path) -> None:
+  """Make the entries of a directory durable, where the OS allows it."""
+  try:
+    fd = os_open(str(path), O_RDONLY)
+  except OSError:
+    return
+  try:
+    fsync(fd)
+  except OSError:
+    pass
+  finally:
+    close(fd)
+
+
+def move_file(src: Path, dst: Path, sync_dir: bool = True) -> Path:
+  """
+  Move src to dst, even across filesystems: the copy is written next to dst,
+  synced and checked against the size of src before being renamed into
+  place, and only then is src removed. Never overwrite dst.
+  """
+  if dst.exists():
+    raise FileExistsError(f"{dst} already exists")
+  try:
+    rename(src, dst)
+    return dst
+  except OSError as e:
+    if e.errno != EXDEV:
+      raise
+
+  tmp = dst.with_name(dst.name + ".tmp")
+  try:
+    with open(src, "rb") as fin, open(tmp, "wb") as fout:
+      shutil.copyfileobj(fin, fout, 1024 * 1024)
+      fout.flush()
+      fsync(fout.fileno())
+    if tmp.stat().st_size != src.stat().st_size:
+      raise OSError(f"Copy of {src} to {tmp} is incomplete")
+    replace(tmp, dst)
+  except BaseException:
+    tmp.unlink(missing_ok=True)
+    raise
+  if sync_dir:
+    fsync_dir(dst.parent)
+  src.unlink()
+  return dst
+
+
+def _is_finished(path: Path) -> bool:
+  """Whether a file left in scratch by an earlier run is worth moving."""
+  name = path.name
+  if path.suffix in PARTIAL_SUFFIXES or name == TARGET_FILE:
+    return False
+  if path.suffix in COMPRESSED_SUFFIXES:
+    # Compression may have been interrupted, read it through
+    if path.suffix == ".bz2":
+      import bz2 as module
+    else:
+      import gzip as module
+    try:
+      with module.open(path, "rb") as f:
+        while f.read(1024 * 1024):
+          pass
+      return True
+    except (OSError, EOFError):
+      return False
+  if name.endswith(".json"):
+    service = "youtube" if name.endswith(".live_chat.json") else "twitch"
+    try:
+      return is_complete(path, service)
+    except (OSError, ValueError):
+      return False
+  return True
+
+
+class StagingArea():
+  """
+  Thread-safe. Files handed to add() are moved once batch_size of them are
+  pending or the oldest one has waited max_delay seconds, and on flush().
+  """
+  def __init__(
+    self,
+    root: Union[Path, str],
+    batch_size: int = 32,
+    max_delay: float = 60.0
+  ) -> None:
+    self.root = Path(root).expanduser()
+    self.root.mkdir(parents=True, exist_ok=True)
+    self.batch_size = max(1, batch_size)
+    self.max_delay = max_delay
+    self._lock = threading.Lock()
+    self._dirs: Dict[Path, Path] = {}
+    self._pending: List[Tuple[Path, Path, Optional[Callable[[Path], None]]]] = []
+    self._oldest = 0.0
+    self.moved = 0
+    self.failed: List[Path] = []
+
+  def directory_for(self, final_dir: Union[Path, str, None]) -> Path:
+    """The scratch directory standing in for final_dir."""
+    final_dir = Path(final_dir or Path()).absolute()
+    with self._lock:
+      if (scratch := self._dirs.get(final_dir)) is not None:
+        return scratch
+      scratch = self.root / sha1(str(final_dir).encode()).hexdigest()[:16]
+      scratch.mkdir(exist_ok=True)
+      target = scratch / TARGET_FILE
+      if not target.exists():
+        target.write_text(str(final_dir))
+      self._dirs[final_dir] = scratch
+      return scratch
+
+  def final_path(self, path: Path) -> Path:
+    """Where path, written in a scratch directory, ends up."""
+    return Path((path.parent / TARGET_FILE).read_text()) / path.name
+
+  def add(
+    self, path: Path, on_moved: Optional[Callable[[Path], None]] = None
+  ) -> Path:
+    """
+    Queue path, written in a scratch directory, for its final directory.
+    on_moved is called with the final path once it is there. Return the
+    final path.
+    """
+    final = self.final_path(path)
+    with self._lock:
+      if not self._pending:
+        self._oldest = time.monotonic()
+      self._pending.append((path, final, on_moved))
+      due = len(self._pending) >= self.batch_size \
+        or time.monotonic() - self._oldest >= self.max_delay
+    if due:
+      self.flush()
+    return final
+
+  def flush(self) -> int:
+    """Move every pending file. Return the number of files moved."""
+    with self._lock:
+      batch, self._pending = self._pending, []
+    # Grouped per directory, which is synced once
+    batch.sort(key=lambda item: str(item[1]))
+    moved = 0
+    synced = set()
+    callbacks = []
+    for src, dst, on_moved in batch:
+      try:
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        move_file(src, dst, sync_dir=False)
+      except OSError as e:
+        log.warning(f"Could not move {src} to {dst}, left in scratch: {e}")
+        print(f"Could not move {src} to {dst}: {e}")
+        with self._lock:
+          self.failed.append(src)
+        continue
+      synced.add(dst.parent)
+      moved += 1
+      if on_moved is not None:
+        callbacks.append((on_moved, dst))
+    for directory in synced:
+      fsync_dir(directory)
+    # Only once the renames are durable, as callbacks record the files as done
+    for on_moved, dst in callbacks:
+      on_moved(dst)
+    if moved:
+      log.info(f"Moved {moved} files out of {self.root}.")
+    with self._lock:
+      self.moved += moved
+    return moved
+
+  def recover(self) -> int:
+    """
+    Move the finished files left in scratch by an earlier run. Partial files
+    are kept, to be resumed. Return the number of files moved.
+    """
+    before = self.moved
+    for target in sorted(self.root.glob(f"*/{TARGET_FILE}")):
+      for path in sorted(target.parent.iterdir()):
+        if path.is_file() and _is_finished(path):
+          self.add(path)
+    self.flush()
+    count = self.moved - before
+    if count:
+      print(f"Moved {count} files left in {self.root} by an earlier run.")
+    return count
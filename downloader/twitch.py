@@ -1,14 +1,11 @@
 from typing import List, Optional
-from downloader.util import find_program
+from downloader.util import ExternalProgram
 
 # Command to download twitch subtitles using TwitchDownloaderCLI
 
-class TwitchDownloaderCLI():
+class TwitchDownloaderCLI(ExternalProgram):
   default_name = "TwitchDownloaderCLI"
 
-  def __init__(self, process_path: Optional[str]) -> None:
-    self.handle = find_program(self.default_name, process_path)
-
   def get_cmd(self, videoId: str, args):
     """Generate yt-dlp to download from twitch"""
     raise NotImplementedError()
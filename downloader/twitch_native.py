@@ -0,0 +1,259 @@
+"""
+Download the chat of Twitch VODs from Twitch's GQL API, without spawning
+TwitchDownloaderCLI for each video.
+
+Comments are requested page by page over the persistent connections of an
+HTTPSession, and written as they arrive in the JSON layout of
+TwitchDownloaderCLI, then compressed with gzip or bz2 if requested. An
+interrupted download is resumed from its last complete comment. Several VODs can be
+fetched at the same time, each one over its own pooled connection.
+"""
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import (
+  Optional, Dict, Generator, Iterable, Tuple, Union, TextIO, Any
+)
+import json
+import re
+from .errors import NotAvailableAnymore
+from .resume import ResumePoint
+from .session import HTTPSession, HTTPError
+from .util import (
+  partial_output, run_many, find_resume_point, compressed_path
+)
+import logging
+log = logging.getLogger()
+
+GQL_URL = "https://gql.twitch.tv/gql"
+# Public client id of the Twitch web player, also used by TwitchDownloaderCLI
+CLIENT_ID = "kimne78kx3ncx6brgo4mv6wki5h1ko"
+COMMENTS_QUERY_HASH = \
+  "b70a3591ff0f4e0313d126c6a1502d79a1c02baebb288227c582044aa76adf6a"
+VIDEO_QUERY = (
+  'query{video(id:"%s"){title,createdAt,lengthSeconds,owner{id,login,displayName}}}'
+)
+# Only the generic cheermote, custom ones are not counted in bits_spent
+cheer_re = re.compile(r"(?:^|(?<=\s))cheer(\d+)(?=\s|$)", re.IGNORECASE)
+
+
+def chat_filename(videoId: str, date: Optional[str] = None) -> str:
+  """Same name as the one given to TwitchDownloaderCLI by TwitchHandler."""
+  return f"{date}_{videoId}.json" if date is not None else f"{videoId}.json"
+
+
+def convert_comment(node: Dict, video_id: str, channel_id: str) -> Dict:
+  """Convert a GQL comment node into a TwitchDownloaderCLI comment."""
+  commenter = node.get("commenter")
+  message = node.get("message") or {}
+  fragments = []
+  emoticons = []
+  body = ""
+  for fragment in message.get("fragments") or ():
+    text = fragment.get("text") or ""
+    emote = fragment.get("emote")
+    fragments.append({
+      "text": text,
+      "emoticon": {"emoticon_id": emote.get("emoteID")} if emote else None
+    })
+    if emote:
+      emoticons.append(
+        {"_id": emote.get("emoteID"), "begin": len(body), "end": len(body) + len(text) - 1})
+    body += text
+
+  return {
+    "_id": node.get("id"),
+    "created_at": node.get("createdAt"),
+    "channel_id": channel_id,
+    "content_type": "video",
+    "content_id": video_id,
+    "content_offset_seconds": node.get("contentOffsetSeconds") or 0,
+    "commenter": {
+      "display_name": commenter.get("displayName"),
+      "_id": commenter.get("id"),
+      "name": commenter.get("login"),
+    } if commenter else None,
+    "message": {
+      "body": body,
+      "bits_spent": sum(int(bits) for bits in cheer_re.findall(body)),
+      "fragments": fragments,
+      "user_badges": [
+        {"_id": badge.get("setID"), "version": badge.get("version")}
+        for badge in message.get("userBadges") or ()
+      ],
+      "user_color": message.get("userColor"),
+      "emoticons": emoticons,
+    },
+  }
+
+
+class TwitchChatFetcher():
+  """
+  Fetch VOD chats from the GQL API. At most max_videos videos are fetched at
+  the same time by download_many(); the session is safe to share with other
+  threads downloading on their own.
+  """
+  def __init__(
+    self,
+    session: Optional[HTTPSession] = None,
+    endpoint: str = GQL_URL,
+    client_id: str = CLIENT_ID,
+    oauth: Optional[str] = None,
+    max_videos: int = 4
+  ) -> None:
+    headers = {"client-id": client_id}
+    if oauth:
+      headers["authorization"] = f"OAuth {oauth}"
+    self.session = session or HTTPSession(max_per_host=max_videos)
+    self.headers = headers
+    self.endpoint = endpoint
+    self.max_videos = max_videos
+
+  def _query(self, payload: Any) -> Any:
+    try:
+      with self.session.post(
+        self.endpoint, json_data=payload, headers=self.headers) as res:
+        return res.json()
+    except HTTPError as e:
+      if e.status == 404:
+        raise NotAvailableAnymore("404 not found.") from e
+      raise
+
+  def video_info(self, video_id: str) -> Dict:
+    """Return title, creation date, length and owner of video_id."""
+    data = self._query({"query": VIDEO_QUERY % video_id, "variables": {}})
+    if errors := data.get("errors"):
+      raise Exception(f"GQL error for {video_id}: {errors[0].get('message')}")
+    video = (data.get("data") or {}).get("video")
+    if video is None:
+      raise NotAvailableAnymore("404 not found.")
+    return video
+
+  def iter_comments(
+    self, video_id: str, channel_id: str = "", start: int = 0
+  ) -> Generator[Dict, None, None]:
+    """
+    Yield the comments of video_id in the TwitchDownloaderCLI format, from
+    start seconds into the video. The next page is only requested once the
+    previous one has been consumed.
+    """
+    variables: Dict[str, Any] = {
+      "videoID": video_id, "contentOffsetSeconds": start}
+    while True:
+      data = self._query([{
+        "operationName": "VideoCommentsByOffsetOrCursor",
+        "variables": variables,
+        "extensions": {
+          "persistedQuery": {"version": 1, "sha256Hash": COMMENTS_QUERY_HASH}
+        }
+      }])
+      page = data[0] if isinstance(data, list) else data
+      if errors := page.get("errors"):
+        raise Exception(f"GQL error for {video_id}: {errors[0].get('message')}")
+      video = (page.get("data") or {}).get("video")
+      if video is None:
+        raise NotAvailableAnymore("404 not found.")
+      comments = video.get("comments") or {}
+      edges = comments.get("edges") or []
+      for edge in edges:
+        yield convert_comment(edge.get("node") or {}, video_id, channel_id)
+
+      if not edges or not (comments.get("pageInfo") or {}).get("hasNextPage"):
+        return
+      variables = {"videoID": video_id, "cursor": edges[-1].get("cursor")}
+
+  def write_chat(
+    self,
+    video_id: str,
+    out: TextIO,
+    info: Optional[Dict] = None,
+    resume: Optional[ResumePoint] = None
+  ) -> int:
+    """
+    Write the chat of video_id to out as a single JSON document, one comment
+    at a time. When resuming, out already holds the header and the comments
+    up to resume. Return the number of comments in the document.
+    """
+    if info is None:
+      info = self.video_info(video_id)
+    owner = info.get("owner") or {}
+    count = 0
+    if resume is None or resume.size == 0:
+      length = info.get("lengthSeconds") or 0
+      header = {
+        "FileInfo": {
+          "Version": {"Major": 1, "Minor": 0, "Patch": 0},
+          "CreatedAt": datetime.now(timezone.utc).isoformat(),
+        },
+        "streamer": {"name": owner.get("displayName"), "id": owner.get("id")},
+        "video": {
+          "title": info.get("title"),
+          "id": video_id,
+          "created_at": info.get("createdAt"),
+          "start": 0,
+          "end": length,
+          "length": length,
+        },
+      }
+      # Leave the document open, comments are streamed into it
+      out.write(json.dumps(header, ensure_ascii=False)[:-1] + ', "comments": [')
+      resume = None
+    else:
+      count = resume.count
+
+    comments = self.iter_comments(
+      video_id, channel_id=owner.get("id") or "",
+      start=int(resume.offset) if resume is not None else 0)
+    for comment in comments:
+      if resume is not None:
+        # Comments up to the last one kept are fetched again
+        offset = comment["content_offset_seconds"]
+        if offset < resume.offset \
+        or (offset == resume.offset and comment["_id"] in resume.seen):
+          continue
+        resume = None
+      if count:
+        out.write(",")
+      out.write(json.dumps(comment, ensure_ascii=False))
+      count += 1
+    out.write('], "embeddedData": null}')
+    return count
+
+  def download(
+    self,
+    video_id: str,
+    out_dir: Union[Path, str, None] = None,
+    date: Optional[str] = None,
+    compression: Optional[str] = None
+  ) -> Path:
+    """
+    Write the chat of video_id in out_dir as {date}_{videoId}.json, or
+    compress it into {date}_{videoId}.json.{compression}. Return the path
+    written. A chat left incomplete by an earlier attempt is resumed. Like
+    TwitchDownloaderCLI with "--collision exit", raise AlreadyPresentError
+    rather than overwrite a complete chat.
+    """
+    path = Path(out_dir or Path()) / chat_filename(video_id, date)
+    resume = find_resume_point(path, compression, "twitch")
+
+    info = self.video_info(video_id)
+    with partial_output(path, compression, resume) as out:
+      count = self.write_chat(video_id, out, info=info, resume=resume)
+    final = compressed_path(path, compression)
+    log.info(f"Written {count} comments of Twitch video {video_id} to {final}.")
+    return final
+
+  def download_many(
+    self,
+    jobs: Iterable[Tuple[str, Union[Path, str, None], Optional[str]]],
+    compression: Optional[str] = None
+  ) -> Generator[Tuple[str, Union[Path, Exception]], None, None]:
+    """
+    Download (video_id, out_dir, date) jobs, max_videos at a time. Yield each
+    video_id with the path written or the exception raised, in job order.
+    """
+    return run_many(
+      self.download, jobs, self.max_videos, name="twitch-chat",
+      compression=compression)
+
+  def close(self) -> None:
+    self.session.close()
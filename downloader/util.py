@@ -1,29 +1,232 @@
-from typing import Optional
-from subprocess import DEVNULL, run
+from typing import (
+  Optional, Dict, Tuple, TextIO, Generator, Iterable, Callable, Any, Union
+)
+from contextlib import contextmanager
 from pathlib import Path
+from os import getenv, access, X_OK, replace, getpid
 from os.path import expanduser
+from .errors import AlreadyPresentError
+from .resume import ResumePoint, resume_point, is_complete
+import json
 import logging
+log = logging.getLogger()
 
+# Set to 1 to remember resolved programs across runs in
+# ~/.cache/ytdl_batch/programs.json, or to the path of another cache file.
+CACHE_ENV = "YTDL_BATCH_PROGRAM_CACHE"
 
-def find_program(default_proc: str, path: Optional[str]) -> Optional[str]:
-  """
-  Check whether default_proc is available in PATH. If it is not, try to lookup
-  at *path* and return if found, otherwise return None.
-  """
+# Programs already resolved by this process
+_resolved: Dict[Tuple[str, str], str] = {}
+
+
+def _cache_path() -> Optional[Path]:
+  value = getenv(CACHE_ENV)
+  if not value or value == "0":
+    return None
+  if value.lower() in ("1", "true", "yes"):
+    base = getenv("XDG_CACHE_HOME") or expanduser("~/.cache")
+    return Path(base) / "ytdl_batch" / "programs.json"
+  return Path(value).expanduser()
+
+
+def _read_cache(cache: Path) -> Dict[str, str]:
+  try:
+    with open(cache, "r") as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+
+def _write_cache(cache: Path, key: str, value: str) -> None:
+  entries = _read_cache(cache)
+  entries[key] = value
+  try:
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache.with_name(f"{cache.name}.{getpid()}.tmp")
+    with open(tmp, "w") as f:
+      json.dump(entries, f, indent=1)
+    replace(tmp, cache)
+  except OSError as e:
+    log.debug(f"Could not write program cache {cache}: {e}")
+
+
+def _resolve(default_proc: str, path: Optional[str]) -> str:
   if not path:
-    which = run(
-      ['which', default_proc], check=False,
-      capture_output=False, stdout=DEVNULL, stderr=DEVNULL
-    )
-    if not which.returncode == 0:
+    import shutil
+    found = shutil.which(default_proc)
+    if found is None:
       raise Exception(
-        f"`which {default_proc}` returned exit code {which.returncode}, "
-        "and did not find the specified program.")
-    return default_proc
+        f"\"{default_proc}\" was not found in PATH, and no path to the program "
+        "was specified.")
+    return found
 
   ppath = Path(expanduser(path))
   if ppath.exists():
     logging.info(f"Using process specified in ENV: \"{ppath}\".")
-    return str(ppath)
+    # Absolute, since downloaders are run from the output directory, and so
+    # that "./program" is not looked up in PATH
+    return str(ppath.absolute())
 
   raise Exception(f"\"{ppath}\" does not exist.")
+
+
+def find_program(default_proc: str, path: Optional[str]) -> str:
+  """
+  Check whether default_proc is available in PATH. If it is not, try to lookup
+  at *path* and return if found, otherwise raise an Exception.
+  The lookup is done in-process and only once per process. If CACHE_ENV is
+  set, results are also kept across runs for as long as they stay executable.
+  """
+  key = (default_proc, path or "")
+  if (found := _resolved.get(key)) is not None:
+    return found
+
+  cache = _cache_path()
+  # The same name may resolve to another program with another PATH
+  cache_key = "\0".join((default_proc, path or "", getenv("PATH", "")))
+  if cache is not None:
+    found = _read_cache(cache).get(cache_key)
+    if found is not None and not access(found, X_OK):
+      found = None
+
+  if found is None:
+    found = _resolve(default_proc, path)
+    if cache is not None:
+      _write_cache(cache, cache_key, found)
+
+  _resolved[key] = found
+  return found
+
+
+class ExternalProgram():
+  """
+  Base class for downloaders which run an external program. The program is
+  only looked up when the first command is built, so that modes which never
+  download do not pay for, or fail on, a missing program.
+  """
+  default_name = ""
+
+  def __init__(self, process_path: Optional[str]) -> None:
+    self.process_path = process_path
+    self._handle: Optional[str] = None
+
+  @property
+  def handle(self) -> str:
+    if self._handle is None:
+      self._handle = find_program(self.default_name, self.process_path)
+    return self._handle
+
+
+def open_output(path: Path, compression: Optional[str], binary: bool = False):
+  """Open path for writing, through gzip or bz2 if compression is set."""
+  mode, encoding = ("wb", None) if binary else ("wt", "utf-8")
+  if compression == "gz":
+    import gzip
+    return gzip.open(path, mode, encoding=encoding)
+  if compression == "bz2":
+    import bz2
+    return bz2.open(path, mode, encoding=encoding)
+  if compression is not None:
+    raise Exception("Incorrect algorithm specified: must be [bz2|gz].")
+  return open(path, mode[0], encoding=encoding)
+
+
+def part_path(path: Path) -> Path:
+  return path.with_name(path.name + ".part")
+
+
+def compressed_path(path: Path, compression: Optional[str]) -> Path:
+  return path.with_name(f"{path.name}.{compression}") if compression else path
+
+
+def find_resume_point(
+  path: Path, compression: Optional[str], service: str
+) -> Optional[ResumePoint]:
+  """
+  Return where to resume the chat to be written at path, if an earlier run
+  left it incomplete, either as path + ".part" or as a truncated path.
+  Raise AlreadyPresentError if the chat is already complete.
+  """
+  final = compressed_path(path, compression)
+  part = part_path(path)
+  if final.exists() or path.exists():
+    if (final != path and final.exists()) or is_complete(path, service):
+      raise AlreadyPresentError(f"{final} already exists.")
+    log.warning(f"{path} is incomplete, resuming it.")
+    replace(path, part)
+
+  if not part.exists():
+    return None
+  point = resume_point(part, service)
+  if point is None:
+    # Interrupted between the end of the download and the rename
+    finish_output(part, final, compression)
+    raise AlreadyPresentError(f"{final} was completed from {part}.")
+  log.info(
+    f"Resuming {part} after {point.count} messages, at {point.offset:.1f}s.")
+  return point
+
+
+def finish_output(part: Path, final: Path, compression: Optional[str]) -> None:
+  """Compress part into final, or rename it to final."""
+  if not compression:
+    replace(part, final)
+    return
+  import shutil
+  tmp = final.with_name(final.name + ".tmp")
+  with open(part, "rb") as src, open_output(tmp, compression, binary=True) as dst:
+    shutil.copyfileobj(src, dst)
+  replace(tmp, final)
+  part.unlink()
+
+
+@contextmanager
+def partial_output(
+  path: Path,
+  compression: Optional[str] = None,
+  resume: Optional[ResumePoint] = None
+) -> Generator[TextIO, None, None]:
+  """
+  Write to path + ".part", so that readers of the directory never see a
+  partial chat. Once complete, it is compressed into path + "." + compression,
+  or renamed to path. If the download fails, the partial chat is kept for the
+  next attempt to resume it from resume, past its last complete message.
+  The partial file is not compressed, as a compressed stream could not be cut
+  back to its last complete message.
+  """
+  part = part_path(path)
+  if resume is not None:
+    with open(part, "r+b") as f:
+      f.truncate(resume.size)
+  try:
+    with open(part, "a" if resume is not None else "w", encoding="utf-8") as out:
+      yield out
+  except BaseException:
+    if part.exists() and part.stat().st_size == 0:
+      part.unlink()
+    else:
+      log.info(f"Kept partial chat {part}, to be resumed on the next attempt.")
+    raise
+  finish_output(part, compressed_path(path, compression), compression)
+
+
+def run_many(
+  func: Callable[..., Any],
+  jobs: Iterable[Tuple],
+  max_workers: int,
+  name: str = "download",
+  **kwargs
+) -> Generator[Tuple[str, Union[Any, Exception]], None, None]:
+  """
+  Call func(*job, **kwargs) for each job, max_workers at a time. Yield the
+  first item of each job with the value returned or the exception raised, in
+  job order.
+  """
+  from concurrent.futures import ThreadPoolExecutor
+  with ThreadPoolExecutor(max_workers, thread_name_prefix=name) as executor:
+    futures = [(job[0], executor.submit(func, *job, **kwargs)) for job in jobs]
+    for key, future in futures:
+      try:
+        yield key, future.result()
+      except Exception as e:
+        yield key, e
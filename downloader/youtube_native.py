@@ -0,0 +1,268 @@
+"""
+Download the live chat replay of Youtube videos without running yt-dlp.
+
+The watch page gives the first continuation of the chat replay, and the
+innertube API returns the chat actions following each continuation. Actions
+are written as they arrive, one JSON document per line like yt-dlp's
+live_chat.json, then compressed with gzip or bz2 if requested. An interrupted
+download is resumed from its last complete line. Requests of all the videos
+go over the keep-alive connections of a shared HTTPSession, which also holds
+the cookies needed for members-only videos.
+"""
+from hashlib import sha1
+from http.cookiejar import CookieJar, MozillaCookieJar
+from pathlib import Path
+from typing import (
+  Optional, Dict, Generator, Iterable, Tuple, Union, TextIO, Any
+)
+import json
+import re
+import time
+from .errors import NotAvailableAnymore, NeedCookies, NoSubsAvailable
+from .resume import ResumePoint, youtube_action_ids, youtube_action_offset
+from .session import HTTPSession, HTTPError
+from .util import (
+  partial_output, run_many, find_resume_point, compressed_path
+)
+import logging
+log = logging.getLogger()
+
+BASE_URL = "https://www.youtube.com"
+HEADERS = {
+  "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.102 Safari/537.36",
+  "accept-language": "en-US,en;q=0.9",
+}
+# Used when the watch page does not hold its own innertube configuration
+DEFAULT_CONTEXT = {"client": {"clientName": "WEB", "clientVersion": "2.20220101.00.00"}}
+
+_decoder = json.JSONDecoder()
+# Characters yt-dlp replaces in file names, with the same replacements
+_unsafe_chars = str.maketrans({
+  "/": "⧸", "\\": "⧹", ":": "：", "*": "＊", "?": "？",
+  '"': "＂", "<": "＜", ">": "＞", "|": "｜", "\0": ""
+})
+
+
+def extract_json(html: str, name: str) -> Optional[Dict]:
+  """Return the object assigned to name in a script of the page, if any."""
+  for match in re.finditer(re.escape(name) + r"\s*=\s*\{|" + re.escape(name) + r"\(\{", html):
+    start = html.index("{", match.start())
+    try:
+      return _decoder.raw_decode(html, start)[0]
+    except ValueError:
+      continue
+  return None
+
+
+def chat_filename(details: Dict) -> str:
+  """
+  Same name as the one yt-dlp is asked for by YTDLDownloader:
+  "%(upload_date)s [%(uploader)s] %(title)s [%(id)s].live_chat.json"
+  """
+  name = (
+    f"{details['upload_date']} [{details['uploader']}] "
+    f"{details['title']} [{details['id']}]"
+  )
+  return name.translate(_unsafe_chars) + ".live_chat.json"
+
+
+def load_cookies(path: Union[Path, str]) -> CookieJar:
+  """Load a Netscape cookies.txt file, as exported for yt-dlp."""
+  jar = MozillaCookieJar(str(path))
+  jar.load(ignore_discard=True, ignore_expires=True)
+  for cookie in jar:
+    # Session cookies, otherwise dropped as expired on the first request
+    if cookie.expires == 0:
+      cookie.expires = None
+      cookie.discard = True
+  return jar
+
+
+def _dig(obj: Any, *keys) -> Any:
+  for key in keys:
+    try:
+      obj = obj[key]
+    except (KeyError, IndexError, TypeError):
+      return None
+  return obj
+
+
+class YoutubeChatFetcher():
+  """
+  Fetch live chat replays. At most max_videos videos are fetched at the same
+  time by download_many(); the session is safe to share with other threads
+  downloading on their own.
+  """
+  def __init__(
+    self,
+    session: Optional[HTTPSession] = None,
+    base_url: str = BASE_URL,
+    cookies: Union[CookieJar, Path, str, None] = None,
+    max_videos: int = 4
+  ) -> None:
+    if cookies is not None and not isinstance(cookies, CookieJar):
+      cookies = load_cookies(cookies)
+    self.session = session or HTTPSession(
+      headers=HEADERS, max_per_host=max_videos, cookies=cookies)
+    if cookies is not None and self.session.cookies is None:
+      self.session.cookies = cookies
+    self.base_url = base_url.rstrip("/")
+    self.max_videos = max_videos
+
+  def _auth_headers(self) -> Dict[str, str]:
+    """
+    Innertube requests are only authenticated with a hash of the SAPISID
+    cookie, on top of the cookies themselves.
+    """
+    jar = self.session.cookies
+    if jar is None:
+      return {}
+    sapisid = next(
+      (c.value for c in jar if c.name in ("SAPISID", "__Secure-3PAPISID")), None)
+    if not sapisid:
+      return {}
+    now = int(time.time())
+    digest = sha1(f"{now} {sapisid} {BASE_URL}".encode()).hexdigest()
+    return {
+      "authorization": f"SAPISIDHASH {now}_{digest}",
+      "x-origin": BASE_URL,
+    }
+
+  def video_info(self, video_id: str) -> Dict:
+    """
+    Read the watch page of video_id. Return its details and the first chat
+    continuation, or raise the reason why its chat cannot be downloaded.
+    """
+    try:
+      with self.session.get(f"{self.base_url}/watch?v={video_id}") as res:
+        html = res.read().decode("utf-8", errors="replace")
+    except HTTPError as e:
+      if e.status in (404, 410):
+        raise NotAvailableAnymore(f"{e.status} {e.reason}") from e
+      raise
+
+    player = extract_json(html, "ytInitialPlayerResponse") or {}
+    status = _dig(player, "playabilityStatus", "status")
+    reason = _dig(player, "playabilityStatus", "reason") or status or ""
+    if status == "LOGIN_REQUIRED" or "members" in reason.lower():
+      raise NeedCookies("Member-only content. Valid cookies are required.")
+    if status is None or status in ("ERROR", "UNPLAYABLE"):
+      raise NotAvailableAnymore(reason or "Video unavailable")
+
+    data = extract_json(html, "ytInitialData") or {}
+    continuation = _dig(
+      data, "contents", "twoColumnWatchNextResults", "conversationBar",
+      "liveChatRenderer", "continuations", 0, "reloadContinuationData",
+      "continuation")
+    if not continuation:
+      raise NoSubsAvailable("No subtitles available for the requested language.")
+
+    details = player.get("videoDetails") or {}
+    date = _dig(player, "microformat", "playerMicroformatRenderer", "uploadDate")
+    config = extract_json(html, "ytcfg.set") or {}
+    return {
+      "id": video_id,
+      "title": details.get("title", ""),
+      "uploader": details.get("author", ""),
+      "upload_date": (date or "")[:10].replace("-", ""),
+      "continuation": continuation,
+      "api_key": config.get("INNERTUBE_API_KEY"),
+      "context": config.get("INNERTUBE_CONTEXT") or DEFAULT_CONTEXT,
+    }
+
+  def iter_actions(
+    self, info: Dict, start: float = 0
+  ) -> Generator[Dict, None, None]:
+    """
+    Yield the chat actions of a video, following its continuation chain from
+    start seconds into the video. The next continuation is only requested
+    once the previous one was consumed.
+    """
+    url = f"{self.base_url}/youtubei/v1/live_chat/get_live_chat_replay"
+    if info.get("api_key"):
+      url += f"?key={info['api_key']}"
+    continuation = info["continuation"]
+    # The first continuation seeks to the player offset
+    offset = int(start * 1000)
+    while continuation:
+      payload = {
+        "context": info["context"],
+        "continuation": continuation,
+        "currentPlayerState": {"playerOffsetMs": str(offset)},
+      }
+      with self.session.post(
+        url, json_data=payload, headers=self._auth_headers()) as res:
+        data = res.json()
+
+      chat = _dig(data, "continuationContents", "liveChatContinuation")
+      if chat is None:
+        return
+      for action in chat.get("actions") or ():
+        if msec := _dig(action, "replayChatItemAction", "videoOffsetTimeMsec"):
+          offset = int(msec)
+        yield action
+
+      # A playerSeekContinuationData marks the end of the replay
+      continuation = _dig(
+        chat, "continuations", 0, "liveChatReplayContinuationData",
+        "continuation")
+
+  def write_chat(
+    self, info: Dict, out: TextIO, resume: Optional[ResumePoint] = None
+  ) -> int:
+    """
+    Write each action on its own line. When resuming, out already holds the
+    actions up to resume. Return the number of lines in the file.
+    """
+    count = resume.count if resume is not None else 0
+    start = resume.offset if resume is not None else 0
+    for action in self.iter_actions(info, start=start):
+      if resume is not None and resume.count:
+        # Actions up to the last one kept are fetched again
+        offset = youtube_action_offset(action)
+        if offset is None or offset < resume.offset \
+        or (offset == resume.offset
+            and set(youtube_action_ids(action)) <= resume.seen):
+          continue
+        resume = None
+      out.write(json.dumps(action, ensure_ascii=False) + "\n")
+      count += 1
+    return count
+
+  def download(
+    self,
+    video_id: str,
+    out_dir: Union[Path, str, None] = None,
+    compression: Optional[str] = None
+  ) -> Path:
+    """
+    Write the chat replay of video_id in out_dir, named like yt-dlp would,
+    or compress it into that name + "." + compression. Return the path
+    written. A chat left incomplete by an earlier attempt is resumed. Like
+    yt-dlp, raise AlreadyPresentError rather than overwrite a complete chat.
+    """
+    info = self.video_info(video_id)
+    path = Path(out_dir or Path()) / chat_filename(info)
+    resume = find_resume_point(path, compression, "youtube")
+
+    with partial_output(path, compression, resume) as out:
+      count = self.write_chat(info, out, resume=resume)
+    final = compressed_path(path, compression)
+    log.info(f"Written {count} chat actions of Youtube video {video_id} to {final}.")
+    return final
+
+  def download_many(
+    self,
+    jobs: Iterable[Tuple[str, Union[Path, str, None]]],
+    compression: Optional[str] = None
+  ) -> Generator[Tuple[str, Union[Path, Exception]], None, None]:
+    """
+    Download (video_id, out_dir) jobs, max_videos at a time. Yield each
+    video_id with the path written or the exception raised, in job order.
+    """
+    return run_many(
+      self.download, jobs, self.max_videos, name="youtube-chat",
+      compression=compression)
+
+  def close(self) -> None:
+    self.session.close()
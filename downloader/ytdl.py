@@ -1,29 +1,38 @@
 from typing import Optional
 from subprocess import run, DEVNULL
 from pathlib import Path
-from .util import find_program
+from .util import ExternalProgram
 import logging
 log = logging.getLogger()
 
 YT_WATCH_URL = r"https://www.youtube.com/watch?v="
 
-class YTDLDownloader():
+class YTDLDownloader(ExternalProgram):
   default_name = "yt-dlp"
 
-  def __init__(self, process_path: Optional[str]) -> None:
-    self.handle = find_program(self.default_name, process_path)
-
   def build_cmd(
-    self, videoId: str, cookies: Optional[Path] = None, skip_video=True):
+    self, videoId: str, cookies: Optional[Path] = None, skip_video=True,
+    fragments: int = 4, external: Optional[str] = None,
+    temp_dir: Optional[Path] = None, info_json: Optional[Path] = None,
+    info_dir: Optional[Path] = None):
+    """
+    fragments is the number of fragments downloaded concurrently, by yt-dlp
+    itself or by the external downloader (only "aria2c" is known here).
+    Fragments and intermediate files go to temp_dir, if given, and only the
+    final file is moved to the current directory by yt-dlp.
+    When only the subs are downloaded, info_json is an info JSON kept from an
+    earlier run, loaded instead of extracting the video page again, and
+    info_dir is where to write a new one, named videoId.info.json.
+    """
     cmd = [str(self.handle), "-v"]
 
     if not skip_video:
       cmd.extend(
         [
           "--exec", "echo", # print name written after postprocessing complete (not sure if this works)
+          "--newline",  # one progress line per update, for callers parsing stdout
           "--embed-thumbnail",
-          # "--concurrent-fragments", "2",
-          "-N", "4",
+          "-N", str(fragments),
           "-4",
           #"--extractor-args", "youtube:player_client=android", "--sleep-interval", "5",
           #"--throttled-rate", "3000", # extract video data again under this rate
@@ -37,7 +46,6 @@ class YTDLDownloader():
           # "-f", "133+251",
           "-f", 'bestvideo[vcodec^=avc1]+bestaudio',
           "-S", '+res:240,res:360,vcodec:avc01', # filter: prefer 240p, otherwise 360p, h264 video codec
-          # "--external-downloader", "aria2c", "--external-downloader-args", "-c -j 3 -x 3 -s 3 -k 1M",
           "--add-metadata",
           "--write-subs",
           "--sub-langs", "live_chat",
@@ -55,18 +63,36 @@ class YTDLDownloader():
           "-o", "%(upload_date)s [%(uploader)s] %(title)s [%(id)s].%(ext)s",
         ]
       )
+      if info_dir is not None and info_json is None:
+        cmd.extend([
+          "--write-info-json", "--no-write-playlist-metafiles",
+          "-o", f"infojson:{info_dir}/%(id)s.%(ext)s",
+        ])
+
+    if external is not None and not skip_video:
+      args = f"-c -j {fragments} -x {fragments} -s {fragments} -k 1M" \
+        if external == "aria2c" else ""
+      cmd.extend(["--downloader", external])
+      if args:
+        cmd.extend(["--downloader-args", f"{external}:{args}"])
+
+    if temp_dir is not None:
+      cmd.extend(["--paths", f"temp:{temp_dir}"])
 
     if cookies is not None:
       cmd.extend(["--cookies", str(cookies)])
 
-    cmd.append(f"{YT_WATCH_URL + videoId}")
+    if info_json is not None and skip_video:
+      cmd.extend(["--load-info-json", str(info_json)])
+    else:
+      cmd.append(f"{YT_WATCH_URL + videoId}")
     return cmd
 
 
-# FIXME
-def dl_ytdlp(video_id: str, cli_path: str, cookies: Optional[Path] = None):
+def dl_ytdlp(
+  video_id: str, cli_path: Optional[str] = None, cookies: Optional[Path] = None):
   """This function will throw any exception from the subprocess module."""
-  ytdlp = YTDLDownloader(cli_path=cli_path)
-  cmd = ytdlp.build_cmd(videoId=video_id, cookies=cookies) # use COOKIE_PATH here
+  ytdlp = YTDLDownloader(process_path=cli_path)
+  cmd = ytdlp.build_cmd(videoId=video_id, cookies=cookies, skip_video=False)
   log.info("Running command: {}".format(" ".join(cmd)))
   run(cmd, check=True)
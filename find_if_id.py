@@ -1,16 +1,15 @@
 from subprocess import run
-from sys import argv
+from pathlib import Path
 from typing import List, Tuple
+import argparse
 import re 
 import logging
 from regex import yt_video_file_pattern
+from profiling import phase, Profiler
 log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG)
-logging.basicConfig()
 
 
 YT_ID_RE = re.compile(yt_video_file_pattern, re.IGNORECASE)
-log.debug(f"videoId regular expression: {YT_ID_RE}")
 
 
 def find_youtube_id(file_list: list):
@@ -22,12 +21,12 @@ def find_youtube_id(file_list: list):
     if match:
       group = match.group(1)
       if group in ids:
-        log.warning(f"ID \'{group}\' from \'{fname}\' was already found.")
+        log.warning("ID '%s' from '%s' was already found.", group, fname)
         dupes.append(fname)
       else:   
         ids.append(group)
     else:
-      log.info(f"Did not match regex: {fname}")
+      log.info("Did not match regex: %s", fname)
       miss.append(fname)
   return ids, miss, dupes
 
@@ -45,7 +44,7 @@ def sort_output(output: str) -> Tuple[List[str], int]:
   # TODO use our own sorting method to match any date format in the string
   filenames.sort()
   for fname in filenames:
-    log.debug(f"Sorted: {fname}")
+    log.debug("Sorted: %s", fname)
   return filenames, line_count
 
 
@@ -59,7 +58,7 @@ def run_find(target_path) -> str:
     # "|", "sed", "-n", r's/^.*\][\s_]\?\(.*\)\..\{3,4\}$/\1/p'
   ]
 
-  log.debug(f"command to run: {cmd}")
+  log.debug("command to run: %s", cmd)
 
   proc = run(
     cmd,
@@ -72,18 +71,49 @@ def run_find(target_path) -> str:
   return proc.stdout
 
 
-def main(target_path):
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Write the Youtube videoIds found in the media file names of a '
+      'directory to ids_found_on_disk.txt.')
+  parser.add_argument(
+    '--profile', action="store_true", default=False,
+    help='Profile each phase of the run and write the reports in the current '
+      'directory.')
+  parser.add_argument(
+    '--profiler', metavar="PROFILER", type=str, default="auto",
+    choices=["auto", "cprofile", "sampling"],
+    help='Profiler used by --profile. "sampling" requires pyinstrument, '
+      '"auto" uses it when it is installed.')
+  parser.add_argument('target_path', metavar='PATH', type=str)
+  return parser.parse_args(args)
+
+
+def main(args=None):
+  pargs = parse_args(args)
+  logging.basicConfig()
+  log.setLevel(logging.DEBUG)
+  log.debug("videoId regular expression: %s", YT_ID_RE)
+  if pargs.profile:
+    with Profiler(Path(), "find_if_id", kind=pargs.profiler):
+      find_ids(pargs.target_path)
+  else:
+    find_ids(pargs.target_path)
+
+
+def find_ids(target_path):
   """
   Crawl files in the given directory and return a set of Youtube videoIds 
   taken from their filenames. Write them to file.
   """
-  filenames, count = sort_output(run_find(target_path))
+  with phase("scan"):
+    filenames, count = sort_output(run_find(target_path))
   print(f"Total files found by suffix: {count}")
 
-  ids, misses, dupes = find_youtube_id(filenames)
+  with phase("plan"):
+    ids, misses, dupes = find_youtube_id(filenames)
   print(f"IDs found (most ancient at the top):")
 
-  with open("ids_found_on_disk.txt", "w") as f:
+  with phase("write"), open("ids_found_on_disk.txt", "w") as f:
       for _id in ids:  # reversed: ids[::-1]:
           print(_id)
           f.write("youtube " + _id + '\n')
@@ -100,4 +130,4 @@ def main(target_path):
     print(dupe)
 
 if __name__ == "__main__":
-  main(argv[1])
\ No newline at end of file
+  main()
\ No newline at end of file
@@ -0,0 +1,308 @@
+#!/bin/env python3
+#
+# Compact set of Youtube and Twitch videoIds.
+#
+# A Python set of 11-character strings costs around 60-70 bytes per Id. Here,
+# Youtube Ids are decoded from base64url into 64-bit integers (the last of the
+# 11 characters only carries 4 bits), Twitch Ids are plain integers, and both are
+# kept in sorted array('Q'), so that each Id costs 8 bytes. Sets can be saved to
+# disk and mmap'ed back, optionally with a Bloom filter to avoid touching the
+# arrays for most negative lookups.
+
+from array import array
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_left
+from heapq import merge
+from os import replace, getpid
+from pathlib import Path
+from typing import Optional, Set, Iterable, Iterator, Union
+import argparse
+import math
+import mmap
+import re
+import struct
+import sys
+import logging
+log = logging.getLogger()
+
+MAGIC = b"YTIDSET1"
+# magic, yt count, twitch count, bloom size in bytes, bloom hash count,
+# size of the text section in bytes
+HEADER = struct.Struct("<8sQQQQQ")
+
+yt_id_re = re.compile(r'^[0-9A-Za-z_-]{10}[AEIMQUYcgkosw048]$')
+twitch_id_re = re.compile(r'^[1-9][0-9]{0,18}$')
+
+MASK64 = (1 << 64) - 1
+
+
+def encode_youtube(video_id: str) -> int:
+  """Decode the 66 bits of a Youtube Id into the 64 bits it actually uses."""
+  return int.from_bytes(urlsafe_b64decode(video_id + "="), "big")
+
+
+def decode_youtube(value: int) -> str:
+  return urlsafe_b64encode(value.to_bytes(8, "big")).decode()[:11]
+
+
+def _sorted_unique(values: Iterable[int]) -> Iterator[int]:
+  last = None
+  for v in values:
+    if v != last:
+      yield v
+      last = v
+
+
+def _mix(value: int) -> int:
+  """splitmix64 finalizer, to spread Ids over the Bloom filter."""
+  value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+  value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & MASK64
+  return value ^ (value >> 31)
+
+
+class BloomFilter():
+  def __init__(self, size: int, hashes: int, data=None) -> None:
+    self.size = max(size, 1)
+    self.hashes = hashes
+    self.bits = data if data is not None else bytearray(self.size)
+
+  @classmethod
+  def for_capacity(cls, capacity: int, error_rate: float = 0.01) -> "BloomFilter":
+    nbits = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    hashes = max(1, round(nbits / max(capacity, 1) * math.log(2)))
+    return cls((nbits + 7) // 8, hashes)
+
+  def _positions(self, value: int) -> Iterator[int]:
+    h = _mix(value)
+    h1, h2 = h & 0xffffffff, h >> 32
+    nbits = self.size * 8
+    for i in range(self.hashes):
+      yield (h1 + i * h2) % nbits
+
+  def add(self, value: int) -> None:
+    for pos in self._positions(value):
+      self.bits[pos >> 3] |= 1 << (pos & 7)
+
+  def __contains__(self, value: int) -> bool:
+    bits = self.bits
+    for pos in self._positions(value):
+      if not bits[pos >> 3] & (1 << (pos & 7)):
+        return False
+    return True
+
+
+class _SortedInts():
+  """
+  Sorted array('Q') of unique integers. Additions are buffered in a small set
+  and merged into the array in batches.
+  """
+  def __init__(self, values=None) -> None:
+    self.values = values if values is not None else array("Q")
+    self.tail: Set[int] = set()
+
+  def add(self, value: int) -> None:
+    self.tail.add(value)
+    if len(self.tail) >= max(65536, len(self.values) // 4):
+      self.compact()
+
+  def compact(self) -> None:
+    if not self.tail:
+      return
+    self.values = array(
+      "Q", _sorted_unique(merge(self.values, sorted(self.tail))))
+    self.tail = set()
+
+  def __contains__(self, value: int) -> bool:
+    if value in self.tail:
+      return True
+    values = self.values
+    i = bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+  def __len__(self) -> int:
+    self.compact()
+    return len(self.values)
+
+  def __iter__(self) -> Iterator[int]:
+    self.compact()
+    return iter(self.values)
+
+
+class IdSet():
+  """
+  Set of videoIds as strings, stored as integers whenever possible. Ids that
+  have neither the Youtube nor the Twitch shape are kept in a regular set.
+  """
+  def __init__(self, ids: Iterable[str] = ()) -> None:
+    self._yt = _SortedInts()
+    self._twitch = _SortedInts()
+    self._other: Set[str] = set()
+    self._bloom: Optional[BloomFilter] = None
+    self._mmap = None
+    self.update(ids)
+
+  @classmethod
+  def from_lines(cls, path: Union[Path, str]) -> "IdSet":
+    """
+    Load a text file with one videoId per line. Comments (#) and the
+    "youtube " prefix are ignored. A saved .idset file is mmap'ed instead.
+    """
+    path = Path(path)
+    if path.suffix == ".idset":
+      return cls.load(path)
+    idset = cls()
+    with open(path, "r") as f:
+      for line in f:
+        line = line.strip()
+        if not line or line.startswith("#"):
+          continue
+        if line.startswith("youtube "):
+          line = line[len("youtube "):].strip()
+        idset.add(line)
+    return idset
+
+  def add(self, video_id: str) -> None:
+    self._bloom = None  # no longer accurate
+    if len(video_id) == 11 and yt_id_re.match(video_id):
+      self._yt.add(encode_youtube(video_id))
+    elif twitch_id_re.match(video_id):
+      self._twitch.add(int(video_id))
+    else:
+      self._other.add(video_id)
+
+  def update(self, ids: Iterable[str]) -> None:
+    for _id in ids:
+      self.add(_id)
+    self._yt.compact()
+    self._twitch.compact()
+
+  def __contains__(self, video_id: str) -> bool:
+    if len(video_id) == 11 and yt_id_re.match(video_id):
+      value = encode_youtube(video_id)
+      if self._bloom is not None and value not in self._bloom:
+        return False
+      return value in self._yt
+    if twitch_id_re.match(video_id):
+      value = int(video_id)
+      if self._bloom is not None and value ^ MASK64 not in self._bloom:
+        return False
+      return value in self._twitch
+    return video_id in self._other
+
+  def __len__(self) -> int:
+    return len(self._yt) + len(self._twitch) + len(self._other)
+
+  def __iter__(self) -> Iterator[str]:
+    for value in self._yt:
+      yield decode_youtube(value)
+    for value in self._twitch:
+      yield str(value)
+    yield from self._other
+
+  def __repr__(self) -> str:
+    return f"<IdSet of {len(self)} Ids>"
+
+  def nbytes(self) -> int:
+    """Approximate memory used by the integer arrays."""
+    return (len(self._yt) + len(self._twitch)) * 8
+
+  def build_bloom(self, error_rate: float = 0.01) -> None:
+    """Build a Bloom filter, checked before the sorted arrays on lookups."""
+    bloom = BloomFilter.for_capacity(
+      len(self._yt) + len(self._twitch), error_rate)
+    for value in self._yt:
+      bloom.add(value)
+    # Twitch values are flipped so as not to collide with small Youtube values
+    for value in self._twitch:
+      bloom.add(value ^ MASK64)
+    self._bloom = bloom
+
+  def save(self, path: Union[Path, str], bloom: bool = False) -> None:
+    """Write to path atomically, in a format that can be mmap'ed back."""
+    path = Path(path)
+    self._yt.compact()
+    self._twitch.compact()
+    if bloom and self._bloom is None:
+      self.build_bloom()
+    other = "\n".join(sorted(self._other)).encode()
+    bloom_bytes = bytes(self._bloom.bits) if self._bloom is not None else b""
+
+    tmp = path.with_name(f"{path.name}.{getpid()}.tmp")
+    with open(tmp, "wb") as f:
+      f.write(HEADER.pack(
+        MAGIC, len(self._yt.values), len(self._twitch.values),
+        len(bloom_bytes), self._bloom.hashes if self._bloom else 0, len(other)))
+      for values in (self._yt.values, self._twitch.values):
+        if sys.byteorder != "little":
+          values = array("Q", values)
+          values.byteswap()
+        values.tofile(f)
+      f.write(bloom_bytes)
+      f.write(other)
+    replace(tmp, path)
+
+  @classmethod
+  def load(cls, path: Union[Path, str], use_mmap: bool = True) -> "IdSet":
+    """
+    Load a set written by save(). With use_mmap, the arrays are not read in
+    memory but paged in from the file on demand.
+    """
+    idset = cls()
+    with open(path, "rb") as f:
+      if use_mmap and sys.byteorder == "little":
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        idset._mmap = buf
+      else:
+        buf = f.read()
+
+    magic, n_yt, n_twitch, n_bloom, hashes, n_other = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+      raise Exception(f"{path} is not a videoId set file.")
+
+    view = memoryview(buf)
+    offset = HEADER.size
+    arrays = []
+    for count in (n_yt, n_twitch):
+      chunk = view[offset:offset + count * 8]
+      if idset._mmap is not None:
+        arrays.append(chunk.cast("Q"))
+      else:
+        values = array("Q", bytes(chunk))
+        if sys.byteorder != "little":
+          values.byteswap()
+        arrays.append(values)
+      offset += count * 8
+    idset._yt = _SortedInts(arrays[0])
+    idset._twitch = _SortedInts(arrays[1])
+
+    if n_bloom:
+      idset._bloom = BloomFilter(n_bloom, hashes, view[offset:offset + n_bloom])
+      offset += n_bloom
+    if n_other:
+      idset._other = set(bytes(view[offset:offset + n_other]).decode().split("\n"))
+    return idset
+
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Convert lists of videoIds into a compact .idset file.')
+  parser.add_argument(
+    '--bloom', action="store_true", default=False,
+    help='Store a Bloom filter to speed up negative lookups.')
+  parser.add_argument('output', metavar='OUTPUT', type=str)
+  parser.add_argument('inputs', metavar='LIST', type=str, nargs='+')
+  return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+  pargs = parse_args(args)
+  idset = IdSet()
+  for f in pargs.inputs:
+    idset.update(IdSet.from_lines(f))
+  idset.save(pargs.output, bloom=pargs.bloom)
+  print(f"Written {len(idset)} Ids to {pargs.output}.")
+  return 0
+
+
+if __name__ == "__main__":
+  exit(main())
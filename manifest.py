@@ -0,0 +1,206 @@
+"""
+NDJSON manifests of the videoIds found on disk, so that scanning and
+downloading can run on different hosts:
+
+  subs.py --mode scan /target | ssh dl-host subs.py --mode download -
+
+Each line is a record {"service", "id", "media_paths", "sub_paths"} for the
+files of one directory. Records are written as soon as a directory has been
+scanned, so the consumer can start before the scan is over, and neither side
+keeps more than one directory's worth of records in memory.
+
+Plain text lists of videoIds (as written by playboard.py or find_if_id.py)
+are read as manifests too, one Id per line, optionally prefixed with its
+service ("youtube zp0sfEVWH9A").
+"""
+from os import walk, sep, listdir
+from pathlib import Path
+from typing import (
+  Optional, List, Dict, Tuple, Generator, Iterable, NamedTuple, TextIO
+)
+import json
+import re
+import sys
+import time
+from regex import BaseScanner, TwitchScanner, YoutubeScanner
+from chatpack import PACK_NAME, pack_members
+from state import YOUTUBE, TWITCH, guess_service
+from metrics import REGISTRY
+import logging
+log = logging.getLogger()
+
+# HACK Twitch must come first, the Youtube regex is greedier and would return
+# too many false positives
+SCANNERS = {
+  TWITCH: TwitchScanner,
+  YOUTUBE: YoutubeScanner,
+}
+
+# Youtube videoIds are 11 base64url characters, Twitch ones are 10 digits
+id_shapes = {
+  YOUTUBE: re.compile(r'^[0-9A-Za-z_-]{11}$'),
+  TWITCH: re.compile(r'^v?(\d{10})$'),
+}
+
+files_scanned = REGISTRY.counter(
+  "subs_files_scanned_total", "Files looked at while walking the supplied path.")
+classify_seconds = REGISTRY.counter(
+  "subs_classify_seconds_total", "Time spent matching file names against the scanners.")
+matches = REGISTRY.counter(
+  "subs_matches_total", "Files in which a videoId was found, per service.")
+
+
+class ManifestRecord(NamedTuple):
+  service: str
+  id: str
+  media_paths: List[str]
+  sub_paths: List[str]
+
+  def to_json(self) -> str:
+    return json.dumps(self._asdict(), ensure_ascii=False)
+
+  @classmethod
+  def from_dict(cls, d: Dict) -> "ManifestRecord":
+    return cls(
+      d.get("service") or guess_service(d["id"]),
+      d["id"],
+      list(d.get("media_paths") or ()),
+      list(d.get("sub_paths") or ())
+    )
+
+
+def scan(
+  path: Path,
+  filter_re: Optional[re.Pattern] = None,
+  services: Iterable[str] = (TWITCH, YOUTUBE)
+) -> Generator[ManifestRecord, None, None]:
+  """
+  Walk path and yield the records of each directory once it has been fully
+  listed, with absolute paths. Directories whose path matches filter_re are
+  skipped.
+  """
+  path = Path(path).absolute()
+  scanners: List[Tuple[str, BaseScanner]] = [
+    (service, SCANNERS[service]()) for service in SCANNERS if service in services
+  ]
+  for root, _, files in walk(path):
+    if filter_re is not None and filter_re.match(root + sep):
+      continue
+    yield from _classify(root, files, scanners)
+
+
+def _classify(
+  root: str, files: List[str], scanners: List[Tuple[str, BaseScanner]]
+) -> Generator[ManifestRecord, None, None]:
+  """
+  Records of the files of the directory root. The chats held by its pack
+  count as subs files, named after the pack: root/chats.pack/name.
+  """
+  start = time.perf_counter()
+  for f in files:
+    if f == PACK_NAME:
+      _add_pack(root, scanners)
+      continue
+    for service, scanner in scanners:
+      if scanner.match(root, f):
+        log.debug("%s videoId found in %s.", service, f)
+        matches.inc(service=service)
+        break
+  classify_seconds.inc(time.perf_counter() - start)
+  files_scanned.inc(len(files))
+
+  for service, scanner in scanners:
+    for _id, (media, subs) in scanner.store.items():
+      yield ManifestRecord(
+        service, _id, [str(p) for p in media], [str(p) for p in subs])
+    scanner.store.clear()
+
+
+def _add_pack(root: str, scanners: List[Tuple[str, BaseScanner]]) -> None:
+  by_service = dict(scanners)
+  for member in pack_members(root):
+    if (scanner := by_service.get(member.service)) is not None:
+      scanner.store[member.id][1].append(Path(root) / PACK_NAME / member.name)
+
+
+def existing_subs(
+  directory: Path, services: Iterable[str] = (TWITCH, YOUTUBE)
+) -> Generator[Tuple[str, str], None, None]:
+  """
+  (service, videoId) of the subs files directly in directory, where the
+  subs of Ids read from a list are downloaded.
+  """
+  directory = Path(directory).absolute()
+  try:
+    files = listdir(directory)
+  except OSError as e:
+    log.warning(f"Cannot list {directory}: {e}")
+    return
+  scanners = [
+    (service, SCANNERS[service]()) for service in SCANNERS if service in services
+  ]
+  for record in _classify(str(directory), files, scanners):
+    if record.sub_paths:
+      yield record.service, record.id
+
+
+def parse_id_line(line: str) -> Optional[Tuple[str, str]]:
+  """
+  (service, videoId) of a line of a text list, or None for blank lines and
+  comments. The service is guessed from the shape of the Id, unless the line
+  starts with it. Raise ValueError for Ids of neither shape.
+  """
+  line = line.split("#", 1)[0].strip()
+  if not line:
+    return None
+  service, _, _id = line.partition(" ")
+  if service.lower() in id_shapes:
+    service, _id = service.lower(), _id.strip()
+  else:
+    service, _id = guess_service(line), line
+  if (match := id_shapes[service].match(_id)) is None:
+    raise ValueError(f"\"{_id}\" is not a {service} videoId")
+  # Twitch Ids may be written as "v1271243650"
+  return service, match.group(1) if match.groups() else _id
+
+
+def write_manifest(records: Iterable[ManifestRecord], out: TextIO) -> int:
+  """Write records as NDJSON, flushing each line for readers on a pipe."""
+  count = 0
+  for record in records:
+    out.write(record.to_json() + "\n")
+    out.flush()
+    count += 1
+  return count
+
+
+def read_manifest(source: TextIO) -> Generator[ManifestRecord, None, None]:
+  """
+  Read records from an NDJSON manifest. Plain text lists of videoIds (one per
+  line, as accepted by previous versions) are read too: their Ids have no
+  known file, and their service is guessed from their shape.
+  """
+  for num, line in enumerate(source, 1):
+    line = line.strip()
+    if not line or line.startswith("#"):
+      continue
+    if line.startswith("{"):
+      try:
+        yield ManifestRecord.from_dict(json.loads(line))
+      except (ValueError, KeyError) as e:
+        log.warning(f"Invalid manifest record at line {num}: {e}")
+      continue
+    try:
+      parsed = parse_id_line(line)
+    except ValueError as e:
+      log.warning(f"Invalid videoId at line {num}: {e}")
+      continue
+    if parsed is not None:
+      yield ManifestRecord(*parsed, [], [])
+
+
+def open_manifest(path: str) -> TextIO:
+  """Open a manifest, or stdin if path is "-"."""
+  if path == "-":
+    return sys.stdin
+  return open(Path(path), "r", encoding="utf-8")
@@ -0,0 +1,308 @@
+#!/bin/env python3
+#
+# Cache of what was learned about each Youtube video (availability, live
+# status, whether it has a live chat replay, upload date, uploader), so that
+# reruns do not extract the same pages again. Entries expire after a TTL, and
+# the least recently used ones are evicted past max_entries. The info JSON
+# written by yt-dlp can be kept alongside, to be fed back with --load-info-json.
+
+from os import scandir
+from pathlib import Path
+from typing import Optional, Dict, List, NamedTuple, Union, Any
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from downloader.errors import NotAvailableAnymore, NeedCookies, NoSubsAvailable
+import logging
+log = logging.getLogger()
+
+DAY = 24 * 3600
+# Format URLs in an info JSON expire after about 6 hours
+INFO_TTL = 5 * 3600
+
+# Values of the "availability" field of yt-dlp, plus our own "unavailable"
+UNAVAILABLE = ("private", "unavailable")
+NEEDS_AUTH = ("needs_auth", "subscriber_only", "premium_only")
+# A chat replay may still appear for these
+LIVE = ("is_live", "is_upcoming", "post_live")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+  video_id TEXT PRIMARY KEY,
+  availability TEXT,
+  live_status TEXT,
+  has_chat INTEGER,
+  upload_date TEXT,
+  uploader TEXT,
+  title TEXT,
+  info_path TEXT,
+  fetched_at REAL NOT NULL,
+  used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS videos_used ON videos (used_at);
+"""
+
+
+class VideoMeta(NamedTuple):
+  video_id: str
+  availability: Optional[str] = None
+  live_status: Optional[str] = None
+  # None when unknown
+  has_chat: Optional[bool] = None
+  upload_date: Optional[str] = None
+  uploader: Optional[str] = None
+  title: Optional[str] = None
+  # Info JSON written by yt-dlp, if kept
+  info_path: Optional[str] = None
+  fetched_at: float = 0.0
+
+  def skip_reason(self, has_cookies: bool = False) -> Optional[Exception]:
+    """The error a download of the chat would end with, if it is known."""
+    if self.availability in UNAVAILABLE:
+      return NotAvailableAnymore(f"Video is {self.availability} (cached)")
+    if self.availability in NEEDS_AUTH and not has_cookies:
+      return NeedCookies("Member-only content. Valid cookies are required. (cached)")
+    if self.has_chat is False and self.live_status not in LIVE:
+      return NoSubsAvailable("No live chat replay (cached)")
+    return None
+
+
+def slim_info(info: Dict[str, Any]) -> VideoMeta:
+  """Keep what matters to us of an info JSON written by yt-dlp."""
+  return VideoMeta(
+    video_id=info["id"],
+    availability=info.get("availability"),
+    live_status=info.get("live_status"),
+    has_chat="live_chat" in (info.get("subtitles") or {}),
+    upload_date=info.get("upload_date"),
+    uploader=info.get("uploader"),
+    title=info.get("title"),
+  )
+
+
+def meta_from_error(video_id: str, error: Exception) -> Optional[VideoMeta]:
+  """What a failed download tells about a video, if anything."""
+  if isinstance(error, NotAvailableAnymore):
+    return VideoMeta(video_id, availability="unavailable")
+  if isinstance(error, NeedCookies):
+    return VideoMeta(video_id, availability="needs_auth")
+  if isinstance(error, NoSubsAvailable):
+    return VideoMeta(video_id, has_chat=False)
+  return None
+
+
+class MetadataCache():
+  """
+  Safe to share between download threads. Info JSON files live in info_dir,
+  named after their videoId, and are removed along with their entry, or as
+  soon as they are too old to be reused (INFO_TTL).
+  """
+  def __init__(
+    self,
+    path: Union[Path, str],
+    ttl: float = 7 * DAY,
+    max_entries: int = 100_000,
+    info_dir: Union[Path, str, None] = None
+  ) -> None:
+    self.path = Path(path)
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.info_dir = Path(info_dir) if info_dir is not None else \
+      self.path.with_name(self.path.name + ".info")
+    self.info_dir.mkdir(parents=True, exist_ok=True)
+    self._lock = threading.RLock()
+    self._puts = 0
+    self.hits = 0
+    self.misses = 0
+
+    self.db = sqlite3.connect(
+      str(self.path), timeout=30, check_same_thread=False, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.executescript(SCHEMA)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.close()
+
+  def get(self, video_id: str) -> Optional[VideoMeta]:
+    """Return the entry of video_id, unless missing or expired."""
+    now = time.time()
+    with self._lock:
+      cur = self.db.execute(
+        "SELECT * FROM videos WHERE video_id = ? AND fetched_at >= ?",
+        (video_id, now - self.ttl))
+      row = cur.fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.db.execute(
+        "UPDATE videos SET used_at = ? WHERE video_id = ?", (now, video_id))
+    entry = dict(zip((c[0] for c in cur.description), row))
+    entry.pop("used_at")
+    if entry["has_chat"] is not None:
+      entry["has_chat"] = bool(entry["has_chat"])
+    return VideoMeta(**entry)
+
+  def put(self, meta: VideoMeta) -> None:
+    """
+    Store meta. Fields left to None keep what was known, so that an error
+    does not erase the details of an earlier extraction.
+    """
+    now = time.time()
+    has_chat = None if meta.has_chat is None else int(meta.has_chat)
+    with self._lock:
+      self.db.execute(
+        """
+        INSERT INTO videos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (video_id) DO UPDATE SET
+          availability = COALESCE(excluded.availability, availability),
+          live_status = COALESCE(excluded.live_status, live_status),
+          has_chat = COALESCE(excluded.has_chat, has_chat),
+          upload_date = COALESCE(excluded.upload_date, upload_date),
+          uploader = COALESCE(excluded.uploader, uploader),
+          title = COALESCE(excluded.title, title),
+          info_path = COALESCE(excluded.info_path, info_path),
+          fetched_at = excluded.fetched_at,
+          used_at = excluded.used_at
+        """,
+        (meta.video_id, meta.availability, meta.live_status, has_chat,
+         meta.upload_date, meta.uploader, meta.title, meta.info_path, now, now))
+      self._puts += 1
+      if self._puts % 256 == 0:
+        self.evict()
+
+  def info_path(self, video_id: str) -> Path:
+    """Where yt-dlp is asked to write the info JSON of video_id."""
+    return self.info_dir / f"{video_id}.info.json"
+
+  def load_info(self, video_id: str) -> Optional[Path]:
+    """
+    The info JSON kept for video_id, if it is recent enough for yt-dlp to
+    reuse its URLs.
+    """
+    path = self.info_path(video_id)
+    try:
+      if time.time() - path.stat().st_mtime < INFO_TTL:
+        return path
+    except OSError:
+      pass
+    return None
+
+  def put_info(self, video_id: str) -> Optional[VideoMeta]:
+    """Cache the details of the info JSON yt-dlp wrote for video_id."""
+    path = self.info_path(video_id)
+    try:
+      with open(path, "r", encoding="utf-8") as f:
+        info = json.load(f)
+    except (OSError, ValueError) as e:
+      log.debug(f"No usable info JSON for {video_id}: {e}")
+      return None
+    meta = slim_info(info)._replace(info_path=str(path))
+    self.put(meta)
+    return meta
+
+  def put_error(self, video_id: str, error: Exception) -> None:
+    if (meta := meta_from_error(video_id, error)) is not None:
+      self.put(meta)
+
+  def evict(self) -> int:
+    """
+    Remove expired entries, then the least recently used ones past
+    max_entries, and info JSON files older than INFO_TTL. Return the number
+    of entries removed.
+    """
+    stale = self._stale_info()
+    with self._lock:
+      rows = self.db.execute(
+        """
+        SELECT video_id, info_path FROM videos WHERE fetched_at < ?
+        UNION
+        SELECT video_id, info_path FROM (
+          SELECT video_id, info_path FROM videos
+          ORDER BY used_at DESC LIMIT -1 OFFSET ?)
+        """,
+        (time.time() - self.ttl, self.max_entries)).fetchall()
+      if not rows and not stale:
+        return 0
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        self.db.executemany(
+          "DELETE FROM videos WHERE video_id = ?", ((r[0],) for r in rows))
+        self.db.executemany(
+          "UPDATE videos SET info_path = NULL WHERE info_path = ?",
+          ((str(path),) for path in stale))
+        self.db.execute("COMMIT")
+      except Exception:
+        if self.db.in_transaction:
+          self.db.execute("ROLLBACK")
+        raise
+    for path in stale + [Path(r[1]) for r in rows if r[1]]:
+      path.unlink(missing_ok=True)
+    if rows:
+      log.info(f"Evicted {len(rows)} entries from {self.path}.")
+    if stale:
+      log.info(f"Removed {len(stale)} expired info JSON files from {self.info_dir}.")
+    return len(rows)
+
+  def _stale_info(self) -> List[Path]:
+    """Info JSON files too old for yt-dlp to reuse their URLs."""
+    limit = time.time() - INFO_TTL
+    stale = []
+    try:
+      with scandir(self.info_dir) as entries:
+        for entry in entries:
+          try:
+            if entry.name.endswith(".info.json") and entry.stat().st_mtime < limit:
+              stale.append(Path(entry.path))
+          except OSError:
+            continue
+    except OSError:
+      pass
+    return stale
+
+  def __len__(self) -> int:
+    with self._lock:
+      return self.db.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+
+  def close(self) -> None:
+    with self._lock:
+      if self.db is None:
+        return
+      self.evict()
+      self.db.close()
+      self.db = None
+
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Inspect or trim the video metadata cache.')
+  parser.add_argument(
+    '--db', metavar='DB', type=str, default="video_metadata.db",
+    help='Path to the metadata cache.')
+  sub = parser.add_subparsers(dest="command", required=True)
+  show = sub.add_parser("show", help='Print the cached entries of videoIds.')
+  show.add_argument('ids', metavar='ID', nargs='+')
+  sub.add_parser("evict", help='Remove expired entries now.')
+  return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+  pargs = parse_args(args)
+  with MetadataCache(pargs.db) as cache:
+    if pargs.command == "show":
+      for _id in pargs.ids:
+        meta = cache.get(_id)
+        print(json.dumps(meta._asdict() if meta else {"video_id": _id}))
+    elif pargs.command == "evict":
+      print(f"Evicted {cache.evict()} entries, {len(cache)} left.")
+  return 0
+
+
+if __name__ == "__main__":
+  exit(main())
@@ -0,0 +1,248 @@
+"""
+Counters, gauges and histograms describing a run, exported as a Prometheus
+textfile (for node_exporter's textfile collector) and as a JSON run summary.
+"""
+from contextlib import contextmanager
+from os import replace, getpid
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, Any, Iterable, Union, Generator
+import json
+import math
+import threading
+import time
+import logging
+log = logging.getLogger()
+
+# Seconds, from a fraction of a second up to a couple of hours
+DEFAULT_BUCKETS = (
+  0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+  return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+  pairs = list(key) + ([extra] if extra else [])
+  if not pairs:
+    return ""
+  return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+  if math.isinf(value):
+    return "+Inf" if value > 0 else "-Inf"
+  if float(value).is_integer():
+    return str(int(value))
+  return repr(float(value))
+
+
+class Metric():
+  type = ""
+
+  def __init__(self, name: str, help: str) -> None:
+    self.name = name
+    self.help = help
+    self._lock = threading.Lock()
+
+  def prometheus_lines(self) -> List[str]:
+    raise NotImplementedError()
+
+  def to_dict(self) -> Dict:
+    raise NotImplementedError()
+
+
+class Counter(Metric):
+  type = "counter"
+
+  def __init__(self, name: str, help: str) -> None:
+    super().__init__(name, help)
+    self.values: Dict[LabelKey, float] = {}
+
+  def inc(self, amount: float = 1, **labels) -> None:
+    key = _label_key(labels)
+    with self._lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def get(self, **labels) -> float:
+    return self.values.get(_label_key(labels), 0)
+
+  def prometheus_lines(self) -> List[str]:
+    return [
+      f"{self.name}{_format_labels(key)} {_format_value(value)}"
+      for key, value in sorted(self.values.items())
+    ]
+
+  def to_dict(self) -> Dict:
+    return {
+      "type": self.type,
+      "help": self.help,
+      "values": [
+        {"labels": dict(key), "value": value}
+        for key, value in sorted(self.values.items())
+      ]
+    }
+
+
+class Gauge(Counter):
+  type = "gauge"
+
+  def set(self, value: float, **labels) -> None:
+    with self._lock:
+      self.values[_label_key(labels)] = value
+
+
+class Histogram(Metric):
+  type = "histogram"
+
+  def __init__(
+    self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS
+  ) -> None:
+    super().__init__(name, help)
+    self.buckets = tuple(sorted(buckets)) + (math.inf,)
+    # Per label set: [bucket counts...], sum, count
+    self.values: Dict[LabelKey, List] = {}
+
+  def observe(self, value: float, **labels) -> None:
+    key = _label_key(labels)
+    with self._lock:
+      entry = self.values.get(key)
+      if entry is None:
+        entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          entry[0][i] += 1
+      entry[1] += value
+      entry[2] += 1
+
+  @contextmanager
+  def time(self, **labels) -> Generator[None, None, None]:
+    """Observe the wall time spent in the with block."""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start, **labels)
+
+  def prometheus_lines(self) -> List[str]:
+    lines = []
+    for key, (counts, total, count) in sorted(self.values.items()):
+      for bound, bucket_count in zip(self.buckets, counts):
+        lines.append(
+          f"{self.name}_bucket{_format_labels(key, ('le', _format_value(bound)))} "
+          f"{bucket_count}")
+      lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+      lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+    return lines
+
+  def to_dict(self) -> Dict:
+    return {
+      "type": self.type,
+      "help": self.help,
+      "values": [
+        {
+          "labels": dict(key),
+          "count": count,
+          "sum": total,
+          "mean": total / count if count else None,
+          "buckets": {
+            _format_value(bound): c for bound, c in zip(self.buckets, counts)
+          }
+        }
+        for key, (counts, total, count) in sorted(self.values.items())
+      ]
+    }
+
+
+class Registry():
+  def __init__(self, prefix: str = "") -> None:
+    self.prefix = prefix
+    self.metrics: Dict[str, Metric] = {}
+    self.started = time.time()
+    self._lock = threading.Lock()
+
+  def _get(self, cls, name: str, help: str, **kwargs) -> Any:
+    name = self.prefix + name
+    with self._lock:
+      metric = self.metrics.get(name)
+      if metric is None:
+        metric = self.metrics[name] = cls(name, help, **kwargs)
+      elif not isinstance(metric, cls):
+        raise Exception(f"Metric {name} is already registered as a {metric.type}.")
+      return metric
+
+  def counter(self, name: str, help: str = "") -> Counter:
+    return self._get(Counter, name, help)
+
+  def gauge(self, name: str, help: str = "") -> Gauge:
+    return self._get(Gauge, name, help)
+
+  def histogram(
+    self, name: str, help: str = "", buckets: Iterable[float] = DEFAULT_BUCKETS
+  ) -> Histogram:
+    return self._get(Histogram, name, help, buckets=buckets)
+
+  @contextmanager
+  def phase(self, name: str) -> Generator[None, None, None]:
+    """Accumulate the wall time spent in each phase of a run."""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.counter(
+        "phase_seconds_total", "Wall time spent in each phase of the run."
+      ).inc(time.perf_counter() - start, phase=name)
+
+  def to_prometheus(self) -> str:
+    lines = []
+    for metric in self.metrics.values():
+      if not metric.values:
+        continue
+      if metric.help:
+        lines.append(f"# HELP {metric.name} {_escape(metric.help)}")
+      lines.append(f"# TYPE {metric.name} {metric.type}")
+      lines.extend(metric.prometheus_lines())
+    return "\n".join(lines) + "\n"
+
+  def to_json(self, **extra) -> Dict:
+    summary = {
+      "started_at": self.started,
+      "duration_seconds": time.time() - self.started,
+    }
+    summary.update(extra)
+    summary["metrics"] = {
+      name: metric.to_dict() for name, metric in self.metrics.items()
+      if metric.values
+    }
+    return summary
+
+  def _write(self, path: Path, content: str) -> None:
+    # The textfile collector may read at any time, never expose partial files
+    tmp = path.with_name(f"{path.name}.{getpid()}.tmp")
+    with open(tmp, "w") as f:
+      f.write(content)
+    replace(tmp, path)
+
+  def write_textfile(self, path: Union[Path, str]) -> None:
+    self.gauge(
+      "last_run_timestamp_seconds", "Unix time at which the last run ended."
+    ).set(time.time())
+    self.gauge(
+      "last_run_duration_seconds", "Wall time of the last run."
+    ).set(time.time() - self.started)
+    self._write(Path(path), self.to_prometheus())
+    log.info(f"Written Prometheus metrics to {path}.")
+
+  def write_json(self, path: Union[Path, str], **extra) -> None:
+    self._write(Path(path), json.dumps(self.to_json(**extra), indent=1) + "\n")
+    log.info(f"Written run summary to {path}.")
+
+
+# Shared by all modules of a run
+REGISTRY = Registry(prefix="ytdl_batch_")
@@ -9,15 +9,16 @@
 # use yt-dlp to generate archive.txt without downloading for example:
 # --flat-playlist Do not extract the videos of a playlist, only list them
 
-from sys import argv
-from typing import List, Mapping
-from urllib.request import Request, urlopen
+from typing import List, Mapping, Optional, Dict, Generator, Iterable, Tuple, Callable, Any
 from urllib.parse import urlencode, quote, urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import replace, getpid
+from pathlib import Path
+import argparse
 import json
-import gzip
-from io import BytesIO
 import logging
 from datetime import datetime, date
+from downloader.session import HTTPSession
 log = logging.getLogger(__name__)
 logging.basicConfig()
 # log.setLevel(logging.DEBUG)
@@ -30,9 +31,9 @@ ENDPOINT = f"{BASE_URL}{PATH}/{TYPE}"
 HEADERS = {
   "origin": "https://playboard.co",
   "referer": "https://playboard.co/",
-  "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.102 Safari/537.36"
-  "accept" "application/json, text/plain, */*",
-  "accept-encoding": "gzip, deflate, br",
+  "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.102 Safari/537.36",
+  "accept": "application/json, text/plain, */*",
+  # accept-encoding is set by HTTPSession, depending on available decoders
   "accept-language": "en,en-US",
   "content-type": "application/json"
 }
@@ -47,70 +48,238 @@ def req(url, params, headers=None, method="POST", data=None):
   return res.json()
 
 
-def do_request(url, headers=None, method="POST", data=None):
-  headers = HEADERS if headers is None else headers
-  req = Request(
-    url,
-    headers=HEADERS,
-    data=data,
-    method=method
-  )
-  log.debug(f"req: {req.full_url} {req.headers}")
-  with urlopen(req) as res:
-    if res.headers.get("content-encoding") == "gzip":
-      content = gzip.decompress(res.read())
-      return json.load(BytesIO(content))
+class PlayboardClient():
+  """
+  Fetch video lists from the Playboard API over persistent connections.
+  At most max_channels channels are fetched at the same time.
+  """
+  def __init__(
+    self,
+    endpoint: str = ENDPOINT,
+    session: Optional[HTTPSession] = None,
+    max_channels: int = 4
+  ) -> None:
+    self.endpoint = endpoint
+    self.session = session or HTTPSession(
+      headers=HEADERS, max_per_host=max_channels)
+    self.max_channels = max_channels
+
+  def get_page(self, params: Dict) -> Dict:
+    url = self.endpoint + (
+      ('&' if urlparse(self.endpoint).query else '?')
+      + urlencode(params, quote_via=quote))
+    log.debug(f"req: {url}")
+    with self.session.post(url) as res:
+      return res.json()
+
+  def iter_pages(self, channel_id: str) -> Generator[List[Dict], None, None]:
+    """
+    Generator of pages of video mappings from Playboard, most recent first.
+    The next page is only requested once the previous one has been consumed.
+    """
+    has_next = True
+    cursor = None
+    params = {
+      "channelId": channel_id,
+      "sortTypeId": "10",
+    }
+
+    while has_next:
+      if cursor is not None:
+        params.update({"cursor": cursor})
+
+      _json = self.get_page(params)
+
+      has_next = _json.get("hasNext")
+      cursor = _json.get("cursor")
 
-    content = str(res.read().decode())
-    log.debug(f"data: {content}")
-    return json.loads(content)
+      yield _json.get("list") or []
+
+  def get_videos_for_channel(self, channel_id: str) -> Generator[Dict, None, None]:
+    """
+    Generator of video mappings from Playboard.
+    """
+    for page in self.iter_pages(channel_id):
+      yield from page
+
+  def sync_channel(
+    self, snapshot: "ChannelSnapshot", full: bool = False
+  ) -> "SyncDelta":
+    """
+    Update snapshot with the latest videos of its channel. Unless full is
+    set, paging stops at the first page that holds only known, unchanged
+    videos: older pages are assumed to be unchanged as well.
+    """
+    delta = SyncDelta()
+    for page in self.iter_pages(snapshot.channel_id):
+      delta.pages += 1
+      changed = False
+      for vid in page:
+        change = snapshot.merge(vid)
+        if change is None:
+          continue
+        changed = True
+        if change == "new":
+          delta.new.append(vid["videoId"])
+        if vid.get("status") == 2 and change in ("new", "deleted"):
+          delta.newly_deleted.append(vid["videoId"])
+      if not changed and not full and not snapshot.was_empty:
+        log.info(
+          f"Page {delta.pages} of {snapshot.channel_id} is unchanged, "
+          "stopping there.")
+        break
+    return delta
+
+  def _for_channels(
+    self, func: Callable[[str], Any], channel_ids: Iterable[str]
+  ) -> Generator[Tuple[str, Any, Optional[Exception]], None, None]:
+    with ThreadPoolExecutor(max_workers=self.max_channels) as pool:
+      futures = {
+        pool.submit(func, channel_id): channel_id for channel_id in channel_ids
+      }
+      for future in as_completed(futures):
+        channel_id = futures[future]
+        try:
+          yield channel_id, future.result(), None
+        except Exception as e:
+          log.exception(e)
+          yield channel_id, None, e
+
+  def fetch_channels(
+    self, channel_ids: Iterable[str]
+  ) -> Generator[Tuple[str, List[Dict], Optional[Exception]], None, None]:
+    """
+    Fetch the complete list of videos of each channel concurrently. Yield
+    (channel_id, videos, error) as soon as a channel is complete.
+    """
+    for channel_id, videos, error in self._for_channels(
+      lambda c: list(self.get_videos_for_channel(c)), channel_ids):
+      yield channel_id, videos or [], error
+
+  def sync_channels(
+    self, channel_ids: Iterable[str], snapshot_dir: Path = Path(), full: bool = False
+  ) -> Generator[
+    Tuple[str, Optional["ChannelSnapshot"], Optional["SyncDelta"], Optional[Exception]],
+    None, None]:
+    """
+    Incrementally sync each channel concurrently, saving its snapshot.
+    Yield (channel_id, snapshot, delta, error) as soon as a channel is done.
+    """
+    def sync(channel_id: str):
+      snapshot = ChannelSnapshot.load(channel_id, snapshot_dir)
+      delta = self.sync_channel(snapshot, full=full)
+      snapshot.save()
+      return snapshot, delta
+
+    for channel_id, result, error in self._for_channels(sync, channel_ids):
+      if error is not None:
+        yield channel_id, None, None, error
+      else:
+        yield channel_id, result[0], result[1], None
+
+  def close(self) -> None:
+    self.session.close()
 
 
 def get_videos_for_channel(channel_id: str):
   """
   Generator of video mappings from Playboard.
   """
-  has_next = True
-  cursor = None
-  params = {
-    "channelId": channel_id,
-    "sortTypeId": "10",
-  }
+  client = PlayboardClient()
+  try:
+    yield from client.get_videos_for_channel(channel_id)
+  finally:
+    client.close()
 
-  while has_next:
-    if cursor is not None:
-      params.update({"cursor": cursor})
 
-    url = ENDPOINT + (('&' if urlparse(ENDPOINT).query else '?') + urlencode(params, quote_via=quote))
-    _json = do_request(url=url)
-    # _json = req(url=ENDPOINT, params=urlencode(params, quote_via=quote))
+class ChannelSnapshot():
+  """
+  Every video known for a channel (videoId -> status, publishedAt, title),
+  persisted as JSON between runs.
+  """
+  def __init__(self, channel_id: str, path: Path) -> None:
+    self.channel_id = channel_id
+    self.path = path
+    self.videos: Dict[str, Dict] = {}
+    self.was_empty = True
 
-    has_next = _json.get("hasNext")
-    cursor = _json.get("cursor")
+  @classmethod
+  def load(cls, channel_id: str, directory: Path = Path()) -> "ChannelSnapshot":
+    snapshot = cls(channel_id, directory / f"playboard_snapshot_{channel_id}.json")
+    if snapshot.path.exists():
+      with open(snapshot.path, "r") as f:
+        snapshot.videos = json.load(f).get("videos", {})
+      snapshot.was_empty = not snapshot.videos
+    return snapshot
 
-    for vid in _json.get("list"):
-      yield vid
+  def merge(self, vid: Dict) -> Optional[str]:
+    """
+    Record vid. Return "new" if it was unknown, "deleted" if its status
+    changed to deleted, "changed" for any other status change, else None.
+    """
+    _id = vid["videoId"]
+    entry = {
+      "status": vid.get("status"),
+      "publishedAt": vid.get("publishedAt"),
+      "title": vid.get("title"),
+    }
+    known = self.videos.get(_id)
+    self.videos[_id] = entry
+    if known is None:
+      return "new"
+    if known.get("status") != entry["status"]:
+      return "deleted" if entry["status"] == 2 else "changed"
+    return None
 
+  def ordered(self) -> List[Dict]:
+    """All known videos, most recently published first."""
+    return [
+      dict(videoId=_id, **entry)
+      for _id, entry in sorted(
+        self.videos.items(),
+        key=lambda item: item[1].get("publishedAt") or 0,
+        reverse=True)
+    ]
 
-def generate_lists(channel_id: str):
-  print(f"Finding video Ids in Playboard for channel \"{channel_id=}\":")
+  def save(self) -> None:
+    tmp = self.path.with_name(f"{self.path.name}.{getpid()}.tmp")
+    with open(tmp, "w") as f:
+      json.dump({
+        "channel_id": self.channel_id,
+        "updated_at": int(datetime.now().timestamp()),
+        "videos": self.videos
+      }, f)
+    replace(tmp, self.path)
 
-  pb_videos = []
 
-  for vid in get_videos_for_channel(channel_id):
-    pb_videos.append(vid)
+class SyncDelta():
+  def __init__(self) -> None:
+    self.pages = 0
+    self.new: List[str] = []
+    self.newly_deleted: List[str] = []
 
-    title = vid.get("title")
-    publishedAt = vid.get("publishedAt")
-    if publishedAt is not None and type(publishedAt) is int:
-      publishedAt = date.fromtimestamp(publishedAt)
 
-    print(
-      f"{vid['videoId']}"
-      + ("\t(deleted)" if vid.get("status") == 2 else '')
-      + (f"\tpublished={str(publishedAt)}" if publishedAt is not None else '')
-      + (f"\t{title=}" if title is not None else '')
-    )
+def print_video(vid: Dict) -> None:
+  title = vid.get("title")
+  publishedAt = vid.get("publishedAt")
+  if publishedAt is not None and type(publishedAt) is int:
+    publishedAt = date.fromtimestamp(publishedAt)
+
+  print(
+    f"{vid['videoId']}"
+    + ("\t(deleted)" if vid.get("status") == 2 else '')
+    + (f"\tpublished={str(publishedAt)}" if publishedAt is not None else '')
+    + (f"\t{title=}" if title is not None else '')
+  )
+
+
+def write_lists(
+  channel_id: str, pb_videos: List[Dict], delta: Optional[SyncDelta] = None
+) -> None:
+  if delta is None:
+    print(f"Found video Ids in Playboard for channel \"{channel_id=}\":")
+    for vid in pb_videos:
+      print_video(vid)
 
   # "2" seems to indicate removed?, "1" and "3" appear to be the same?
   possibly_removed = [v["videoId"] for v in pb_videos if v["status"] == 2]
@@ -132,6 +301,90 @@ def generate_lists(channel_id: str):
       for _id in possibly_removed:
         f.write(_id + "\n")
 
+  if delta is None:
+    return
+
+  # Only what changed since the previous run
+  for name, ids in (("new", delta.new), ("newly_deleted", delta.newly_deleted)):
+    if not ids:
+      continue
+    with open(f"playboard_ids_{channel_id}_{name}_{date_fmt}.txt", "w") as f:
+      for _id in ids:
+        f.write(_id + "\n")
+
+
+def generate_lists(
+  *channel_ids: str,
+  client: Optional[PlayboardClient] = None,
+  snapshot_dir: Path = Path(),
+  full: bool = False
+) -> int:
+  """
+  Sync all given channels concurrently and write their lists. Return the
+  number of channels that could not be fetched.
+  """
+  _client = client or PlayboardClient()
+  failed = 0
+  try:
+    for channel_id, snapshot, delta, error in _client.sync_channels(
+      channel_ids, snapshot_dir=snapshot_dir, full=full):
+      if error is not None:
+        print(f"Failed fetching channel \"{channel_id}\": {error}")
+        failed += 1
+        continue
+      print(
+        f"Channel \"{channel_id}\": fetched {delta.pages} pages, "
+        f"{len(delta.new)} new videos, {len(delta.newly_deleted)} newly deleted.")
+      for _id in delta.new:
+        print_video(dict(videoId=_id, **snapshot.videos[_id]))
+      for _id in delta.newly_deleted:
+        if _id not in delta.new:
+          print_video(dict(videoId=_id, **snapshot.videos[_id]))
+      write_lists(channel_id, snapshot.ordered(), delta=delta)
+  finally:
+    if client is None:
+      _client.close()
+  return failed
+
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Generate lists of videoIds from Playboard for each channel.')
+  parser.add_argument(
+    '--jobs', metavar='N', type=int, default=4,
+    help='Maximum number of channels fetched at the same time.')
+  parser.add_argument(
+    '--retries', metavar='N', type=int, default=3,
+    help='Number of retries for each failed request.')
+  parser.add_argument(
+    '--full', action="store_true", default=False,
+    help='Page through the entire history of each channel, instead of stopping '
+      'at the first page without any change.')
+  parser.add_argument(
+    '--snapshot-dir', metavar='DIR', type=str, default=".",
+    help='Directory holding the playboard_snapshot_*.json files.')
+  parser.add_argument(
+    'channel_ids', metavar='CHANNEL_ID', type=str, nargs='+')
+  return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+  pargs = parse_args(args)
+  client = PlayboardClient(
+    session=HTTPSession(
+      headers=HEADERS, max_per_host=pargs.jobs, retries=pargs.retries),
+    max_channels=pargs.jobs
+  )
+  try:
+    return 1 if generate_lists(
+      *pargs.channel_ids,
+      client=client,
+      snapshot_dir=Path(pargs.snapshot_dir),
+      full=pargs.full
+    ) else 0
+  finally:
+    client.close()
+
 
 if __name__ == "__main__":
-  generate_lists(argv[1])
+  exit(main())
@@ -0,0 +1,270 @@
+"""
+Profile the phases of a run (scan, download, compress..., and plan in the
+scripts that have one).
+
+Code wraps its phases with `with phase("scan"):`. Hooks registered with
+add_phase_hook() are entered around every phase; the metrics registry and the
+Profiler below are such hooks. When nothing is registered, phase() costs
+next to nothing. The profilers themselves are only imported by Profiler.
+"""
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+from typing import Optional, List, Callable, ContextManager, Generator, Dict, Any
+import threading
+import time
+import logging
+log = logging.getLogger()
+
+PhaseHook = Callable[[str], ContextManager]
+
+_hooks: List[PhaseHook] = []
+
+
+def add_phase_hook(hook: PhaseHook) -> None:
+  if hook not in _hooks:
+    _hooks.append(hook)
+
+
+def remove_phase_hook(hook: PhaseHook) -> None:
+  if hook in _hooks:
+    _hooks.remove(hook)
+
+
+@contextmanager
+def phase(name: str) -> Generator[None, None, None]:
+  if not _hooks:
+    yield
+    return
+  with ExitStack() as stack:
+    for hook in list(_hooks):
+      stack.enter_context(hook(name))
+    yield
+
+
+def sampling_available() -> bool:
+  try:
+    import pyinstrument  # noqa: F401
+  except ImportError:
+    return False
+  return True
+
+
+class Profiler():
+  """
+  Profile each phase separately, with cProfile or with the pyinstrument
+  sampling profiler, and diff tracemalloc snapshots taken at the phase
+  boundaries. Reports are written in output_dir as
+  {prefix}.{phase}.pstats (or .txt for pyinstrument) and
+  {prefix}.{phase}.alloc.txt, plus a {prefix}.summary.txt for the whole run.
+
+  Phases nested in a phase already being profiled on the same thread are part
+  of the outer profile. A phase entered on another thread while a phase is
+  being profiled (the scan thread, the pool of download jobs) is profiled on
+  that thread as well, with cProfile only: all its runs, on all threads, are
+  merged in a single {prefix}.{phase}.threads.pstats, without allocation
+  report, and its seconds in the summary add up the time of each thread.
+  From Python 3.12 on, the outer cProfile already sees every thread.
+  """
+  def __init__(
+    self,
+    output_dir: Path,
+    prefix: str,
+    kind: str = "auto",
+    top: int = 30,
+    trace_frames: int = 1
+  ) -> None:
+    if kind == "auto":
+      kind = "sampling" if sampling_available() else "cprofile"
+    if kind == "sampling" and not sampling_available():
+      log.warning("pyinstrument is not installed, falling back to cProfile.")
+      kind = "cprofile"
+    self.kind = kind
+    self.output_dir = Path(output_dir)
+    self.prefix = prefix + "." + time.strftime("%Y%m%d-%H%M%S")
+    self.top = top
+    self.trace_frames = trace_frames
+    self.reports: List[Path] = []
+    # phase name -> (wall time, allocated bytes at the end, peak bytes)
+    self.phases: Dict[str, List[float]] = {}
+    self._lock = threading.Lock()
+    # thread ident -> phase profiled on that thread
+    self._active: Dict[int, str] = {}
+    self._runs: Dict[str, int] = {}
+    # phase name -> one cProfile per thread, for phases run on other threads
+    self._thread_profiles: Dict[str, Dict[int, Any]] = {}
+    self._started_tracing = False
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.stop()
+
+  def start(self) -> None:
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+      tracemalloc.start(self.trace_frames)
+      self._started_tracing = True
+    add_phase_hook(self.phase)
+
+  def stop(self) -> None:
+    remove_phase_hook(self.phase)
+    self._write_thread_profiles()
+    self._write_summary()
+    if self._started_tracing:
+      import tracemalloc
+      tracemalloc.stop()
+      self._started_tracing = False
+    for path in self.reports:
+      log.info(f"Profile written to {path}")
+
+  def _path(self, name: str, suffix: str) -> Path:
+    path = self.output_dir / f"{self.prefix}.{name}.{suffix}"
+    self.reports.append(path)
+    return path
+
+  @contextmanager
+  def phase(self, name: str) -> Generator[None, None, None]:
+    thread = threading.get_ident()
+    with self._lock:
+      if thread in self._active:
+        nested = True
+      else:
+        nested = False
+        concurrent = bool(self._active)
+        self._active[thread] = name
+    if nested:
+      yield
+      return
+    try:
+      with (self._thread_phase if concurrent else self._phase)(name):
+        yield
+    finally:
+      with self._lock:
+        del self._active[thread]
+
+  @contextmanager
+  def _thread_phase(self, name: str) -> Generator[None, None, None]:
+    """Profile a phase run on a thread while another phase is profiled."""
+    profiler = None
+    if self.kind == "cprofile":
+      import cProfile
+      thread = threading.get_ident()
+      with self._lock:
+        profiles = self._thread_profiles.setdefault(name, {})
+        if thread not in profiles:
+          profiles[thread] = cProfile.Profile()
+        profiler = profiles[thread]
+      try:
+        profiler.enable()
+      except ValueError:
+        # Python >= 3.12: the outer profile already covers this thread
+        profiler = None
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      if profiler is not None:
+        profiler.disable()
+      elapsed = time.perf_counter() - start
+      with self._lock:
+        self.phases.setdefault(name, [0.0, 0, 0])[0] += elapsed
+
+  @contextmanager
+  def _phase(self, name: str) -> Generator[None, None, None]:
+    import cProfile
+    import tracemalloc
+
+    # A phase run more than once gets one report per run
+    self._runs[name] = run = self._runs.get(name, 0) + 1
+    label = name if run == 1 else f"{name}-{run}"
+    if self.kind == "sampling":
+      from pyinstrument import Profiler as SamplingProfiler
+      profiler = SamplingProfiler()
+    else:
+      profiler = cProfile.Profile()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    if self.kind == "sampling":
+      profiler.start()
+    else:
+      profiler.enable()
+    try:
+      yield
+    finally:
+      if self.kind == "sampling":
+        profiler.stop()
+      else:
+        profiler.disable()
+      elapsed = time.perf_counter() - start
+      after = tracemalloc.take_snapshot()
+      current, peak = tracemalloc.get_traced_memory()
+
+      with self._lock:
+        entry = self.phases.setdefault(name, [0.0, 0, 0])
+        entry[0] += elapsed
+        entry[1] = current
+        entry[2] = max(entry[2], peak)
+      try:
+        self._write_profile(label, profiler)
+        self._write_allocations(label, before, after, peak)
+      except OSError as e:
+        log.warning(f"Could not write the profile of phase {name}: {e}")
+
+  def _write_profile(self, name: str, profiler) -> None:
+    if self.kind == "sampling":
+      self._path(name, "txt").write_text(profiler.output_text(unicode=True))
+      return
+    import io
+    import pstats
+    profiler.dump_stats(self._path(name, "pstats"))
+    # Also keep a readable version, sorted by cumulative time
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(self.top)
+    self._path(name, "cumulative.txt").write_text(out.getvalue())
+
+  def _write_thread_profiles(self) -> None:
+    import io
+    import pstats
+    for name, profiles in self._thread_profiles.items():
+      profiles = [p for p in profiles.values() if p.getstats()]
+      if not profiles:
+        continue
+      try:
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(self._path(f"{name}.threads", "pstats"))
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(self.top)
+        self._path(f"{name}.threads", "cumulative.txt").write_text(out.getvalue())
+      except OSError as e:
+        log.warning(f"Could not write the thread profile of phase {name}: {e}")
+    self._thread_profiles.clear()
+
+  def _write_allocations(self, name: str, before, after, peak: int) -> None:
+    import tracemalloc
+    filters = [
+      tracemalloc.Filter(False, tracemalloc.__file__),
+      tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ]
+    stats = after.filter_traces(filters).compare_to(
+      before.filter_traces(filters), "lineno")
+    lines = [f"Peak traced memory during {name}: {peak / 1024:.1f} KiB", ""]
+    lines.append(f"Top {self.top} allocation sites by size difference:")
+    lines.extend(str(stat) for stat in stats[:self.top])
+    self._path(name, "alloc.txt").write_text("\n".join(lines) + "\n")
+
+  def _write_summary(self) -> None:
+    if not self.phases:
+      return
+    lines = [f"{'phase':<12} {'seconds':>10} {'end KiB':>12} {'peak KiB':>12}"]
+    for name, (elapsed, current, peak) in self.phases.items():
+      lines.append(
+        f"{name:<12} {elapsed:>10.3f} {current / 1024:>12.1f} {peak / 1024:>12.1f}")
+    try:
+      self._path("summary", "txt").write_text("\n".join(lines) + "\n")
+    except OSError as e:
+      log.warning(f"Could not write the profile summary: {e}")
+    print("\n".join(lines))
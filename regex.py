@@ -104,7 +104,9 @@ class YoutubeScanner(BaseScanner):
 
     # The second group should match the extension (this check might not be necessary)
     if len(match.groups()) < 2:
-      log.warning(f"{__class__} failed to match second capture group for {filename}: {match}.")
+      log.warning(
+        "%s failed to match second capture group for %s: %s.",
+        __class__, filename, match)
       return False
 
     _id = match.group("id")
@@ -115,7 +117,7 @@ class YoutubeScanner(BaseScanner):
     # the type of extension detected.
     self.store[_id][1 if match.group("extension") in yt_sub_exts else 0]\
       .append(Path(Path(root) / Path(filename)))
-    log.debug(f"{__class__} found youtube media file {filename}")
+    log.debug("%s found youtube media file %s", __class__, filename)
 
     return True
 
@@ -128,28 +130,28 @@ class TwitchScanner(BaseScanner):
   def match(self, root: str, filename: str) -> bool:
     match = self.subt_regex.match(filename)
     if match is not None:
-      log.debug(f"{__class__} matched twitch sub file {filename}")
+      log.debug("%s matched twitch sub file %s", __class__, filename)
       # if not match.group("extension"):
       #   log.debug("No extension matched. Trying again for media file...")
       #   pass
       _id = match.group("id")
       self.store[_id][1].append(Path(Path(root) / Path(filename)))
       return True
-    log.debug(f"{__class__} no sub file match for {filename}")
+    log.debug("%s no sub file match for %s", __class__, filename)
 
     # We may have mutliple twitchIds in the same filename, hence the iteration
     vid_match = self.vid_regex.finditer(filename)
     if vid_match:
       found = False
       for m in vid_match:
-        log.debug(f"{__class__} matched twitch video file {filename}: {m}")
+        log.debug("%s matched twitch video file %s: %s", __class__, filename, m)
         _id = m.group("id")
 
         if not _id:
           continue
 
         _ext = m.group("extension")
-        log.debug(f"{__class__} extension for {filename}: {_ext}.")
+        log.debug("%s extension for %s: %s.", __class__, filename, _ext)
         # if not _ext:
         #   continue
         # _date = m.group("date")
@@ -0,0 +1,416 @@
+#!/bin/env python3
+#
+# Persistent job state for all downloaders, stored in a single SQLite database
+# in WAL mode. Each job is keyed by (service, videoId) and holds its status,
+# number of attempts, last error, output path and timestamps.
+# This replaces the subs_failed.txt, ignored_subs.txt and _done/_failed/_deleted
+# text lists, which can be imported once with the functions below.
+
+from pathlib import Path
+from typing import Optional, List, Dict, Generator, Tuple, Iterable, Union
+import argparse
+import re
+import sqlite3
+import threading
+import time
+import logging
+log = logging.getLogger()
+
+DONE = "done"
+FAILED = "failed"
+IGNORED = "ignored"
+DELETED = "deleted"
+STATUSES = (DONE, FAILED, IGNORED, DELETED)
+# Jobs with these statuses should not be attempted again
+SKIP_STATUSES = (FAILED, IGNORED, DELETED)
+
+# Default service names
+YOUTUBE = "youtube"
+TWITCH = "twitch"
+YOUTUBE_VIDEO = "youtube-video"
+
+twitch_id_re = re.compile(r'^v?(\d{10})$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+  service TEXT NOT NULL,
+  video_id TEXT NOT NULL,
+  status TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  last_error TEXT,
+  output_path TEXT,
+  source_path TEXT,
+  created_at REAL NOT NULL,
+  updated_at REAL NOT NULL,
+  PRIMARY KEY (service, video_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (service, status);
+CREATE TABLE IF NOT EXISTS imports (
+  path TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  imported_at REAL NOT NULL
+);
+"""
+
+UPSERT = """
+INSERT INTO jobs (
+  service, video_id, status, attempts, last_error, output_path, source_path,
+  created_at, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (service, video_id) DO UPDATE SET
+  status = excluded.status,
+  attempts = jobs.attempts + excluded.attempts,
+  last_error = excluded.last_error,
+  output_path = COALESCE(excluded.output_path, jobs.output_path),
+  source_path = COALESCE(excluded.source_path, jobs.source_path),
+  updated_at = excluded.updated_at
+"""
+
+# Imported entries never override what is already known
+INSERT_IGNORE = """
+INSERT INTO jobs (
+  service, video_id, status, attempts, last_error, output_path, source_path,
+  created_at, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (service, video_id) DO NOTHING
+"""
+
+
+def guess_service(video_id: str) -> str:
+  """Twitch videoIds are 10 digits, Youtube ones are 11 base64url characters."""
+  return TWITCH if twitch_id_re.match(video_id) else YOUTUBE
+
+
+class StateStore():
+  """
+  Job state shared by all workers of a process, and by concurrent processes
+  thanks to WAL mode. Writes are buffered and committed in batches (group
+  commit), either every batch_size records or every flush_interval seconds.
+  """
+  def __init__(
+    self,
+    path: Union[Path, str],
+    batch_size: int = 64,
+    flush_interval: float = 2.0
+  ) -> None:
+    self.path = Path(path)
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self._lock = threading.RLock()
+    self._pending: List[Tuple] = []
+    # Latest status of buffered records, so lookups see unflushed writes
+    self._pending_status: Dict[Tuple[str, str], str] = {}
+    self._last_flush = time.monotonic()
+
+    self.db = sqlite3.connect(
+      str(self.path), timeout=30, check_same_thread=False, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.executescript(SCHEMA)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.close()
+
+  def record(
+    self,
+    service: str,
+    video_id: str,
+    status: str,
+    error: Optional[str] = None,
+    output_path: Optional[Path] = None,
+    source_path: Optional[Path] = None,
+    attempt: bool = True
+  ) -> None:
+    """Buffer a status change for a job. It is committed with the next batch."""
+    if status not in STATUSES:
+      raise Exception(f"Invalid job status: {status}.")
+    now = time.time()
+    row = (
+      service, video_id, status, 1 if attempt else 0, error,
+      str(output_path) if output_path is not None else None,
+      str(source_path) if source_path is not None else None,
+      now, now
+    )
+    with self._lock:
+      self._pending.append(row)
+      self._pending_status[(service, video_id)] = status
+      if len(self._pending) >= self.batch_size \
+      or time.monotonic() - self._last_flush >= self.flush_interval:
+        self.flush()
+
+  def flush(self) -> None:
+    """Commit all buffered records in a single transaction."""
+    with self._lock:
+      self._last_flush = time.monotonic()
+      if not self._pending:
+        return
+      rows = self._pending
+      self._pending = []
+      try:
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.executemany(UPSERT, rows)
+        self.db.execute("COMMIT")
+      except Exception:
+        # Keep the records for the next flush, whatever happens below
+        self._pending = rows + self._pending
+        # BEGIN may have failed itself (database locked)
+        if self.db.in_transaction:
+          self.db.execute("ROLLBACK")
+        raise
+      self._pending_status.clear()
+      log.debug(f"Committed {len(rows)} job state records to {self.path}.")
+
+  def status(self, service: str, video_id: str) -> Optional[str]:
+    with self._lock:
+      pending = self._pending_status.get((service, video_id))
+      if pending is not None:
+        return pending
+      row = self.db.execute(
+        "SELECT status FROM jobs WHERE service = ? AND video_id = ?",
+        (service, video_id)
+      ).fetchone()
+    return row[0] if row else None
+
+  def should_skip(self, service: str, video_id: str) -> bool:
+    return self.status(service, video_id) in SKIP_STATUSES
+
+  def get(self, service: str, video_id: str) -> Optional[Dict]:
+    self.flush()
+    with self._lock:
+      cur = self.db.execute(
+        "SELECT * FROM jobs WHERE service = ? AND video_id = ?",
+        (service, video_id))
+      row = cur.fetchone()
+      if row is None:
+        return None
+      return dict(zip((c[0] for c in cur.description), row))
+
+  def ids(
+    self, service: str, statuses: Iterable[str] = STATUSES
+  ) -> Generator[str, None, None]:
+    self.flush()
+    statuses = tuple(statuses)
+    with self._lock:
+      rows = self.db.execute(
+        "SELECT video_id FROM jobs WHERE service = ? AND status IN "
+        f"({','.join('?' * len(statuses))}) ORDER BY updated_at",
+        (service, *statuses)
+      ).fetchall()
+    for row in rows:
+      yield row[0]
+
+  def jobs(
+    self, service: Optional[str] = None, status: Optional[str] = None
+  ) -> List[Dict]:
+    self.flush()
+    query = "SELECT * FROM jobs"
+    clauses, params = [], []
+    if service is not None:
+      clauses.append("service = ?")
+      params.append(service)
+    if status is not None:
+      clauses.append("status = ?")
+      params.append(status)
+    if clauses:
+      query += " WHERE " + " AND ".join(clauses)
+    with self._lock:
+      cur = self.db.execute(query + " ORDER BY updated_at", params)
+      names = [c[0] for c in cur.description]
+      return [dict(zip(names, row)) for row in cur.fetchall()]
+
+  def counts(self, service: str) -> Dict[str, int]:
+    self.flush()
+    with self._lock:
+      return dict(self.db.execute(
+        "SELECT status, COUNT(*) FROM jobs WHERE service = ? GROUP BY status",
+        (service,)
+      ).fetchall())
+
+  def forget(self, service: str, video_id: str) -> None:
+    self.flush()
+    with self._lock:
+      self.db.execute(
+        "DELETE FROM jobs WHERE service = ? AND video_id = ?",
+        (service, video_id))
+
+  def import_rows(self, source: Path, rows: Iterable[Tuple]) -> int:
+    """
+    Insert rows read from a legacy text file, unless that exact file
+    (same size and mtime) was already imported. Return the number of new jobs.
+    """
+    source = source.absolute()
+    st = source.stat()
+    self.flush()
+    with self._lock:
+      known = self.db.execute(
+        "SELECT size, mtime_ns FROM imports WHERE path = ?", (str(source),)
+      ).fetchone()
+      if known == (st.st_size, st.st_mtime_ns):
+        return 0
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        before = self.db.total_changes
+        self.db.executemany(INSERT_IGNORE, rows)
+        added = self.db.total_changes - before
+        self.db.execute(
+          "INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?)",
+          (str(source), st.st_size, st.st_mtime_ns, time.time()))
+        self.db.execute("COMMIT")
+      except Exception:
+        if self.db.in_transaction:
+          self.db.execute("ROLLBACK")
+        raise
+    if added:
+      log.info(f"Imported {added} jobs from {source}.")
+    return added
+
+  def close(self) -> None:
+    with self._lock:
+      if self.db is None:
+        return
+      self.flush()
+      self.db.close()
+      self.db = None
+
+
+def read_id_lines(path: Path) -> Generator[str, None, None]:
+  """
+  Yield videoIds from a text file, one per line. Comments (#) are ignored, as
+  well as the "youtube " prefix used by yt-dlp archive files.
+  """
+  with open(path, "r") as f:
+    for line in f:
+      line = line.strip()
+      if not line or line.startswith("#"):
+        continue
+      if line.startswith("youtube "):
+        line = line[len("youtube "):].strip()
+      yield line
+
+
+def import_failed_cache(store: StateStore, path: Path, service: str) -> int:
+  """
+  Import a subs_failed.txt file, where each line is Id\\tPath[\\tError].
+  """
+  def rows():
+    now = time.time()
+    with open(path, "r") as f:
+      for line in f:
+        values = line.strip().split('\t')
+        if not values[0]:
+          continue
+        _path = values[1] if len(values) > 1 else None
+        error = values[2] if len(values) > 2 else None
+        yield (service, values[0], FAILED, 1, error, None, _path, now, now)
+  return store.import_rows(path, rows())
+
+
+def import_id_list(
+  store: StateStore,
+  path: Path,
+  status: str,
+  service: Optional[str] = None
+) -> int:
+  """
+  Import a list of videoIds with the same status. If service is None, it is
+  guessed from the shape of each videoId.
+  """
+  def rows():
+    now = time.time()
+    attempts = 1 if status in (DONE, FAILED) else 0
+    for _id in read_id_lines(path):
+      yield (
+        service or guess_service(_id), _id, status, attempts,
+        None, None, None, now, now
+      )
+  return store.import_rows(path, rows())
+
+
+def import_subs_lists(store: StateStore, directory: Path = Path()) -> int:
+  """Import the text files written by previous versions of subs.py."""
+  added = 0
+  sources = (
+    ("yt_subs_failed.txt", YOUTUBE),
+    ("twitch_subs_failed.txt", TWITCH),
+  )
+  for name, service in sources:
+    if (directory / name).exists():
+      added += import_failed_cache(store, directory / name, service)
+  if (directory / "ignored_subs.txt").exists():
+    added += import_id_list(store, directory / "ignored_subs.txt", IGNORED)
+  return added
+
+
+def import_batch_lists(
+  store: StateStore, id_list_file: Path, service: str = YOUTUBE_VIDEO
+) -> int:
+  """
+  Import the _done, _failed and _deleted lists kept next to id_list_file by
+  ytdl_batch_video_dl.py.
+  """
+  added = 0
+  for suffix, status in (("_done", DONE), ("_failed", FAILED), ("_deleted", DELETED)):
+    path = id_list_file.with_name(id_list_file.stem + suffix + id_list_file.suffix)
+    if path.exists():
+      added += import_id_list(store, path, status, service=service)
+  return added
+
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Inspect or update the job state database.')
+  parser.add_argument(
+    '--db', metavar='DB', type=str, default="subs_state.db",
+    help='Path to the state database.')
+  sub = parser.add_subparsers(dest="command", required=True)
+
+  imp = sub.add_parser("import", help='Import legacy text lists.')
+  imp.add_argument(
+    '--service', type=str, default=None,
+    help='Service of the imported Ids (guessed from their shape by default).')
+  imp.add_argument(
+    '--status', type=str, choices=STATUSES, default=None,
+    help='Status of the imported Ids. If omitted, the file is read as a '
+      'subs_failed.txt file (Id\\tPath\\tError).')
+  imp.add_argument('files', metavar='FILE', nargs='+')
+
+  lst = sub.add_parser("list", help='Print jobs as Id\\tPath\\tError.')
+  lst.add_argument('--service', type=str, default=None)
+  lst.add_argument('--status', type=str, choices=STATUSES, default=None)
+
+  fgt = sub.add_parser("forget", help='Remove jobs, so they are attempted again.')
+  fgt.add_argument('--service', type=str, default=None)
+  fgt.add_argument('ids', metavar='ID', nargs='+')
+  return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+  pargs = parse_args(args)
+  with StateStore(pargs.db) as store:
+    if pargs.command == "import":
+      for f in pargs.files:
+        if pargs.status is None:
+          added = import_failed_cache(
+            store, Path(f), pargs.service or YOUTUBE)
+        else:
+          added = import_id_list(
+            store, Path(f), pargs.status, service=pargs.service)
+        print(f"Imported {added} new jobs from {f}.")
+    elif pargs.command == "list":
+      for job in store.jobs(service=pargs.service, status=pargs.status):
+        print(
+          f"{job['video_id']}\t{job['source_path'] or ''}\t"
+          f"{job['last_error'] or job['status']}")
+    elif pargs.command == "forget":
+      for _id in pargs.ids:
+        store.forget(pargs.service or guess_service(_id), _id)
+  return 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  exit(main())
@@ -1,96 +1,244 @@
 #!/bin/env python3
-from os import walk, sep, getenv
+from os import walk, sep, getenv, replace
 from os.path import join as pjoin
 import sys
 import re
 from pathlib import Path
-from typing import Optional, List, Dict, Generator, Tuple, Any, Union, MutableSet
+from typing import (
+  Optional, List, Dict, Generator, Tuple, Any, Union, MutableSet, Iterable,
+  Deque
+)
 import argparse
-import gzip
 import bz2
-import shutil
-from pprint import pprint
+import gzip
+import hashlib
+import queue
+import threading
+from collections import deque
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor, Future
 # import fileinput
 import logging
 from subprocess import run, CalledProcessError
 from regex import BaseScanner, TwitchScanner, YoutubeScanner
 from downloader.twitch import TwitchDownloaderCLI
 from downloader.ytdl import YTDLDownloader
+from downloader.resume import is_complete
+from downloader.util import part_path
+from downloader.staging import StagingArea
+from chat_slim import slim_file
+from chatpack import PACK_NAME
+# Re-exported, callers used to import them from here
+from downloader.errors import (
+  AlreadyPresentError, NotAvailableAnymore, NeedCookies, NoSubsAvailable
+)
+from state import (
+  StateStore, import_subs_lists, DONE, FAILED, YOUTUBE, TWITCH
+)
+from constants import missing_paths
+from idset import IdSet
+from manifest import (
+  ManifestRecord, scan, write_manifest, read_manifest, open_manifest,
+  existing_subs
+)
+from metacache import MetadataCache, VideoMeta
+from metrics import REGISTRY
+from profiling import phase, add_phase_hook, Profiler
+from workqueue import (
+  WorkQueue, Heartbeat, DONE as QUEUE_DONE, FAILED as QUEUE_FAILED
+)
+import time
 
 log = logging.getLogger()
 # log.setLevel(logging.DEBUG)
 
-class AlreadyPresentError(Exception):
-  pass
-
-class NotAvailableAnymore(Exception):
-  pass
-
-class NeedCookies(Exception):
-  pass
-
-class NoSubsAvailable(Exception):
-  pass
-
+downloads = REGISTRY.counter(
+  "subs_downloads_total", "Download attempts, per service and result.")
+download_seconds = REGISTRY.histogram(
+  "subs_download_seconds", "Wall time of each downloader run.")
+download_failures = REGISTRY.counter(
+  "subs_download_failures_total", "Failed downloads, per exception class.")
+bytes_written = REGISTRY.counter(
+  "subs_bytes_written_total", "Size of the chat files written by the downloaders.")
+compress_seconds = REGISTRY.histogram(
+  "subs_compress_seconds", "Wall time of each file compression.")
+compress_bytes = REGISTRY.counter(
+  "subs_compress_bytes_total", "Bytes read and written by compression.")
+compression_ratio = REGISTRY.histogram(
+  "subs_compression_ratio", "Compressed size over original size.",
+  buckets=(0.02, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1))
+compress_throughput = REGISTRY.histogram(
+  "subs_compress_throughput_bytes_per_second", "Uncompressed bytes processed per second.",
+  buckets=(1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9))
+
+
+
+# Levels of trust in the compressed output: verify it always, only before
+# removing the original, or never
+VERIFY_ALWAYS = "always"
+VERIFY_REMOVE = "remove"
+VERIFY_NEVER = "never"
+CHUNK_SIZE = 1024 * 1024
+# End of a Twitch chat whose comments array was closed. Embedded emotes are
+# not matched, those chats are decoded.
+CLOSED_CHAT_TAIL = re.compile(rb'\]\s*,\s*"embeddedData"\s*:\s*null\s*\}\s*$')
+
+
+class CompressionAudit():
+  """
+  Append-only log of compressed files, one line per file as
+  time\talgo\tsha256\tsize\tverified\tcompressed path\toriginal path, where
+  the digest and size are those of the original, for later audits.
+  """
+  def __init__(self, path: Union[Path, str]) -> None:
+    self.path = Path(path)
+    self._lock = threading.Lock()
+
+  def write(
+    self, in_file: Path, out_file: Path, algo: str, digest: str, size: int,
+    verified: Optional[bool]
+  ) -> None:
+    state = "skipped" if verified is None else ("ok" if verified else "mismatch")
+    line = "\t".join((
+      time.strftime("%Y-%m-%dT%H:%M:%S"), algo, digest, str(size), state,
+      str(out_file.absolute()), str(in_file.absolute()))) + "\n"
+    with self._lock:
+      with open(self.path, "a", encoding="utf-8") as f:
+        f.write(line)
 
 
 def compress(
   in_file: Path,
   in_fd = None,
   algo: str = "bz2",
-  on_success = "remove"
-) -> Optional[Path]:
+  on_success = "remove",
+  verify: str = VERIFY_REMOVE,
+  audit: Optional[CompressionAudit] = None,
+  executor: Optional[ThreadPoolExecutor] = None
+) -> Union[Path, Future, None]:
   """
   Compress file pointed to by in_file. in_fd can be an open file descriptor to
   the file. out_dir is the output directory. If on_success == "remove" the
-  original file will be deleted.
+  original file will be deleted, once the output is known to decompress to
+  the same bytes (unless verify is VERIFY_NEVER). The verification and the
+  removal run on executor, if given.
 
   Return:
   ------
-  Output bz2 file path on effective compression, otherwise None.
+  Output bz2 file path on effective compression, otherwise None. With an
+  executor, a Future of it, as the output is only known to be good once
+  verified.
   """
   out_file = in_file.with_suffix(in_file.suffix + f".{algo}")
   log.debug(f"Will compress {in_file.name} into {out_file.name}...")
   written = None
 
+  start = time.perf_counter()
   if in_fd is None:
     with open(in_file, "rb") as in_fd:
       written = _compress_file(in_fd, out_file=out_file, algo=algo)
   else:   # Reuse the open file descriptor if possible
     written = _compress_file(in_fd, out_file=out_file, algo=algo)
 
-  if written:
-    if on_success == "remove" and out_file.exists():
+  if not written:
+    return None
+  _observe_compression(in_file, out_file, algo, time.perf_counter() - start)
+  digest, size = written
+
+  def finish() -> bool:
+    verified = None
+    if verify == VERIFY_ALWAYS \
+    or (verify == VERIFY_REMOVE and on_success == "remove"):
+      verified = verify_compressed(out_file, algo, digest, size)
+    if audit is not None:
+      audit.write(in_file, out_file, algo, digest, size, verified)
+    if verified is False:
+      log.error(f"{out_file} does not decompress to {in_file}. Removing it.")
+      print(f"Compressed file {out_file} is corrupt, keeping {in_file}.")
+      out_file.unlink(missing_ok=True)
+      return False
+    if on_success == "remove":
       log.info(f"Removing original file \"{in_file}\".")
       in_file.unlink()
-    return out_file
-  else:
-    return None
+    return True
 
+  if executor is not None:
+    future = executor.submit(lambda: out_file if finish() else None)
+    future.add_done_callback(_log_failure)
+    return future
+  return out_file if finish() else None
 
-def _compress_file(in_fd, out_file: Path, algo: str) -> bool:
-  """Compress in_fd into the file pointed by out_file.
-  If compression has occured, return True. If out file already existed
-  return False."""
 
-  if out_file.exists():
-    log.warning(f"{out_file} already exists. Skipping compression.")
-    return False
+def _log_failure(future) -> None:
+  if (e := future.exception()) is not None:
+    log.exception(e)
+    print(f"Failed to finish compression: {e}")
 
-  if algo == "bz2":
-    with bz2.open(out_file, "wb") as f:
-      # Write compressed data to file
-      f.write(in_fd.read())
-    return True
 
-  elif algo == "gz":
-    with gzip.open(out_file, "wb") as f_out:
-      shutil.copyfileobj(in_fd, f_out)
-    return True
+def _observe_compression(
+  in_file: Path, out_file: Path, algo: str, elapsed: float) -> None:
+  try:
+    size_in = in_file.stat().st_size
+    size_out = out_file.stat().st_size
+  except OSError:
+    return
+  compress_seconds.observe(elapsed, algo=algo)
+  compress_bytes.inc(size_in, algo=algo, direction="in")
+  compress_bytes.inc(size_out, algo=algo, direction="out")
+  if size_in:
+    compression_ratio.observe(size_out / size_in, algo=algo)
+  if elapsed > 0:
+    compress_throughput.observe(size_in / elapsed, algo=algo)
+
 
+def _open_compressed(path: Path, algo: str, mode: str):
+  if algo == "bz2":
+    return bz2.open(path, mode)
+  elif algo == "gz":
+    return gzip.open(path, mode)
   raise Exception("Incorrect algorithm specified: must be [bz2|gz].")
 
 
+def _compress_file(in_fd, out_file: Path, algo: str) -> Optional[Tuple[str, int]]:
+  """Compress in_fd into the file pointed by out_file, through a temporary
+  file renamed once complete. If compression has occured, return the sha256
+  digest and the size of the input. If out file already existed return None."""
+
+  if out_file.exists():
+    log.warning(f"{out_file} already exists. Skipping compression.")
+    return None
+
+  digest = hashlib.sha256()
+  size = 0
+  tmp = out_file.with_name(out_file.name + ".tmp")
+  try:
+    with _open_compressed(tmp, algo, "wb") as f:
+      while chunk := in_fd.read(CHUNK_SIZE):
+        digest.update(chunk)
+        size += len(chunk)
+        f.write(chunk)
+    replace(tmp, out_file)
+  except BaseException:
+    tmp.unlink(missing_ok=True)
+    raise
+  return digest.hexdigest(), size
+
+
+def verify_compressed(path: Path, algo: str, digest: str, size: int) -> bool:
+  """Whether path decompresses to size bytes of the given sha256 digest."""
+  check = hashlib.sha256()
+  read = 0
+  try:
+    with _open_compressed(path, algo, "rb") as f:
+      while chunk := f.read(CHUNK_SIZE):
+        check.update(chunk)
+        read += len(chunk)
+  except (OSError, EOFError, ValueError) as e:
+    log.warning(f"Cannot decompress {path}: {e}")
+    return False
+  return read == size and check.hexdigest() == digest
+
+
 def find_files(path: Path, exts: List[str] = ["json"]) -> Generator[Path, None, None]:
   """Return all files with the given extensions in exts."""
   # for root, dirs, files in walk(path):
@@ -121,50 +269,9 @@ def crawl_files(
       yield root, f
 
 
-class CacheFile():
-  """
-  Store errors for each Id as Id\tPath.name\tError message.
-  """
-  def __init__(self, path: Path) -> None:
-    self.path = path
-    self.already_existed = True
-    if not path.exists():
-      self.already_existed = False
-      path.touch()
-
-  def write(self, data: str, mode='a'):
-    # TODO enforce a consistent format in order to load back safely
-    with open(self.path, mode) as f:
-      f.write(data)
-
-  def load_lines(self) -> Dict[str, List[Path]]:
-    with open(self.path, 'r') as f:
-      found = {}
-      for line in f.readlines():
-        line = line.strip()
-        if not line:
-          continue
-
-        values = line.split('\t')
-        if len(values) == 3:
-          # Currently we don't care about loading errors back in
-          _id, _path, _ = values
-        else:
-          _id, _path = values
-
-        found[_id] = [Path(_path)]
-    return found
-
-  def __del__(self):
-    log.debug(f"Closing cache file handle {self.path}.")
-    if self.path.exists() and self.path.stat().st_size == 0:
-      log.debug(f"Removing empty {self.path}.")
-      self.path.unlink(missing_ok=True)
-
-
 class ProcessHandler():
-  cached_fail_name = "subs_failed.txt"
   service_name = ""
+  service_key = ""
   downloader = None
 
   def __init__(self, *args, **kwargs) -> None:
@@ -173,21 +280,29 @@ class ProcessHandler():
       self.cookies = Path(cookies).expanduser()
 
     self.scanner: BaseScanner = kwargs["regex"]
-    self.failed_cache: CacheFile = kwargs["failed_cache"]
+    self.state: StateStore = kwargs["state"]
     self._to_download: Optional[Dict] = None
-    self._failed_download: Dict = {}
-    self._ignored: MutableSet[str] = kwargs.get("ignored", set())
-
-    if self.failed_cache.already_existed:
-      self._failed_download = self.failed_cache.load_lines()
-      if len(self._failed_download):
-        print(
-          f"Loaded {len(self._failed_download)} failed downloads from "
-          f"\"{self.failed_cache.path.name}\"."
-        )
-        log.debug(f"Loaded failed download Ids:\n{self._failed_download}")
-      else:
-        print(f"No failed {self.service_name} download found from a previous run.")
+    # Extra Ids to skip, on top of the ones ignored in the state database
+    self._ignored: IdSet = kwargs.get("ignored") or IdSet()
+    # Local scratch space where subs are written before being moved
+    self.staging: Optional[StagingArea] = kwargs.get("staging")
+    # Whether compressed subs are decompressed and checked, and where their
+    # digests are logged
+    self.verify: str = kwargs.get("verify") or VERIFY_REMOVE
+    self.audit: Optional[CompressionAudit] = kwargs.get("audit")
+    # Replace live chats by their slim version before compressing them, and
+    # with keep_original, keep the full one compressed alongside
+    self.slim: bool = kwargs.get("slim") or False
+    self.keep_original: bool = kwargs.get("keep_original") or False
+
+    counts = self.state.counts(self.service_key)
+    if counts:
+      print(
+        f"Known {self.service_name} jobs: "
+        + ", ".join(f"{count} {status}" for status, count in counts.items())
+      )
+    else:
+      print(f"No {self.service_name} download found from a previous run.")
 
   # def __del__(self):
   #   if self._to_download:
@@ -209,26 +324,33 @@ class ProcessHandler():
         for _id in ids.keys()
         # Only load Ids that do not have any associated subs files already (at index 1)
         if (len(ids[_id][1]) == 0 and len(ids[_id][0]) > 0)
-        and _id not in self._failed_download.keys()
-        and _id not in self._ignored
+        and self.wants(_id)
       )
     )
     return self._to_download
 
+  def wants(self, _id: str) -> bool:
+    """Whether _id is neither ignored nor known to fail."""
+    return _id not in self._ignored \
+      and not self.state.should_skip(self.service_key, _id)
+
   def _prepare_args(
     self, videoId: str, paths: List[Path], out_path: Optional[Path]) -> Dict:
     if len(paths) > 1:
       log.warning(
         f"There was more than one file with videoId \"{videoId}\": "
         f"{', '.join(str(p) for p in paths)}. "
-        f"Downloaded file will be placed in the first path: {str(paths[0])}."
+        f"Downloaded file will be placed in the first path: {str(paths[0])}. "
+        f"Copies can be found with dedupe.py."
       )
     # We default to the first path reported
     _path = paths[0] if len(paths) > 0 else None
 
     # Determine the output directory for the subtitle file
     _out_path = out_path
-    if _path is not None:
+    # The media directory may not exist on this host, if paths come from a
+    # manifest written on another one
+    if _path is not None and _path.parent.is_dir():
       _out_path = _path.parent if out_path is not None else out_path
     args = {
       "source_path": _path,
@@ -240,6 +362,133 @@ class ProcessHandler():
     # virtual
     raise NotImplementedError()
 
+  def download_one(
+    self,
+    _id: str,
+    paths: List[Path],
+    compression: str,
+    out_path: Optional[Path] = None,
+    remove_compressed: bool = False
+  ) -> Tuple[str, Optional[Path], Optional[Path]]:
+    """
+    Download the subs of _id next to the first of its media files (or in
+    out_path), compress them and record the outcome in the state database.
+    Return the result ("ok", "no_output", "already_present" or "failed"), the
+    path to the written file and the path to the compressed file.
+    """
+    args = self._prepare_args(videoId=_id, paths=paths, out_path=out_path)
+    args["compression"] = compression
+    _out_path = args.get("out_path")
+    source_path = paths[0] if paths else None
+    if self.staging is not None:
+      args["out_path"] = self.staging.directory_for(_out_path)
+
+    print(f"Downloading subs for {_id} ({source_path or _out_path})...")
+
+    start = time.perf_counter()
+    try:
+      # written = self.downloader.download(_id, out_path=_out_path)
+      try:
+        written = self._download(_id, args)
+      finally:
+        elapsed = time.perf_counter() - start
+
+      if not written:
+        log.warning(
+          f"No filename written for Id {_id} by {self.downloader.default_name} "
+          f"according to its stdout.")
+        self._observe_download("no_output", elapsed)
+        return "no_output", None, None
+
+      written = Path() / written if type(written) is str else written.absolute()
+      print(f"Written subtitle file: \"{written}\".")
+      self._observe_download("ok", elapsed)
+      if written.exists():
+        bytes_written.inc(written.stat().st_size, service=self.service_key)
+        if self.slim:
+          with phase("slim"):
+            self._slim(written, compression, remove_compressed)
+
+      if written.name.endswith(f".json.{compression}"):
+        # Streamed through the compressor by the downloader itself
+        compressed = written
+      else:
+        with phase("compress"):
+          compressed = compress(
+            written, in_fd=None, algo=compression,
+            on_success="remove" if remove_compressed else "nothing",
+            verify=self.verify, audit=self.audit
+          )
+      if compressed:
+        print(f"Compressed file: \"{compressed}\"")
+      if self.staging is not None:
+        return "ok", *self._stage(_id, written, compressed, source_path)
+      self.state.record(
+        self.service_key, _id, DONE,
+        output_path=compressed or written, source_path=source_path)
+      return "ok", written, compressed
+
+    except AlreadyPresentError:
+      self._observe_download("already_present", time.perf_counter() - start)
+      log.warning(
+        f"File {_out_path} was already present according to "
+        f"{self.downloader.default_name}.")
+      return "already_present", None, None
+    except (NotAvailableAnymore, NoSubsAvailable, Exception) as e:
+      print(f"Failed to download live chat for {_id}: {e}")
+      log.warning(f"VideoId {_id} is not available anymore: {e}")
+      self._observe_download("failed", time.perf_counter() - start)
+      download_failures.inc(
+        service=self.service_key, exception=type(e).__name__)
+      self.state.record(
+        self.service_key, _id, FAILED, error=str(e), source_path=source_path)
+      return "failed", None, None
+
+  def _slim(self, written: Path, compression: str, remove_compressed: bool) -> None:
+    """Replace written by its slim version. A failure leaves it as it was."""
+    try:
+      kept = slim_file(written, keep_original=self.keep_original)
+    except (OSError, ValueError) as e:
+      log.warning(f"Cannot slim {written}: {e}")
+      print(f"Keeping the full live chat {written}: {e}")
+      return
+    if kept is None:
+      return
+    if not kept.name.endswith(f".json.{compression}"):
+      kept = compress(
+        kept, algo=compression,
+        on_success="remove" if remove_compressed else "nothing",
+        verify=self.verify, audit=self.audit) or kept
+    if self.staging is not None:
+      self.staging.add(kept)
+
+  def _stage(
+    self,
+    _id: str,
+    written: Path,
+    compressed: Optional[Path],
+    source_path: Optional[Path]
+  ) -> Tuple[Optional[Path], Optional[Path]]:
+    """
+    Queue the files written in scratch for their final directory. The
+    download is only recorded as done once its subs are there. Return the
+    final paths of written and compressed.
+    """
+    def record(final: Path) -> None:
+      self.state.record(
+        self.service_key, _id, DONE, output_path=final, source_path=source_path)
+
+    if compressed and written != compressed and written.exists():
+      self.staging.add(written)
+    output = self.staging.add(compressed or written, on_moved=record)
+    return self.staging.final_path(written), output if compressed else None
+
+  def flush(self) -> None:
+    """Move the subs still in scratch, and commit the outcomes recorded."""
+    if self.staging is not None:
+      self.staging.flush()
+    self.state.flush()
+
   def download(
     self,
     compression: str,
@@ -252,54 +501,38 @@ class ProcessHandler():
     did_download = []
     did_compress = []
     for _id, _paths in self.to_download.items():
-      args = self._prepare_args(videoId=_id, paths=_paths, out_path=out_path)
-      _out_path = args.get("out_path")
-
-      print(f"Downloading subs for {_id} ({_paths[0]})...")
-
-      try:
-        # written = self.downloader.download(_id, out_path=_out_path)
-        written = self._download(_id, args)
-
-        if not written:
-          log.warning(
-            f"No filename written for Id {_id} by {self.downloader.default_name} "
-            f"according to its stdout.")
-          continue
+      result, written, compressed = self.download_one(
+        _id, _paths, compression=compression, out_path=out_path,
+        remove_compressed=remove_compressed)
+      if result == "ok":
         did_download.append(_id)
-
-        written = Path() / written if type(written) is str else written.absolute()
-        print(f"Written subtitle file: \"{written}\".")
-
-        compressed = compress(
-          written, in_fd=None, algo=compression,
-          on_success="remove" if remove_compressed else "nothing"
-        )
         if compressed:
-          print(f"Compressed file: \"{compressed}\"")
           did_compress.append(compressed)
-
-      except AlreadyPresentError:
-        log.warning(
-          f"File {_out_path} was already present according to "
-          f"{self.downloader.default_name}.")
-      except (NotAvailableAnymore, NoSubsAvailable, Exception) as e:
-        print(f"Failed to download live chat for {_id}: {e}")
-        log.warning(f"VideoId {_id} is not available anymore: {e}")
+      elif result == "failed":
         did_fail.append(_id)
-        self.failed_cache.write(_id + '\t' + str(_paths[0]) + '\t' + str(e) + "\n")
 
+    self.flush()
     return did_download, did_compress, did_fail
 
+  def _observe_download(self, result: str, elapsed: float) -> None:
+    downloads.inc(service=self.service_key, result=result)
+    download_seconds.observe(elapsed, service=self.service_key, result=result)
+
 
 class YoutubeHandler(ProcessHandler):
-  cached_fail_name = "yt_" + ProcessHandler.cached_fail_name
   service_name = "Youtube"
+  service_key = YOUTUBE
 
   def __init__(self, *args, **kwargs) -> None:
     super().__init__(
       regex=YoutubeScanner(),
-      failed_cache=CacheFile(Path(self.cached_fail_name))
+      state=kwargs["state"],
+      ignored=kwargs.get("ignored"),
+      staging=kwargs.get("staging"),
+      verify=kwargs.get("verify"),
+      audit=kwargs.get("audit"),
+      slim=kwargs.get("slim"),
+      keep_original=kwargs.get("keep_original")
     )
     self.downloader = YTDLDownloader(process_path=kwargs["process_path"])
     
@@ -307,13 +540,53 @@ class YoutubeHandler(ProcessHandler):
     if cookies := kwargs.get("cookies"):
       self.cookies = Path(cookies).expanduser()
 
+    # What earlier runs learned about each video
+    self.metadata: Optional[MetadataCache] = kwargs.get("metadata")
+
+    # Follow the chat replay continuations here instead of running yt-dlp
+    self.fetcher = None
+    if kwargs.get("engine") == "native":
+      # Imported here, so that other runs do not load ssl and http.client
+      from downloader.youtube_native import YoutubeChatFetcher
+      self.fetcher = YoutubeChatFetcher(
+        cookies=self.cookies, max_videos=kwargs.get("jobs") or 1)
+
   def _download(self, videoId: str, kwargs) -> Optional[Path]:
     """Call yt-dlp on videoId. Return the path to the written file."""
+    if self.metadata is None:
+      return self._fetch(videoId, kwargs)
+
+    if (meta := self.metadata.get(videoId)) is not None \
+    and (reason := meta.skip_reason(has_cookies=self.cookies is not None)):
+      log.info(f"Skipping {videoId} according to {self.metadata.path}: {reason}")
+      raise reason
+    try:
+      written = self._fetch(videoId, kwargs)
+    except Exception as e:
+      self.metadata.put_error(videoId, e)
+      raise
+    if self.fetcher is not None:
+      self.metadata.put(VideoMeta(videoId, availability="public", has_chat=True))
+    else:
+      self.metadata.put_info(videoId)
+    return written
+
+  def _fetch(self, videoId: str, kwargs) -> Optional[Path]:
+    out_path = kwargs.get("out_path")
+    if self.fetcher is not None:
+      return self.fetcher.download(
+        videoId, out_dir=out_path, compression=kwargs.get("compression"))
+
+    info_json = info_dir = None
+    if self.metadata is not None:
+      # Saves extracting the video page again, if recent enough
+      info_json = self.metadata.load_info(videoId)
+      info_dir = self.metadata.info_dir
     # use COOKIE_PATH here if needed
     cmd = self.downloader.build_cmd(
-      videoId, cookies=self.cookies, skip_video=True
+      videoId, cookies=self.cookies, skip_video=True,
+      info_json=info_json, info_dir=info_dir
     )
-    out_path = kwargs.get("out_path")
 
     log.debug(f"Running download method: {cmd}, out_path: {out_path}.")
 
@@ -352,15 +625,25 @@ class YoutubeHandler(ProcessHandler):
 
 
 class TwitchHandler(ProcessHandler):
-  cached_fail_name = "twitch_" + ProcessHandler.cached_fail_name
   service_name = "Twitch"
+  service_key = TWITCH
 
-  def __init__(self, *args, **kwargs) -> None:    
+  def __init__(self, *args, **kwargs) -> None:
     super().__init__(
       regex=TwitchScanner(),
-      failed_cache=CacheFile(Path(self.cached_fail_name)),
+      state=kwargs["state"],
+      ignored=kwargs.get("ignored"),
+      staging=kwargs.get("staging"),
+      verify=kwargs.get("verify"),
+      audit=kwargs.get("audit")
     )
     self.downloader = TwitchDownloaderCLI(process_path=kwargs["process_path"])
+    # Fetch chats from the GQL API instead of running TwitchDownloaderCLI
+    self.fetcher = None
+    if kwargs.get("engine") == "native":
+      # Imported here, so that other runs do not load ssl and http.client
+      from downloader.twitch_native import TwitchChatFetcher
+      self.fetcher = TwitchChatFetcher(max_videos=kwargs.get("jobs") or 1)
     
     self.cookies: Optional[Path] = None
     if cookies := kwargs.get("cookies"):
@@ -382,8 +665,14 @@ class TwitchHandler(ProcessHandler):
     if not videoId:
       raise Exception(f"No videoId submitted: {videoId}")
 
-    cmd = self.downloader.build_cmd(videoId, kwargs)
     out_path = kwargs.get("out_path")
+    if self.fetcher is not None:
+      # Compressed on the fly, download_one() leaves it as is
+      return self.fetcher.download(
+        videoId, out_dir=out_path, date=kwargs.get("date"),
+        compression=kwargs.get("compression"))
+
+    cmd = self.downloader.build_cmd(videoId, kwargs)
 
     log.debug(f"Running command: {cmd}, out_path: {out_path}")
 
@@ -409,6 +698,317 @@ class TwitchHandler(ProcessHandler):
     return out_path / Path(cmd[-1]) if out_path is not None else Path(cmd[-1])
 
 
+class ManifestConsumer():
+  """
+  Download the subs of manifest records that have media files but no subs,
+  as they are fed. Each Id is attempted once, and not at all if subs were
+  seen for it, either in an earlier record or through add_subs(), which a
+  scanning thread may call at any time.
+  """
+  def __init__(
+    self,
+    handlers: List[ProcessHandler],
+    compression: str,
+    out_path: Optional[Path] = None,
+    remove_compressed: bool = False,
+    dry_run: bool = False,
+    jobs: int = 1
+  ) -> None:
+    self.handlers = {handler.service_key: handler for handler in handlers}
+    self.compression = compression
+    self.out_path = out_path
+    self.remove_compressed = remove_compressed
+    self.dry_run = dry_run
+    # Downloads run on a pool of jobs threads when jobs > 1. feed() blocks
+    # while they are all busy, so records are not read too far ahead.
+    self.jobs = max(1, jobs)
+    self._executor: Optional[ThreadPoolExecutor] = None
+    self._slots = threading.BoundedSemaphore(self.jobs)
+    self._errors: List[BaseException] = []
+    # Compact sets, to keep memory low on manifests of the whole library
+    self._subs = {key: IdSet() for key in self.handlers}
+    self._attempted = {key: IdSet() for key in self.handlers}
+    self._downloaded = {key: IdSet() for key in self.handlers}
+    self._lock = threading.Lock()
+    self.results: Dict[str, int] = {}
+    self.failed: List[str] = []
+    self.not_compressed: List[str] = []
+
+  def add_subs(self, service: str, _id: str) -> None:
+    if service in self._subs:
+      with self._lock:
+        self._subs[service].add(_id)
+
+  def has_subs(self, service: str, _id: str) -> bool:
+    with self._lock:
+      return _id in self._subs[service]
+
+  def feed(self, record: ManifestRecord) -> Optional[str]:
+    """
+    Download record if needed. Return the result, or None if skipped or if
+    the download was handed to the pool of jobs threads.
+    """
+    handler = self.handlers.get(record.service)
+    if handler is None:
+      return None
+    if record.sub_paths:
+      self.add_subs(record.service, record.id)
+      return None
+    if self.has_subs(record.service, record.id) \
+    or record.id in self._attempted[record.service] \
+    or not handler.wants(record.id):
+      return None
+    # Ids read from a list have no files to check: trust the state instead
+    if not record.media_paths \
+    and handler.state.status(record.service, record.id) == DONE:
+      return None
+    self._attempted[record.service].add(record.id)
+
+    if self.dry_run:
+      print(f"Would download {handler.service_name} subs for {record.id}.")
+      return None
+
+    if self.jobs == 1:
+      return self._download(handler, record)
+
+    if self._executor is None:
+      self._executor = ThreadPoolExecutor(self.jobs, thread_name_prefix="download")
+    self._slots.acquire()
+    self._executor.submit(self._job, handler, record) \
+      .add_done_callback(self._done)
+    return None
+
+  def _job(self, handler: ProcessHandler, record: ManifestRecord) -> Optional[str]:
+    # Its own phase, so that --profile sees the threads of the pool
+    with phase("job"):
+      return self._download(handler, record)
+
+  def _done(self, future) -> None:
+    self._slots.release()
+    if (e := future.exception()) is not None:
+      with self._lock:
+        self._errors.append(e)
+
+  def _download(
+    self, handler: ProcessHandler, record: ManifestRecord
+  ) -> Optional[str]:
+    # feed() may have waited a long time for a slot, while the scan went on
+    if self.has_subs(record.service, record.id):
+      log.debug("Subs of %s were found meanwhile, skipping.", record.id)
+      return None
+    result, _, compressed = handler.download_one(
+      record.id, [Path(p) for p in record.media_paths],
+      compression=self.compression, out_path=self.out_path,
+      remove_compressed=self.remove_compressed)
+    with self._lock:
+      self.results[result] = self.results.get(result, 0) + 1
+      if result == "failed":
+        self.failed.append(record.id)
+      elif result == "ok":
+        self._downloaded[record.service].add(record.id)
+        if not compressed:
+          self.not_compressed.append(record.id)
+    return result
+
+  def late_subs(self) -> List[Tuple[str, str]]:
+    """
+    Downloaded Ids for which subs were found afterwards, in another directory
+    than their media files, scanned after the download had started.
+    """
+    with self._lock:
+      return [
+        (service, _id)
+        for service, ids in self._downloaded.items()
+        for _id in ids
+        if _id in self._subs[service]
+      ]
+
+  def flush(self) -> None:
+    """Wait for the downloads still running, and commit their outcome."""
+    if self._executor is not None:
+      self._executor.shutdown(wait=True)
+      self._executor = None
+    for handler in self.handlers.values():
+      handler.flush()
+    if self._errors:
+      raise self._errors[0]
+
+
+def download_manifest(
+  records: Iterable[ManifestRecord],
+  handlers: List[ProcessHandler],
+  compression: str,
+  out_path: Optional[Path] = None,
+  remove_compressed: bool = False,
+  dry_run: bool = False,
+  jobs: int = 1,
+  known_subs: Iterable[Tuple[str, str]] = ()
+) -> Tuple[Dict[str, int], List[str]]:
+  """
+  Download the subs of each record of a manifest as soon as it is read, if it
+  has no subs file. known_subs are (service, videoId) of subs found
+  elsewhere, such as in out_path. Return the number of downloads per result
+  and the Ids that failed.
+  """
+  consumer = ManifestConsumer(
+    handlers, compression, out_path=out_path,
+    remove_compressed=remove_compressed, dry_run=dry_run, jobs=jobs)
+  for service, _id in known_subs:
+    consumer.add_subs(service, _id)
+  try:
+    for record in records:
+      consumer.feed(record)
+  finally:
+    consumer.flush()
+  return consumer.results, consumer.failed
+
+
+def _record_dir(record: ManifestRecord) -> str:
+  """Directory listed for record. Chats of a pack count as its directory's."""
+  parent = Path((record.media_paths or record.sub_paths)[0]).parent
+  return str(parent.parent if parent.name == PACK_NAME else parent)
+
+
+def stream_downloads(
+  path: Path,
+  filter_re: Optional[re.Pattern],
+  handlers: List[ProcessHandler],
+  compression: str,
+  out_path: Optional[Path] = None,
+  remove_compressed: bool = False,
+  dry_run: bool = False,
+  max_pending: int = 1024,
+  jobs: int = 1
+) -> ManifestConsumer:
+  """
+  Scan path on a background thread while downloading in this one. The Ids of
+  each directory are queued as soon as its listing is complete, so downloads
+  start right away. At most max_pending records wait in the queue; the scan
+  pauses when it is full.
+
+  Subs found by the scan are taken into account immediately. The media-only
+  Ids of a directory that holds no subs at all are held back until the scan
+  is over, as their subs may be kept in another directory: they are settled
+  by a final pass, once every subs file has been seen. Those of directories
+  that hold subs are downloaded right away.
+  """
+  consumer = ManifestConsumer(
+    handlers, compression, out_path=out_path,
+    remove_compressed=remove_compressed, dry_run=dry_run, jobs=jobs)
+  pending: "queue.Queue[Optional[ManifestRecord]]" = queue.Queue(max_pending)
+  stop = threading.Event()
+  errors: List[BaseException] = []
+
+  def put(item) -> bool:
+    while not stop.is_set():
+      try:
+        pending.put(item, timeout=0.5)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def produce() -> None:
+    held: List[ManifestRecord] = []
+    try:
+      with phase("scan"):
+        records = scan(path, filter_re, services=list(consumer.handlers))
+        for _, group in groupby(records, key=_record_dir):
+          group = list(group)
+          media_only = []
+          for record in group:
+            if record.sub_paths:
+              consumer.add_subs(record.service, record.id)
+            elif record.media_paths:
+              media_only.append(record)
+          if len(media_only) == len(group):
+            held.extend(media_only)
+            continue
+          for record in media_only:
+            log.debug("Queueing %s %s.", record.service, record.id)
+            if not put(record):
+              return
+      for record in held:
+        log.debug("Queueing held back %s %s.", record.service, record.id)
+        if not put(record):
+          return
+    except BaseException as e:
+      errors.append(e)
+    finally:
+      put(None)
+
+  producer = threading.Thread(target=produce, name="scan", daemon=True)
+  producer.start()
+  try:
+    while (record := pending.get()) is not None:
+      consumer.feed(record)
+  finally:
+    stop.set()
+    producer.join()
+    consumer.flush()
+  if errors:
+    raise errors[0]
+  return consumer
+
+
+def work(
+  queue: WorkQueue,
+  handlers: List[ProcessHandler],
+  compression: str,
+  out_path: Optional[Path] = None,
+  remove_compressed: bool = False,
+  poll_interval: float = 10.0
+) -> Dict[str, int]:
+  """
+  Claim jobs from a shared queue and download them until the queue is empty.
+  Outcomes are recorded both in the queue and in the state database of the
+  handlers. Return the number of jobs per result.
+  """
+  by_service = {handler.service_key: handler for handler in handlers}
+  results: Dict[str, int] = {}
+
+  with Heartbeat(queue):
+    while True:
+      leases = queue.claim(by_service)
+      if not leases:
+        # Jobs leased by other workers come back if their lease expires
+        if queue.remaining(by_service) == 0:
+          break
+        time.sleep(poll_interval)
+        continue
+
+      for lease in leases:
+        handler = by_service[lease.service]
+        if not handler.wants(lease.video_id):
+          queue.complete(lease, QUEUE_FAILED, error="skipped by the state database")
+          results["skipped"] = results.get("skipped", 0) + 1
+          continue
+
+        print(f"Claimed {lease.service} {lease.video_id} (attempt {lease.attempt}).")
+        try:
+          result, _, _ = handler.download_one(
+            lease.video_id, [Path(p) for p in lease.media_paths],
+            compression=compression, out_path=out_path,
+            remove_compressed=remove_compressed)
+        except BaseException:
+          # Let another worker have it right away, e.g. on KeyboardInterrupt
+          queue.release(lease)
+          raise
+        handler.state.flush()
+        results[result] = results.get(result, 0) + 1
+
+        if result in ("ok", "already_present"):
+          queue.complete(lease, QUEUE_DONE)
+        else:
+          job = handler.state.get(handler.service_key, lease.video_id)
+          queue.complete(
+            lease, QUEUE_FAILED,
+            error=(job or {}).get("last_error") or result)
+  for handler in handlers:
+    handler.flush()
+  return results
+
+
 # cf. https://stackoverflow.com/questions/898669
 textchars = bytearray({7,8,9,10,12,13,27} | set(range(0x20, 0x100)) - {0x7f})
 is_binary_string = lambda bytes: bool(bytes.translate(None, textchars))
@@ -417,14 +1017,54 @@ is_binary_string = lambda bytes: bool(bytes.translate(None, textchars))
 def compress_subs(
   supplied_path: Path,
   compression: str,
-  remove_compressed: bool
+  remove_compressed: bool,
+  verify: str = VERIFY_REMOVE,
+  audit: Optional[CompressionAudit] = None
 ) -> Generator[Optional[Path], None, None]:
   """
-  Find json sub files in supplied path and compress them all.
+  Find json sub files in supplied path and compress them all. Each output is
+  verified on a background thread while the next file is compressed.
   """
+  with ThreadPoolExecutor(1, thread_name_prefix="verify") as verifier:
+    yield from _compress_all(
+      supplied_path, compression, remove_compressed, verify, audit, verifier)
+
+
+def _interrupted_chat(path: Path) -> bool:
+  """
+  Whether path is a chat whose download was cut short. Other JSON files are
+  not checked. Twitch chats are only decoded when they are still being
+  written (.part sibling) or their tail does not show the comments array
+  closed and followed by an empty "embeddedData".
+  """
+  if path.name.endswith(".live_chat.json"):
+    return not is_complete(path, YOUTUBE)
+  if not TwitchScanner.subt_regex.match(path.name):
+    return False
+  if not part_path(path).exists():
+    size = path.stat().st_size
+    with open(path, "rb") as f:
+      f.seek(max(0, size - 64))
+      if CLOSED_CHAT_TAIL.search(f.read()):
+        return False
+  return not is_complete(path, TWITCH)
+
+
+def _compress_all(
+  supplied_path: Path,
+  compression: str,
+  remove_compressed: bool,
+  verify: str,
+  audit: Optional[CompressionAudit],
+  verifier: ThreadPoolExecutor
+) -> Generator[Optional[Path], None, None]:
+  # Outputs still being verified, reported once they are
+  pending: Deque[Future] = deque()
   # Gather all json files
   files = find_files(path=supplied_path, exts=["json"])
   for f in files:
+    while pending and pending[0].done():
+      yield _verified(pending.popleft())
     # Make sure it's a text file
     with open(f, "rb") as fd:
       if is_binary_string(fd.read(1024)):
@@ -432,15 +1072,37 @@ def compress_subs(
         continue
       # Have to rewind the cursor after reading the first chunk!
       fd.seek(0)
+      if _interrupted_chat(f):
+        log.warning(f"{f} is incomplete. Skipping, until its download is resumed.")
+        print(f"Skipping incomplete chat file {f}")
+        continue
       try:
-        yield compress(
+        future = compress(
           f,
           fd,
           algo=compression,
-          on_success=("remove" if remove_compressed else "nothing")
+          on_success=("remove" if remove_compressed else "nothing"),
+          verify=verify,
+          audit=audit,
+          executor=verifier
         )
       except Exception as e:
         log.exception(e)
+        continue
+      if future is None:
+        yield None
+      else:
+        pending.append(future)
+  while pending:
+    yield _verified(pending.popleft())
+
+
+def _verified(future: Future) -> Optional[Path]:
+  try:
+    return future.result()
+  except Exception:
+    # Already reported by _log_failure
+    return None
 
 
 def parse_args(args):
@@ -448,7 +1110,12 @@ def parse_args(args):
     description='Download subtitles, or compress subtitles already present on disk.')
   parser.add_argument(
     '--mode', metavar='MODE', type=str,
-    help='download or compress', required=True, choices=["download", "compress"])
+    help='download, scan, work, compress or stats. "scan" writes an NDJSON manifest '
+      'of the videoIds found in PATH, which the download mode accepts as PATH. '
+      '"work" downloads jobs claimed from the queue database at PATH, shared '
+      'with the workers of other hosts (see workqueue.py).',
+    required=True,
+    choices=["download", "scan", "work", "compress", "stats"])
   parser.add_argument(
     '--compression', metavar='ALGO', type=str, choices=["bz2", "gz"], default="bz2",
     help='Type of compression to use')
@@ -465,20 +1132,111 @@ def parse_args(args):
   parser.add_argument(
     '--remove-compressed', action="store_true", default=False,
     help='Remove subtitle file after compression has succeeded.')
+  parser.add_argument(
+    '--verify-compressed', metavar="WHEN", type=str, default=VERIFY_REMOVE,
+    choices=[VERIFY_ALWAYS, VERIFY_REMOVE, VERIFY_NEVER],
+    help='Decompress each compressed file and compare it to the original: '
+      '"always", only before removing the original with --remove-compressed '
+      '("remove"), or "never" to trust the compressor. Originals are only '
+      'removed if they match.')
+  parser.add_argument(
+    '--slim-chat', action="store_true", default=False,
+    help='Replace Youtube live chats by a slim version before compressing '
+      'them, with one message per line and only the fields read by '
+      'chat_reader.py (timestamps, author, message, badges, paid amount).')
+  parser.add_argument(
+    '--keep-original-chat', action="store_true", default=False,
+    help='With --slim-chat, also keep the original live chat, compressed, as '
+      '*.live_chat.orig.json.ALGO.')
+  parser.add_argument(
+    '--audit-log', metavar="FILE", type=str, default=None,
+    help='Append the sha256 digest and size of each compressed original, and '
+      'whether its compressed file was verified, to FILE.')
   parser.add_argument(
     '--cookies', metavar="COOKIES", type=str, default=None,
     help='Path to cookie file to pass to downloaders (for members-only videos).')
   parser.add_argument(
     '--log-level', metavar="LOG-LEVEL", type=str, default="WARNING",
     help='Minimum log level to justify writing to log file on disk.')
+  parser.add_argument(
+    '--state-db', metavar="DB", type=str, default="subs_state.db",
+    help='SQLite database holding the state of every download (failed, ignored...).')
+  parser.add_argument(
+    '--ignore-list', metavar="LIST", type=str, action="append", default=[],
+    help='Text file of videoIds (or .idset file built by idset.py) to skip. '
+      'Can be repeated.')
+  parser.add_argument(
+    '--jobs', metavar="N", type=int, default=None,
+    help='Number of worker processes for the stats mode (defaults to the number of CPUs).')
+  parser.add_argument(
+    '--stats-cache', metavar="CACHE", type=str, default="chat_stats_cache.json",
+    help='JSON file where chat stats are cached between runs (stats mode).')
+  parser.add_argument(
+    '--metrics-textfile', metavar="PROM", type=str, default=None,
+    help='Write run metrics to this file in the Prometheus text format '
+      '(for node_exporter\'s textfile collector).')
+  parser.add_argument(
+    '--metrics-json', metavar="JSON", type=str, default=None,
+    help='Write a JSON summary of the run metrics to this file.')
+  parser.add_argument(
+    '--profile', action="store_true", default=False,
+    help='Profile each phase of the run (scan, download, job, slim, compress) and '
+      'write the reports next to subs.log.')
+  parser.add_argument(
+    '--profiler', metavar="PROFILER", type=str, default="auto",
+    choices=["auto", "cprofile", "sampling"],
+    help='Profiler used by --profile. "sampling" requires pyinstrument, '
+      '"auto" uses it when it is installed.')
+  parser.add_argument(
+    '--manifest', metavar="MANIFEST", type=str, default=None,
+    help='File where the scan mode writes its manifest (default: stdout).')
+  parser.add_argument(
+    '--lease-seconds', metavar="SECONDS", type=float, default=300.0,
+    help='Work mode: a claimed job goes back to the queue if the worker stops '
+      'renewing its lease for this long.')
+  parser.add_argument(
+    '--twitch-engine', metavar="ENGINE", type=str, default="cli",
+    choices=["cli", "native"],
+    help='"cli" runs TwitchDownloaderCLI for each video, "native" fetches chats '
+      'from the Twitch API directly and compresses them on the fly.')
+  parser.add_argument(
+    '--youtube-engine', metavar="ENGINE", type=str, default="ytdlp",
+    choices=["ytdlp", "native"],
+    help='"ytdlp" runs yt-dlp for each video, "native" follows the live chat '
+      'replay itself and compresses it on the fly.')
+  parser.add_argument(
+    '--download-jobs', metavar="N", type=int, default=1,
+    help='Number of videos downloaded at the same time (download mode).')
+  parser.add_argument(
+    '--metadata-cache', metavar="DB", type=str, default=None,
+    help='SQLite cache of what is known about each Youtube video (availability, '
+      'live status, live chat), to skip videos known to have no chat and to '
+      'reuse the info JSON of yt-dlp instead of extracting pages again.')
+  parser.add_argument(
+    '--metadata-ttl', metavar="DAYS", type=float, default=7.0,
+    help='Days after which entries of --metadata-cache are extracted again.')
+  parser.add_argument(
+    '--metadata-max-entries', metavar="N", type=int, default=100_000,
+    help='Least recently used entries of --metadata-cache are evicted past N.')
+  parser.add_argument(
+    '--staging-dir', metavar="DIR", type=str, default=None,
+    help='Local directory (SSD, tmpfs) where subs are downloaded and '
+      'compressed, before being moved to their final directory in batches.')
+  parser.add_argument(
+    '--staging-batch', metavar="N", type=int, default=32,
+    help='Number of finished files moved out of --staging-dir at once.')
   parser.add_argument(
     '--dry-run', action="store_true",
     help='Only print what is done but do not download anything.')
   parser.add_argument(
     'path', metavar='PATH', type=str,
     help='Path where to look up for files. This can be a directory in which case'
-      ' we will scan for missing subtitle files. If this is a text file, each '
-      'line holds a videoId that will be downloaded in the current directory.')
+      ' we will scan for missing subtitle files. If this is a manifest written by'
+      ' the scan mode ("-" to read it from stdin), its records are downloaded as'
+      ' they are read. If this is a text file, each line holds a videoId '
+      '(optionally prefixed with "youtube " or "twitch ", "#" starts a comment) '
+      'whose subs are downloaded in --output-path, unless they are already '
+      'there or recorded as done. The list is read as it is downloaded.')
   pargs = parser.parse_args(args)
   return pargs
 
@@ -486,9 +1244,9 @@ def parse_args(args):
 def setup_logger(
   log_level: str = "WARNING",
   output_path: Optional[Path] = None
-) -> None:
+) -> Path:
   """
-  Add file handler to the global log object.
+  Add file handler to the global log object. Return the path to the log file.
   """
   if not output_path:
     output_path = Path() / ("subs.log")
@@ -509,134 +1267,282 @@ def setup_logger(
     format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
     level=level
   )
-  log.setLevel(logging.DEBUG)
+  # Records below the requested level are dropped before being formatted
+  log.setLevel(level)
+  return output_path
 
 
 def main(args=None) -> int:
   pargs: argparse.Namespace = parse_args(args)
-  setup_logger(log_level=pargs.log_level)
+  log_path = setup_logger(log_level=pargs.log_level)
+  add_phase_hook(REGISTRY.phase)
+  profiler = None
+  if pargs.profile:
+    profiler = Profiler(log_path.absolute().parent, "subs", kind=pargs.profiler)
+    profiler.start()
+  try:
+    return run_mode(pargs)
+  finally:
+    if profiler is not None:
+      profiler.stop()
+    write_metrics(pargs)
+
+
+def write_metrics(pargs: argparse.Namespace) -> None:
+  try:
+    if pargs.metrics_textfile:
+      REGISTRY.write_textfile(pargs.metrics_textfile)
+    if pargs.metrics_json:
+      REGISTRY.write_json(
+        pargs.metrics_json, mode=pargs.mode, target=str(Path(pargs.path).absolute()))
+  except OSError as e:
+    log.exception(e)
+    print(f"Failed to write metrics: {e}")
+
+
+def selected_services(pargs: argparse.Namespace) -> List[str]:
+  if pargs.service == "all":
+    return [TWITCH, YOUTUBE]
+  return [TWITCH if pargs.service == "twitch" else YOUTUBE]
+
+
+def make_handlers(
+  pargs: argparse.Namespace,
+  state: StateStore,
+  ignored: IdSet,
+  yt_downloader_path: Optional[str],
+  twitch_downloader_path: Optional[str],
+  staging: Optional[StagingArea] = None,
+  metadata: Optional[MetadataCache] = None,
+  audit: Optional[CompressionAudit] = None
+) -> List[ProcessHandler]:
+  # HACK it is important that Twitch handler be first because Youtube's 
+  # regex is greedier and would return too many false positives
+  services: List[ProcessHandler] = []
+  selected = selected_services(pargs)
+
+  if TWITCH in selected:
+    services.append(TwitchHandler(
+        cookies=pargs.cookies,
+        process_path=twitch_downloader_path,
+        state=state,
+        ignored=ignored,
+        engine=pargs.twitch_engine,
+        jobs=pargs.download_jobs,
+        staging=staging,
+        verify=pargs.verify_compressed,
+        audit=audit
+      )
+    )
+  if YOUTUBE in selected:
+    services.append(YoutubeHandler(
+        cookies=pargs.cookies,
+        process_path=yt_downloader_path,
+        state=state,
+        ignored=ignored,
+        engine=pargs.youtube_engine,
+        jobs=pargs.download_jobs,
+        staging=staging,
+        verify=pargs.verify_compressed,
+        audit=audit,
+        metadata=metadata,
+        slim=pargs.slim_chat,
+        keep_original=pargs.keep_original_chat
+      )
+    )
+  return services
+
 
+def run_mode(pargs: argparse.Namespace) -> int:
   filter_dir_re = None
   if pargs.exclude_regex:
     filter_dir_re = re.compile(pargs.exclude_regex, re.IGNORECASE)
 
   supplied_path = Path(pargs.path)
-  if not supplied_path.exists():
+  from_stdin = pargs.path == "-"
+  if not from_stdin and not supplied_path.exists():
     print("Supplied path doesn't exist.")
     return 1
 
-  yt_downloader_path = getenv("YTDL")
-  if not yt_downloader_path:
-    print("No Youtube downloader found in env variable \"YTDL\"!")
-
-  twitch_downloader_path = getenv("TDCLI")
-  if not twitch_downloader_path:
-    print("No Twitch downloader found in env variable \"TDCLI\"!")
+  if pargs.mode == "scan":
+    if from_stdin or not supplied_path.is_dir():
+      print("The scan mode expects a directory.", file=sys.stderr)
+      return 1
+    out = open(pargs.manifest, "w", encoding="utf-8") \
+      if pargs.manifest else sys.stdout
+    try:
+      with phase("scan"):
+        count = write_manifest(
+          scan(supplied_path, filter_dir_re, services=selected_services(pargs)),
+          out)
+    finally:
+      if out is not sys.stdout:
+        out.close()
+    # stdout may be the manifest itself
+    print(f"Written {count} manifest records.", file=sys.stderr)
+
+  elif pargs.mode in ("download", "work"):
+    # Programs are only looked up in PATH when the first download starts
+    yt_downloader_path = getenv("YTDL")
+    if not yt_downloader_path and pargs.youtube_engine == "ytdlp":
+      print("No Youtube downloader found in env variable \"YTDL\"!")
+
+    twitch_downloader_path = getenv("TDCLI")
+    if not twitch_downloader_path and pargs.twitch_engine == "cli":
+      print("No Twitch downloader found in env variable \"TDCLI\"!")
 
-  if pargs.mode == "download":
     output_path = Path(pargs.output_path) if pargs.output_path is not None \
       else Path()
 
-    ignored_file = Path("ignored_subs.txt")
-    ignored_set = set()
-    if ignored_file.exists():
-      with open(ignored_file, 'r') as f:
-        for line in f.readlines():
-          ignored_set.add(line.strip())
-      if ignored_set:
-        print(f"Loaded {len(ignored_set)} Ids to ignore from {ignored_file}")
+    state = StateStore(pargs.state_db)
+    # Lists written by previous versions (yt_subs_failed.txt,
+    # twitch_subs_failed.txt, ignored_subs.txt) are imported whenever they change
+    if imported := import_subs_lists(state):
+      print(f"Imported {imported} Ids from legacy text lists into {state.path}.")
+
+    ignored = IdSet()
+    for ignore_list in pargs.ignore_list:
+      ignored.update(IdSet.from_lines(ignore_list))
+    if len(ignored):
+      print(f"Loaded {len(ignored)} Ids to ignore from {', '.join(pargs.ignore_list)}")
 
     if output_path.is_file():
-      # FIXME this file should be loaded instead!
       print(
-        f"{output_path} is an existing file. Will output to current working "
-        "directory instead.")
-      output_path = Path()
-
-    # HACK it is important that Twitch handler be first because Youtube's 
-    # regex is greedier and would return too many false positives
-    services: List[ProcessHandler] = []
-
-    if pargs.service == "twitch" or "all":
-      services.append(TwitchHandler(
-          cookies=pargs.cookies, 
-          process_path=twitch_downloader_path,
-          ignored=ignored_set
-        )
-      )
-    if pargs.service == "youtube" or "all":
-      services.append(YoutubeHandler(
-          cookies=pargs.cookies, 
-          process_path=yt_downloader_path,
-          ignored=ignored_set
-        )
-      )
-
-    for root, f in crawl_files(supplied_path, filter_re=filter_dir_re):
-      for search in services:
-        if search.scanner.match(root, f):
-          log.debug(f"{search.service_name} videoId found in {f}.")
-          # Optimization: we had a match, skip any other lookup
-          break
-        else:
-          log.debug(f"No {search.service_name} videoId found in {f}.")
-
-    for search in services:
-      print(f"Found {len(search.to_download)} {search.service_name} videoIds to download: ")
-      for _id, _ in search.to_download.items():
-        print(_id)
-
-      log.debug(
-        f"{len(search.scanner.store.keys())} files found by regexes: ")
-
-      # FIXME This assumes the logger has a FileHandler
-      with open(log.handlers[0].baseFilename, 'a') as f:
-        # Avoid printing to stdout, only to log file instead
-        original_stdout = sys.stdout
-        sys.stdout = f
-        pprint(search.scanner.store)
-        sys.stdout = original_stdout
-
-      log.debug(
-        f"{len(search.to_download)} {search.service_name} subs to download:\n" +
-        '\n'.join(f'{id}: {paths}' for id, paths in search.to_download.items())
-      )
-
-      if len(search.to_download) == 0:
-        continue
-
-      if pargs.dry_run:
-        continue
-
-      downloaded, compressed, failed = search.download(
-        compression=pargs.compression,
-        out_path=output_path,
-        remove_compressed=pargs.remove_compressed
-      )
-
+        f"{output_path} is an existing file. Lists of videoIds are read from "
+        "PATH, --output-path must be a directory.", file=sys.stderr)
+      state.close()
+      return 1
+
+    if pargs.cookies and missing_paths([pargs.cookies]):
+      print(f"Cookies file {pargs.cookies} does not exist.", file=sys.stderr)
+      state.close()
+      return 1
+
+    staging = None
+    if pargs.staging_dir:
+      staging = StagingArea(pargs.staging_dir, batch_size=pargs.staging_batch)
+      if not pargs.dry_run:
+        staging.recover()
+
+    metadata = None
+    if pargs.metadata_cache and YOUTUBE in selected_services(pargs):
+      metadata = MetadataCache(
+        pargs.metadata_cache, ttl=pargs.metadata_ttl * 24 * 3600,
+        max_entries=pargs.metadata_max_entries)
+
+    services = make_handlers(
+      pargs, state, ignored,
+      yt_downloader_path=yt_downloader_path,
+      twitch_downloader_path=twitch_downloader_path,
+      staging=staging,
+      metadata=metadata,
+      audit=CompressionAudit(pargs.audit_log) if pargs.audit_log else None)
+
+    if pargs.mode == "work":
+      queue = WorkQueue(supplied_path, lease_seconds=pargs.lease_seconds)
+      print(f"Worker {queue.worker} claiming jobs from {supplied_path}.")
+      try:
+        with phase("download"):
+          results = work(
+            queue, services,
+            compression=pargs.compression,
+            out_path=output_path,
+            remove_compressed=pargs.remove_compressed)
+      finally:
+        queue.close()
+        state.close()
+        if metadata is not None:
+          metadata.close()
       print(
-        f"Successfully downloaded {len(downloaded)} / "
-        f"{len(search.to_download)} subtitle files."
-      )
+        "Queue is empty. Results: "
+        + ", ".join(f"{count} {result}" for result, count in results.items()))
+      return 0
 
-      if len(failed) > 0:
+    if from_stdin or supplied_path.is_file():
+      source = open_manifest(pargs.path)
+      try:
+        with phase("download"):
+          results, failed = download_manifest(
+            read_manifest(source), services,
+            compression=pargs.compression,
+            out_path=output_path,
+            remove_compressed=pargs.remove_compressed,
+            dry_run=pargs.dry_run,
+            jobs=pargs.download_jobs,
+            known_subs=existing_subs(output_path, selected_services(pargs)))
+      finally:
+        if source is not sys.stdin:
+          source.close()
+        state.close()
+        if metadata is not None:
+          metadata.close()
+      print(
+        f"Successfully downloaded {results.get('ok', 0)} / "
+        f"{sum(results.values())} subtitle files.")
+      if failed:
         print("Failed getting subtitles for these ids:")
         for fail in failed:
           print(fail)
+      return 0
+
+    try:
+      with phase("download"):
+        consumer = stream_downloads(
+          supplied_path, filter_dir_re, services,
+          compression=pargs.compression,
+          out_path=output_path,
+          remove_compressed=pargs.remove_compressed,
+          dry_run=pargs.dry_run,
+          jobs=pargs.download_jobs)
+    finally:
+      state.close()
+      if metadata is not None:
+        metadata.close()
+
+    print(
+      f"Successfully downloaded {consumer.results.get('ok', 0)} / "
+      f"{sum(consumer.results.values())} subtitle files."
+    )
+
+    if consumer.failed:
+      print("Failed getting subtitles for these ids:")
+      for fail in consumer.failed:
+        print(fail)
+
+    if consumer.not_compressed:
+      print("Subs that failed to compress:")
+      for s in consumer.not_compressed:
+        print(s)
 
-      if len(downloaded) != len(compressed):
-        print("Subs that failed to compress:")
-        for s in [_s for _s in downloaded if _s not in compressed]:
-          print(s)
+    if late := consumer.late_subs():
+      print(
+        "Subs for these ids were found in another directory after they had "
+        "been downloaded again:")
+      for service, _id in late:
+        print(f"{service} {_id}")
 
   elif pargs.mode == "compress":
-    for c in compress_subs(
+    with phase("compress"):
+      for c in compress_subs(
+        supplied_path,
+        compression=pargs.compression,
+        remove_compressed=pargs.remove_compressed,
+        verify=pargs.verify_compressed,
+        audit=CompressionAudit(pargs.audit_log) if pargs.audit_log else None
+      ):
+        if c is not None:
+          print(f"Written {c}")
+
+  elif pargs.mode == "stats":
+    # Pulls in multiprocessing, only needed by this mode
+    import chat_stats
+    failed = chat_stats.report(
       supplied_path,
-      compression=pargs.compression,
-      remove_compressed=pargs.remove_compressed
-    ):
-      if c is not None:
-        print(f"Written {c}")
+      jobs=pargs.jobs,
+      cache_path=Path(pargs.stats_cache) if pargs.stats_cache else None
+    )
+    if failed:
+      return 1
 
   return 0
 
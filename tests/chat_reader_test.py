@@ -0,0 +1,72 @@
+import bz2
+import io
+from pathlib import Path
+from unittest import TestCase
+
+from ytdl_batch.chat_reader import (
+  JSONStream, ReadaheadReader, iter_messages, open_chat, parse_amount
+)
+from .chat_stats_test import twitch_doc, write_yt
+
+
+def test_youtube_records(tmp_path):
+  path = write_yt(tmp_path, "a [abcdefghijk].live_chat.json.bz2", opener=bz2.open)
+  messages = list(iter_messages(path))
+  assert len(messages) == 5
+  assert messages[0].service == "youtube"
+  assert messages[0].author_name == "alice"
+  assert messages[0].text == "hi"
+  assert messages[0].offset == 1.0
+  assert messages[-1].kind == "paid"
+  assert (messages[-1].currency, messages[-1].amount) == ("$", 2.5)
+
+
+def test_detect_format_from_content(tmp_path):
+  # The file name does not follow the date_videoId pattern
+  path = tmp_path / "renamed.json"
+  path.write_text(twitch_doc([(1.5, "a", 0), (61, "b", 100)]))
+  messages = list(iter_messages(path))
+  assert [m.service for m in messages] == ["twitch", "twitch"]
+  assert messages[1].kind == "paid"
+  assert messages[1].author_name == "B"
+
+
+def test_readahead_matches_plain_read(tmp_path):
+  data = b"".join(b"line %d\n" % i for i in range(100_000))
+  path = tmp_path / "data.bz2"
+  path.write_bytes(bz2.compress(data))
+  with open_chat(path) as fd:
+    assert fd.read() == data
+  with open_chat(path) as fd:
+    assert sum(1 for _ in fd) == 100_000
+
+
+def test_readahead_early_close(tmp_path):
+  raw = ReadaheadReader(io.BytesIO(b"x" * 1_000_000), chunk_size=10, depth=2)
+  assert raw.read(5) == b"xxxxx"
+  # Must not hang while the producer waits on a full queue
+  raw.close()
+  assert raw.closed
+
+
+class TestJSONStream(TestCase):
+
+  def test_small_chunks(self):
+    # Elements and skipped values straddle chunk boundaries
+    doc = twitch_doc([(i, f"user{i}", 0) for i in range(50)])
+    for chunk_size in (1, 2, 7, 64):
+      with self.subTest(chunk_size=chunk_size):
+        stream = JSONStream(io.StringIO(doc), chunk_size=chunk_size)
+        comments = list(stream.iter_array("comments"))
+        self.assertEqual(len(comments), 50)
+        self.assertEqual(comments[-1]["commenter"]["_id"], "user49")
+
+  def test_missing_key(self):
+    stream = JSONStream(io.StringIO('{"a": 1, "b": "x]"}'), chunk_size=3)
+    self.assertEqual(list(stream.iter_array("comments")), [])
+
+  def test_parse_amount(self):
+    self.assertEqual(parse_amount("$5.00"), ("$", 5.0))
+    self.assertEqual(parse_amount("¥1,000"), ("¥", 1000.0))
+    self.assertEqual(parse_amount("1.000,50 €"), ("€", 1000.5))
+    self.assertEqual(parse_amount("CA$10.00"), ("CA$", 10.0))
@@ -0,0 +1,120 @@
+import bz2
+import gzip
+import io
+import json
+from pathlib import Path
+
+import pytest
+
+from ytdl_batch.chat_reader import iter_messages
+from ytdl_batch.chat_slim import slim_chat, slim_file, original_path
+from ytdl_batch.state import StateStore
+from .conftest import FakeHandler
+
+THUMBNAILS = {"thumbnails": [
+  {"url": f"https://yt4.ggpht.com/abcdef=s{size}-c-k-c0x00ffffff-no-rj", "width": size,
+   "height": size} for size in (32, 64)]}
+
+
+def renderer(i: int) -> dict:
+  return {
+    "message": {"runs": [
+      {"text": f"hello {i} "},
+      {"emoji": {"emojiId": "UCx/abc", "shortcuts": [":_wave:"], "image": THUMBNAILS}},
+    ]},
+    "authorName": {"simpleText": f"user{i % 7}"},
+    "authorPhoto": THUMBNAILS,
+    "contextMenuEndpoint": {
+      "clickTrackingParams": "CAEQl98BIhMI" * 8,
+      "commandMetadata": {"webCommandMetadata": {"ignoreNavigation": True}},
+      "liveChatItemContextMenuEndpoint": {"params": "Q2g0S0dnb2FD" * 20}},
+    "id": f"ChwKGkNQ{i:010}",
+    "timestampUsec": str(1641500000000000 + i * 1_000_000),
+    "authorBadges": [{"liveChatAuthorBadgeRenderer": {
+      "customThumbnail": THUMBNAILS, "tooltip": "Member (1 year)",
+      "accessibility": {"accessibilityData": {"label": "Member (1 year)"}}}}],
+    "authorExternalChannelId": f"UC{i % 7:022}",
+    "contextMenuAccessibility": {"accessibilityData": {"label": "Chat actions"}},
+  }
+
+
+def line(i: int) -> str:
+  if i % 10 == 9:
+    item = {"liveChatPaidMessageRenderer": dict(
+      renderer(i), purchaseAmountText={"simpleText": "$5.00"})}
+  else:
+    item = {"liveChatTextMessageRenderer": renderer(i)}
+  return json.dumps({
+    "clickTrackingParams": "CAEQl98BIhMI" * 4,
+    "replayChatItemAction": {
+      "actions": [
+        {"clickTrackingParams": "CAEQl98BIhMI", "addChatItemAction": {
+          "item": item, "clientId": "CNjJ7"}},
+        # Not a message
+        {"addLiveChatTickerItemAction": {"item": {}, "durationSec": "10"}},
+      ],
+      "videoOffsetTimeMsec": str(1000 * i)
+    }
+  })
+
+
+@pytest.fixture
+def chat(tmp_path) -> Path:
+  path = tmp_path / "20220106 [Gawr Gura] chat with me [zp0sfEVWH9A].live_chat.json"
+  path.write_text("".join(line(i) + "\n" for i in range(100)))
+  return path
+
+
+def test_same_messages_in_fewer_bytes(chat, tmp_path):
+  out = io.BytesIO()
+  assert slim_chat(io.BytesIO(chat.read_bytes()), out) == (100, 100)
+  assert len(out.getvalue()) * 5 < chat.stat().st_size
+
+  slim = tmp_path / "slim.live_chat.json"
+  slim.write_bytes(out.getvalue())
+  full = list(iter_messages(chat))
+  assert list(iter_messages(slim)) == full
+  assert full[9].kind == "paid" and full[9].amount == 5.0
+  assert full[0].text == "hello 0 :_wave:"
+  assert full[0].badges == ("Member (1 year)",)
+
+
+def test_slim_compressed_file_in_place(chat):
+  path = chat.with_name(chat.name + ".gz")
+  path.write_bytes(gzip.compress(chat.read_bytes()))
+  full = list(iter_messages(path))
+
+  kept = slim_file(path, keep_original=True)
+  assert kept == original_path(path)
+  assert kept.name.endswith(".live_chat.orig.json.gz")
+  assert gzip.decompress(kept.read_bytes()) == chat.read_bytes()
+  assert list(iter_messages(path)) == full
+  assert not list(path.parent.glob("*.tmp"))
+
+  # A slim chat is not slimmed again, and is left untouched
+  with pytest.raises(ValueError):
+    slim_file(path)
+  assert list(iter_messages(path)) == full
+
+
+def test_newer_schema_is_refused(tmp_path):
+  path = tmp_path / "a.live_chat.json"
+  path.write_text('{"schema": "ytdl_batch/slim_live_chat", "version": 99}\n{}\n')
+  with pytest.raises(ValueError):
+    list(iter_messages(path))
+
+
+def test_handler_slims_before_compressing(chat, tmp_path):
+  out = tmp_path / "out"
+  out.mkdir()
+  with StateStore(tmp_path / "state.db") as state:
+    handler = FakeHandler(
+      state, content=chat.read_text(), slim=True, keep_original=True)
+    result, _, compressed = handler.download_one(
+      "zp0sfEVWH9A", [], compression="bz2", out_path=out, remove_compressed=True)
+
+  assert result == "ok"
+  assert sorted(p.name for p in out.iterdir()) == [
+    "zp0sfEVWH9A.live_chat.json.bz2", "zp0sfEVWH9A.live_chat.orig.json.bz2"]
+  assert bz2.decompress(compressed.read_bytes()).startswith(b'{"schema": ')
+  assert list(iter_messages(compressed)) == list(iter_messages(chat))
@@ -0,0 +1,108 @@
+import bz2
+import gzip
+import json
+from pathlib import Path
+
+from ytdl_batch.chat_stats import StatsCache, collect_stats, compute_stats
+
+
+def yt_line(offset_ms, author_id, name, amount=None):
+  if amount is None:
+    item = {"liveChatTextMessageRenderer": {
+      "message": {"runs": [{"text": "hi"}]},
+      "authorName": {"simpleText": name},
+      "authorExternalChannelId": author_id,
+    }}
+  else:
+    item = {"liveChatPaidMessageRenderer": {
+      "purchaseAmountText": {"simpleText": amount},
+      "authorName": {"simpleText": name},
+      "authorExternalChannelId": author_id,
+    }}
+  return json.dumps({
+    "replayChatItemAction": {
+      "actions": [{"addChatItemAction": {"item": item}}],
+      "videoOffsetTimeMsec": str(offset_ms)
+    }
+  })
+
+
+def twitch_doc(comments):
+  return json.dumps({
+    "FileInfo": {"Version": {"Major": 1}},
+    "streamer": {"name": "someone", "id": 1},
+    "video": {"title": "a \"quoted\" [title] {x}", "length": 120},
+    "comments": [
+      {
+        "_id": str(i),
+        "content_offset_seconds": offset,
+        "commenter": {"_id": author, "display_name": author.upper()},
+        "message": {"body": "hello", "bits_spent": bits},
+      }
+      for i, (offset, author, bits) in enumerate(comments)
+    ],
+    "embeddedData": {"thirdParty": [{"data": "\\\\\"" * 50}]},
+  })
+
+
+def write_yt(tmp_path: Path, name: str, opener=open) -> Path:
+  path = tmp_path / name
+  lines = [
+    yt_line(1000, "UC1", "alice"),
+    yt_line(30000, "UC2", "bob"),
+    yt_line(65000, "UC1", "alice"),
+    yt_line(70000, "UC3", "carol", amount="$5.00"),
+    yt_line(80000, "UC3", "carol", amount="$2.50"),
+  ]
+  with opener(path, "wt") as f:
+    f.write("\n".join(lines) + "\n")
+  return path
+
+
+def test_youtube_stats(tmp_path):
+  path = write_yt(tmp_path, "20230101 [author] title [abcdefghijk].live_chat.json")
+  stats = compute_stats(path)
+  assert stats["service"] == "youtube"
+  assert stats["messages"] == 5
+  assert stats["unique_chatters"] == 3
+  assert stats["duration_minutes"] == 2
+  assert stats["per_minute"] == [2, 3]
+  assert stats["top_chatters"][0][1] == 2
+  assert stats["superchats"] == {"$": 7.5}
+  assert stats["superchat_count"] == 2
+
+
+def test_compressed_archives(tmp_path):
+  plain = compute_stats(write_yt(tmp_path, "a [abcdefghijk].live_chat.json"))
+  bz = compute_stats(
+    write_yt(tmp_path, "b [abcdefghijk].live_chat.json.bz2", opener=bz2.open))
+  gz = compute_stats(
+    write_yt(tmp_path, "c [abcdefghijk].live_chat.json.gz", opener=gzip.open))
+  assert plain == bz == gz
+
+
+def test_twitch_stats(tmp_path):
+  path = tmp_path / "20230101_1234567890.json"
+  path.write_text(
+    twitch_doc([(1.5, "a", 0), (61, "b", 100), (62, "a", 0), (130, "c", 0)]))
+  stats = compute_stats(path)
+  assert stats["service"] == "twitch"
+  assert stats["messages"] == 4
+  assert stats["unique_chatters"] == 3
+  assert stats["per_minute"] == [1, 2, 1]
+  assert stats["superchats"] == {"bits": 100}
+
+
+def test_cache_hits(tmp_path):
+  path = write_yt(tmp_path, "a [abcdefghijk].live_chat.json")
+  cache_path = tmp_path / "cache.json"
+  cache = StatsCache(cache_path)
+  first = list(collect_stats([path], cache=cache, jobs=1))
+  cache.save()
+
+  cache = StatsCache(cache_path)
+  assert cache.get(path) == first[0][1]
+  # Any change to the archive invalidates its entry
+  with open(path, "a") as f:
+    f.write(yt_line(90000, "UC4", "dave") + "\n")
+  assert cache.get(path) is None
@@ -0,0 +1,113 @@
+import bz2
+import os
+
+import pytest
+
+from ytdl_batch.chatpack import (
+  ChatPack, PACK_NAME, pack_directories, main
+)
+from ytdl_batch.manifest import scan
+from ytdl_batch.state import YOUTUBE, TWITCH
+
+YT_MEDIA = "20220106 Gawr Gura Ch. hololive-EN chat with mee_[240]_zp0sfEVWH9A.mkv"
+YT_SUB = "20220106 Gawr Gura Ch. hololive-EN chat with mee_[240]_zp0sfEVWH9A.live_chat.json.bz2"
+YT_MEDIA2 = "20220201 Gawr Gura [test] testname [240]_zwEIsPcwwdk.mp4"
+TWITCH_MEDIA = "20220121 AmarisYuri PARANORMAL-SCARY VIDEOS [270]_1271243650.mp4"
+TWITCH_SUB = "20220121_1271243650.json.bz2"
+
+
+def chat(path, text: str):
+  path.write_bytes(bz2.compress(text.encode() * 100))
+  return path
+
+
+def test_append_lookup_extract(tmp_path):
+  a = chat(tmp_path / YT_SUB, "a")
+  b = chat(tmp_path / TWITCH_SUB, "b")
+  os.utime(a, (1_600_000_000, 1_600_000_000))
+  pack = ChatPack(tmp_path / PACK_NAME)
+  assert pack.append([(a, YOUTUBE, "zp0sfEVWH9A"), (b, TWITCH, "1271243650")]) == [a, b]
+
+  # A new reader sees both
+  pack = ChatPack(tmp_path / PACK_NAME)
+  assert len(pack) == 2
+  assert (TWITCH, "1271243650") in pack and (YOUTUBE, "1271243650") not in pack
+  [member] = pack.lookup(YOUTUBE, "zp0sfEVWH9A")
+  data = a.read_bytes()
+  assert pack.read(member) == data
+
+  a.unlink()
+  assert pack.extract(member, tmp_path) == a
+  assert a.read_bytes() == data and a.stat().st_mtime == 1_600_000_000
+
+
+def test_replace_and_compact(tmp_path):
+  a = chat(tmp_path / YT_SUB, "a")
+  pack = ChatPack(tmp_path / PACK_NAME)
+  pack.append([(a, YOUTUBE, "zp0sfEVWH9A")])
+  chat(a, "newer")
+  pack.append([(a, YOUTUBE, "zp0sfEVWH9A")])
+  assert len(pack) == 1
+  size = pack.path.stat().st_size
+  assert size > pack.live_bytes + len(a.read_bytes())
+
+  reclaimed = pack.compact()
+  assert reclaimed > 0 and pack.path.stat().st_size == size - reclaimed
+  pack = ChatPack(tmp_path / PACK_NAME)
+  assert bz2.decompress(pack.read(pack.lookup(YOUTUBE, "zp0sfEVWH9A")[0])).startswith(b"newer")
+
+
+def test_interrupted_append_keeps_last_index(tmp_path):
+  a = chat(tmp_path / YT_SUB, "a")
+  pack = ChatPack(tmp_path / PACK_NAME)
+  pack.append([(a, YOUTUBE, "zp0sfEVWH9A")])
+  good = pack.path.stat().st_size
+  # Members written, but neither their index nor its footer
+  with open(pack.path, "ab") as f:
+    f.write(bz2.compress(b"cut") + b"YTCHPAK1")
+
+  pack = ChatPack(tmp_path / PACK_NAME)
+  assert len(pack) == 1 and pack.end == good
+  b = chat(tmp_path / TWITCH_SUB, "b")
+  pack.append([(b, TWITCH, "1271243650")])
+  assert len(ChatPack(tmp_path / PACK_NAME)) == 2
+
+
+def test_newer_version_is_refused(tmp_path):
+  from ytdl_batch import chatpack
+  a = chat(tmp_path / YT_SUB, "a")
+  pack = ChatPack(tmp_path / PACK_NAME)
+  pack.append([(a, YOUTUBE, "zp0sfEVWH9A")])
+  chatpack.VERSION, version = 99, chatpack.VERSION
+  try:
+    pack.append([(a, YOUTUBE, "zp0sfEVWH9A")])
+  finally:
+    chatpack.VERSION = version
+  with pytest.raises(ValueError):
+    ChatPack(tmp_path / PACK_NAME)
+
+
+def test_scanners_see_packed_subs(tmp_path):
+  channel = tmp_path / "channel"
+  channel.mkdir()
+  for name in (YT_MEDIA, YT_MEDIA2, TWITCH_MEDIA):
+    (channel / name).touch()
+  chat(channel / YT_SUB, "a")
+  chat(channel / TWITCH_SUB, "b")
+  # Plain chats may still be written to, they are left alone
+  (channel / "20220201 [test] [zwEIsPcwwdk].live_chat.json").write_text("{}")
+
+  assert pack_directories(tmp_path, remove=True) == (2, 1)
+  assert sorted(p.name for p in channel.iterdir() if ".json" in p.name or p.suffix == ".pack") \
+    == ["20220201 [test] [zwEIsPcwwdk].live_chat.json", PACK_NAME]
+
+  records = {(r.service, r.id): r for r in scan(tmp_path)}
+  assert records[(YOUTUBE, "zp0sfEVWH9A")].sub_paths == [str(channel / PACK_NAME / YT_SUB)]
+  assert records[(TWITCH, "1271243650")].sub_paths == [str(channel / PACK_NAME / TWITCH_SUB)]
+  assert records[(YOUTUBE, "zwEIsPcwwdk")].sub_paths
+
+  # Packing again has nothing left to do
+  assert pack_directories(tmp_path, remove=True) == (0, 0)
+
+  assert main(["extract", str(channel), "zp0sfEVWH9A"]) == 0
+  assert (channel / YT_SUB).exists()
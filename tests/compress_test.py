@@ -0,0 +1,99 @@
+import bz2
+import gzip
+
+import pytest
+
+from ytdl_batch import subs
+from ytdl_batch.subs import (
+  compress, compress_subs, verify_compressed, CompressionAudit
+)
+
+CHAT = b'{"replayChatItemAction": {}}\n' * 50_000
+
+
+@pytest.mark.parametrize("algo, decompress", [("bz2", bz2.decompress), ("gz", gzip.decompress)])
+def test_compress_verifies_then_removes(tmp_path, algo, decompress):
+  original = tmp_path / "a.live_chat.json"
+  original.write_bytes(CHAT)
+  audit = CompressionAudit(tmp_path / "audit.tsv")
+
+  out = compress(original, algo=algo, on_success="remove", audit=audit)
+  assert out == tmp_path / f"a.live_chat.json.{algo}"
+  assert not original.exists()
+  assert decompress(out.read_bytes()) == CHAT
+  assert not list(tmp_path.glob("*.tmp"))
+
+  _, logged_algo, digest, size, verified, out_path, in_path = \
+    audit.path.read_text().rstrip("\n").split("\t")
+  assert (logged_algo, int(size), verified) == (algo, len(CHAT), "ok")
+  assert (out_path, in_path) == (str(out), str(original))
+  assert verify_compressed(out, algo, digest, len(CHAT))
+  assert not verify_compressed(out, algo, digest, len(CHAT) + 1)
+
+
+def test_corrupt_output_keeps_original(tmp_path, monkeypatch):
+  original = tmp_path / "a.live_chat.json"
+  original.write_bytes(CHAT)
+  compress_file = subs._compress_file
+
+  def truncating(in_fd, out_file, algo):
+    written = compress_file(in_fd, out_file, algo)
+    data = out_file.read_bytes()
+    out_file.write_bytes(data[:len(data) // 2])
+    return written
+  monkeypatch.setattr(subs, "_compress_file", truncating)
+
+  assert compress(original, algo="gz", on_success="remove") is None
+  assert original.read_bytes() == CHAT
+  assert not (tmp_path / "a.live_chat.json.gz").exists()
+
+  # Trusting the compressor skips the check
+  assert compress(original, algo="gz", on_success="remove", verify="never")
+  assert not original.exists()
+
+
+def test_failed_compression_leaves_no_output(tmp_path, monkeypatch):
+  original = tmp_path / "a.live_chat.json"
+  original.write_bytes(CHAT)
+
+  class Exploding():
+    def __init__(self, path, mode):
+      self.f = open(path, mode)
+    def __enter__(self):
+      return self
+    def __exit__(self, *exc):
+      self.f.close()
+    def write(self, chunk):
+      raise OSError(28, "No space left on device")
+  monkeypatch.setattr(subs, "_open_compressed", lambda path, algo, mode: Exploding(path, mode))
+
+  with pytest.raises(OSError):
+    compress(original, algo="gz", on_success="remove")
+  assert original.exists()
+  assert [p.name for p in tmp_path.iterdir()] == ["a.live_chat.json"]
+
+
+def test_compress_subs_verifies_in_background(tmp_path):
+  for i in range(3):
+    (tmp_path / f"{i}.live_chat.json").write_bytes(CHAT)
+  audit = CompressionAudit(tmp_path / "audit.tsv")
+
+  written = list(compress_subs(tmp_path, "bz2", remove_compressed=True, audit=audit))
+  assert sorted(p.name for p in written) == [f"{i}.live_chat.json.bz2" for i in range(3)]
+  # The generator waits for the verifier before returning
+  assert not list(tmp_path.glob("*.json"))
+  assert len(audit.path.read_text().splitlines()) == 3
+
+
+def test_compress_subs_reports_failed_verification(tmp_path, monkeypatch):
+  for i in range(2):
+    (tmp_path / f"{i}.live_chat.json").write_bytes(CHAT)
+  monkeypatch.setattr(
+    subs, "verify_compressed", lambda path, *args: not path.name.startswith("1."))
+
+  written = list(compress_subs(tmp_path, "gz", remove_compressed=True))
+  # The corrupt output is not reported as written
+  assert sorted(p.name for p in written if p is not None) == ["0.live_chat.json.gz"]
+  assert None in written
+  assert sorted(p.name for p in tmp_path.iterdir()) == [
+    "0.live_chat.json.gz", "1.live_chat.json"]
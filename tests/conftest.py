@@ -1,3 +1,8 @@
+from pathlib import Path
+
+from ytdl_batch.regex import YoutubeScanner
+from ytdl_batch.state import YOUTUBE
+from ytdl_batch.subs import ProcessHandler
 
 
 class File():
@@ -61,4 +66,32 @@ TEST_CASES = [
     '20220124 Amaris Yuri SUPER SEISO LEOPARD PLAYING WITH HER FOOD(SUBSCRIBERS!) [270]_1274522871.mp4',
     '1274522871',
     '20220124'),
-]
\ No newline at end of file
+]
+
+
+class FakeDownloader():
+  default_name = "fake"
+
+
+class FakeHandler(ProcessHandler):
+  """
+  Youtube handler whose downloads write content, or raise for the videoIds
+  in fail. Other keyword arguments are passed to ProcessHandler.
+  """
+  service_name = "Youtube"
+  service_key = YOUTUBE
+  downloader = FakeDownloader()
+
+  def __init__(self, state, content="{}", fail=("zwEIsPcwwdk",), **kwargs) -> None:
+    super().__init__(regex=YoutubeScanner(), state=state, **kwargs)
+    self.content = content
+    self.fail = fail
+    self.calls = []
+
+  def _download(self, videoId, args):
+    self.calls.append((videoId, args["out_path"]))
+    if videoId in self.fail:
+      raise Exception("Private video")
+    written = Path(args["out_path"]) / f"{videoId}.live_chat.json"
+    written.write_text(self.content)
+    return written
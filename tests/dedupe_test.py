@@ -0,0 +1,115 @@
+import io
+import os
+
+import pytest
+
+from ytdl_batch import dedupe
+from ytdl_batch.dedupe import (
+  collect, find_duplicates, same_id_variants, link_set, sample_ranges,
+  print_report, main
+)
+
+YT_MEDIA = "20220106 Gawr Gura Ch. hololive-EN chat with mee_[240]_zp0sfEVWH9A.mkv"
+YT_COPY = "20220106 [Gawr Gura] chat with me [360][zp0sfEVWH9A].mkv"
+YT_REENCODE = "20220106 [Gawr Gura] chat with me [720][zp0sfEVWH9A].mp4"
+YT_OTHER = "20220201 Gawr Gura [test] testname [240]_zwEIsPcwwdk.mp4"
+TWITCH_MEDIA = "20220121 AmarisYuri PARANORMAL-SCARY VIDEOS [270]_1271243650.mp4"
+
+SIZE = 1024 * 1024
+
+
+def content(seed: int, size: int = SIZE) -> bytes:
+  return bytes((seed + i * 7) % 251 for i in range(256)) * (size // 256)
+
+
+@pytest.fixture
+def archive(tmp_path):
+  for directory, name, data in (
+    ("a", YT_MEDIA, content(1)),
+    ("b", YT_COPY, content(1)),
+    ("b", YT_REENCODE, content(2)),
+    ("c", YT_OTHER, content(3)),
+    ("c", TWITCH_MEDIA, content(4)),
+  ):
+    (tmp_path / directory).mkdir(exist_ok=True)
+    (tmp_path / directory / name).write_bytes(data)
+  # Same size and samples as YT_OTHER, but one byte differs outside of them
+  middle = bytearray(content(3))
+  middle[SIZE // 8] ^= 0xff
+  (tmp_path / "c" / "20220202 [someone] other [1111111111a].webm").write_bytes(middle)
+  return tmp_path
+
+
+def test_sample_ranges():
+  assert sample_ranges(400, 100) == [(0, 400)]
+  ranges = sample_ranges(10_000, 100)
+  assert ranges[0] == (0, 100) and ranges[-1] == (9_900, 100)
+  assert len(ranges) == 5
+
+
+def test_find_duplicates(archive, monkeypatch):
+  files = collect([archive])
+  assert len(files) == 6
+
+  hashed = []
+  full_hash = dedupe.full_hash
+  monkeypatch.setattr(dedupe, "full_hash", lambda p: hashed.append(p.name) or full_hash(p))
+  duplicates = find_duplicates(files, jobs=2, sample_size=4096)
+
+  assert [[f.path.name for f in d.files] for d in duplicates] == [[YT_MEDIA, YT_COPY]]
+  assert duplicates[0].wasted == SIZE
+  # Only the files whose samples collide are read in full
+  assert sorted(hashed) == sorted([
+    YT_MEDIA, YT_COPY, YT_OTHER, "20220202 [someone] other [1111111111a].webm"])
+
+  variants = same_id_variants(files, duplicates)
+  assert list(variants) == [("youtube", "zp0sfEVWH9A")]
+  assert [f.path.name for f in variants[("youtube", "zp0sfEVWH9A")]] == \
+    [YT_MEDIA, YT_REENCODE]
+
+  out = io.StringIO()
+  print_report(duplicates, variants, out=out)
+  assert "1 duplicate sets, 1.0 MiB to reclaim, 1 videoIds" in out.getvalue()
+
+
+def test_hardlink_duplicates(archive):
+  duplicates = find_duplicates(collect([archive]), sample_size=4096)
+  assert link_set(duplicates[0], "hardlink") == 1
+  a = archive / "a" / YT_MEDIA
+  b = archive / "b" / YT_COPY
+  assert os.path.samefile(a, b)
+  assert not list(archive.rglob("*.dedupe.tmp"))
+  # Already linked files are not reported again
+  assert find_duplicates(collect([archive]), sample_size=4096) == []
+
+
+def test_changed_files_are_not_linked(archive):
+  duplicates = find_duplicates(collect([archive]), sample_size=4096)
+  copy = duplicates[0].files[1].path
+  # Rewritten in place after hashing, same size
+  with open(copy, "r+b") as f:
+    f.write(b"changed")
+  os.utime(copy, ns=(0, duplicates[0].files[1].mtime_ns + 1))
+  assert link_set(duplicates[0], "hardlink") == 0
+  assert not os.path.samefile(duplicates[0].files[0].path, copy)
+  assert copy.read_bytes().startswith(b"changed")
+  assert not list(archive.rglob("*.dedupe.tmp"))
+
+
+def test_reflink_unsupported_leaves_files(archive, monkeypatch):
+  def reflink(src, dst):
+    dst.touch()
+    raise OSError(95, "Operation not supported")
+  monkeypatch.setattr(dedupe, "reflink", reflink)
+  duplicates = find_duplicates(collect([archive]), sample_size=4096)
+  assert link_set(duplicates[0], "reflink") == 0
+  assert (archive / "b" / YT_COPY).stat().st_size == SIZE
+  assert not list(archive.rglob("*.dedupe.tmp"))
+
+
+def test_main_json(archive, capsys):
+  assert main(["--min-size", "1", "--json", "-", str(archive)]) == 0
+  import json
+  report = json.loads(capsys.readouterr().out)
+  assert len(report["duplicates"]) == 1
+  assert report["same_id"][0]["id"] == "zp0sfEVWH9A"
@@ -0,0 +1,68 @@
+import json
+import os
+import pytest
+from ytdl_batch.downloader import util
+from ytdl_batch.downloader.util import find_program, CACHE_ENV
+from ytdl_batch.downloader.ytdl import YTDLDownloader
+from ytdl_batch.downloader.twitch import TwitchDownloaderCLI
+
+
+@pytest.fixture
+def program(tmp_path, monkeypatch):
+  monkeypatch.setattr(util, "_resolved", {})
+  monkeypatch.delenv(CACHE_ENV, raising=False)
+  bin_dir = tmp_path / "bin"
+  bin_dir.mkdir()
+  prog = bin_dir / "fake-dl"
+  prog.write_text("#!/bin/sh\n")
+  prog.chmod(0o755)
+  monkeypatch.setenv("PATH", str(bin_dir))
+  return prog
+
+
+def test_find_in_path(program):
+  assert find_program("fake-dl", None) == str(program)
+  with pytest.raises(Exception):
+    find_program("missing-dl", None)
+
+
+def test_relative_path_is_absolute(program, monkeypatch):
+  monkeypatch.chdir(program.parent)
+  assert find_program("whatever", "./fake-dl") == str(program)
+  with pytest.raises(Exception):
+    find_program("whatever", "./missing-dl")
+
+
+def test_resolved_once_per_process(program, monkeypatch):
+  assert find_program("fake-dl", None) == str(program)
+  monkeypatch.setenv("PATH", "")
+  assert find_program("fake-dl", None) == str(program)
+
+
+def test_cache_across_runs(program, tmp_path, monkeypatch):
+  cache = tmp_path / "programs.json"
+  monkeypatch.setenv(CACHE_ENV, str(cache))
+  assert find_program("fake-dl", None) == str(program)
+  assert list(json.loads(cache.read_text()).values()) == [str(program)]
+
+  # A new process trusts the cache while the program is still executable
+  monkeypatch.setattr(util, "_resolved", {})
+  with monkeypatch.context() as m:
+    m.setattr("shutil.which", lambda *a, **kw: pytest.fail("looked up"))
+    assert find_program("fake-dl", None) == str(program)
+
+  monkeypatch.setattr(util, "_resolved", {})
+  program.chmod(0o644)
+  with pytest.raises(Exception):
+    find_program("fake-dl", None)
+
+
+def test_lazy_handle(program):
+  yt = YTDLDownloader(process_path=None)
+  twitch = TwitchDownloaderCLI(process_path="/nonexistent/TwitchDownloaderCLI")
+  assert yt._handle is None
+  with pytest.raises(Exception):
+    twitch.build_cmd("1234567890", {})
+
+  os.rename(program, program.parent / "yt-dlp")
+  assert yt.build_cmd("zp0sfEVWH9A")[0] == str(program.parent / "yt-dlp")
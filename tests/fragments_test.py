@@ -0,0 +1,106 @@
+import json
+import time
+
+import pytest
+
+from ytdl_batch.downloader.fragments import (
+  FragmentController, FragmentSettings, DownloadStats, parse_speed
+)
+from ytdl_batch.downloader.ytdl import YTDLDownloader
+
+MB = 1024 ** 2
+
+
+def at_hour(hour):
+  return lambda: time.struct_time((2022, 1, 21, hour, 0, 0, 4, 21, 0))
+
+
+@pytest.mark.parametrize("text, expected", [
+  ("2.30MiB/s", 2.3 * MB),
+  ("512.00KiB/s", 512 * 1024),
+  ("1.5MB/s", 1.5e6),
+  ("Unknown B/s", None),
+  (None, None),
+])
+def test_parse_speed(text, expected):
+  assert parse_speed(text) == expected
+
+
+def test_download_stats():
+  stats = DownloadStats()
+  stats.feed("[download]  10.0% of ~ 120.50MiB at 1.00MiB/s", "1.00MiB/s")
+  stats.feed("[download]  20.0% of ~ 120.50MiB at 3.00MiB/s", "3.00MiB/s")
+  assert stats.throughput == 2 * MB
+  assert not stats.is_throttled()
+  for _ in range(3):
+    stats.feed("[download] Got error: timed out. Retrying fragment 12 (1/50)...")
+  assert stats.is_throttled()
+  stats = DownloadStats()
+  stats.feed("ERROR: unable to download video data: HTTP Error 429: Too Many Requests")
+  assert stats.is_throttled() and stats.throughput is None
+
+
+def test_climbs_while_throughput_improves():
+  controller = FragmentController(initial=4, clock=at_hour(2))
+  settings = controller.settings()
+  assert settings == FragmentSettings(4)
+  settings = controller.observe(settings, 2 * MB)
+  assert settings == FragmentSettings(5)
+  settings = controller.observe(settings, 3 * MB)
+  assert settings == FragmentSettings(6)
+  # Slower: back to the best one, and stay there
+  settings = controller.observe(settings, 1 * MB)
+  assert settings == FragmentSettings(5)
+  assert controller.observe(settings, 3 * MB) == FragmentSettings(5)
+
+
+def test_throttling_halves_then_switches_downloader():
+  controller = FragmentController(
+    initial=8, max_fragments=8, external="aria2c", clock=at_hour(14))
+  settings = controller.observe(controller.settings(), None, throttled=True)
+  assert settings == FragmentSettings(4)
+  settings = controller.observe(settings, None, throttled=True)
+  assert settings == FragmentSettings(4, "aria2c")
+  assert controller.observe(settings, None, throttled=True) == FragmentSettings(2, "aria2c")
+
+
+def test_history_per_period_of_the_day(tmp_path):
+  path = tmp_path / "cache" / "throughput.json"
+  night = FragmentController(history_path=path, clock=at_hour(2))
+  for fragments, speed in ((4, 2), (8, 6), (12, 3)):
+    night.observe(FragmentSettings(fragments), speed * MB)
+  day = FragmentController(history_path=path, clock=at_hour(14))
+  day.observe(FragmentSettings(2), 1 * MB)
+  day.observe(FragmentSettings(4), None, throttled=True)
+  night.save()
+  day.save()
+  assert json.loads(path.read_text())["version"] == 1
+  assert not list(path.parent.glob("*.tmp"))
+
+  # The next batch starts from the best setting of its time of the day
+  assert FragmentController(history_path=path, clock=at_hour(1)).settings() \
+    == FragmentSettings(8)
+  assert FragmentController(history_path=path, clock=at_hour(13)).settings() \
+    == FragmentSettings(2)
+  # Settings out of the allowed range are not picked
+  assert FragmentController(
+    history_path=path, max_fragments=6, clock=at_hour(1)).settings() \
+    == FragmentSettings(4)
+
+
+def test_corrupt_history_is_ignored(tmp_path):
+  path = tmp_path / "throughput.json"
+  path.write_text("{not json")
+  assert FragmentController(history_path=path, initial=3).settings() \
+    == FragmentSettings(3)
+
+
+def test_build_cmd_fragments():
+  yt = YTDLDownloader(process_path="/bin/true")
+  cmd = yt.build_cmd("zp0sfEVWH9A", skip_video=False, fragments=7)
+  assert cmd[cmd.index("-N") + 1] == "7"
+  assert "--downloader" not in cmd
+
+  cmd = yt.build_cmd("zp0sfEVWH9A", skip_video=False, fragments=3, external="aria2c")
+  assert cmd[cmd.index("--downloader") + 1] == "aria2c"
+  assert cmd[cmd.index("--downloader-args") + 1] == "aria2c:-c -j 3 -x 3 -s 3 -k 1M"
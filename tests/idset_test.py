@@ -0,0 +1,69 @@
+import random
+import string
+from unittest import TestCase
+
+from ytdl_batch.idset import IdSet, encode_youtube, decode_youtube
+
+YT_LAST = "AEIMQUYcgkosw048"
+YT_CHARS = string.ascii_letters + string.digits + "-_"
+
+
+def random_yt_id(rng):
+  return "".join(rng.choice(YT_CHARS) for _ in range(10)) + rng.choice(YT_LAST)
+
+
+class TestIdSet(TestCase):
+
+  def setUp(self):
+    rng = random.Random(42)
+    self.yt = {random_yt_id(rng) for _ in range(5000)}
+    self.twitch = {str(rng.randrange(10**9, 10**10)) for _ in range(5000)}
+    self.other = {"not an id", "youtube abc", "0123456789"}
+
+  def test_roundtrip_encoding(self):
+    for _id in list(self.yt)[:100] + ["dQw4w9WgXcQ", "__________A", "-_-_-_-_-_w"]:
+      self.assertEqual(decode_youtube(encode_youtube(_id)), _id)
+
+  def test_membership(self):
+    ids = IdSet(self.yt | self.twitch | self.other)
+    self.assertEqual(len(ids), len(self.yt) + len(self.twitch) + len(self.other))
+    for _id in self.yt | self.twitch | self.other:
+      self.assertIn(_id, ids)
+    self.assertNotIn("aaaaaaaaaaA", ids)
+    self.assertNotIn("1000000000", ids)
+    self.assertEqual(set(ids), self.yt | self.twitch | self.other)
+
+  def test_duplicates_and_incremental_adds(self):
+    ids = IdSet(sorted(self.twitch))
+    ids.update(sorted(self.twitch))
+    ids.add("dQw4w9WgXcQ")
+    self.assertEqual(len(ids), len(self.twitch) + 1)
+    self.assertIn("dQw4w9WgXcQ", ids)
+
+  def test_save_and_mmap(self):
+    import tempfile
+    from pathlib import Path
+    ids = IdSet(self.yt | self.twitch | self.other)
+    with tempfile.TemporaryDirectory() as tmp:
+      for bloom in (False, True):
+        path = Path(tmp) / f"ids_{bloom}.idset"
+        ids.save(path, bloom=bloom)
+        for use_mmap in (True, False):
+          with self.subTest(bloom=bloom, use_mmap=use_mmap):
+            loaded = IdSet.load(path, use_mmap=use_mmap)
+            self.assertEqual(len(loaded), len(ids))
+            for _id in self.yt | self.twitch | self.other:
+              self.assertIn(_id, loaded)
+            self.assertNotIn("1000000000", loaded)
+            # Loaded sets can still grow
+            loaded.add("dQw4w9WgXcQ")
+            self.assertIn("dQw4w9WgXcQ", loaded)
+
+  def test_from_lines(self):
+    import tempfile
+    from pathlib import Path
+    with tempfile.TemporaryDirectory() as tmp:
+      path = Path(tmp) / "list.txt"
+      path.write_text("# comment\nyoutube dQw4w9WgXcQ\n1234567890\n\n")
+      ids = IdSet.from_lines(path)
+      self.assertEqual(sorted(ids), ["1234567890", "dQw4w9WgXcQ"])
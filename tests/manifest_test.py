@@ -0,0 +1,252 @@
+import pytest
+import io
+import json
+from pathlib import Path
+from ytdl_batch.manifest import (
+  ManifestRecord, scan, write_manifest, read_manifest, parse_id_line,
+  existing_subs
+)
+from ytdl_batch.state import StateStore, YOUTUBE, TWITCH, DONE, FAILED
+from ytdl_batch.subs import download_manifest
+from .conftest import FakeHandler
+
+YT_MEDIA = "20220106 Gawr Gura Ch. hololive-EN chat with mee_[240]_zp0sfEVWH9A.mkv"
+YT_SUB = "20220106 Gawr Gura Ch. hololive-EN chat with mee_[240]_zp0sfEVWH9A.live_chat.json"
+YT_MEDIA2 = "20220201 Gawr Gura [test] testname [240]_zwEIsPcwwdk.mp4"
+TWITCH_MEDIA = "20220121 AmarisYuri PARANORMAL-SCARY VIDEOS [270]_1271243650.mp4"
+TWITCH_SUB = "20220121_1271243650.json"
+
+
+def make_tree(root: Path) -> None:
+  for directory, names in {
+    "a": [YT_MEDIA, YT_SUB, "notes.txt"],
+    "b": [YT_MEDIA2, TWITCH_MEDIA],
+    "c": [TWITCH_SUB],
+    "excluded": [YT_MEDIA2],
+  }.items():
+    (root / directory).mkdir()
+    for name in names:
+      (root / directory / name).touch()
+
+
+def test_scan_per_directory(tmp_path):
+  import re
+  make_tree(tmp_path)
+  records = list(scan(tmp_path, filter_re=re.compile(".*/excluded/")))
+  by_key = {}
+  for r in records:
+    by_key.setdefault((r.service, r.id), []).append(r)
+
+  assert [r.sub_paths for r in by_key[(YOUTUBE, "zp0sfEVWH9A")]] == \
+    [[str(tmp_path / "a" / YT_SUB)]]
+  assert by_key[(YOUTUBE, "zwEIsPcwwdk")][0].media_paths == [str(tmp_path / "b" / YT_MEDIA2)]
+  # Media and subs of this Id live in different directories
+  twitch = by_key[(TWITCH, "1271243650")]
+  assert len(twitch) == 2
+  assert sorted(bool(r.sub_paths) for r in twitch) == [False, True]
+
+
+def test_roundtrip_and_text_lists():
+  record = ManifestRecord(YOUTUBE, "zp0sfEVWH9A", ["/v/a é.mkv"], [])
+  out = io.StringIO()
+  assert write_manifest([record], out) == 1
+  assert json.loads(out.getvalue())["media_paths"] == ["/v/a é.mkv"]
+
+  source = io.StringIO(
+    out.getvalue() + "# comment\n\nyoutube zwEIsPcwwdk\n1271243650\n{broken\n")
+  assert list(read_manifest(source)) == [
+    record,
+    ManifestRecord(YOUTUBE, "zwEIsPcwwdk", [], []),
+    ManifestRecord(TWITCH, "1271243650", [], []),
+  ]
+
+
+def test_parse_id_lines():
+  assert parse_id_line("zp0sfEVWH9A") == (YOUTUBE, "zp0sfEVWH9A")
+  assert parse_id_line("  youtube zp0sfEVWH9A  # chat with me") == (YOUTUBE, "zp0sfEVWH9A")
+  assert parse_id_line("twitch v1271243650") == (TWITCH, "1271243650")
+  # An 11 digits Id is a Youtube one
+  assert parse_id_line("12712436500") == (YOUTUBE, "12712436500")
+  assert parse_id_line("# zp0sfEVWH9A") is None
+  for line in ("zp0sfEVWH9", "twitch zp0sfEVWH9A", "https://youtu.be/zp0sfEVWH9A"):
+    with pytest.raises(ValueError):
+      parse_id_line(line)
+
+
+def test_download_manifest(tmp_path):
+  media_dir = tmp_path / "media"
+  media_dir.mkdir()
+  out_dir = tmp_path / "out"
+  out_dir.mkdir()
+  records = [
+    # Subs already listed: never downloaded
+    ManifestRecord(YOUTUBE, "aaaaaaaaaaA", [], ["/x/aaaaaaaaaaA.live_chat.json"]),
+    ManifestRecord(YOUTUBE, "aaaaaaaaaaA", [str(media_dir / "a.mkv")], []),
+    ManifestRecord(YOUTUBE, "zp0sfEVWH9A", [str(media_dir / "b.mkv")], []),
+    # Same Id in another directory: attempted once
+    ManifestRecord(YOUTUBE, "zp0sfEVWH9A", [str(media_dir / "c.mkv")], []),
+    # Media directory unknown on this host: written to out_path
+    ManifestRecord(YOUTUBE, "zwEIsPcwwdk", ["/nonexistent/d.mkv"], []),
+    # No handler for this service
+    ManifestRecord(TWITCH, "1271243650", [], []),
+  ]
+  with StateStore(tmp_path / "state.db") as state:
+    handler = FakeHandler(state)
+    results, failed = download_manifest(
+      iter(records), [handler], compression="gz", out_path=out_dir,
+      remove_compressed=True)
+
+    assert handler.calls == [("zp0sfEVWH9A", media_dir), ("zwEIsPcwwdk", out_dir)]
+    assert results == {"ok": 1, "failed": 1}
+    assert failed == ["zwEIsPcwwdk"]
+    assert (media_dir / "zp0sfEVWH9A.live_chat.json.gz").exists()
+    assert state.status(YOUTUBE, "zp0sfEVWH9A") == DONE
+    assert state.status(YOUTUBE, "zwEIsPcwwdk") == FAILED
+
+    # Known failures are skipped on the next run
+    handler.calls.clear()
+    download_manifest(iter(records[4:5]), [handler], compression="gz")
+    assert handler.calls == []
+
+
+def test_download_id_list(tmp_path):
+  out_dir = tmp_path / "out"
+  out_dir.mkdir()
+  (out_dir / "20220106_zp0sfEVWH9A.live_chat.json.bz2").touch()
+  source = io.StringIO(
+    "# from playboard.py\n"
+    "youtube zp0sfEVWH9A\n"
+    "not an id\n"
+    "bbbbbbbbbbB\n"
+    "ccccccccccC # done last week\n"
+    "bbbbbbbbbbB\n"
+    "1271243650\n")
+  with StateStore(tmp_path / "state.db") as state:
+    state.record(YOUTUBE, "ccccccccccC", DONE)
+    handler = FakeHandler(state)
+    results, _ = download_manifest(
+      read_manifest(source), [handler], compression="gz", out_path=out_dir,
+      known_subs=existing_subs(out_dir))
+
+    assert handler.calls == [("bbbbbbbbbbB", out_dir)]
+    assert results == {"ok": 1}
+    assert sorted(existing_subs(out_dir)) == [
+      (YOUTUBE, "bbbbbbbbbbB"), (YOUTUBE, "zp0sfEVWH9A")]
+
+
+def test_download_manifest_jobs(tmp_path):
+  records = [
+    ManifestRecord(YOUTUBE, f"{i:02}aaaaaaaaA", [str(tmp_path / f"{i}.mkv")], [])
+    for i in range(12)
+  ] + [ManifestRecord(YOUTUBE, "zwEIsPcwwdk", [str(tmp_path / "z.mkv")], [])]
+  with StateStore(tmp_path / "state.db") as state:
+    handler = FakeHandler(state)
+    results, failed = download_manifest(
+      iter(records), [handler], compression="gz", out_path=tmp_path, jobs=4)
+
+    assert results == {"ok": 12, "failed": 1}
+    assert failed == ["zwEIsPcwwdk"]
+    assert len(handler.calls) == 13
+    assert state.status(YOUTUBE, "11aaaaaaaaA") == DONE
+
+
+def test_stream_downloads(tmp_path):
+  from ytdl_batch.subs import stream_downloads
+  lib = tmp_path / "lib"
+  lib.mkdir()
+  make_tree(lib)
+  # The subs of this one are in another directory, scanned later or earlier.
+  # Its media directory "b" holds no subs, so it waits for the end of the scan.
+  (lib / "z").mkdir()
+  (lib / "z" / "20220201_zwEIsPcwwdk.live_chat.json").touch()
+  for i in range(20):
+    (lib / f"d{i:02}").mkdir()
+    (lib / f"d{i:02}" / f"20220101 stream [240]_{i:02}aaaaaaaaA.mkv").touch()
+
+  with StateStore(tmp_path / "state.db") as state:
+    handler = FakeHandler(state)
+    consumer = stream_downloads(
+      lib, None, [handler], compression="gz", out_path=tmp_path, max_pending=2)
+    ids = [c[0] for c in handler.calls]
+    assert "zp0sfEVWH9A" not in ids
+    assert sorted(i for i in set(ids) if i.endswith("aaaaaaaaA")) == \
+      [f"{i:02}aaaaaaaaA" for i in range(20)]
+    assert "zwEIsPcwwdk" not in ids
+    assert consumer.results == {"ok": 20}
+    assert consumer.late_subs() == []
+
+
+def test_stream_downloads_settles_held_back(tmp_path):
+  from ytdl_batch.subs import stream_downloads
+  lib = tmp_path / "lib"
+  lib.mkdir()
+  make_tree(lib)
+  # Directories that hold subs have their missing ones downloaded at once
+  (lib / "a" / "20220101 stream [240]_00aaaaaaaaA.mkv").touch()
+  (lib / "z").mkdir()
+  (lib / "z" / "20220101_00aaaaaaaaA.live_chat.json").touch()
+
+  with StateStore(tmp_path / "state.db") as state:
+    handler = FakeHandler(state)
+    consumer = stream_downloads(
+      lib, None, [handler], compression="gz", out_path=tmp_path)
+    # Whether "z" was listed before "a" depends on the file system
+    if "00aaaaaaaaA" in [c[0] for c in handler.calls]:
+      assert consumer.late_subs() == [(YOUTUBE, "00aaaaaaaaA")]
+    # Held back, then settled as it has subs nowhere
+    assert "zwEIsPcwwdk" in consumer.failed
+
+
+def test_consumer_checks_subs_before_download(tmp_path):
+  import threading
+  import time
+  from ytdl_batch.subs import ManifestConsumer
+  started = threading.Event()
+  release = threading.Event()
+
+  class SlowHandler(FakeHandler):
+    def _download(self, videoId, args):
+      started.set()
+      release.wait(5)
+      return super()._download(videoId, args)
+
+  records = [
+    ManifestRecord(YOUTUBE, f"{i:02}aaaaaaaaA", [str(tmp_path / f"{i}.mkv")], [])
+    for i in range(3)
+  ]
+  with StateStore(tmp_path / "state.db") as state:
+    handler = SlowHandler(state)
+    consumer = ManifestConsumer([handler], "gz", out_path=tmp_path, jobs=2)
+    consumer.feed(records[0])
+    consumer.feed(records[1])
+    started.wait(5)
+    # Waits for a free slot, while the scan finds the subs of the last one
+    feeder = threading.Thread(target=consumer.feed, args=(records[2],))
+    feeder.start()
+    while "02aaaaaaaaA" not in consumer._attempted[YOUTUBE]:
+      time.sleep(0.01)
+    consumer.add_subs(YOUTUBE, "02aaaaaaaaA")
+    release.set()
+    feeder.join(5)
+    consumer.flush()
+
+    assert sorted(c[0] for c in handler.calls) == ["00aaaaaaaaA", "01aaaaaaaaA"]
+    assert consumer.results == {"ok": 2}
+
+
+def test_stream_downloads_scan_error(tmp_path, monkeypatch):
+  from ytdl_batch import subs
+
+  def broken(*args, **kwargs):
+    yield ManifestRecord(YOUTUBE, "zp0sfEVWH9A", [str(tmp_path / "a.mkv")], [])
+    yield ManifestRecord(YOUTUBE, "00aaaaaaaaA", [], [str(tmp_path / "b.json")])
+    # Held back, and never settled since the scan did not complete
+    yield ManifestRecord(YOUTUBE, "01aaaaaaaaA", [str(tmp_path / "c" / "c.mkv")], [])
+    raise OSError("gone")
+  monkeypatch.setattr(subs, "scan", broken)
+  with StateStore(tmp_path / "state.db") as state:
+    handler = FakeHandler(state)
+    with pytest.raises(OSError):
+      subs.stream_downloads(
+        tmp_path, None, [handler], compression="gz", out_path=tmp_path)
+    assert handler.calls == [("zp0sfEVWH9A", tmp_path)]
@@ -0,0 +1,158 @@
+import json
+import sys
+import time
+
+import pytest
+
+# The errors as imported by metacache, which runs from the root of the repository
+from ytdl_batch.metacache import (
+  MetadataCache, VideoMeta, slim_info,
+  NoSubsAvailable, NeedCookies, NotAvailableAnymore
+)
+from ytdl_batch.state import StateStore, YOUTUBE
+from ytdl_batch.subs import YoutubeHandler
+
+INFO = {
+  "id": "zp0sfEVWH9A", "title": "chat with me", "uploader": "Gawr Gura",
+  "upload_date": "20220106", "availability": "public", "live_status": "was_live",
+  "subtitles": {"live_chat": [{"ext": "json", "url": "https://www.youtube.com/watch?v=zp0sfEVWH9A"}]},
+  "formats": [{"format_id": "18"}] * 100,
+}
+
+# Writes the info JSON where asked, and a live chat unless the video has none
+FAKE_YTDLP = """\
+import json, sys
+args = sys.argv[1:]
+with open(sys.argv[0] + ".calls", "a") as f:
+  f.write(json.dumps(args) + "\\n")
+if "--load-info-json" in args:
+  info = json.load(open(args[args.index("--load-info-json") + 1]))
+else:
+  video_id = args[-1].split("v=")[-1]
+  info = dict(INFO, id=video_id)
+  if video_id == "noChat00000":
+    info["subtitles"] = {}
+  if "--write-info-json" in args:
+    template = [a for a in args if a.startswith("infojson:")][0][len("infojson:"):]
+    path = template.replace("%(id)s", video_id).replace("%(ext)s", "info.json")
+    json.dump(info, open(path, "w"))
+if not info["subtitles"]:
+  print(f"[info] There are no subtitles for the requested languages")
+  print("no subtitles for the requested language")
+  sys.exit(0)
+name = f"{info['id']}.live_chat.json"
+open(name, "w").write("{}\\n")
+print(f"[info] Writing video subtitles to: {name}")
+"""
+
+
+@pytest.fixture
+def ytdlp(tmp_path):
+  path = tmp_path / "yt-dlp"
+  path.write_text(f"#!{sys.executable}\nINFO = {INFO!r}\n" + FAKE_YTDLP)
+  path.chmod(0o755)
+  return path
+
+
+def calls(ytdlp):
+  with open(str(ytdlp) + ".calls") as f:
+    return [json.loads(line) for line in f]
+
+
+def test_slim_info():
+  meta = slim_info(INFO)
+  assert meta == VideoMeta(
+    "zp0sfEVWH9A", "public", "was_live", True, "20220106", "Gawr Gura", "chat with me")
+  assert meta.skip_reason() is None
+  assert isinstance(slim_info(dict(INFO, subtitles={})).skip_reason(), NoSubsAvailable)
+  # The chat replay of a live stream may still come
+  assert slim_info(dict(INFO, subtitles={}, live_status="is_live")).skip_reason() is None
+
+
+def test_skip_reasons():
+  assert isinstance(
+    VideoMeta("a", availability="unavailable").skip_reason(), NotAvailableAnymore)
+  members = VideoMeta("a", availability="subscriber_only")
+  assert isinstance(members.skip_reason(), NeedCookies)
+  assert members.skip_reason(has_cookies=True) is None
+
+
+def test_errors_keep_known_details(tmp_path):
+  with MetadataCache(tmp_path / "meta.db") as cache:
+    cache.put(slim_info(INFO))
+    cache.put_error("zp0sfEVWH9A", NoSubsAvailable("none"))
+    cache.put_error("zp0sfEVWH9A", Exception("timed out"))
+    meta = cache.get("zp0sfEVWH9A")
+    assert meta.has_chat is False and meta.uploader == "Gawr Gura"
+    assert cache.get("missing0000") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_ttl_and_lru_eviction(tmp_path, monkeypatch):
+  cache = MetadataCache(tmp_path / "meta.db", ttl=100, max_entries=2)
+  now = time.time()
+  for i, video_id in enumerate(("a", "b", "c")):
+    monkeypatch.setattr(time, "time", lambda: now + i)
+    info = cache.info_path(video_id)
+    info.write_text("{}")
+    cache.put(VideoMeta(video_id, has_chat=True, info_path=str(info)))
+  monkeypatch.setattr(time, "time", lambda: now + 10)
+  assert cache.get("a") is not None
+
+  # "b" is the least recently used
+  assert cache.evict() == 1
+  assert cache.get("b") is None and not cache.info_path("b").exists()
+  assert cache.get("c") is not None
+
+  monkeypatch.setattr(time, "time", lambda: now + 1000)
+  assert cache.get("a") is None
+  cache.close()
+  assert not list(cache.info_dir.iterdir())
+
+
+def test_expired_info_files_are_removed(tmp_path):
+  import os
+  from ytdl_batch.metacache import INFO_TTL
+  cache = MetadataCache(tmp_path / "meta.db")
+  for video_id in ("old", "new"):
+    info = cache.info_path(video_id)
+    info.write_text("{}")
+    cache.put(VideoMeta(video_id, has_chat=True, info_path=str(info)))
+  old = time.time() - INFO_TTL - 60
+  os.utime(cache.info_path("old"), (old, old))
+
+  # The entry stays, only its info JSON goes
+  assert cache.evict() == 0
+  assert not cache.info_path("old").exists() and cache.info_path("new").exists()
+  assert cache.get("old").info_path is None and cache.get("old").has_chat
+  assert cache.get("new").info_path == str(cache.info_path("new"))
+  cache.close()
+
+
+def test_handler_skips_and_reuses_info(tmp_path, ytdlp):
+  out = tmp_path / "out"
+  out.mkdir()
+  with StateStore(tmp_path / "state.db") as state, \
+  MetadataCache(tmp_path / "meta.db") as cache:
+    handler = YoutubeHandler(state=state, process_path=str(ytdlp), metadata=cache)
+
+    result, written, _ = handler.download_one(
+      "zp0sfEVWH9A", [], compression="gz", out_path=out)
+    assert result == "ok"
+    assert "--write-info-json" in calls(ytdlp)[0]
+    assert cache.get("zp0sfEVWH9A").has_chat is True
+
+    assert handler.download_one("noChat00000", [], "gz", out_path=out)[0] == "failed"
+    assert cache.get("noChat00000").has_chat is False
+    # Known to have no chat: yt-dlp is not run again
+    state.forget(YOUTUBE, "noChat00000")
+    assert handler.download_one("noChat00000", [], "gz", out_path=out)[0] == "failed"
+    assert len(calls(ytdlp)) == 2
+    assert "(cached)" in state.get(YOUTUBE, "noChat00000")["last_error"]
+
+    # A recent info JSON is fed back instead of extracting the page again
+    written.unlink()
+    (out / (written.name + ".gz")).unlink()
+    assert handler.download_one("zp0sfEVWH9A", [], "gz", out_path=out)[0] == "ok"
+    last = calls(ytdlp)[-1]
+    assert last[-2:] == ["--load-info-json", str(cache.info_path("zp0sfEVWH9A"))]
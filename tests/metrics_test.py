@@ -0,0 +1,66 @@
+import json
+import pytest
+from ytdl_batch.metrics import Registry
+
+
+def test_counter_labels():
+  registry = Registry(prefix="t_")
+  c = registry.counter("failures_total", "Failures.")
+  c.inc(service="youtube", exception="NeedCookies")
+  c.inc(2, service="youtube", exception="NeedCookies")
+  c.inc(service="twitch", exception="NotAvailableAnymore")
+  assert c.get(service="youtube", exception="NeedCookies") == 3
+  assert registry.counter("failures_total") is c
+
+  text = registry.to_prometheus()
+  assert "# TYPE t_failures_total counter" in text
+  assert 't_failures_total{exception="NeedCookies",service="youtube"} 3' in text
+  assert 't_failures_total{exception="NotAvailableAnymore",service="twitch"} 1' in text
+
+
+def test_type_conflict():
+  registry = Registry()
+  registry.counter("x")
+  with pytest.raises(Exception):
+    registry.histogram("x")
+
+
+def test_histogram():
+  registry = Registry()
+  h = registry.histogram("seconds", "Seconds.", buckets=(1, 5))
+  for value in (0.5, 2, 3, 10):
+    h.observe(value, service="youtube")
+  text = registry.to_prometheus()
+  assert 'seconds_bucket{service="youtube",le="1"} 1' in text
+  assert 'seconds_bucket{service="youtube",le="5"} 3' in text
+  assert 'seconds_bucket{service="youtube",le="+Inf"} 4' in text
+  assert 'seconds_sum{service="youtube"} 15.5' in text
+  assert 'seconds_count{service="youtube"} 4' in text
+
+  summary = registry.to_json()["metrics"]["seconds"]
+  assert summary["values"][0]["count"] == 4
+  assert summary["values"][0]["mean"] == pytest.approx(3.875)
+
+
+def test_label_escaping():
+  registry = Registry()
+  registry.counter("c").inc(path='a "b"\\c\n')
+  assert 'c{path="a \\"b\\"\\\\c\\n"} 1' in registry.to_prometheus()
+
+
+def test_write_files(tmp_path):
+  registry = Registry()
+  with registry.phase("scan"):
+    registry.counter("files_total").inc(10)
+  registry.write_textfile(tmp_path / "run.prom")
+  registry.write_json(tmp_path / "run.json", mode="download")
+
+  text = (tmp_path / "run.prom").read_text()
+  assert "files_total 10" in text
+  assert 'phase_seconds_total{phase="scan"}' in text
+  assert "last_run_timestamp_seconds" in text
+
+  summary = json.loads((tmp_path / "run.json").read_text())
+  assert summary["mode"] == "download"
+  assert summary["metrics"]["files_total"]["values"][0]["value"] == 10
+  assert not list(tmp_path.glob("*.tmp"))
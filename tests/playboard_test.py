@@ -0,0 +1,143 @@
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+from ytdl_batch.downloader.session import HTTPSession, HTTPError
+from ytdl_batch.playboard import PlayboardClient
+
+PAGE_SIZE = 3
+
+
+def fake_videos(channel_id, count):
+  return [
+    {"videoId": f"{channel_id[:5]}{i:06d}", "status": 2 if i % 4 == 0 else 1,
+     "publishedAt": 1700000000 - i * 86400, "title": f"video {i}"}
+    for i in range(count)
+  ]
+
+
+class MockPlayboard(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  channels = {}
+  fail_next = {}
+
+  def log_message(self, *args):
+    pass
+
+  def do_POST(self):
+    query = parse_qs(urlsplit(self.path).query)
+    channel_id = query["channelId"][0]
+    if self.fail_next.get(channel_id, 0) > 0:
+      self.fail_next[channel_id] -= 1
+      self.send_response(503)
+      self.send_header("content-length", "0")
+      self.send_header("retry-after", "0")
+      self.end_headers()
+      return
+    if channel_id not in self.channels:
+      self.send_response(404)
+      self.send_header("content-length", "0")
+      self.end_headers()
+      return
+
+    start = int(query.get("cursor", ["0"])[0])
+    videos = self.channels[channel_id]
+    body = json.dumps({
+      "list": videos[start:start + PAGE_SIZE],
+      "hasNext": start + PAGE_SIZE < len(videos),
+      "cursor": str(start + PAGE_SIZE),
+    }).encode()
+    self.send_response(200)
+    if "gzip" in self.headers.get("accept-encoding", ""):
+      body = gzip.compress(body)
+      self.send_header("content-encoding", "gzip")
+    self.send_header("content-type", "application/json")
+    self.send_header("content-length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+  MockPlayboard.channels = {
+    "UCchannelA": fake_videos("UCchannelA", 10),
+    "UCchannelB": fake_videos("UCchannelB", 7),
+    "UCchannelC": fake_videos("UCchannelC", 1),
+  }
+  MockPlayboard.fail_next = {"UCchannelB": 2}
+  httpd = ThreadingHTTPServer(("127.0.0.1", 0), MockPlayboard)
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield f"http://127.0.0.1:{httpd.server_address[1]}/v1/search/video"
+  httpd.shutdown()
+  httpd.server_close()
+
+
+def test_paginates_over_one_connection(server):
+  session = HTTPSession(max_per_host=1)
+  client = PlayboardClient(endpoint=server, session=session, max_channels=1)
+  videos = list(client.get_videos_for_channel("UCchannelA"))
+  assert [v["videoId"] for v in videos] == \
+    [v["videoId"] for v in MockPlayboard.channels["UCchannelA"]]
+  # 4 pages, a single keep-alive connection
+  assert session.connections_opened == 1
+  client.close()
+
+
+def test_fetch_channels_concurrently_with_retries(server):
+  session = HTTPSession(max_per_host=3, backoff=0.01)
+  client = PlayboardClient(endpoint=server, session=session, max_channels=3)
+  results = {
+    channel_id: (videos, error)
+    for channel_id, videos, error in client.fetch_channels(
+      ["UCchannelA", "UCchannelB", "UCchannelC", "UCmissing"])
+  }
+  assert len(results["UCchannelA"][0]) == 10
+  # Survived two 503 responses
+  assert len(results["UCchannelB"][0]) == 7
+  assert len(results["UCchannelC"][0]) == 1
+  assert isinstance(results["UCmissing"][1], HTTPError)
+  assert session.connections_opened <= 3
+  client.close()
+
+
+def test_incremental_sync(server, tmp_path):
+  from ytdl_batch.playboard import ChannelSnapshot
+  client = PlayboardClient(endpoint=server, session=HTTPSession(), max_channels=1)
+
+  snapshot = ChannelSnapshot.load("UCchannelA", tmp_path)
+  delta = client.sync_channel(snapshot)
+  snapshot.save()
+  # First sync goes through the whole history
+  assert delta.pages == 4
+  assert len(delta.new) == 10
+
+  videos = MockPlayboard.channels["UCchannelA"]
+  videos.insert(0, {"videoId": "UCchanew0001", "status": 1, "publishedAt": 1800000000})
+  videos[2]["status"] = 2
+  snapshot = ChannelSnapshot.load("UCchannelA", tmp_path)
+  delta = client.sync_channel(snapshot)
+  assert delta.new == ["UCchanew0001"]
+  assert delta.newly_deleted == [videos[2]["videoId"]]
+  # Stopped at the first unchanged page
+  assert delta.pages == 2
+  assert len(snapshot.ordered()) == 11
+  assert snapshot.ordered()[0]["videoId"] == "UCchanew0001"
+
+  assert client.sync_channel(snapshot, full=True).pages == 4
+  client.close()
+
+
+def test_retry_after_is_capped():
+  class Reply:
+    def __init__(self, value):
+      self.headers = {"retry-after": value}
+  session = HTTPSession(backoff=1.0)
+  assert session._delay(0, Reply("5")) == 5.0
+  assert session._delay(0, Reply("86400")) == 60.0
+  # A longer backoff still wins
+  assert session._delay(7, Reply("86400")) == 128.0
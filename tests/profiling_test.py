@@ -0,0 +1,77 @@
+from contextlib import contextmanager
+from ytdl_batch.profiling import (
+  phase, add_phase_hook, remove_phase_hook, Profiler
+)
+
+
+def test_phase_hooks():
+  seen = []
+
+  @contextmanager
+  def hook(name):
+    seen.append(("enter", name))
+    yield
+    seen.append(("exit", name))
+
+  with phase("scan"):
+    pass
+  add_phase_hook(hook)
+  try:
+    with phase("scan"):
+      seen.append(("body", "scan"))
+  finally:
+    remove_phase_hook(hook)
+  with phase("plan"):
+    pass
+  assert seen == [("enter", "scan"), ("body", "scan"), ("exit", "scan")]
+
+
+def test_profiler_reports(tmp_path):
+  with Profiler(tmp_path, "run", kind="cprofile") as profiler:
+    with phase("scan"):
+      data = [str(i) * 10 for i in range(10000)]
+      # Nested phases are part of the outer profile
+      with phase("compress"):
+        sorted(data)
+    with phase("download"):
+      pass
+    with phase("download"):
+      pass
+
+  names = sorted(p.name[len(profiler.prefix) + 1:] for p in tmp_path.iterdir())
+  assert names == [
+    "download-2.alloc.txt", "download-2.cumulative.txt", "download-2.pstats",
+    "download.alloc.txt", "download.cumulative.txt", "download.pstats",
+    "scan.alloc.txt", "scan.cumulative.txt", "scan.pstats",
+    "summary.txt",
+  ]
+  assert set(profiler.phases) == {"scan", "download"}
+  assert "Peak traced memory during scan" in \
+    (tmp_path / f"{profiler.prefix}.scan.alloc.txt").read_text()
+  summary = (tmp_path / f"{profiler.prefix}.summary.txt").read_text()
+  assert "scan" in summary and "download" in summary
+
+
+def test_profiler_threads(tmp_path):
+  import sys
+  import threading
+
+  def scan():
+    with phase("scan"):
+      sorted(str(i) for i in range(10000))
+
+  with Profiler(tmp_path, "run", kind="cprofile") as profiler:
+    with phase("download"):
+      threads = [threading.Thread(target=scan) for _ in range(2)]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+
+  names = sorted(p.name[len(profiler.prefix) + 1:] for p in tmp_path.iterdir())
+  if sys.version_info < (3, 12):
+    # Both threads in one report, with no allocations
+    assert "scan.threads.pstats" in names and "scan.threads.cumulative.txt" in names
+    assert "sorted" in (tmp_path / f"{profiler.prefix}.scan.threads.cumulative.txt").read_text()
+  assert "scan.alloc.txt" not in names and "download.pstats" in names
+  assert set(profiler.phases) == {"scan", "download"}
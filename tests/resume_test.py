@@ -0,0 +1,123 @@
+import json
+
+from ytdl_batch.downloader import resume
+from ytdl_batch.downloader.resume import (
+  youtube_resume_point, twitch_resume_point, is_complete
+)
+
+
+def youtube_line(i, ids):
+  return json.dumps({"replayChatItemAction": {
+    "actions": [
+      {"addChatItemAction": {"item": {"liveChatTextMessageRenderer": {"id": _id}}}}
+      for _id in ids
+    ],
+    "videoOffsetTimeMsec": str(i * 1000),
+  }}) + "\n"
+
+
+def test_youtube_resume_point(tmp_path, monkeypatch):
+  lines = [youtube_line(i, [f"id{i}"]) for i in range(50)]
+  # Two lines at the same offset
+  lines.append(youtube_line(49, ["id49b"]))
+  path = tmp_path / "a.live_chat.json"
+  path.write_text("".join(lines))
+  assert youtube_resume_point(path) is None
+  assert is_complete(path, "youtube")
+
+  # Reading the tail must go back far enough to find a complete line
+  monkeypatch.setattr(resume, "TAIL_SIZE", 16)
+  path.write_text("".join(lines) + lines[0][:30])
+  point = youtube_resume_point(path)
+  assert point.size == len("".join(lines).encode())
+  assert point.offset == 49.0
+  assert point.seen == {"id49", "id49b"}
+  assert point.count == 51
+
+  # A .part file is incomplete even if its last line is
+  part = tmp_path / "a.live_chat.json.part"
+  part.write_text("".join(lines[:3]))
+  assert youtube_resume_point(part).size == part.stat().st_size
+
+  part.write_text(lines[0][:10])
+  assert youtube_resume_point(part) == (0, 0.0, frozenset(), 0)
+
+
+def test_twitch_resume_point(tmp_path):
+  comments = [
+    {"_id": f"c{i}", "content_offset_seconds": i // 2, "message": {"body": "}]"}}
+    for i in range(6)
+  ]
+  doc = json.dumps({"streamer": {"name": "é"}, "comments": comments, "embeddedData": None})
+  path = tmp_path / "20220101_1234567890.json"
+  path.write_text(doc, encoding="utf-8")
+  assert twitch_resume_point(path) is None
+
+  end = doc.index('{"_id": "c5"') - 2
+  path.write_text(doc[:end + 20], encoding="utf-8")
+  point = twitch_resume_point(path)
+  assert point.size == len(doc[:end].encode())
+  assert point.count == 5
+  assert point.offset == 2
+  assert point.seen == {"c4"}
+  assert not is_complete(path, "twitch")
+
+  path.write_text(doc[:doc.index("[") + 1])
+  assert twitch_resume_point(path).count == 0
+  path.write_text(doc[:10])
+  assert twitch_resume_point(path).size == 0
+
+
+def test_compress_skips_incomplete_chats(tmp_path):
+  from ytdl_batch.subs import compress_subs
+  line = youtube_line(1, ["id1"])
+  (tmp_path / "20220101 [a] b [zp0sfEVWH9A].live_chat.json").write_text(line * 2)
+  (tmp_path / "20220101 [a] b [zwEIsPcwwdk].live_chat.json").write_text(line + line[:20])
+
+  written = list(compress_subs(tmp_path, compression="gz", remove_compressed=True))
+  assert [p.name for p in written] == \
+    ["20220101 [a] b [zp0sfEVWH9A].live_chat.json.gz"]
+  assert (tmp_path / "20220101 [a] b [zwEIsPcwwdk].live_chat.json").exists()
+
+
+def test_compress_only_checks_chats(tmp_path, monkeypatch):
+  import json
+  from ytdl_batch import subs
+  from ytdl_batch.subs import compress_subs
+  # Not chats: compressed whatever their layout
+  (tmp_path / "info.json").write_text(json.dumps({"a": [1, 2]}, indent=2))
+  (tmp_path / "single.json").write_text('{"a": 1}')
+  twitch = {
+    "video": {}, "comments": [{"content_offset_seconds": 1}], "embeddedData": None}
+  (tmp_path / "20220121_1271243650.json").write_text(json.dumps(twitch))
+  cut = json.dumps(twitch)[:-10]
+  (tmp_path / "20220122_1271243651.json").write_text(cut)
+
+  decoded = []
+  monkeypatch.setattr(
+    subs, "is_complete", lambda path, service: decoded.append(path.name) or False)
+  written = list(compress_subs(tmp_path, compression="gz", remove_compressed=True))
+  assert sorted(p.name for p in written) == [
+    "20220121_1271243650.json.gz", "info.json.gz", "single.json.gz"]
+  # Closed Twitch chats are not decoded
+  assert decoded == ["20220122_1271243651.json"]
+
+
+
+def test_compress_skips_native_chats(tmp_path, monkeypatch):
+  from ytdl_batch import subs
+  from ytdl_batch.subs import compress_subs
+  from ytdl_batch.downloader.twitch_native import TwitchChatFetcher
+  fetcher = TwitchChatFetcher()
+  monkeypatch.setattr(fetcher, "iter_comments", lambda *args, **kwargs: iter([
+    {"_id": str(i), "content_offset_seconds": i} for i in range(3)]))
+  info = {"title": "stream", "lengthSeconds": 10, "owner": {"id": "7"}}
+  with open(tmp_path / "20220121_1271243650.json", "w") as f:
+    assert fetcher.write_chat("1271243650", f, info=info) == 3
+
+  decoded = []
+  monkeypatch.setattr(
+    subs, "is_complete", lambda path, service: decoded.append(path.name) or False)
+  written = list(compress_subs(tmp_path, compression="gz", remove_compressed=True))
+  assert [p.name for p in written] == ["20220121_1271243650.json.gz"]
+  assert decoded == []
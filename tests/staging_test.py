@@ -0,0 +1,111 @@
+import bz2
+import errno
+
+import pytest
+
+from ytdl_batch.downloader import staging
+from ytdl_batch.downloader.staging import StagingArea, move_file
+from ytdl_batch.state import StateStore, YOUTUBE, DONE
+from .conftest import FakeHandler
+
+YT_MEDIA = "20220106 Gawr Gura Ch. hololive-EN chat with mee_[240]_zp0sfEVWH9A.mkv"
+
+
+@pytest.fixture
+def cross_device(monkeypatch):
+  """Make every rename fail as if src and dst were on different filesystems."""
+  def rename(src, dst):
+    raise OSError(errno.EXDEV, "Invalid cross-device link")
+  monkeypatch.setattr(staging, "rename", rename)
+
+
+def test_move_file_across_filesystems(tmp_path, cross_device):
+  src = tmp_path / "src.json"
+  src.write_bytes(b"x" * 3_000_000)
+  dst = tmp_path / "archive" / "dst.json"
+  dst.parent.mkdir()
+
+  assert move_file(src, dst) == dst
+  assert not src.exists()
+  assert dst.stat().st_size == 3_000_000
+  assert not list(dst.parent.glob("*.tmp"))
+
+  src.write_text("other")
+  with pytest.raises(FileExistsError):
+    move_file(src, dst)
+  assert src.exists() and dst.stat().st_size == 3_000_000
+
+
+def test_moves_in_batches(tmp_path, cross_device):
+  area = StagingArea(tmp_path / "scratch", batch_size=3)
+  archive = tmp_path / "archive"
+  scratch = area.directory_for(archive)
+  assert area.directory_for(archive) == scratch
+  assert scratch.parent == area.root
+
+  moved = []
+  for i in range(4):
+    path = scratch / f"{i}.json.bz2"
+    path.write_text(str(i))
+    assert area.add(path, on_moved=moved.append) == archive / path.name
+  # The first 3 went together, the last one waits for the next batch
+  assert sorted(p.name for p in archive.iterdir()) == [f"{i}.json.bz2" for i in range(3)]
+  assert area.flush() == 1
+  assert len(moved) == 4 and area.moved == 4
+  assert sorted(p.name for p in scratch.iterdir()) == [".target"]
+
+
+def test_callbacks_after_directory_sync(tmp_path, monkeypatch):
+  events = []
+  monkeypatch.setattr(staging, "fsync_dir", lambda path: events.append("sync"))
+  area = StagingArea(tmp_path / "scratch", batch_size=10)
+  scratch = area.directory_for(tmp_path / "archive")
+  for i in range(2):
+    path = scratch / f"{i}.json.bz2"
+    path.write_text(str(i))
+    area.add(path, on_moved=lambda dst: events.append(dst.name))
+  area.flush()
+  assert events == ["sync", "0.json.bz2", "1.json.bz2"]
+
+
+def test_recover_leaves_partial_files(tmp_path):
+  area = StagingArea(tmp_path / "scratch")
+  archive = tmp_path / "archive"
+  scratch = area.directory_for(archive)
+  (scratch / "done.json.bz2").write_bytes(bz2.compress(b"{}\n" * 100))
+  (scratch / "cut.json.bz2").write_bytes(bz2.compress(b"{}\n" * 100)[:20])
+  (scratch / "resume.live_chat.json.part").write_text("{}\n")
+  (scratch / "truncated.live_chat.json").write_text('{}\n{"a": ')
+
+  # A new run finds what the earlier one left behind
+  assert StagingArea(tmp_path / "scratch").recover() == 1
+  assert [p.name for p in archive.iterdir()] == ["done.json.bz2"]
+  assert sorted(p.name for p in scratch.iterdir()) == [
+    ".target", "cut.json.bz2", "resume.live_chat.json.part",
+    "truncated.live_chat.json"]
+
+
+def test_handler_downloads_in_scratch(tmp_path):
+  media_dir = tmp_path / "media"
+  media_dir.mkdir()
+  (media_dir / YT_MEDIA).touch()
+  area = StagingArea(tmp_path / "scratch", batch_size=10)
+
+  with StateStore(tmp_path / "state.db") as state:
+    handler = FakeHandler(state, content="{}\n", staging=area)
+    result, written, compressed = handler.download_one(
+      "zp0sfEVWH9A", [media_dir / YT_MEDIA], compression="bz2",
+      out_path=tmp_path, remove_compressed=True)
+
+    assert result == "ok"
+    assert handler.calls[0][1].parent == area.root
+    assert compressed == media_dir / "zp0sfEVWH9A.live_chat.json.bz2"
+    # Nothing reaches the media directory, nor is recorded, before the batch
+    assert not compressed.exists()
+    assert state.status(YOUTUBE, "zp0sfEVWH9A") is None
+
+    handler.flush()
+    assert compressed.exists() and not written.exists()
+    assert bz2.decompress(compressed.read_bytes()) == b"{}\n"
+    assert state.get(YOUTUBE, "zp0sfEVWH9A")["output_path"] == str(compressed)
+    assert state.status(YOUTUBE, "zp0sfEVWH9A") == DONE
@@ -0,0 +1,91 @@
+import sqlite3
+import threading
+from pathlib import Path
+
+import pytest
+
+from ytdl_batch.state import (
+  StateStore, import_subs_lists, import_batch_lists,
+  DONE, FAILED, IGNORED, DELETED, YOUTUBE, TWITCH, YOUTUBE_VIDEO
+)
+
+
+def test_record_and_lookup(tmp_path):
+  with StateStore(tmp_path / "state.db", batch_size=10) as store:
+    store.record(YOUTUBE, "abcdefghijk", FAILED, error="404")
+    # Not committed yet, but visible
+    assert store.status(YOUTUBE, "abcdefghijk") == FAILED
+    assert store.should_skip(YOUTUBE, "abcdefghijk")
+    store.record(YOUTUBE, "abcdefghijk", DONE, output_path=Path("out.json.bz2"))
+
+  with StateStore(tmp_path / "state.db") as store:
+    job = store.get(YOUTUBE, "abcdefghijk")
+    assert job["status"] == DONE
+    assert job["attempts"] == 2
+    assert job["output_path"] == "out.json.bz2"
+    assert not store.should_skip(YOUTUBE, "abcdefghijk")
+    # Services are independent
+    assert store.status(TWITCH, "abcdefghijk") is None
+
+
+def test_concurrent_writers(tmp_path):
+  store = StateStore(tmp_path / "state.db", batch_size=7)
+
+  def work(n):
+    for i in range(100):
+      store.record(TWITCH, f"{n}{i:09d}", DONE)
+
+  threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert store.counts(TWITCH) == {DONE: 400}
+  store.close()
+
+
+def test_locked_flush_keeps_records(tmp_path):
+  store = StateStore(tmp_path / "state.db", batch_size=10)
+  store.db.execute("PRAGMA busy_timeout=0")
+  other = sqlite3.connect(str(tmp_path / "state.db"), isolation_level=None)
+  other.execute("BEGIN IMMEDIATE")
+  store.record(YOUTUBE, "abcdefghijk", DONE)
+  with pytest.raises(sqlite3.OperationalError, match="locked"):
+    store.flush()
+  assert store.status(YOUTUBE, "abcdefghijk") == DONE
+
+  other.execute("ROLLBACK")
+  other.close()
+  store.flush()
+  assert store.counts(YOUTUBE) == {DONE: 1}
+  store.close()
+
+
+def test_import_legacy_lists(tmp_path):
+  (tmp_path / "yt_subs_failed.txt").write_text(
+    "abcdefghijk\t/some/path.mp4\tStatus code: 1\nbbcdefghijk\t/other.mp4\n")
+  (tmp_path / "ignored_subs.txt").write_text("1234567890\ncbcdefghijk\n")
+  store = StateStore(tmp_path / "state.db")
+  assert import_subs_lists(store, tmp_path) == 4
+  # Unchanged files are not imported twice
+  assert import_subs_lists(store, tmp_path) == 0
+  assert store.get(YOUTUBE, "abcdefghijk")["last_error"] == "Status code: 1"
+  assert store.status(TWITCH, "1234567890") == IGNORED
+  assert store.status(YOUTUBE, "cbcdefghijk") == IGNORED
+
+  # Imported entries do not override newer state
+  store.record(YOUTUBE, "bbcdefghijk", DONE)
+  with open(tmp_path / "yt_subs_failed.txt", "a") as f:
+    f.write("dbcdefghijk\t/path.mp4\terror\n")
+  assert import_subs_lists(store, tmp_path) == 1
+  assert store.status(YOUTUBE, "bbcdefghijk") == DONE
+  store.close()
+
+
+def test_import_batch_lists(tmp_path):
+  (tmp_path / "ids_done.txt").write_text("youtube abcdefghijk\n# comment\n")
+  (tmp_path / "ids_deleted.txt").write_text("bbcdefghijk\n")
+  with StateStore(tmp_path / "state.db") as store:
+    assert import_batch_lists(store, tmp_path / "ids.txt") == 2
+    assert store.status(YOUTUBE_VIDEO, "abcdefghijk") == DONE
+    assert store.status(YOUTUBE_VIDEO, "bbcdefghijk") == DELETED
@@ -51,3 +51,16 @@ def test_regex(twitch_files, yt_files):
     for f in TWITCH_MEDIA_W_SUB + TWITCH_MEDIA_WO_SUB:
       assert f in [(files, subs) for files, subs in tr.scanner.store.values()]
 
+
+
+def test_import_leaves_network_modules_out():
+  import subprocess
+  import sys
+  from pathlib import Path
+  repo = Path(__file__).absolute().parent.parent
+  out = subprocess.run(
+    [sys.executable, "-c",
+     "import sys, subs; print(' '.join(m for m in ('ssl', 'http.client', "
+     "'urllib.request', 'http.cookiejar') if m in sys.modules))"],
+    cwd=repo, capture_output=True, text=True, check=True).stdout
+  assert out.strip() == ""
@@ -0,0 +1,226 @@
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ytdl_batch.chat_reader import iter_messages
+from ytdl_batch.downloader.errors import AlreadyPresentError, NotAvailableAnymore
+from ytdl_batch.downloader.session import HTTPSession
+from ytdl_batch.downloader.twitch_native import TwitchChatFetcher, convert_comment
+from ytdl_batch.state import StateStore, DONE, TWITCH
+from ytdl_batch.subs import TwitchHandler
+
+PAGE_SIZE = 4
+
+
+def fake_comments(video_id, count):
+  return [
+    {
+      "id": f"{video_id}-{i}",
+      "commenter": {"id": "42", "login": "viewer", "displayName": "Viewer"},
+      "contentOffsetSeconds": i * 10,
+      "createdAt": "2022-01-21T20:00:00.5Z",
+      "message": {
+        "fragments": [{"text": f"hello {i}", "emote": None}]
+          + ([{"text": " cheer100", "emote": None}] if i == 1 else []),
+        "userBadges": [{"setID": "subscriber", "version": "12"}],
+        "userColor": "#FF0000",
+      },
+    }
+    for i in range(count)
+  ]
+
+
+class MockGQL(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  videos = {}
+  requests = []
+
+  def log_message(self, *args):
+    pass
+
+  def reply(self, payload):
+    body = json.dumps(payload).encode()
+    self.send_response(200)
+    self.send_header("content-type", "application/json")
+    self.send_header("content-length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    assert self.headers["client-id"]
+    payload = json.loads(self.rfile.read(int(self.headers["content-length"])))
+    if isinstance(payload, dict):
+      video_id = payload["query"].split('"')[1]
+      if video_id not in self.videos:
+        return self.reply({"data": {"video": None}})
+      return self.reply({"data": {"video": {
+        "title": "stream", "createdAt": "2022-01-21T20:00:00Z",
+        "lengthSeconds": 3600,
+        "owner": {"id": "7", "login": "streamer", "displayName": "Streamer"}
+      }}})
+
+    variables = payload[0]["variables"]
+    video_id = variables["videoID"]
+    if video_id not in self.videos:
+      return self.reply([{"data": {"video": None}}])
+    self.requests.append(variables)
+    if "cursor" in variables:
+      start = int(variables["cursor"])
+    else:
+      # Comments are 10 seconds apart
+      start = -(-variables["contentOffsetSeconds"] // 10)
+    comments = self.videos[video_id][start:start + PAGE_SIZE]
+    self.reply([{"data": {"video": {"comments": {
+      "edges": [
+        {"cursor": str(start + i + 1), "node": node}
+        for i, node in enumerate(comments)
+      ],
+      "pageInfo": {"hasNextPage": start + PAGE_SIZE < len(self.videos[video_id])}
+    }}}}])
+
+
+@pytest.fixture
+def server():
+  MockGQL.videos = {
+    "1271243650": fake_comments("1271243650", 10),
+    "1241120429": fake_comments("1241120429", 3),
+    "1286818234": fake_comments("1286818234", 0),
+  }
+  MockGQL.requests = []
+  httpd = ThreadingHTTPServer(("127.0.0.1", 0), MockGQL)
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield f"http://127.0.0.1:{httpd.server_address[1]}/gql"
+  httpd.shutdown()
+  httpd.server_close()
+
+
+def test_convert_comment():
+  comment = convert_comment(fake_comments("1", 2)[1], "1", "7")
+  assert comment["message"]["body"] == "hello 1 cheer100"
+  assert comment["message"]["bits_spent"] == 100
+  assert comment["message"]["user_badges"] == [{"_id": "subscriber", "version": "12"}]
+  assert comment["commenter"]["name"] == "viewer"
+
+
+def test_download_pages_into_compressor(server, tmp_path):
+  session = HTTPSession(max_per_host=1)
+  fetcher = TwitchChatFetcher(session=session, endpoint=server)
+  path = fetcher.download("1271243650", tmp_path, date="20220121", compression="gz")
+
+  assert path == tmp_path / "20220121_1271243650.json.gz"
+  assert not list(tmp_path.glob("*.part"))
+  # Video info, then 3 pages, over the same connection
+  assert session.connections_opened == 1
+  doc = json.loads(gzip.decompress(path.read_bytes()))
+  assert doc["streamer"]["id"] == "7"
+  assert len(doc["comments"]) == 10
+
+  messages = list(iter_messages(path))
+  assert [m.offset for m in messages] == [i * 10 for i in range(10)]
+  assert messages[1].amount == 100
+
+  with pytest.raises(AlreadyPresentError):
+    fetcher.download("1271243650", tmp_path, date="20220121", compression="gz")
+
+
+def test_missing_video(server, tmp_path):
+  fetcher = TwitchChatFetcher(endpoint=server)
+  with pytest.raises(NotAvailableAnymore):
+    fetcher.download("1111111111", tmp_path)
+  assert not list(tmp_path.iterdir())
+
+
+def test_download_many(server, tmp_path):
+  session = HTTPSession(max_per_host=2)
+  fetcher = TwitchChatFetcher(session=session, endpoint=server, max_videos=2)
+  jobs = [
+    (video_id, tmp_path, None)
+    for video_id in ("1271243650", "1111111111", "1241120429", "1286818234")
+  ]
+  results = dict(fetcher.download_many(jobs))
+
+  assert isinstance(results.pop("1111111111"), NotAvailableAnymore)
+  assert results == {
+    video_id: tmp_path / f"{video_id}.json" for video_id in results
+  }
+  assert json.loads((tmp_path / "1286818234.json").read_text())["comments"] == []
+  assert session.connections_opened <= 2
+
+
+def test_native_handler(server, tmp_path):
+  media = tmp_path / "20220121 stream [270]_1271243650.mp4"
+  media.touch()
+  with StateStore(tmp_path / "state.db") as state:
+    handler = TwitchHandler(
+      state=state, process_path=None, engine="native")
+    handler.fetcher.endpoint = server
+    result, written, compressed = handler.download_one(
+      "1271243650", [media], compression="bz2", out_path=tmp_path)
+
+    assert result == "ok"
+    assert written == compressed == tmp_path / "20220121_1271243650.json.bz2"
+    assert state.status(TWITCH, "1271243650") == DONE
+
+    result, _, _ = handler.download_one(
+      "1111111111", [], compression="bz2", out_path=tmp_path)
+    assert result == "failed"
+    assert "404" in state.get(TWITCH, "1111111111")["last_error"]
+
+
+def test_resume_partial_download(server, tmp_path):
+  fetcher = TwitchChatFetcher(endpoint=server)
+  complete = fetcher.download("1271243650", tmp_path, date="20220121")
+  expected = json.loads(complete.read_text())
+
+  # Interrupted in the middle of the 7th comment
+  text = complete.read_text()
+  cut = text.index('{"_id": "1271243650-6"') + 30
+  part = complete.with_name(complete.name + ".part")
+  part.write_text(text[:cut])
+  complete.unlink()
+  MockGQL.requests.clear()
+
+  path = fetcher.download("1271243650", tmp_path, date="20220121", compression="gz")
+  assert path == tmp_path / "20220121_1271243650.json.gz"
+  assert not part.exists()
+  # Resumed from the offset of the last complete comment
+  assert MockGQL.requests[0] == {"videoID": "1271243650", "contentOffsetSeconds": 50}
+  doc = json.loads(gzip.decompress(path.read_bytes()))
+  assert doc["comments"] == expected["comments"]
+
+
+def test_truncated_chat_is_not_present(server, tmp_path):
+  fetcher = TwitchChatFetcher(endpoint=server)
+  complete = fetcher.download("1241120429", tmp_path)
+  text = complete.read_text()
+  complete.write_text(text[:text.index('{"_id": "1241120429-2"') + 5])
+
+  assert fetcher.download("1241120429", tmp_path) == complete
+  assert json.loads(complete.read_text())["comments"][2]["_id"] == "1241120429-2"
+  with pytest.raises(AlreadyPresentError):
+    fetcher.download("1241120429", tmp_path)
+
+
+def test_failed_download_keeps_partial_chat(server, tmp_path, monkeypatch):
+  fetcher = TwitchChatFetcher(endpoint=server)
+  comments = fetcher.iter_comments
+
+  def interrupted(*args, **kwargs):
+    for i, comment in enumerate(comments(*args, **kwargs)):
+      if i == 5:
+        raise ConnectionError("reset")
+      yield comment
+  monkeypatch.setattr(fetcher, "iter_comments", interrupted)
+  with pytest.raises(ConnectionError):
+    fetcher.download("1271243650", tmp_path)
+  part = tmp_path / "1271243650.json.part"
+  assert part.exists()
+
+  monkeypatch.setattr(fetcher, "iter_comments", comments)
+  path = fetcher.download("1271243650", tmp_path)
+  assert len(json.loads(path.read_text())["comments"]) == 10
+  assert not part.exists()
@@ -0,0 +1,127 @@
+import sqlite3
+import time
+from ytdl_batch.manifest import ManifestRecord
+from ytdl_batch.state import StateStore, YOUTUBE, TWITCH
+from ytdl_batch.state import DONE as STATE_DONE, FAILED as STATE_FAILED
+from ytdl_batch.subs import work
+from ytdl_batch.workqueue import (
+  WorkQueue, Heartbeat, PENDING, LEASED, DONE, FAILED
+)
+from .conftest import FakeHandler
+
+
+def test_enqueue(tmp_path):
+  with WorkQueue(tmp_path / "q.db") as queue:
+    assert queue.enqueue([
+      (YOUTUBE, "zp0sfEVWH9A", ["/a.mkv"]),
+      ManifestRecord(YOUTUBE, "zwEIsPcwwdk", ["/b.mkv"], []),
+      ManifestRecord(TWITCH, "1271243650", ["/c.mp4"], []),
+    ]) == 3
+    # Known jobs are not added twice, and subs found later complete them
+    assert queue.enqueue([
+      ManifestRecord(YOUTUBE, "zp0sfEVWH9A", ["/a2.mkv"], []),
+      ManifestRecord(TWITCH, "1271243650", [], ["/c.json"]),
+    ]) == 0
+    assert queue.counts() == {
+      YOUTUBE: {PENDING: 2}, TWITCH: {DONE: 1}}
+
+
+def test_enqueue_commits_in_batches(tmp_path, monkeypatch):
+  monkeypatch.setattr("ytdl_batch.workqueue.ENQUEUE_BATCH", 2)
+  path = tmp_path / "q.db"
+  other = sqlite3.connect(str(path), timeout=0, isolation_level=None)
+
+  def jobs():
+    yield (YOUTUBE, "zp0sfEVWH9A", [])
+    yield (YOUTUBE, "zwEIsPcwwdk", [])
+    # The first batch is committed, other writers are not locked out
+    other.execute("BEGIN IMMEDIATE")
+    other.execute("ROLLBACK")
+    yield (TWITCH, "1271243650", [])
+
+  with WorkQueue(path) as queue:
+    assert queue.enqueue(jobs()) == 3
+    assert queue.counts() == {YOUTUBE: {PENDING: 2}, TWITCH: {PENDING: 1}}
+  other.close()
+
+
+def test_claims_are_exclusive(tmp_path):
+  path = tmp_path / "q.db"
+  with WorkQueue(path, worker="a") as a, WorkQueue(path, worker="b") as b:
+    a.enqueue([(YOUTUBE, "zp0sfEVWH9A", []), (YOUTUBE, "zwEIsPcwwdk", [])])
+    first = a.claim([YOUTUBE])
+    second = b.claim([YOUTUBE])
+    assert len(first) == len(second) == 1
+    assert first[0].video_id != second[0].video_id
+    assert a.claim([YOUTUBE]) == [] and a.claim([TWITCH]) == []
+    assert a.workers() == {"a": 1, "b": 1}
+
+    assert a.complete(first[0], DONE)
+    assert b.complete(second[0], FAILED, error="boom")
+    assert a.remaining([YOUTUBE]) == 0
+    assert a.counts() == {YOUTUBE: {DONE: 1, FAILED: 1}}
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+  path = tmp_path / "q.db"
+  with WorkQueue(path, lease_seconds=0.05, max_attempts=2, worker="crashed") as a, \
+       WorkQueue(path, lease_seconds=60, worker="b") as b:
+    a.enqueue([(YOUTUBE, "zp0sfEVWH9A", ["/a.mkv"])])
+    lost = a.claim([YOUTUBE])[0]
+    assert b.claim([YOUTUBE]) == []
+    time.sleep(0.1)
+
+    taken = b.claim([YOUTUBE])[0]
+    assert taken.attempt == 2 and taken.media_paths == ["/a.mkv"]
+    # The first worker comes back too late
+    assert not a.complete(lost, DONE)
+    assert b.complete(taken, DONE)
+
+
+def test_max_attempts(tmp_path):
+  with WorkQueue(tmp_path / "q.db", lease_seconds=0.01, max_attempts=2) as queue:
+    queue.enqueue([(YOUTUBE, "zp0sfEVWH9A", [])])
+    for _ in range(2):
+      assert len(queue.claim([YOUTUBE])) == 1
+      time.sleep(0.03)
+    assert queue.claim([YOUTUBE]) == []
+    assert queue.counts() == {YOUTUBE: {FAILED: 1}}
+    assert queue.requeue(failed=True) == 1
+    assert queue.counts() == {YOUTUBE: {PENDING: 1}}
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+  path = tmp_path / "q.db"
+  with WorkQueue(path, lease_seconds=0.2, worker="a") as a, \
+       WorkQueue(path, worker="b") as b:
+    a.enqueue([(YOUTUBE, "zp0sfEVWH9A", [])])
+    lease = a.claim([YOUTUBE])[0]
+    with Heartbeat(a, interval=0.02):
+      time.sleep(0.4)
+      assert b.claim([YOUTUBE]) == []
+    assert a.complete(lease, DONE)
+
+
+def test_workers(tmp_path):
+  path = tmp_path / "q.db"
+  with WorkQueue(path) as queue:
+    queue.enqueue([
+      (YOUTUBE, "zp0sfEVWH9A", ["/nonexistent/a.mkv"]),
+      (YOUTUBE, "zwEIsPcwwdk", []),
+      (TWITCH, "1271243650", []),
+    ])
+
+  with StateStore(tmp_path / "state.db") as state, WorkQueue(path) as queue:
+    results = work(
+      queue, [FakeHandler(state)], compression="gz", out_path=tmp_path,
+      remove_compressed=True)
+    assert results == {"ok": 1, "failed": 1}
+    assert (tmp_path / "zp0sfEVWH9A.live_chat.json.gz").exists()
+    assert state.status(YOUTUBE, "zp0sfEVWH9A") == STATE_DONE
+    assert state.status(YOUTUBE, "zwEIsPcwwdk") == STATE_FAILED
+    # Twitch jobs are left to workers handling Twitch
+    assert queue.counts() == {
+      YOUTUBE: {DONE: 1, FAILED: 1}, TWITCH: {PENDING: 1}}
+    failed = [row for row in queue.db.execute(
+      "SELECT last_error FROM queue WHERE status = ?", (FAILED,))]
+    assert failed == [("Private video",)]
@@ -0,0 +1,215 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+from ytdl_batch.chat_reader import iter_messages
+from ytdl_batch.downloader.errors import (
+  AlreadyPresentError, NotAvailableAnymore, NeedCookies, NoSubsAvailable
+)
+from ytdl_batch.downloader.session import HTTPSession
+from ytdl_batch.downloader.youtube_native import YoutubeChatFetcher, extract_json
+from ytdl_batch.regex import YoutubeScanner
+from ytdl_batch.state import StateStore, DONE, FAILED, YOUTUBE
+from ytdl_batch.subs import YoutubeHandler
+
+
+def chat_action(video_id, i):
+  return {"replayChatItemAction": {
+    "actions": [{"addChatItemAction": {"item": {"liveChatTextMessageRenderer": {
+      "id": f"{video_id}-{i}",
+      "message": {"runs": [{"text": f"hello {i}"}]},
+      "authorName": {"simpleText": "viewer"},
+      "authorExternalChannelId": "UCviewer",
+      "timestampUsec": str(1641495600000000 + i * 1000000),
+    }}}}],
+    "videoOffsetTimeMsec": str(i * 1000),
+  }}
+
+
+# Trimmed down from the watch pages and the replies of get_live_chat_replay
+def watch_page(video_id, status="OK", reason=None, chat=True):
+  player = {
+    "playabilityStatus": {"status": status, **({"reason": reason} if reason else {})},
+    "videoDetails": {"videoId": video_id, "title": "chat with me/you", "author": "Gawr Gura"},
+    "microformat": {"playerMicroformatRenderer": {"uploadDate": "2022-01-06"}},
+  }
+  data = {"contents": {"twoColumnWatchNextResults": {}}}
+  if chat:
+    data["contents"]["twoColumnWatchNextResults"]["conversationBar"] = {
+      "liveChatRenderer": {"continuations": [
+        {"reloadContinuationData": {"continuation": f"{video_id}:0"}}
+      ], "isReplay": True}}
+  return (
+    "<html><script>ytcfg.set({\"INNERTUBE_API_KEY\": \"key\", "
+    "\"INNERTUBE_CONTEXT\": {\"client\": {\"clientName\": \"WEB\"}}});</script>"
+    f"<script>var ytInitialPlayerResponse = {json.dumps(player)};</script>"
+    f"<script>var ytInitialData = {json.dumps(data)};</script></html>"
+  )
+
+
+class MockYoutube(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  pages = {}
+  chats = {}
+  page_size = 3
+  requests = []
+
+  def log_message(self, *args):
+    pass
+
+  def reply(self, body, content_type="application/json", status=200):
+    body = body.encode()
+    self.send_response(status)
+    self.send_header("content-type", content_type)
+    self.send_header("content-length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    video_id = parse_qs(urlsplit(self.path).query)["v"][0]
+    if video_id not in self.pages:
+      return self.reply("", status=404)
+    self.reply(self.pages[video_id], content_type="text/html")
+
+  def do_POST(self):
+    assert parse_qs(urlsplit(self.path).query)["key"] == ["key"]
+    payload = json.loads(self.rfile.read(int(self.headers["content-length"])))
+    self.requests.append((payload, self.headers.get("authorization")))
+    video_id, start = payload["continuation"].split(":")
+    start = int(start)
+    if start == 0:
+      # Seek, actions are one second apart
+      start = -(-int(payload["currentPlayerState"]["playerOffsetMs"]) // 1000)
+    actions = self.chats[video_id][start:start + self.page_size]
+    end = start + self.page_size
+    if end < len(self.chats[video_id]):
+      continuation = {"liveChatReplayContinuationData": {"continuation": f"{video_id}:{end}"}}
+    else:
+      continuation = {"playerSeekContinuationData": {"continuation": "seek"}}
+    self.reply(json.dumps({"continuationContents": {"liveChatContinuation": {
+      "actions": actions, "continuations": [continuation]}}}))
+
+
+@pytest.fixture
+def server():
+  MockYoutube.pages = {
+    "zp0sfEVWH9A": watch_page("zp0sfEVWH9A"),
+    "zwEIsPcwwdk": watch_page("zwEIsPcwwdk"),
+    "membersOnly": watch_page(
+      "membersOnly", "UNPLAYABLE", "Join this channel to get access to members-only content"),
+    "removed0000": watch_page("removed0000", "ERROR", "This video has been removed"),
+    "noChat00000": watch_page("noChat00000", chat=False),
+  }
+  MockYoutube.chats = {
+    "zp0sfEVWH9A": [chat_action("zp0sfEVWH9A", i) for i in range(8)],
+    "zwEIsPcwwdk": [chat_action("zwEIsPcwwdk", i) for i in range(2)],
+  }
+  MockYoutube.requests = []
+  httpd = ThreadingHTTPServer(("127.0.0.1", 0), MockYoutube)
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield f"http://127.0.0.1:{httpd.server_address[1]}"
+  httpd.shutdown()
+  httpd.server_close()
+
+
+def test_extract_json():
+  html = watch_page("zp0sfEVWH9A")
+  assert extract_json(html, "ytcfg.set")["INNERTUBE_API_KEY"] == "key"
+  assert extract_json(html, "ytInitialPlayerResponse")["videoDetails"]["author"] == "Gawr Gura"
+  assert extract_json(html, "missing") is None
+
+
+def test_download_follows_continuations(server, tmp_path):
+  session = HTTPSession(max_per_host=1)
+  fetcher = YoutubeChatFetcher(session=session, base_url=server)
+  path = fetcher.download("zp0sfEVWH9A", tmp_path, compression="gz")
+
+  assert path.name == \
+    "20220106 [Gawr Gura] chat with me⧸you [zp0sfEVWH9A].live_chat.json.gz"
+  # Named like yt-dlp's output, so that the next scan finds the subs
+  assert YoutubeScanner().match(str(tmp_path), path.name)
+  # The watch page, then 3 continuations, over the same connection
+  assert session.connections_opened == 1
+  offsets = [p["currentPlayerState"]["playerOffsetMs"] for p, _ in MockYoutube.requests]
+  assert offsets == ["0", "2000", "5000"]
+
+  messages = list(iter_messages(path))
+  assert [m.text for m in messages] == [f"hello {i}" for i in range(8)]
+  assert messages[3].offset == 3.0
+
+  with pytest.raises(AlreadyPresentError):
+    fetcher.download("zp0sfEVWH9A", tmp_path, compression="gz")
+
+
+@pytest.mark.parametrize("video_id, exception", [
+  ("membersOnly", NeedCookies),
+  ("removed0000", NotAvailableAnymore),
+  ("unknown0000", NotAvailableAnymore),
+  ("noChat00000", NoSubsAvailable),
+])
+def test_errors(server, tmp_path, video_id, exception):
+  fetcher = YoutubeChatFetcher(base_url=server)
+  with pytest.raises(exception):
+    fetcher.download(video_id, tmp_path)
+  assert not list(tmp_path.iterdir())
+
+
+def test_cookies_authenticate(server, tmp_path):
+  cookies = tmp_path / "cookies.txt"
+  cookies.write_text(
+    "# Netscape HTTP Cookie File\n"
+    ".youtube.com\tTRUE\t/\tTRUE\t0\tSAPISID\tsecret\n")
+  fetcher = YoutubeChatFetcher(base_url=server, cookies=cookies)
+  fetcher.download("zwEIsPcwwdk", tmp_path)
+  assert MockYoutube.requests
+  assert all(auth.startswith("SAPISIDHASH ") for _, auth in MockYoutube.requests)
+
+
+def test_download_many(server, tmp_path):
+  session = HTTPSession(max_per_host=2)
+  fetcher = YoutubeChatFetcher(session=session, base_url=server, max_videos=2)
+  results = dict(fetcher.download_many(
+    [(video_id, tmp_path) for video_id in ("zp0sfEVWH9A", "removed0000", "zwEIsPcwwdk")]))
+
+  assert isinstance(results["removed0000"], NotAvailableAnymore)
+  assert results["zwEIsPcwwdk"].exists()
+  assert results["zp0sfEVWH9A"].exists()
+  assert session.connections_opened <= 2
+
+
+def test_native_handler(server, tmp_path):
+  with StateStore(tmp_path / "state.db") as state:
+    handler = YoutubeHandler(state=state, process_path=None, engine="native")
+    handler.fetcher.base_url = server
+    result, written, compressed = handler.download_one(
+      "zwEIsPcwwdk", [], compression="bz2", out_path=tmp_path)
+    assert result == "ok"
+    assert written == compressed and compressed.name.endswith(".live_chat.json.bz2")
+    assert state.status(YOUTUBE, "zwEIsPcwwdk") == DONE
+
+    result, _, _ = handler.download_one(
+      "membersOnly", [], compression="bz2", out_path=tmp_path)
+    assert result == "failed"
+    assert state.status(YOUTUBE, "membersOnly") == FAILED
+
+
+def test_resume_truncated_chat(server, tmp_path):
+  fetcher = YoutubeChatFetcher(base_url=server)
+  complete = fetcher.download("zp0sfEVWH9A", tmp_path)
+  expected = complete.read_text()
+
+  # Interrupted while writing the 6th line
+  lines = expected.splitlines(keepends=True)
+  complete.write_text("".join(lines[:5]) + lines[5][:40])
+  MockYoutube.requests.clear()
+
+  path = fetcher.download("zp0sfEVWH9A", tmp_path, compression="bz2")
+  assert path == complete.with_name(complete.name + ".bz2")
+  assert not complete.exists()
+  assert MockYoutube.requests[0][0]["currentPlayerState"]["playerOffsetMs"] == "4000"
+  import bz2
+  assert bz2.decompress(path.read_bytes()).decode() == expected
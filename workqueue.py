@@ -0,0 +1,362 @@
+#!/bin/env python3
+#
+# Work queue shared by download workers running on several hosts.
+#
+# The queue is a SQLite file on shared storage. Workers claim jobs by taking a
+# lease on them, which they renew with heartbeats while the download runs. The
+# job of a worker that crashed, or lost its connection to the storage, goes
+# back to the queue once its lease expires. Leases rely on the clocks of the
+# hosts being roughly in sync (NTP), with lease_seconds well above any skew.
+#
+# Usage:
+#   workqueue.py QUEUE enqueue (DIR | MANIFEST | -)
+#   workqueue.py QUEUE status
+#   workqueue.py QUEUE requeue [--failed]
+#   subs.py --mode work QUEUE   (on each worker host)
+
+from os import getpid
+from pathlib import Path
+from typing import Optional, List, Dict, Iterable, NamedTuple, Union
+import argparse
+import json
+import random
+import socket
+import sqlite3
+import threading
+import time
+import logging
+log = logging.getLogger()
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+# Jobs enqueued per transaction
+ENQUEUE_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+  service TEXT NOT NULL,
+  video_id TEXT NOT NULL,
+  media_paths TEXT NOT NULL DEFAULT '[]',
+  status TEXT NOT NULL DEFAULT 'pending',
+  owner TEXT,
+  token INTEGER,
+  lease_expires REAL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  last_error TEXT,
+  created_at REAL NOT NULL,
+  updated_at REAL NOT NULL,
+  PRIMARY KEY (service, video_id)
+);
+CREATE INDEX IF NOT EXISTS queue_status ON queue (status, lease_expires);
+"""
+
+
+class Lease(NamedTuple):
+  service: str
+  video_id: str
+  media_paths: List[str]
+  token: int
+  attempt: int
+
+
+def worker_name() -> str:
+  return f"{socket.gethostname()}:{getpid()}:{random.getrandbits(32):08x}"
+
+
+class WorkQueue():
+  """
+  Jobs go from pending to leased when claimed, then to done or failed.
+  A leased job whose lease expired can be claimed again, up to max_attempts
+  times in total, after which it is marked failed.
+
+  The rollback journal is used instead of WAL, since WAL needs shared memory
+  and does not work on network filesystems.
+  """
+  def __init__(
+    self,
+    path: Union[Path, str],
+    lease_seconds: float = 300.0,
+    max_attempts: int = 3,
+    worker: Optional[str] = None
+  ) -> None:
+    self.path = Path(path)
+    self.lease_seconds = lease_seconds
+    self.max_attempts = max_attempts
+    self.worker = worker or worker_name()
+    self._lock = threading.Lock()
+    self.db = sqlite3.connect(
+      str(self.path), timeout=60, check_same_thread=False, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=DELETE")
+    self.db.executescript(SCHEMA)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.close()
+
+  def _transaction(self, func):
+    with self._lock:
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        result = func()
+        self.db.execute("COMMIT")
+      except Exception:
+        if self.db.in_transaction:
+          self.db.execute("ROLLBACK")
+        raise
+    return result
+
+  def enqueue(self, jobs: Iterable) -> int:
+    """
+    Add jobs, given as (service, id, media_paths) tuples or as manifest
+    records. Jobs already in the queue are left untouched, except that pending
+    jobs are marked done once a record lists subs for them.
+    Jobs are committed every ENQUEUE_BATCH, so that a long directory walk does
+    not hold the write lock (and block the heartbeats of the workers).
+    Return the number of new jobs.
+    """
+    added = 0
+    batch: List = []
+    for job in jobs:
+      batch.append(job)
+      if len(batch) >= ENQUEUE_BATCH:
+        added += self._insert(batch)
+        batch = []
+    if batch:
+      added += self._insert(batch)
+    return added
+
+  def _insert(self, batch: List) -> int:
+    def insert():
+      added = 0
+      now = time.time()
+      for job in batch:
+        if len(job) > 3 and job[3]:  # manifest record with subs
+          self.db.execute(
+            "INSERT INTO queue (service, video_id, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (service, video_id) "
+            "DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at "
+            "WHERE status = ?",
+            (job[0], job[1], DONE, now, now, PENDING))
+          continue
+        added += self.db.execute(
+          "INSERT INTO queue (service, video_id, media_paths, created_at, updated_at) "
+          "VALUES (?, ?, ?, ?, ?) ON CONFLICT (service, video_id) DO NOTHING",
+          (job[0], job[1], json.dumps(list(job[2])), now, now)).rowcount
+      return added
+    return self._transaction(insert)
+
+  def claim(self, services: Iterable[str], limit: int = 1) -> List[Lease]:
+    """Lease up to limit pending or expired jobs for this worker."""
+    services = tuple(services)
+    placeholders = ",".join("?" * len(services))
+
+    def take():
+      now = time.time()
+      # Jobs whose workers died too many times are given up
+      self.db.execute(
+        f"UPDATE queue SET status = ?, owner = NULL, token = NULL, "
+        f"last_error = 'lease expired', updated_at = ? "
+        f"WHERE status = ? AND lease_expires < ? AND attempts >= ? "
+        f"AND service IN ({placeholders})",
+        (FAILED, now, LEASED, now, self.max_attempts, *services))
+      rows = self.db.execute(
+        f"SELECT service, video_id, media_paths, attempts FROM queue "
+        f"WHERE service IN ({placeholders}) "
+        f"AND (status = ? OR (status = ? AND lease_expires < ?)) "
+        f"ORDER BY attempts, created_at LIMIT ?",
+        (*services, PENDING, LEASED, now, limit)
+      ).fetchall()
+      leases = []
+      for service, video_id, media_paths, attempts in rows:
+        token = random.getrandbits(62)
+        self.db.execute(
+          "UPDATE queue SET status = ?, owner = ?, token = ?, lease_expires = ?, "
+          "attempts = attempts + 1, updated_at = ? "
+          "WHERE service = ? AND video_id = ?",
+          (LEASED, self.worker, token, now + self.lease_seconds, now,
+           service, video_id))
+        leases.append(
+          Lease(service, video_id, json.loads(media_paths), token, attempts + 1))
+      return leases
+    return self._transaction(take)
+
+  def heartbeat(self) -> int:
+    """Extend all the leases held by this worker. Return how many there are."""
+    now = time.time()
+    with self._lock:
+      cur = self.db.execute(
+        "UPDATE queue SET lease_expires = ?, updated_at = ? "
+        "WHERE owner = ? AND status = ?",
+        (now + self.lease_seconds, now, self.worker, LEASED))
+      return cur.rowcount
+
+  def complete(
+    self, lease: Lease, status: str = DONE, error: Optional[str] = None
+  ) -> bool:
+    """
+    Mark a leased job done or failed, or put it back with status PENDING.
+    Return False if the lease was lost, i.e. expired and taken by another
+    worker in the meantime.
+    """
+    if status not in (DONE, FAILED, PENDING):
+      raise Exception(f"Invalid job status: {status}.")
+    with self._lock:
+      cur = self.db.execute(
+        "UPDATE queue SET status = ?, owner = NULL, token = NULL, "
+        "lease_expires = NULL, last_error = ?, updated_at = ? "
+        "WHERE service = ? AND video_id = ? AND token = ? AND status = ?",
+        (status, error, time.time(), lease.service, lease.video_id,
+         lease.token, LEASED))
+    if cur.rowcount == 0:
+      log.warning(
+        f"Lease on {lease.service} {lease.video_id} was lost, "
+        "another worker may have taken over.")
+      return False
+    return True
+
+  def release(self, lease: Lease) -> bool:
+    """Give a job back without counting the attempt."""
+    with self._lock:
+      cur = self.db.execute(
+        "UPDATE queue SET status = ?, owner = NULL, token = NULL, "
+        "lease_expires = NULL, attempts = MAX(attempts - 1, 0), updated_at = ? "
+        "WHERE service = ? AND video_id = ? AND token = ? AND status = ?",
+        (PENDING, time.time(), lease.service, lease.video_id, lease.token, LEASED))
+    return cur.rowcount > 0
+
+  def remaining(self, services: Iterable[str]) -> int:
+    """Number of jobs pending or being worked on."""
+    services = tuple(services)
+    with self._lock:
+      return self.db.execute(
+        f"SELECT COUNT(*) FROM queue WHERE status IN (?, ?) "
+        f"AND service IN ({','.join('?' * len(services))})",
+        (PENDING, LEASED, *services)
+      ).fetchone()[0]
+
+  def counts(self) -> Dict[str, Dict[str, int]]:
+    with self._lock:
+      rows = self.db.execute(
+        "SELECT service, status, COUNT(*) FROM queue GROUP BY service, status"
+      ).fetchall()
+    counts: Dict[str, Dict[str, int]] = {}
+    for service, status, count in rows:
+      counts.setdefault(service, {})[status] = count
+    return counts
+
+  def workers(self) -> Dict[str, int]:
+    """Number of leases held by each worker."""
+    with self._lock:
+      return dict(self.db.execute(
+        "SELECT owner, COUNT(*) FROM queue WHERE status = ? AND lease_expires >= ? "
+        "GROUP BY owner", (LEASED, time.time())
+      ).fetchall())
+
+  def requeue(self, failed: bool = False) -> int:
+    """Put expired leases, and failed jobs if asked, back to pending."""
+    statuses = (LEASED, FAILED) if failed else (LEASED,)
+    def reset():
+      cur = self.db.execute(
+        f"UPDATE queue SET status = ?, owner = NULL, token = NULL, "
+        f"lease_expires = NULL, attempts = 0, updated_at = ? "
+        f"WHERE status IN ({','.join('?' * len(statuses))}) "
+        f"AND (status != ? OR lease_expires < ?)",
+        (PENDING, time.time(), *statuses, LEASED, time.time()))
+      return cur.rowcount
+    return self._transaction(reset)
+
+  def close(self) -> None:
+    with self._lock:
+      if self.db is not None:
+        self.db.close()
+        self.db = None
+
+
+class Heartbeat():
+  """Renew the leases of a worker from a background thread."""
+  def __init__(self, queue: WorkQueue, interval: Optional[float] = None) -> None:
+    self.queue = queue
+    self.interval = interval or max(queue.lease_seconds / 3, 0.05)
+    self._stop = threading.Event()
+    self._thread: Optional[threading.Thread] = None
+
+  def __enter__(self):
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+
+  def _run(self) -> None:
+    while not self._stop.wait(self.interval):
+      try:
+        self.queue.heartbeat()
+      except sqlite3.Error as e:
+        # The storage may be briefly unavailable, the lease has some margin
+        log.warning(f"Heartbeat failed: {e}")
+
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Manage the queue of downloads shared by "subs.py --mode work" workers.')
+  parser.add_argument('queue', metavar='QUEUE', type=str, help='Queue database file.')
+  sub = parser.add_subparsers(dest="command", required=True)
+
+  enqueue = sub.add_parser(
+    'enqueue', help='Add the videoIds without subs found in a directory or manifest.')
+  enqueue.add_argument(
+    'source', metavar='SOURCE', type=str,
+    help='Directory to scan, manifest written by "subs.py --mode scan", '
+      'text list of videoIds, or - for stdin.')
+  enqueue.add_argument(
+    '--exclude-regex', metavar='EXCLUDE', type=str, default=None,
+    help='Regex to filter out directories when scanning.')
+
+  sub.add_parser('status', help='Show the number of jobs per status and the active workers.')
+
+  requeue = sub.add_parser('requeue', help='Put jobs with expired leases back in the queue.')
+  requeue.add_argument(
+    '--failed', action="store_true", default=False,
+    help='Also retry failed jobs.')
+  return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+  pargs = parse_args(args)
+  queue = WorkQueue(pargs.queue)
+  try:
+    if pargs.command == "enqueue":
+      from manifest import scan, read_manifest, open_manifest
+      import re
+      if Path(pargs.source).is_dir():
+        filter_re = re.compile(pargs.exclude_regex, re.IGNORECASE) \
+          if pargs.exclude_regex else None
+        added = queue.enqueue(scan(Path(pargs.source), filter_re))
+      else:
+        with open_manifest(pargs.source) as source:
+          added = queue.enqueue(read_manifest(source))
+      print(f"Queued {added} new jobs.")
+
+    elif pargs.command == "status":
+      for service, counts in sorted(queue.counts().items()):
+        print(f"{service}: " + ", ".join(f"{c} {s}" for s, c in sorted(counts.items())))
+      for worker, count in sorted(queue.workers().items()):
+        print(f"worker {worker}: {count} leases")
+
+    elif pargs.command == "requeue":
+      print(f"Requeued {queue.requeue(failed=pargs.failed)} jobs.")
+  finally:
+    queue.close()
+  return 0
+
+
+if __name__ == "__main__":
+  exit(main())
@@ -1,18 +1,40 @@
 #!/bin/env python3
 
-from subprocess import run
-from sys import argv
+from subprocess import Popen, PIPE, STDOUT, DEVNULL
+from os import getenv, fsync
 from os.path import exists
-from typing import Union
+from typing import Union, Optional, List, Dict, Tuple, Deque
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from pathlib import Path
-from downloader import ytdl
-from constants import SFX, py_ver_tuple
+import argparse
+import re
+import threading
+import time
+from downloader.ytdl import YTDLDownloader
+from downloader.fragments import (
+  FragmentController, FragmentSettings, DownloadStats, default_history_path
+)
+from constants import SFX, py_ver_tuple, missing_paths
+from idset import IdSet
+from state import (
+  StateStore, import_batch_lists, DONE, FAILED, DELETED, YOUTUBE_VIDEO
+)
+from profiling import phase, Profiler
 
 
 # NOTE this module is probably partially obsolete since yt-dlp can work
 # with archive.txt files
 # TODO rework this to leverage that feature
 
+# "[download]  42.3% of ~ 120.50MiB at    2.30MiB/s ETA 00:31 (frag 12/40)"
+progress_re = re.compile(
+  r'^\[download\]\s+(?P<percent>[\d.]+)%'
+  r'(?:\s+of\s+~?\s*(?P<size>\S+))?'
+  r'(?:\s+at\s+(?P<speed>\S+))?'
+  r'(?:\s+ETA\s+(?P<eta>\S+))?'
+)
+
 
 def play_sound(key: str) -> None:
   """snd_path is a key in SFX dict."""
@@ -25,10 +47,33 @@ def play_sound(key: str) -> None:
   snd_path = Path(snd_pathstr)
   if not snd_path.exists():
     return
-  run(['paplay', str(snd_path)])
+  # Do not block the caller while the sound is playing
+  Popen(['paplay', str(snd_path)], stdout=DEVNULL, stderr=DEVNULL)
+
+
+class Notifier():
+  """
+  Call play_sound() at most once every min_interval seconds per key, so that
+  a burst of finished downloads does not turn into a burst of sounds.
+  """
+  def __init__(self, enabled: bool = True, min_interval: float = 30.0) -> None:
+    self.enabled = enabled
+    self.min_interval = min_interval
+    self._last: Dict[str, float] = {}
+    self._lock = threading.Lock()
+
+  def notify(self, key: str) -> None:
+    if not self.enabled:
+      return
+    now = time.monotonic()
+    with self._lock:
+      if now - self._last.get(key, -self.min_interval) < self.min_interval:
+        return
+      self._last[key] = now
+    play_sound(key)
 
 
-def load_from_file(fpath: Path, add_to: Union[list, set]) -> None:
+def load_from_file(fpath: Path, add_to: Union[list, set, IdSet]) -> None:
   """
   Load lines in fpath into add_to. Order is preserved if add_to is a list.
   Ignore lines starting with # (comments).
@@ -39,11 +84,13 @@ def load_from_file(fpath: Path, add_to: Union[list, set]) -> None:
     return
   with open(fpath, 'r') as f:
     if isinstance(add_to, list):
+      seen = set(add_to)
       for line in f:
         stripped = line.strip()
         if not stripped or stripped.startswith("#"):
           continue
-        if stripped not in add_to:
+        if stripped not in seen:
+          seen.add(stripped)
           add_to.append(stripped)
     else:
       for line in f:
@@ -53,48 +100,331 @@ def load_from_file(fpath: Path, add_to: Union[list, set]) -> None:
         add_to.add(stripped)
 
 
-def main(id_list_file):
+class Journal():
+  """
+  Append-only log of started, finished and failed downloads, one event per
+  line as event\\tvideoId[\\tinfo]. Each event is flushed to disk before the
+  download goes on, so that a crash can be resumed exactly where it stopped.
+  """
+  START = "start"
+  DONE = "done"
+  FAIL = "fail"
+
+  def __init__(self, path: Path) -> None:
+    self.path = path
+    self._lock = threading.Lock()
+    self._fd = None
+
+  def replay(self) -> Tuple[IdSet, IdSet, List[str]]:
+    """
+    Return the Ids done, failed, and started but never finished (in the order
+    they were started) according to the journal.
+    """
+    done, failed = IdSet(), IdSet()
+    started: Dict[str, None] = {}
+    if not self.path.exists():
+      return done, failed, []
+    with open(self.path, "r") as f:
+      for line in f:
+        values = line.rstrip("\n").split("\t")
+        if len(values) < 2:
+          continue  # truncated last line
+        event, _id = values[0], values[1]
+        if event == self.START:
+          started[_id] = None
+        elif event == self.DONE:
+          done.add(_id)
+          started.pop(_id, None)
+        elif event == self.FAIL:
+          failed.add(_id)
+          started.pop(_id, None)
+    return done, failed, list(started)
+
+  def write(self, event: str, _id: str, info: str = "") -> None:
+    line = f"{event}\t{_id}" + (f"\t{info}" if info else "") + "\n"
+    with self._lock:
+      if self._fd is None:
+        self._fd = open(self.path, "a")
+      self._fd.write(line)
+      self._fd.flush()
+      fsync(self._fd.fileno())
+
+  def close(self) -> None:
+    with self._lock:
+      if self._fd is not None:
+        self._fd.close()
+        self._fd = None
+
+
+class BatchDownloader():
+  """
+  Download videos with up to jobs concurrent yt-dlp processes.
+  """
+  def __init__(
+    self,
+    downloader: YTDLDownloader,
+    journal: Journal,
+    state: StateStore,
+    jobs: int = 2,
+    cookies: Optional[Path] = None,
+    notifier: Optional[Notifier] = None,
+    report_interval: float = 5.0,
+    fragments: FragmentSettings = FragmentSettings(4),
+    controller: Optional[FragmentController] = None,
+    staging_dir: Optional[Path] = None
+  ) -> None:
+    self.downloader = downloader
+    self.journal = journal
+    self.state = state
+    self.jobs = max(1, jobs)
+    self.cookies = cookies
+    self.notifier = notifier or Notifier(enabled=False)
+    self.report_interval = report_interval
+    self.fragments = fragments
+    # Overrides fragments, from the throughput of the previous downloads
+    self.controller = controller
+    # Local directory for fragments and intermediate files
+    self.staging_dir = staging_dir
+
+    self.total = 0
+    self.finished = 0
+    self.failed: List[str] = []
+    # Latest progress line of each running download
+    self.progress: Dict[str, str] = {}
+    self._lock = threading.Lock()
+    self._last_report = 0.0
+
+  def _report(self, force: bool = False) -> None:
+    now = time.monotonic()
+    with self._lock:
+      if not force and now - self._last_report < self.report_interval:
+        return
+      self._last_report = now
+      running = " | ".join(f"{_id}: {p}" for _id, p in self.progress.items())
+      print(f"[{self.finished}/{self.total}] {running}")
+
+  def download_one(self, _id: str) -> None:
+    """Run yt-dlp for a single videoId. Raise an Exception on failure."""
+    settings = self.controller.settings() if self.controller else self.fragments
+    cmd = self.downloader.build_cmd(
+      _id, cookies=self.cookies, skip_video=False,
+      fragments=settings.fragments, external=settings.external,
+      temp_dir=self.staging_dir)
+    tail: Deque[str] = deque(maxlen=20)
+    stats = DownloadStats()
+    self.journal.write(Journal.START, _id)
+
+    proc = Popen(
+      cmd, stdout=PIPE, stderr=STDOUT, text=True, encoding="utf-8",
+      errors="replace", bufsize=1)
+    with self._lock:
+      self.progress[_id] = "starting"
+    try:
+      for line in proc.stdout:
+        line = line.rstrip()
+        match = progress_re.match(line)
+        stats.feed(line, match.group("speed") if match else None)
+        if match:
+          with self._lock:
+            self.progress[_id] = f"{match.group('percent')}%" + (
+              f" at {match.group('speed')}" if match.group("speed") else "")
+          self._report()
+        elif line:
+          tail.append(line)
+      returncode = proc.wait()
+    finally:
+      if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+      with self._lock:
+        self.progress.pop(_id, None)
+
+    if self.controller is not None:
+      # A failed download says nothing about throughput, unless throttled
+      if returncode == 0 or stats.is_throttled():
+        self.controller.observe(
+          settings, stats.throughput if returncode == 0 else None,
+          throttled=stats.is_throttled())
+
+    if returncode != 0:
+      errors = [l for l in tail if "ERROR" in l]
+      raise Exception(
+        f"Return code {returncode}" + (f": {errors[-1]}" if errors else ""))
+
+  def _on_finished(self, _id: str, future: Future) -> None:
+    error = future.exception()
+    with self._lock:
+      self.finished += 1
+      count = self.finished
+    if error is not None:
+      print(f"ERROR downloading {_id}: {error}")
+      self.journal.write(Journal.FAIL, _id, str(error).replace("\n", " "))
+      self.state.record(YOUTUBE_VIDEO, _id, FAILED, error=str(error))
+      self.failed.append(_id)
+      self.notifier.notify("FAILED")
+    else:
+      self.journal.write(Journal.DONE, _id)
+      self.state.record(YOUTUBE_VIDEO, _id, DONE)
+      self.notifier.notify("SUCCESS")
+    print(f"{'=' * 20} {count}/{self.total} {'=' * 20}\n")
+
+  def run(self, ids: List[str]) -> List[str]:
+    """
+    Download all ids, keeping at most self.jobs downloads in flight.
+    Return the list of Ids that failed.
+    """
+    self.total = len(ids)
+    pending = iter(ids)
+    in_flight: Dict[Future, str] = {}
+
+    with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+      while True:
+        while len(in_flight) < self.jobs:
+          _id = next(pending, None)
+          if _id is None:
+            break
+          in_flight[pool.submit(self.download_one, _id)] = _id
+        if not in_flight:
+          break
+        finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in finished:
+          self._on_finished(in_flight.pop(future), future)
+
+    self._report(force=True)
+    return self.failed
+
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+    description='Download every video listed in a file of videoIds.')
+  parser.add_argument(
+    '-j', '--jobs', metavar='N', type=int, default=2,
+    help='Number of concurrent video downloads.')
+  parser.add_argument(
+    '--cookies', metavar="COOKIES", type=str, default=None,
+    help='Path to cookie file to pass to yt-dlp (for members-only videos).')
+  parser.add_argument(
+    '--no-sound', action="store_true", default=False,
+    help='Do not play notification sounds.')
+  parser.add_argument(
+    '--sound-interval', metavar="SECONDS", type=float, default=30.0,
+    help='Minimum delay between two notification sounds of the same kind.')
+  parser.add_argument(
+    '--profile', action="store_true", default=False,
+    help='Profile each phase of the run and write the reports next to LIST.')
+  parser.add_argument(
+    '--profiler', metavar="PROFILER", type=str, default="auto",
+    choices=["auto", "cprofile", "sampling"],
+    help='Profiler used by --profile. "sampling" requires pyinstrument, '
+      '"auto" uses it when it is installed.')
+  parser.add_argument(
+    '--fragments', metavar='N', type=int, default=4,
+    help='Concurrent fragments of the first download, when the throughput '
+      'history has nothing better for this time of the day.')
+  parser.add_argument(
+    '--max-fragments', metavar='N', type=int, default=16,
+    help='Never download more fragments of a video at the same time.')
+  parser.add_argument(
+    '--no-adapt', action="store_true", default=False,
+    help='Always download --fragments fragments at the same time, instead '
+      'of adjusting them to the measured throughput.')
+  parser.add_argument(
+    '--external-downloader', metavar='NAME', type=str, default=None,
+    choices=["aria2c"],
+    help='Switch to this downloader when yt-dlp keeps being throttled, '
+      'or always use it with --no-adapt.')
+  parser.add_argument(
+    '--throughput-history', metavar='PATH', type=str, default=None,
+    help='Where the throughput of each setting is kept between runs. '
+      'Default: $XDG_CACHE_HOME/ytdl_batch/throughput.json')
+  parser.add_argument(
+    '--staging-dir', metavar='DIR', type=str, default=None,
+    help='Local directory (SSD, tmpfs) where yt-dlp writes fragments and '
+      'intermediate files. Only finished videos are moved to the current directory.')
+  parser.add_argument(
+    '--state-db', metavar='DB', type=str, default=None,
+    help='Database of the outcome of each download. Default: LIST_state.db '
+      'next to LIST. The _done, _failed and _deleted lists of earlier '
+      'versions are imported into it.')
+  parser.add_argument(
+    'id_list_file', metavar='LIST', type=str,
+    help='Text file holding one videoId per line.')
+  return parser.parse_args(args)
+
+
+def main(args=None):
+  pargs = parse_args(args)
+  if pargs.profile:
+    with Profiler(
+      Path(pargs.id_list_file).absolute().parent, "ytdl_batch_video_dl",
+      kind=pargs.profiler
+    ):
+      run_batch(pargs)
+  else:
+    run_batch(pargs)
+
+
+def run_batch(pargs: argparse.Namespace):
+  id_list_file = Path(pargs.id_list_file)
   ids_todo = []
-  ids_done = set()
-  ids_failed = set()
-  ids_deleted = set()
+  ids_done = IdSet()
+  ids_failed = IdSet()
+  ids_deleted = IdSet()
 
   # Temporary backport: pathlib in python < 3.9 does not have Path.with_stem method
-  if int(py_ver_tuple[1]) < 9: 
+  if int(py_ver_tuple[1]) < 9:
     print(f"Python version is {py_ver_tuple}. Using backport workaround.")
     def with_stem(path: Path, stem: str):
       """Return a new path with the stem changed."""
       return path.with_name(stem + path.suffix)
 
-    done_list = with_stem(id_list_file, id_list_file.stem + "_done")
-    failed_list = with_stem(id_list_file, id_list_file.stem + "_failed")
-    deleted_list = with_stem(id_list_file, id_list_file.stem + "_deleted")
+    state_db = with_stem(id_list_file, id_list_file.stem + "_state").with_suffix(".db")
     uniqued_ids = with_stem(id_list_file, id_list_file.stem + "_total")
+    journal_file = with_stem(id_list_file, id_list_file.stem + "_journal")
   else:
-    done_list = id_list_file.with_stem(id_list_file.stem + "_done")
-    failed_list = id_list_file.with_stem(id_list_file.stem + "_failed")
-    # This holds a list of IDs we know for sure have been deleted.
-    # It is curated by the user, usually updated from the _failed log.
-    deleted_list = id_list_file.with_stem(id_list_file.stem + "_deleted")
+    state_db = id_list_file.with_stem(id_list_file.stem + "_state").with_suffix(".db")
     uniqued_ids = id_list_file.with_stem(id_list_file.stem + "_total")
+    journal_file = id_list_file.with_stem(id_list_file.stem + "_journal")
 
   if not id_list_file.exists():
     print(f"File \"{id_list_file}\" does not exist.")
     exit(1)
+  if pargs.cookies and missing_paths([pargs.cookies]):
+    print(f"Cookies file \"{pargs.cookies}\" does not exist.")
+    exit(1)
+
+  state = StateStore(Path(pargs.state_db) if pargs.state_db else state_db)
+  with phase("plan"):
+    # TODO load a Blocked list of videos to discard
+    load_from_file(id_list_file, ids_todo)
+    # The _deleted list is curated by the user, usually from the failures.
+    # It is imported again whenever it changes.
+    import_batch_lists(state, id_list_file)
+    ids_done.update(state.ids(YOUTUBE_VIDEO, [DONE]))
+    ids_failed.update(state.ids(YOUTUBE_VIDEO, [FAILED]))
+    ids_deleted.update(state.ids(YOUTUBE_VIDEO, [DELETED]))
 
-  # TODO load a Blocked list of videos to discard
-  load_from_file(id_list_file, ids_todo)
-  load_from_file(done_list, ids_done)
-  load_from_file(failed_list, ids_failed)
-  load_from_file(deleted_list, ids_deleted)
+    # The journal may know about downloads that did not make it to the
+    # database, if the last run crashed before committing them
+    journal = Journal(journal_file)
+    journal_done, journal_failed, interrupted = journal.replay()
+    for journal_ids, known, status in (
+      (journal_done, ids_done, DONE), (journal_failed, ids_failed, FAILED)
+    ):
+      for _id in journal_ids:
+        if _id not in known:
+          state.record(YOUTUBE_VIDEO, _id, status, attempt=False)
+      known.update(journal_ids)
+  if interrupted:
+    print(f"Resuming {len(interrupted)} interrupted downloads first: {', '.join(interrupted)}")
 
-  # Write unique ids because our user input list may have duplicates 
+  # Write unique ids because our user input list may have duplicates
   with open(uniqued_ids, 'w') as f:
     for _id in ids_todo:
       f.write(_id + "\n")
 
   ids = [
-    _id for _id in ids_todo
+    _id for _id in dict.fromkeys(interrupted + ids_todo)
     if _id not in ids_done
     and _id not in ids_failed
     and _id not in ids_deleted
@@ -108,6 +438,7 @@ def main(id_list_file):
         f"Deleted: {len(ids_deleted)}, "
         f"Total: {len(ids)}"
     )
+    state.close()
     exit(0)
 
   print(f"Loaded Done videos: {len(ids_done)}, "
@@ -116,30 +447,46 @@ def main(id_list_file):
     f"Remaining todo: {len(ids)}"
   )
 
-  for _id in ids:
-    try:
-      # TODO capture (and pipe) output and report on
-      # "[download] Skipping fragment 123 ..."
-      ytdl.dl_ytdlp(_id, cookies=None)  # use COOKIE_PATH here (pathlib.Path)
-    except Exception as e:
-      play_sound("FAILED")
-      print(f"ERROR. Return code: {e}; ")
+  controller = None
+  if not pargs.no_adapt:
+    controller = FragmentController(
+      history_path=Path(pargs.throughput_history).expanduser()
+        if pargs.throughput_history else default_history_path(),
+      initial=pargs.fragments,
+      max_fragments=pargs.max_fragments,
+      external=pargs.external_downloader)
 
-      with open(failed_list, "a") as fe:
-          print(f"Adding \"{_id}\" to {failed_list}")
-          fe.write(_id + "\n")
-      continue
-
-    with open(done_list, 'a') as f:
-        print(f"Adding \"{_id}\" to {done_list}")
-        f.write(_id + "\n")
+  batch = BatchDownloader(
+    YTDLDownloader(process_path=getenv("YTDL")),
+    journal=journal,
+    state=state,
+    jobs=pargs.jobs,
+    cookies=Path(pargs.cookies).expanduser() if pargs.cookies else None,
+    notifier=Notifier(
+      enabled=not pargs.no_sound, min_interval=pargs.sound_interval),
+    fragments=FragmentSettings(pargs.fragments, pargs.external_downloader),
+    controller=controller,
+    staging_dir=Path(pargs.staging_dir).expanduser().absolute()
+      if pargs.staging_dir else None
+  )
+  try:
+    with phase("download"):
+      failed = batch.run(ids)
+  finally:
+    journal.close()
+    state.close()
+    if controller is not None:
+      controller.save()
 
-    print(f"{'=' * 20} {ids.index(_id) + 1}/{len(ids)} {'=' * 20}\n")
-    play_sound("SUCCESS")
+  print(f"Downloaded {len(ids) - len(failed)} / {len(ids)} videos.")
+  if failed:
+    print("Failed downloading these ids:")
+    for _id in failed:
+      print(_id)
 
 
 if __name__ == "__main__":
   #
-  # Usage: $0 video_ids.txt
+  # Usage: $0 [-j N] video_ids.txt
   #
-  main(Path(argv[1]))
+  main()